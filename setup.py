@@ -38,7 +38,7 @@ setup(
     # out so SwiftStack can still use ${python:Depends}
     #install_requires=["swift"],
     test_suite='nose.collector',
-    tests_require=["nose"],
-    scripts=[],
+    tests_require=["nose", "mock"],
+    scripts=['bin/swift-undelete-provision', 'bin/swift-undelete-reaper'],
     entry_points={
         'paste.filter_factory': ['undelete=swift_undelete:filter_factory']})
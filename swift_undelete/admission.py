@@ -0,0 +1,307 @@
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Admission control for trash copies.
+
+A mass delete turns into as many trash COPYs, all at once, which can take
+the object servers' disks and the proxies' bandwidth away from everyone
+else. This holds copies to limits, globally and per account:
+
+ * bytes per second, with the same "next available time" counters in
+   memcache that Swift's ratelimit middleware uses, so that all proxy
+   workers (and proxies) share them;
+ * concurrent copies, with counters in memcache too. A worker that dies
+   mid-copy leaks its slot until the counter expires, so the count is
+   approximate.
+
+Without memcache, each worker keeps the counters to itself.
+
+There is also a circuit breaker, kept per worker, that stops copies for a
+while when too many of them recently failed or took too long.
+
+A copy that can't be admitted raises Overloaded, and the middleware decides
+what becomes of the delete.
+"""
+import collections
+import math
+import time
+
+import eventlet
+from swift.common import utils
+from swift.common.memcached import MemcacheConnectionError
+
+CLOCK_ACCURACY = 1000  # counters are kept in milliseconds
+# how long, in seconds, a concurrency counter lives in memcache; bounds how
+# long a dead worker's slots stay taken
+SLOT_TTL = 60
+# how long a bucket of bytes may go unused and still be saved up for a
+# burst, in seconds
+RATE_BUFFER = 5
+# how often, in seconds, a copy waiting for a slot tries again
+SLOT_POLL_INTERVAL = 0.1
+
+
+class Overloaded(Exception):
+    """
+    A trash copy can't be admitted (in time).
+
+    :param reason: which limit turned it down ("breaker", "copies" or
+                   "bytes")
+    :param retry_after: seconds after which trying again makes sense
+    """
+
+    def __init__(self, reason, retry_after):
+        super(Overloaded, self).__init__(reason, retry_after)
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class LocalCounters(object):
+    """
+    Just enough of a memcache client, kept in this worker, for when there
+    is no memcache.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, key):
+        value, expires = self._values.get(key, (None, None))
+        if expires and expires <= time.time():
+            return None
+        return value
+
+    def set(self, key, value, serialize=True, time=0):
+        self._values[key] = (value, _expiry(time))
+
+    def incr(self, key, delta=1, time=0):
+        value = self.get(key)
+        if value is None:
+            value = max(0, delta)
+            self._values[key] = (value, _expiry(time))
+        else:
+            value = max(0, int(value) + delta)
+            self._values[key] = (value, self._values[key][1])
+        return value
+
+    def decr(self, key, delta=1, time=0):
+        return self.incr(key, -delta, time)
+
+
+def _expiry(ttl):
+    return time.time() + ttl if ttl else None
+
+
+class CircuitBreaker(object):
+    """
+    Trips when, over the last window seconds (and at least min_copies
+    copies), the share of copies that failed reaches error_rate or their
+    mean latency reaches latency. Once tripped, it stays open for cooldown
+    seconds, then lets a single copy through, whose outcome closes it or
+    opens it again. (If that copy never reports back, another gets through
+    after a further cooldown.)
+    """
+
+    def __init__(self, error_rate=0, latency=0, window=60, min_copies=20,
+                 cooldown=30):
+        self.error_rate = error_rate
+        self.latency = latency
+        self.window = window
+        self.min_copies = min_copies
+        self.cooldown = cooldown
+        # (finished at, latency, failed) for recent copies
+        self._copies = collections.deque()
+        self.open_until = None
+        # when the copy that may close the breaker again was let through
+        self._probe_at = None
+
+    @property
+    def enabled(self):
+        return bool(self.error_rate or self.latency)
+
+    def allow(self):
+        """
+        :returns: 0 if a copy may go ahead, else seconds until one might
+        """
+        if self.open_until is None:
+            return 0
+        now = time.time()
+        if now < self.open_until:
+            return self.open_until - now
+        elif self._probe_at is not None and \
+                now < self._probe_at + self.cooldown:
+            return self._probe_at + self.cooldown - now
+        self._probe_at = now
+        return 0
+
+    def record(self, failed, latency):
+        """
+        Note the outcome of a copy, tripping (or resetting) the breaker.
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        if self.open_until is not None:
+            if self._probe_at is None:
+                # a copy from before the breaker tripped
+                return
+            self._probe_at = None
+            self.open_until = now + self.cooldown if failed else None
+            return
+        self._copies.append((now, latency, failed))
+        while self._copies and self._copies[0][0] < now - self.window:
+            self._copies.popleft()
+        if len(self._copies) < self.min_copies:
+            return
+        failures = sum(1 for _at, _latency, f in self._copies if f)
+        mean = sum(l for _at, l, _failed in self._copies) / len(self._copies)
+        if self.error_rate and \
+                float(failures) / len(self._copies) >= self.error_rate or \
+                self.latency and mean >= self.latency:
+            self.open_until = now + self.cooldown
+            self._copies.clear()
+
+
+class Slot(object):
+    """
+    An admitted copy's hold on the concurrency limits; release it once the
+    copy is done.
+    """
+
+    def __init__(self, memcache, keys):
+        self.memcache = memcache
+        self.keys = keys
+
+    def release(self):
+        for key in self.keys:
+            try:
+                self.memcache.decr(key, time=SLOT_TTL)
+            except MemcacheConnectionError:
+                pass
+        self.keys = []
+
+
+class AdmissionControl(object):
+    """
+    Limits on trash copies: bytes per second and concurrent copies, in
+    total and per account, plus a circuit breaker. A limit of 0 is no
+    limit.
+    """
+
+    def __init__(self, bytes_per_second=0, account_bytes_per_second=0,
+                 max_copies=0, account_max_copies=0, breaker=None):
+        self.bytes_per_second = bytes_per_second
+        self.account_bytes_per_second = account_bytes_per_second
+        self.max_copies = max_copies
+        self.account_max_copies = account_max_copies
+        self.breaker = breaker or CircuitBreaker()
+        self.local = LocalCounters()
+
+    @property
+    def limits_bytes(self):
+        """
+        Whether admitting a copy takes knowing its size.
+        """
+        return bool(self.bytes_per_second or self.account_bytes_per_second)
+
+    def _memcache(self, env):
+        return utils.cache_from_env(env, allow_none=True) or self.local
+
+    def acquire(self, env, account, size=0, max_wait=0):
+        """
+        Admit a copy of size bytes from an account, waiting up to max_wait
+        seconds for the limits to allow it.
+
+        :returns: a Slot to release once the copy is done
+        :raises Overloaded: if the copy can't be admitted in time
+        """
+        deadline = time.time() + max_wait
+        retry_after = self.breaker.allow()
+        if retry_after:
+            raise Overloaded('breaker', retry_after)
+        memcache = self._memcache(env)
+        slot = Slot(memcache, [])
+        try:
+            for key, limit in (
+                    ('undelete/admission/copies', self.max_copies),
+                    ('undelete/admission/copies/%s' % account,
+                     self.account_max_copies)):
+                if limit:
+                    self._take_slot(memcache, key, limit, deadline)
+                    slot.keys.append(key)
+            for key, rate in (
+                    ('undelete/admission/bytes', self.bytes_per_second),
+                    ('undelete/admission/bytes/%s' % account,
+                     self.account_bytes_per_second)):
+                if rate and size:
+                    self._take_bytes(memcache, key, rate, size, deadline)
+        except Overloaded:
+            slot.release()
+            raise
+        return slot
+
+    def _take_slot(self, memcache, key, limit, deadline):
+        while True:
+            try:
+                taken = memcache.incr(key, time=SLOT_TTL)
+            except MemcacheConnectionError:
+                # better to copy than to refuse every delete
+                return
+            if taken <= limit:
+                return
+            try:
+                memcache.decr(key, time=SLOT_TTL)
+            except MemcacheConnectionError:
+                pass
+            left = deadline - time.time()
+            if left <= 0:
+                raise Overloaded('copies', SLOT_POLL_INTERVAL)
+            eventlet.sleep(min(SLOT_POLL_INTERVAL, left))
+
+    def _take_bytes(self, memcache, key, rate, size, deadline):
+        """
+        Take size bytes from a shared bucket, the way Swift's ratelimit
+        middleware takes requests: the counter is the time at which the
+        bucket will next have bytes to spare.
+        """
+        now_m = int(round(time.time() * CLOCK_ACCURACY))
+        cost_m = int(round(float(size) * CLOCK_ACCURACY / rate))
+        try:
+            running_m = memcache.incr(key, delta=cost_m)
+        except MemcacheConnectionError:
+            return
+        need_to_sleep_m = 0
+        if now_m - running_m > RATE_BUFFER * CLOCK_ACCURACY:
+            try:
+                memcache.set(key, str(now_m + cost_m), serialize=False)
+            except MemcacheConnectionError:
+                pass
+        else:
+            need_to_sleep_m = max(running_m - now_m - cost_m, 0)
+        need_to_sleep = float(need_to_sleep_m) / CLOCK_ACCURACY
+        if time.time() + need_to_sleep > deadline:
+            try:
+                memcache.decr(key, delta=cost_m)
+            except MemcacheConnectionError:
+                pass
+            raise Overloaded('bytes', need_to_sleep)
+        if need_to_sleep:
+            eventlet.sleep(need_to_sleep)
+
+    def record(self, status, latency):
+        """
+        Note how a trash copy went, for the circuit breaker's sake.
+        """
+        self.breaker.record(status >= 500, latency)
@@ -0,0 +1,122 @@
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming compression of trashed object bodies.
+
+Trash is written once and, unless someone restores it, never read, so what
+compresses well is worth storing compressed. Bodies are compressed and
+decompressed a chunk at a time, so neither direction holds more than a chunk
+(plus zlib's window) in memory, however big the object.
+
+Only zlib is supported, since it is all the standard library has; the codec
+is recorded with each trashed object so that others can be added later.
+"""
+import zlib
+
+CODEC_ZLIB = 'zlib'
+CODECS = (CODEC_ZLIB,)
+DEFAULT_LEVEL = 6
+# how much of a body to try compressing before committing to it
+SAMPLE_SIZE = 64 * 1024
+# the most that decompressing a single chunk may produce, which keeps a
+# highly compressed body from blowing up in memory
+CHUNK_SIZE = 64 * 1024
+
+
+def read_sample(chunks, size=SAMPLE_SIZE):
+    """
+    Read the start of a body.
+
+    :param chunks: iterator of byte strings
+    :returns: 2-tuple (list of the chunks read, at least size bytes' worth
+              unless the body is shorter, iterator of the rest)
+    """
+    chunks = iter(chunks)
+    sample = []
+    read = 0
+    for chunk in chunks:
+        sample.append(chunk)
+        read += len(chunk)
+        if read >= size:
+            break
+    return sample, chunks
+
+
+def sample_ratio(sample, level=DEFAULT_LEVEL):
+    """
+    How well the start of a body compresses: the compressed size as a share
+    of the original, or 1.0 for an empty sample.
+    """
+    data = b''.join(sample)
+    if not data:
+        return 1.0
+    return float(len(zlib.compress(data, level))) / len(data)
+
+
+class CompressingIter(object):
+    """
+    Compress a body as it is read.
+
+    :param chunks: iterable of byte strings to compress; closed (if it can
+                   be) along with this
+    :param level: zlib compression level
+    """
+
+    def __init__(self, chunks, level=DEFAULT_LEVEL):
+        self.chunks = chunks
+        self.compressor = zlib.compressobj(level)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.bytes_in += len(chunk)
+            out = self.compressor.compress(chunk)
+            if out:
+                self.bytes_out += len(out)
+                yield out
+        out = self.compressor.flush()
+        self.bytes_out += len(out)
+        yield out
+
+    def close(self):
+        close_method = getattr(self.chunks, 'close', None)
+        if callable(close_method):
+            close_method()
+
+
+def decompress_iter(chunks, codec=CODEC_ZLIB):
+    """
+    Decompress a body as it is read, CHUNK_SIZE bytes at most at a time.
+
+    :raises ValueError: if the codec is unknown
+    """
+    if codec not in CODECS:
+        raise ValueError('Unknown codec %r' % codec)
+    return _decompress(chunks)
+
+
+def _decompress(chunks):
+    # raises zlib.error (as the body is read) if the body is corrupt
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        while chunk:
+            out = decompressor.decompress(chunk, CHUNK_SIZE)
+            if out:
+                yield out
+            chunk = decompressor.unconsumed_tail
+    out = decompressor.flush()
+    if out:
+        yield out
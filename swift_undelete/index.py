@@ -0,0 +1,273 @@
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deletion-time index of trashed objects.
+
+Each trashed object gets a record (deletion time, original path, ETag, size
+and where in the trash it went). Records are buffered in the proxy worker and
+written out in batches, as newline-delimited JSON, into an index container in
+each account:
+
+    <index container>/time/<bucket>/<flush timestamp>-<random>
+    <index container>/name/<shard>/<flush timestamp>-<random>
+
+The first kind groups records by deletion time (in buckets of bucket_size
+seconds); the second by a hash of the original path, into one of 256 shards.
+Looking up what was deleted in a time range, or where a particular object
+went, therefore means reading a few index objects rather than listing whole
+trash containers. Each index object expires along with the longest-lived
+trash it describes.
+
+Every flush can write to every name shard, so a shard gains an object per
+flush. Unless told otherwise, a lookup by path therefore only covers the
+last lookup_window seconds of deletions; an earlier deleted_after widens it,
+at the cost of reading every index object in the shard written since.
+
+Buffered records are lost if the worker dies before flushing them, so the
+index is a faster way into the trash, not a replacement for it.
+"""
+import hashlib
+import json
+import time
+import uuid
+
+import eventlet
+from swift.common import constraints, http, swob, utils, wsgi
+
+DEFAULT_INDEX_CONTAINER = ".undelete-index"
+DEFAULT_FLUSH_INTERVAL = 60  # seconds
+DEFAULT_BATCH_SIZE = 1000  # records
+DEFAULT_BUCKET_SIZE = 3600  # seconds
+DEFAULT_LOOKUP_WINDOW = 3600  # seconds
+INDEX_CONTENT_TYPE = 'application/x-ndjson'
+
+
+def make_record(deleted_at, path, etag, size, trash):
+    """
+    Build an index record.
+
+    :param deleted_at: utils.Timestamp of the deletion
+    :param path: WSGI string "/<container>/<object>" that was deleted
+    :param etag: ETag of the deleted object, or None if unknown
+    :param size: size in bytes of the deleted object, or None if unknown
+    :param trash: WSGI string "/<trash container>/<object>" it went to
+    """
+    return {'deleted_at': deleted_at.internal,
+            'path': swob.wsgi_to_str(path),
+            'etag': etag.strip('"') if etag else None,
+            'bytes': size,
+            'trash': swob.wsgi_to_str(trash)}
+
+
+def time_bucket(timestamp, bucket_size):
+    """
+    The name of the time bucket a deletion time falls in.
+    """
+    return '%010d' % (int(float(timestamp)) // bucket_size * bucket_size)
+
+
+def name_shard(path):
+    """
+    The name shard a (native string) original path falls in.
+    """
+    return hashlib.md5(path.encode('utf-8')).hexdigest()[:2]
+
+
+class DeletionIndex(object):
+    """
+    Buffers index records per account and writes them out in batches.
+
+    A batch is written once it holds batch_size records, or flush_interval
+    seconds after its first record, whichever comes first.
+    """
+
+    def __init__(self, app, container=DEFAULT_INDEX_CONTAINER,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 bucket_size=DEFAULT_BUCKET_SIZE, lifetime=0,
+                 lookup_window=DEFAULT_LOOKUP_WINDOW, logger=None):
+        self.app = app
+        self.container = container
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        # how far back a lookup by path goes, unless told; 0 for all the way
+        self.lookup_window = lookup_window
+        # index objects needn't outlive the trash they describe
+        self.lifetime = lifetime
+        self.logger = logger or utils.get_logger(
+            {}, log_route='undelete', statsd_tail_prefix='undelete')
+        # (vrs, account) -> list of (record, lifetime) not yet written
+        self._pending = {}
+
+    def add(self, vrs, account, record, lifetime=None):
+        """
+        Buffer a record, flushing the account's batch in the background if
+        it is full.
+
+        :param lifetime: seconds the trashed object is kept, 0 for ever;
+                         by default, the index's lifetime
+        """
+        if lifetime is None:
+            lifetime = self.lifetime
+        key = (vrs, account)
+        pending = self._pending.setdefault(key, [])
+        pending.append((record, lifetime))
+        if len(pending) >= self.batch_size:
+            eventlet.spawn_n(self.flush, vrs, account)
+        elif len(pending) == 1:
+            eventlet.spawn_after(self.flush_interval, self.flush, vrs,
+                                 account)
+
+    def flush(self, vrs, account):
+        """
+        Write out an account's buffered records, if any.
+        """
+        records = self._pending.pop((vrs, account), None)
+        if not records:
+            return
+        by_name = {}
+        for record, lifetime in records:
+            for prefix in ('time/%s/' % time_bucket(record['deleted_at'],
+                                                    self.bucket_size),
+                           'name/%s/' % name_shard(record['path'])):
+                by_name.setdefault(prefix, []).append((record, lifetime))
+        suffix = '%s-%s' % (utils.Timestamp(time.time()).internal,
+                            uuid.uuid4().hex[:8])
+        for prefix, members in sorted(by_name.items()):
+            batch = [record for record, _lifetime in members]
+            lifetimes = [lifetime for _record, lifetime in members]
+            # kept as long as the longest-lived of its objects' trash
+            lifetime = 0 if 0 in lifetimes else max(lifetimes)
+            status = self._put(vrs, account, prefix + suffix, batch,
+                               lifetime)
+            if not http.is_success(status):
+                self.logger.increment('index.error')
+                self.logger.error(
+                    'Failed to write %d undelete index records for %s: %d',
+                    len(batch), account, status)
+        self.logger.increment('index.flush')
+
+    def _put(self, vrs, account, name, records, lifetime):
+        body = b''.join(json.dumps(record).encode('utf-8') + b'\n'
+                        for record in records)
+        headers = {'Content-Type': INDEX_CONTENT_TYPE}
+        if lifetime:
+            headers['X-Delete-After'] = str(lifetime)
+        path = swob.wsgi_quote('/'.join(('', vrs, account, self.container,
+                                         name)))
+
+        status = self._request('PUT', path, body, headers)
+        if status == 404:
+            self._request('PUT', swob.wsgi_quote('/'.join(
+                ('', vrs, account, self.container))))
+            status = self._request('PUT', path, body, headers)
+        return status
+
+    def _request(self, method, path, body=None, headers=None):
+        """
+        :returns: HTTP status code
+        """
+        # Flushes happen in the background, outside of any client request,
+        # so they can't be made on anyone's behalf.
+        req = wsgi.make_pre_authed_request(
+            {}, method=method, path=path, body=body, headers=headers,
+            agent='Undelete', swift_source='UN')
+        resp = req.get_response(self.app)
+        # read (and close) the short response body
+        resp.body
+        return resp.status_int
+
+    def lookup(self, env, vrs, account, after=None, before=None, path=None):
+        """
+        Find the index records for deletions in a time range, or of an
+        object, reading index objects on behalf of the original requester.
+
+        :param env: WSGI environment for original request
+        :param after: utils.Timestamp; only records of deletions at or
+                      after this time. For a lookup by path, defaults to
+                      lookup_window seconds ago.
+        :param before: utils.Timestamp; only records of deletions before
+                       this time
+        :param path: native string "/<container>/<object>"; only records
+                     of deletions of this object
+
+        :returns: iterator of records, oldest index object first
+        :raises HTTPException: if the index couldn't be read
+        """
+        if path is not None:
+            if after is None and self.lookup_window:
+                after = utils.Timestamp(time.time() - self.lookup_window)
+            prefix = 'name/%s/' % name_shard(path)
+            # index objects are named for when they were written, which is
+            # never before the deletions they record
+            marker = prefix + after.internal if after is not None else ''
+            end_marker = ''
+        else:
+            prefix = 'time/'
+            marker = end_marker = ''
+            if after is not None:
+                marker = prefix + time_bucket(after, self.bucket_size)
+            if before is not None:
+                end_marker = prefix + time_bucket(
+                    float(before) + self.bucket_size, self.bucket_size)
+
+        for name in self._list(env, vrs, account, prefix, marker,
+                               end_marker):
+            for record in self._read(env, vrs, account, name):
+                deleted_at = utils.Timestamp(record['deleted_at'])
+                if path is not None and record['path'] != path or \
+                        after is not None and deleted_at < after or \
+                        before is not None and deleted_at >= before:
+                    continue
+                yield record
+
+    def _list(self, env, vrs, account, prefix, marker, end_marker):
+        container_path = swob.wsgi_quote('/'.join(
+            ('', vrs, account, self.container)))
+        while True:
+            query = 'format=json&prefix=%s&marker=%s' % (
+                swob.wsgi_quote(prefix, safe=''),
+                swob.wsgi_quote(marker, safe=''))
+            if end_marker:
+                query += '&end_marker=' + swob.wsgi_quote(end_marker, safe='')
+            resp = wsgi.make_subrequest(
+                env, method='GET', path='%s?%s' % (container_path, query),
+                agent='%(orig)s Undelete', swift_source='UN').get_response(
+                    self.app)
+            if resp.status_int == 404:
+                return
+            elif resp.status_int != 200:
+                raise swob.HTTPException(status=resp.status,
+                                         body=resp.body)
+            page = json.loads(resp.body)
+            for item in page:
+                yield swob.str_to_wsgi(item['name'])
+            if len(page) < constraints.CONTAINER_LISTING_LIMIT:
+                return
+            marker = swob.str_to_wsgi(page[-1]['name'])
+
+    def _read(self, env, vrs, account, name):
+        resp = wsgi.make_subrequest(
+            env, method='GET', path=swob.wsgi_quote('/'.join(
+                ('', vrs, account, self.container, name))),
+            agent='%(orig)s Undelete', swift_source='UN').get_response(
+                self.app)
+        if resp.status_int == 404:
+            # expired since the listing was made
+            return []
+        elif resp.status_int != 200:
+            raise swob.HTTPException(status=resp.status, body=resp.body)
+        return [json.loads(line) for line in resp.body.split(b'\n') if line]
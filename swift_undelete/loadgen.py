@@ -0,0 +1,687 @@
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load generator for the undelete middleware.
+
+Drives the filter built by filter_factory, configured as in a proxy config
+(or with options given on the command line), with a replay of Swift proxy
+access logs or a synthetic mix of requests. Behind it sits StandInSwift, an
+in-process imitation of the rest of the proxy pipeline that keeps track of
+containers and object sizes (but not their content), with configurable
+latency and failures: random 404s on COPY, 507s once it holds more than a
+given number of bytes, random 503s, and slow containers. Nothing touches the
+network or the disk.
+
+It reports throughput, p50/p99/p999 latency per client request method, and
+how many backend requests each client request cost, broken down by backend
+method for DELETEs:
+
+    python -m swift_undelete.loadgen --conf /etc/swift/proxy-server.conf \\
+        --log /var/log/swift/proxy.log --speed 10 --latency 5
+    python -m swift_undelete.loadgen -o trash_buckets=on --requests 100000 \\
+        --mix DELETE=0.5,PUT=0.5 --containers 1000 --copy-404-rate 0.01
+
+Requests made by middleware (those with a swift_source in the log) and bulk
+deletes (whose bodies aren't logged) are left out of a replay. Objects that
+the replay uses before (or without) uploading them are created up front,
+with the size the log shows for them, or --default-size.
+"""
+import argparse
+import json
+import math
+import random
+import sys
+import time
+from collections import Counter, defaultdict, namedtuple
+from io import BytesIO
+
+import eventlet
+from swift.common import swob, utils
+
+from swift_undelete.middleware import close_if_possible, \
+    compile_patterns, filter_factory
+
+timer = getattr(time, 'perf_counter', time.time)
+
+DEFAULT_MIX = 'PUT=0.3,GET=0.35,HEAD=0.1,DELETE=0.25'
+
+# One client request: its method, path (quoted, with any query string),
+# object size in bytes (uploaded for PUT, or created up front), and when to
+# send it, in seconds from the start of the run (None for right away).
+Request = namedtuple('Request', 'method path size at')
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(fraction * len(sorted_values))) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+def _respond(start_response, status, headers=None, body=None):
+    code = int(status.split(' ', 1)[0])
+    if body is None and code >= 400:
+        # the body swob would have given the error
+        body = ('<html><h1>%s</h1><p>%s</p></html>' %
+                swob.RESPONSE_REASONS[code]).encode('utf-8')
+    start_response(status, list((headers or {}).items()))
+    return [body] if body else []
+
+
+class StandInSwift(object):
+    """
+    Stands in for everything to the right of the middleware.
+
+    Accounts always exist. Containers and objects exist once created (by a
+    request, or by create_container and create_object); objects are
+    remembered by size and headers only, and come back as zeros.
+
+    Every request is counted against its swift.trans_id, which subrequests
+    inherit from the client request; pop_requests hands over the counts
+    for one client request. Requests without one (the middleware's
+    background work) are counted under None.
+
+    :param latency: seconds every request takes
+    :param jitter: mean of an exponentially distributed extra delay
+    :param copy_404_rate: fraction of COPYs that get a 404 regardless
+    :param error_rate: fraction of requests that get a 503
+    :param capacity: bytes the cluster holds before PUTs and COPYs get
+                     507s; 0 for no limit
+    :param slow_containers: compiled pattern (see compile_patterns) of
+                            "<account>/<container>" that get slow_latency
+                            extra
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, copy_404_rate=0.0,
+                 error_rate=0.0, capacity=0, slow_containers=None,
+                 slow_latency=0.0, rng=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.copy_404_rate = copy_404_rate
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.slow_containers = slow_containers
+        self.slow_latency = slow_latency
+        self.rng = rng or random.Random()
+        # (account, container) -> container headers
+        self.containers = {}
+        # (account, container, object) -> (size, object headers)
+        self.objects = {}
+        self.used_bytes = 0
+        self.requests = defaultdict(Counter)
+
+    def pop_requests(self, trans_id):
+        return self.requests.pop(trans_id, Counter())
+
+    def create_container(self, account, container, headers=None):
+        self.containers.setdefault((account, container), headers or {})
+
+    def create_object(self, account, container, obj, size, headers=None):
+        self.create_container(account, container)
+        self._store((account, container, obj), size, dict(
+            headers or {}, **{'X-Timestamp': utils.Timestamp.now().internal,
+                              'Content-Type': 'application/octet-stream'}))
+
+    def _store(self, key, size, headers):
+        old = self.objects.get(key)
+        if old is not None:
+            self.used_bytes -= old[0]
+        self.objects[key] = (size, headers)
+        self.used_bytes += size
+
+    def _remove(self, key):
+        size, _headers = self.objects.pop(key)
+        self.used_bytes -= size
+
+    def _full(self, size):
+        return self.capacity and self.used_bytes + size > self.capacity
+
+    def __call__(self, env, start_response):
+        req = swob.Request(env)
+        self.requests[env.get('swift.trans_id')][req.method] += 1
+        try:
+            _vrs, acc, con, obj = req.split_path(2, 4, True)
+        except ValueError:
+            return _respond(start_response, '400 Bad Request')
+
+        delay = self.latency
+        if self.jitter:
+            delay += self.rng.expovariate(1.0 / self.jitter)
+        if con and self.slow_containers is not None and \
+                self.slow_containers.match('/'.join((acc, con))):
+            delay += self.slow_latency
+        if delay:
+            eventlet.sleep(delay)
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return _respond(start_response, '503 Service Unavailable')
+
+        if obj:
+            handler = getattr(self, 'object_' + req.method, None)
+            args = (acc, con, obj)
+        elif con:
+            handler = getattr(self, 'container_' + req.method, None)
+            args = (acc, con)
+        else:
+            handler = getattr(self, 'account_' + req.method, None)
+            args = (acc,)
+        if handler is None:
+            return _respond(start_response, '405 Method Not Allowed')
+        return handler(req, start_response, *args)
+
+    def _listing(self, req, start_response, names):
+        prefix = req.params.get('prefix', '')
+        marker = req.params.get('marker', '')
+        end_marker = req.params.get('end_marker', '')
+        limit = int(req.params.get('limit', 10000))
+        items = [item for item in sorted(names, key=lambda i: i['name'])
+                 if item['name'].startswith(prefix) and
+                 item['name'] > marker and
+                 (not end_marker or item['name'] < end_marker)][:limit]
+        return _respond(start_response, '200 OK',
+                        {'Content-Type': 'application/json'},
+                        json.dumps(items).encode('utf-8'))
+
+    def account_HEAD(self, req, start_response, acc):
+        return _respond(start_response, '204 No Content')
+
+    def account_GET(self, req, start_response, acc):
+        return self._listing(req, start_response, [
+            {'name': swob.wsgi_to_str(c), 'count': 0, 'bytes': 0}
+            for a, c in self.containers if a == acc])
+
+    def account_POST(self, req, start_response, acc):
+        if 'bulk-delete' not in req.params:
+            return _respond(start_response, '204 No Content')
+        deleted = not_found = 0
+        for line in req.body.splitlines():
+            parts = swob.wsgi_unquote(
+                swob.bytes_to_wsgi(line.strip())).lstrip('/').split('/', 1)
+            key = (acc, parts[0], parts[1]) if len(parts) > 1 else None
+            if key in self.objects:
+                self._remove(key)
+                deleted += 1
+            elif key is None and (acc, parts[0]) in self.containers:
+                del self.containers[(acc, parts[0])]
+                deleted += 1
+            else:
+                not_found += 1
+        return _respond(start_response, '200 OK',
+                        {'Content-Type': 'application/json'},
+                        json.dumps({'Response Status': '200 OK',
+                                    'Response Body': '',
+                                    'Number Deleted': deleted,
+                                    'Number Not Found': not_found,
+                                    'Errors': []}).encode('utf-8'))
+
+    def container_PUT(self, req, start_response, acc, con):
+        if (acc, con) in self.containers:
+            return _respond(start_response, '202 Accepted')
+        self.create_container(acc, con, dict(req.headers))
+        return _respond(start_response, '201 Created')
+
+    def container_HEAD(self, req, start_response, acc, con):
+        if (acc, con) not in self.containers:
+            return _respond(start_response, '404 Not Found')
+        return _respond(start_response, '204 No Content')
+
+    def container_POST(self, req, start_response, acc, con):
+        return self.container_HEAD(req, start_response, acc, con)
+
+    def container_GET(self, req, start_response, acc, con):
+        if (acc, con) not in self.containers:
+            return _respond(start_response, '404 Not Found')
+        return self._listing(req, start_response, [
+            {'name': swob.wsgi_to_str(o), 'bytes': size,
+             'hash': 'd41d8cd98f00b204e9800998ecf8427e',
+             'content_type': headers.get('Content-Type', ''),
+             'last_modified': utils.Timestamp(
+                 headers['X-Timestamp']).isoformat}
+            for (a, c, o), (size, headers) in self.objects.items()
+            if (a, c) == (acc, con)])
+
+    def container_DELETE(self, req, start_response, acc, con):
+        if (acc, con) not in self.containers:
+            return _respond(start_response, '404 Not Found')
+        if any((a, c) == (acc, con) for a, c, _o in self.objects):
+            return _respond(start_response, '409 Conflict')
+        del self.containers[(acc, con)]
+        return _respond(start_response, '204 No Content')
+
+    def _object_headers(self, req):
+        headers = dict((k, v) for k, v in req.headers.items()
+                       if k.lower().startswith(('x-object-meta-',
+                                                'x-symlink-'))
+                       or k.lower() in ('content-type', 'x-delete-at'))
+        if req.headers.get('X-Delete-After'):
+            headers['X-Delete-At'] = str(
+                int(time.time() + int(req.headers['X-Delete-After'])))
+        headers['X-Timestamp'] = utils.Timestamp.now().internal
+        return headers
+
+    def object_PUT(self, req, start_response, acc, con, obj):
+        if (acc, con) not in self.containers:
+            return _respond(start_response, '404 Not Found')
+        # The body is never read; its declared length is all that counts.
+        size = req.content_length or 0
+        if self._full(size):
+            return _respond(start_response, '507 Insufficient Storage')
+        self._store((acc, con, obj), size, self._object_headers(req))
+        return _respond(start_response, '201 Created',
+                        {'Etag': 'd41d8cd98f00b204e9800998ecf8427e'})
+
+    def object_COPY(self, req, start_response, acc, con, obj):
+        source = self.objects.get((acc, con, obj))
+        dest_con, _, dest_obj = swob.wsgi_unquote(
+            req.headers.get('Destination', '')).lstrip('/').partition('/')
+        if source is None or (acc, dest_con) not in self.containers or \
+                self.copy_404_rate and \
+                self.rng.random() < self.copy_404_rate:
+            return _respond(start_response, '404 Not Found')
+        size, headers = source
+        if self._full(size):
+            return _respond(start_response, '507 Insufficient Storage')
+        dest = (acc, dest_con, dest_obj)
+        versions = self.containers[(acc, dest_con)].get('X-Versions-Location')
+        if dest in self.objects and versions and \
+                (acc, versions) in self.containers:
+            old = self.objects[dest]
+            self._store((acc, versions, '%03x%s/%s' % (
+                len(dest_obj), dest_obj, old[1]['X-Timestamp'])), *old)
+        new_headers = dict(headers)
+        new_headers.update(self._object_headers(req))
+        self._store(dest, size, new_headers)
+        return _respond(start_response, '201 Created',
+                        {'Etag': 'd41d8cd98f00b204e9800998ecf8427e'})
+
+    def object_HEAD(self, req, start_response, acc, con, obj):
+        source = self.objects.get((acc, con, obj))
+        if source is None:
+            return _respond(start_response, '404 Not Found')
+        size, headers = source
+        start_response('200 OK', list(dict(
+            headers, **{'Content-Length': str(size),
+                        'Etag': 'd41d8cd98f00b204e9800998ecf8427e'}).items()))
+        return []
+
+    def object_GET(self, req, start_response, acc, con, obj):
+        resp = self.object_HEAD(req, start_response, acc, con, obj)
+        source = self.objects.get((acc, con, obj))
+        if source is None:
+            return resp
+        return self._zeros(source[0])
+
+    @staticmethod
+    def _zeros(size, chunk_size=65536):
+        chunk = b'\0' * chunk_size
+        while size > chunk_size:
+            yield chunk
+            size -= chunk_size
+        yield chunk[:size]
+
+    def object_DELETE(self, req, start_response, acc, con, obj):
+        if (acc, con, obj) not in self.objects:
+            return _respond(start_response, '404 Not Found')
+        self._remove((acc, con, obj))
+        return _respond(start_response, '204 No Content')
+
+    def object_POST(self, req, start_response, acc, con, obj):
+        if (acc, con, obj) not in self.objects:
+            return _respond(start_response, '404 Not Found')
+        return _respond(start_response, '202 Accepted')
+
+
+def parse_access_log(lines):
+    """
+    Parse Swift proxy access log lines (proxy-logging's default format,
+    optionally behind a syslog prefix).
+
+    :returns: 2-tuple (list of Requests, dict of (path -> size) for the
+              objects that must exist before the replay starts)
+    """
+    requests = []
+    first_seen = {}
+    sizes = {}
+    start = None
+    for line in lines:
+        marker = line.find('proxy-server: ')
+        fields = (line[marker + len('proxy-server: '):] if marker >= 0
+                  else line).split()
+        if len(fields) < 19 or fields[16] != '-' or \
+                not fields[4].startswith('/v1/'):
+            continue
+        method, path, status = fields[3], fields[4], fields[6]
+        if 'bulk-delete' in path:
+            continue
+        try:
+            at = float(fields[18])
+        except ValueError:
+            at = None
+        if start is None and at is not None:
+            start = at
+        size = 0
+        for field in (fields[10], fields[11]):
+            if field.isdigit():
+                size = max(size, int(field))
+        object_path = path.split('?', 1)[0]
+        if object_path.count('/') >= 4:
+            if size and method in ('PUT', 'GET'):
+                sizes.setdefault(object_path, size)
+            first_seen.setdefault(object_path, (method, status))
+        requests.append(Request(method, path,
+                                size if method == 'PUT' else 0,
+                                None if at is None or start is None
+                                else at - start))
+
+    # Objects deleted, read or copied without having been uploaded first
+    # must have been there already (if the request succeeded).
+    existing = dict((path, sizes.get(path))
+                    for path, (method, status) in first_seen.items()
+                    if method != 'PUT' and status.startswith('2'))
+    return requests, existing
+
+
+def synthetic_workload(rng, requests, accounts=1, containers=10, mix=None,
+                       size_median=65536, size_sigma=1.5, initial_objects=1000,
+                       rate=0):
+    """
+    Make up a workload.
+
+    Object sizes are lognormally distributed around size_median; objects
+    spread evenly over the containers of every account. DELETEs, GETs and
+    HEADs pick a random object uploaded earlier (or created up front).
+
+    :param mix: dict of method -> relative frequency
+    :param rate: requests per second, arriving at random; 0 to send them
+                 as fast as the concurrency allows
+    :returns: 2-tuple (list of Requests, dict of (path -> size) for the
+              objects to create before the run)
+    """
+    mix = mix or parse_mix(DEFAULT_MIX)
+    methods = sorted(mix)
+    weights = [mix[m] for m in methods]
+    container_paths = ['/v1/AUTH_load%d/c%d' % (a, c)
+                       for a in range(accounts) for c in range(containers)]
+
+    def size():
+        return int(rng.lognormvariate(math.log(size_median), size_sigma))
+
+    live = []
+    existing = {}
+    for i in range(initial_objects):
+        path = '%s/seed%d' % (rng.choice(container_paths), i)
+        existing[path] = size()
+        live.append(path)
+
+    workload = []
+    at = 0.0
+    for i in range(requests):
+        if rate:
+            at += rng.expovariate(rate)
+        method = _weighted_choice(rng, methods, weights)
+        if method == 'PUT' or not live:
+            path = '%s/o%d' % (rng.choice(container_paths), i)
+            live.append(path)
+            workload.append(Request('PUT', path, size(),
+                                    at if rate else None))
+            continue
+        index = rng.randrange(len(live))
+        path = live[index]
+        if method == 'DELETE':
+            live[index] = live[-1]
+            live.pop()
+        workload.append(Request(method, path, 0, at if rate else None))
+    return workload, existing
+
+
+def _weighted_choice(rng, choices, weights):
+    point = rng.random() * sum(weights)
+    for choice, weight in zip(choices, weights):
+        point -= weight
+        if point < 0:
+            return choice
+    return choices[-1]
+
+
+def parse_mix(value):
+    """
+    Parse "DELETE=0.5,PUT=0.5" into a dict.
+    """
+    mix = {}
+    for item in value.split(','):
+        method, _, weight = item.partition('=')
+        mix[method.strip().upper()] = float(weight)
+    return mix
+
+
+def seed(backend, existing, default_size):
+    """
+    Create the objects (and containers) a workload expects to exist.
+    """
+    for path, size in existing.items():
+        _vrs, acc, con, obj = swob.wsgi_unquote(path).lstrip('/').split(
+            '/', 3)
+        backend.create_object(acc, con, obj,
+                              default_size if size is None else size)
+
+
+def run(app, backend, workload, concurrency=32, speed=1.0):
+    """
+    Send a workload through the app, concurrently.
+
+    :param speed: how much faster than their timestamps to send requests
+                  that have one; 0 to ignore timestamps altogether
+    :returns: a dict of results (see report)
+    """
+    results = defaultdict(lambda: {'latencies': [], 'statuses': Counter(),
+                                   'backend': Counter()})
+    pool = eventlet.GreenPool(concurrency)
+
+    def send(i, request):
+        env = swob.Request.blank(
+            swob.wsgi_unquote(request.path.split('?', 1)[0]),
+            environ={'REQUEST_METHOD': request.method,
+                     'QUERY_STRING': request.path.partition('?')[2]}).environ
+        env['swift.trans_id'] = 'tx%x' % i
+        if request.method == 'PUT':
+            env['CONTENT_LENGTH'] = str(request.size)
+            env['wsgi.input'] = BytesIO(b'')
+        status = [None]
+
+        def start_response(s, headers, exc_info=None):
+            status[0] = s
+
+        begin = timer()
+        resp_iter = app(env, start_response)
+        try:
+            for _chunk in resp_iter:
+                pass
+        finally:
+            close_if_possible(resp_iter)
+        elapsed = timer() - begin
+        result = results[request.method]
+        result['latencies'].append(elapsed)
+        result['statuses'][status[0].split(' ', 1)[0]] += 1
+        result['backend'].update(backend.pop_requests(env['swift.trans_id']))
+
+    begin = timer()
+    sent = []
+    for i, request in enumerate(workload):
+        if speed and request.at is not None:
+            delay = request.at / speed - (timer() - begin)
+            if delay > 0:
+                eventlet.sleep(delay)
+        sent.append(pool.spawn(send, i, request))
+    for thread in sent:
+        # a request that raised is a bug in the middleware; let it show
+        thread.wait()
+    elapsed = timer() - begin
+    return {'elapsed': elapsed, 'methods': dict(results),
+            'background': backend.pop_requests(None)}
+
+
+def report(results):
+    """
+    Summarize run's results as a JSON-friendly dict.
+    """
+    summary = {'elapsed': results['elapsed'], 'methods': {},
+               'background': dict(results['background'])}
+    total = 0
+    for method, result in sorted(results['methods'].items()):
+        latencies = sorted(result['latencies'])
+        count = len(latencies)
+        total += count
+        summary['methods'][method] = {
+            'count': count,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'p999_ms': percentile(latencies, 0.999) * 1000,
+            'statuses': dict(result['statuses']),
+            'backend_per_request': sum(result['backend'].values()) /
+            float(count),
+            'backend_by_method': dict(
+                (m, n / float(count)) for m, n in result['backend'].items()),
+        }
+    summary['requests'] = total
+    summary['req_per_s'] = total / results['elapsed'] \
+        if results['elapsed'] else None
+    return summary
+
+
+def format_report(summary):
+    lines = ['%d requests in %.2fs: %.0f req/s' % (
+        summary['requests'], summary['elapsed'], summary['req_per_s'] or 0),
+        '%-8s %8s %9s %9s %9s %9s  %s' % (
+            'method', 'count', 'p50 ms', 'p99 ms', 'p999 ms', 'backend',
+            'statuses')]
+    for method, m in sorted(summary['methods'].items()):
+        lines.append('%-8s %8d %9.2f %9.2f %9.2f %9.2f  %s' % (
+            method, m['count'], m['p50_ms'], m['p99_ms'], m['p999_ms'],
+            m['backend_per_request'], ' '.join(
+                '%s:%d' % s for s in sorted(m['statuses'].items()))))
+    if 'DELETE' in summary['methods']:
+        lines.append('backend requests per DELETE: ' + ', '.join(
+            '%s %.2f' % item for item in sorted(
+                summary['methods']['DELETE']['backend_by_method'].items())))
+    if summary['background']:
+        lines.append('background requests: ' + ', '.join(
+            '%s %d' % item for item in sorted(
+                summary['background'].items())))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    middleware = parser.add_argument_group('middleware')
+    middleware.add_argument('--conf', help='proxy config to take the '
+                            'middleware\'s settings from')
+    middleware.add_argument('--filter-section', default='filter:undelete')
+    middleware.add_argument('-o', '--option', action='append', default=[],
+                            metavar='KEY=VALUE',
+                            help='middleware setting (overrides --conf)')
+
+    workload = parser.add_argument_group('workload')
+    workload.add_argument('--log', action='append', default=[],
+                          help='proxy access log to replay ("-" for stdin); '
+                          'without one, the workload is synthetic')
+    workload.add_argument('--speed', type=float, default=0,
+                          help='replay this many times faster than logged; '
+                          '0 for as fast as possible')
+    workload.add_argument('--default-size', type=int, default=65536,
+                          help='size of pre-existing objects the log '
+                          'doesn\'t give a size for')
+    workload.add_argument('--requests', type=int, default=10000)
+    workload.add_argument('--mix', default=DEFAULT_MIX)
+    workload.add_argument('--accounts', type=int, default=1)
+    workload.add_argument('--containers', type=int, default=10,
+                          help='containers per account')
+    workload.add_argument('--size-median', type=int, default=65536)
+    workload.add_argument('--size-sigma', type=float, default=1.5)
+    workload.add_argument('--initial-objects', type=int, default=1000)
+    workload.add_argument('--rate', type=float, default=0,
+                          help='synthetic requests per second; 0 for as '
+                          'fast as possible')
+    workload.add_argument('--concurrency', type=int, default=32)
+    workload.add_argument('--seed', type=int, default=None)
+
+    backend = parser.add_argument_group('backend')
+    backend.add_argument('--latency', type=float, default=0,
+                         help='milliseconds per backend request')
+    backend.add_argument('--jitter', type=float, default=0,
+                         help='mean extra milliseconds, exponentially '
+                         'distributed')
+    backend.add_argument('--copy-404-rate', type=float, default=0)
+    backend.add_argument('--error-rate', type=float, default=0)
+    backend.add_argument('--capacity', type=int, default=0,
+                         help='bytes stored before 507s; 0 for no limit')
+    backend.add_argument('--slow-containers', default='',
+                         help='glob patterns of "<account>/<container>"')
+    backend.add_argument('--slow-latency', type=float, default=0,
+                         help='extra milliseconds for slow containers')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    conf = {}
+    if args.conf:
+        conf.update(utils.readconf(args.conf, args.filter_section))
+    for option in args.option:
+        key, _, value = option.partition('=')
+        conf[key.strip()] = value.strip()
+
+    rng = random.Random(args.seed)
+    stand_in = StandInSwift(
+        latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+        copy_404_rate=args.copy_404_rate, error_rate=args.error_rate,
+        capacity=args.capacity,
+        slow_containers=compile_patterns(args.slow_containers),
+        slow_latency=args.slow_latency / 1000.0, rng=rng)
+    app = filter_factory({}, **conf)(stand_in)
+
+    if args.log:
+        lines = []
+        for name in args.log:
+            with (sys.stdin if name == '-' else open(name)) as fp:
+                lines.extend(fp)
+        requests, existing = parse_access_log(lines)
+        speed = args.speed
+    else:
+        requests, existing = synthetic_workload(
+            rng, args.requests, accounts=args.accounts,
+            containers=args.containers, mix=parse_mix(args.mix),
+            size_median=args.size_median, size_sigma=args.size_sigma,
+            initial_objects=args.initial_objects, rate=args.rate)
+        speed = 1.0 if args.rate else 0
+    seed(stand_in, existing, args.default_size)
+    # Containers are created as the workload runs into them, the way a
+    # real cluster would already have them.
+    for request in requests:
+        parts = swob.wsgi_unquote(request.path.split('?', 1)[0]).split('/')
+        if len(parts) >= 5:
+            stand_in.create_container(parts[2], parts[3])
+
+    summary = report(run(app, stand_in, requests,
+                         concurrency=args.concurrency, speed=speed))
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        print(format_report(summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,28 @@ When this middleware is installed, an object DELETE request will cause a copy
 of the object to be saved into a "trash location" prior to deletion.
 Subsequently, an administrator can recover the deleted object.
 
+To restore an object, POST to it with an "undelete" query parameter:
+
+    POST /v1/AUTH_test/photos/cat.jpg?undelete
+
+To restore many objects at once, POST to their container instead. Optional
+"prefix", "deleted_after" and "deleted_before" parameters (the latter two UNIX
+timestamps) pick which trashed objects come back. Progress is streamed back as
+one JSON object per line, the last of which lists any errors:
+
+    POST /v1/AUTH_test/photos?undelete&prefix=2014/&deleted_after=1400000000
+
+Restores are made as the requester, who therefore needs read access to the
+trash as well as write access to the container. Objects that have been
+recreated since their deletion are left alone.
+
+With deletion_index turned on, each trashed object is also recorded in an index
+(see swift_undelete/index.py), which answers "what was deleted when" and "where
+did this object go" without listing trash containers:
+
+    GET /v1/AUTH_test?undelete-index&deleted_after=1400000000
+    GET /v1/AUTH_test?undelete-index&path=/photos/cat.jpg
+
 Caveats:
 
  * This does not provide protection against overwriting an object. Use Swift's
@@ -34,21 +56,160 @@ Caveats:
    unable to delete it. In extremely full clusters, this may result in a
    situation where you need to add capacity before you can delete objects.
 
-Future work:
+With trash_account_prefix set, trash lives in a separate account per
+customer account (e.g. AUTH_.trash-test for AUTH_test) instead of next to the
+customer's containers, which keeps trash out of the customer's account DB.
 
- * Allow undelete to be enabled only for particular accounts or containers
+With preserve_segments on, deleting a static large object with
+"?multipart-manifest=delete" trashes and deletes its manifest but leaves its
+segments alone, so that it costs a few small requests however big the object
+is. A copy of the manifest in the account's segments ledger lets
+swift-undelete-reaper delete the segments once the trash expires.
 
- * Move to separate account, not container, for trash. This requires Swift to
-   allow cross-account COPY requests.
+With compress_trash on, trash that compresses well (logs, JSON, CSV and the
+like) is stored zlib-compressed, streamed through the proxy instead of copied
+server-side; restores decompress it on the way back.
+
+With trash_naming = timestamped, each trashed copy is named
+"<object>/<inverted deletion timestamp>" in a single trash container, instead
+of overwriting the last copy into a versions container:
+
+    POST /v1/AUTH_test/photos/cat.jpg?undelete&version=8499999999.87654
+
+Future work:
 
  * If block_trash_deletes is on, modify the Allow header in responses (both
    OPTIONS responses and any other 405 response).
 
 """
-from swift.common import http, swob, utils, wsgi
+import calendar
+import fnmatch
+import itertools
+import json
+import re
+import os
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+import eventlet
+from eventlet import semaphore
+from swift.common import constraints, http, swob, utils, wsgi
+from swift.proxy.controllers.base import get_account_info, get_cache_key, \
+    get_container_info, get_object_info, set_object_info_cache
+
+from swift_undelete import admission, compression, index, packing, \
+    shadow
 
 DEFAULT_TRASH_PREFIX = ".trash-"
 DEFAULT_TRASH_LIFETIME = 86400 * 90  # 90 days expressed in seconds
+DEFAULT_TRASH_CACHE_TTL = 300  # seconds
+DEFAULT_TRASH_CACHE_SIZE = 10000  # entries
+DEFAULT_BULK_DELETE_CONCURRENCY = 10
+DEFAULT_MAX_DELETES_PER_REQUEST = 10000
+# longest line a bulk delete body can usefully hold, as in Swift's bulk
+MAX_PATH_LENGTH = constraints.MAX_OBJECT_NAME_LENGTH + \
+    constraints.MAX_CONTAINER_NAME_LENGTH + 2
+DEFAULT_RESTORE_CONCURRENCY = 10
+DEFAULT_SEGMENT_SIZE = 100 * 1024 * 1024
+DEFAULT_SEGMENTED_COPY_CONCURRENCY = 4
+DEFAULT_CONTENT_CONTAINER = ".undelete-content"
+DEFAULT_SEGMENTS_CONTAINER = ".undelete-segments"
+# Accounts that have trash are listed, as zero-byte objects, in this hidden
+# container, which is where the reaper (see reaper.py) finds them.
+REGISTRY_ACCOUNT = ".undelete"
+REGISTRY_CONTAINER = "accounts"
+BULK_RESPONSE_FORMATS = ['text/plain', 'application/json', 'application/xml',
+                         'text/xml']
+
+# Objects bigger than large_object_threshold go to a trash container with
+# this suffix, or don't get saved at all.
+LARGE_TRASH_SUFFIX = '-large'
+LARGE_OBJECT_SEPARATE = 'separate'
+LARGE_OBJECT_SKIP = 'skip'
+LARGE_OBJECT_ACTIONS = (LARGE_OBJECT_SEPARATE, LARGE_OBJECT_SKIP)
+
+# With trash_buckets on, trash goes into one container per trash container and
+# (UTC) day, named <trash container>@<YYYYMMDD>, which expires as a whole.
+# ("@" rather than "-" because plenty of real containers end in a date.)
+BUCKET_SEPARATOR = '@'
+BUCKET_DATE_FORMAT = '%Y%m%d'
+BUCKET_SECONDS = 86400
+
+# With trash_shards set, a container's trash is spread over shards named
+# <trash prefix><trash prefix><container>-<n>. That is what the trash of a
+# trash container would be called, and trash containers have none, so no real
+# container's trash can take a shard's name, as it could with a separator
+# alone (the trash of "logs-1" would be shard 1 of "logs").
+
+# What becomes of a delete whose trash copy admission control turns down
+ADMISSION_WAIT = 'wait'
+ADMISSION_429 = '429'
+ADMISSION_503 = '503'
+ADMISSION_TOMBSTONE = 'tombstone'
+ADMISSION_ACTIONS = (ADMISSION_WAIT, ADMISSION_429, ADMISSION_503,
+                     ADMISSION_TOMBSTONE)
+DEFAULT_ADMISSION_MAX_WAIT = 10  # seconds
+
+# "plain" trash keeps each object's name, and a versions container keeps the
+# copies of objects deleted more than once; "timestamped" trash names each
+# copy "<object>/<inverted deletion timestamp>", so that one container keeps
+# them all, newest first.
+NAMING_PLAIN = 'plain'
+NAMING_TIMESTAMPED = 'timestamped'
+NAMINGS = (NAMING_PLAIN, NAMING_TIMESTAMPED)
+TRASH_VERSION_RE = re.compile(r'^\d{10}\.\d{5}$')
+
+MODE_COPY = 'copy'
+MODE_TOMBSTONE = 'tombstone'
+MODE_SHADOW = 'shadow'
+MODES = (MODE_COPY, MODE_TOMBSTONE, MODE_SHADOW)
+# how long, in seconds, shadow mode remembers trash containers it would have
+# created, so that each is counted once
+SHADOW_CONTAINER_TTL = 30 * 86400
+
+# Tombstoned objects carry these (transient sysmeta survives neither client
+# requests nor the next POST, and is stripped from responses by gatekeeper).
+TOMBSTONE_HEADER = 'X-Object-Transient-Sysmeta-Undelete-Trashed'
+TOMBSTONE_DELETE_AT_HEADER = 'X-Object-Transient-Sysmeta-Undelete-Delete-At'
+# ... and this content-type parameter, which is what lets us spot them in
+# container listings.
+TOMBSTONE_PARAM = 'undelete_trashed'
+TOMBSTONE_PARAM_RE = re.compile(r'\s*;\s*%s=[^;]*' % TOMBSTONE_PARAM)
+# The pointer left in the trash container in place of a copy
+TOMBSTONE_CONTENT_TYPE = 'application/x-undelete-tombstone'
+TOMBSTONE_TARGET_HEADER = 'X-Object-Sysmeta-Undelete-Target'
+# With segmented_copy_threshold set, big objects go into trash as static large
+# objects, whose segments live in a container with this suffix; the manifest
+# carries this header. Each segment copy gets this many tries.
+TRASH_SEGMENTS_SUFFIX = '-segments'
+SEGMENTED_HEADER = 'X-Object-Sysmeta-Undelete-Segmented'
+SEGMENT_COPY_TRIES = 2
+
+# With preserve_segments on, a trashed static large object manifest names its
+# entry in the segments ledger with this
+SEGMENTS_HEADER = 'X-Object-Sysmeta-Undelete-Segments'
+# With compress_trash on, a compressed trash object carries its codec, and the
+# ETag and length of the object it was compressed from
+CODEC_HEADER = 'X-Object-Sysmeta-Undelete-Codec'
+ORIGINAL_ETAG_HEADER = 'X-Object-Sysmeta-Undelete-Etag'
+ORIGINAL_LENGTH_HEADER = 'X-Object-Sysmeta-Undelete-Length'
+# where in a pack (see swift_undelete.packing) its index starts
+PACK_INDEX_HEADER = 'X-Object-Sysmeta-Undelete-Pack-Index'
+DEFAULT_COMPRESS_MIN_SIZE = 4096
+DEFAULT_COMPRESS_MAX_RATIO = 0.8
+# content types that are compressed already
+DEFAULT_COMPRESS_SKIP_CONTENT_TYPES = (
+    'image/*, video/*, audio/*, application/zip, application/gzip, '
+    'application/x-gzip, application/x-bzip2, application/x-xz, '
+    'application/zstd, application/x-7z-compressed, application/vnd.rar, '
+    'application/x-rar-compressed')
+# Object headers that a POST drops unless they're sent again
+POST_PRESERVED_HEADERS = ('content-type', 'content-disposition',
+                          'content-encoding', 'x-object-manifest')
 
 
 # Helper method stolen from a pending Swift change in Gerrit.
@@ -65,12 +226,365 @@ def friendly_error(orig_error):
     return "Error copying object to trash:\n" + orig_error
 
 
+def metadata_to_repost(headers):
+    """
+    Pick out of an object HEAD response the metadata that a POST to that
+    object has to send again in order to keep it.
+    """
+    return dict((key, value) for key, value in headers.items()
+                if key.lower().startswith('x-object-meta-') or
+                key.lower() in POST_PRESERVED_HEADERS)
+
+
+def make_object_request(req, vrs, account, container, obj):
+    """
+    Make a bodiless DELETE request for a single object out of another
+    request (e.g. a bulk delete), keeping its auth and other context, and
+    its multipart-manifest parameter, which bulk passes on to each DELETE.
+    """
+    env = req.environ.copy()
+    env['REQUEST_METHOD'] = 'DELETE'
+    env['PATH_INFO'] = '/'.join(('', vrs, account, container, obj))
+    env['QUERY_STRING'] = ''
+    if req.params.get('multipart-manifest'):
+        env['QUERY_STRING'] = 'multipart-manifest=%s' % swob.wsgi_quote(
+            req.params['multipart-manifest'], safe='')
+    env['CONTENT_LENGTH'] = '0'
+    env['wsgi.input'] = BytesIO(b'')
+    env.pop('CONTENT_TYPE', None)
+    env.pop('HTTP_TRANSFER_ENCODING', None)
+    return swob.Request(env)
+
+
+def compile_patterns(patterns):
+    """
+    Compile a comma-separated list of glob patterns into one regex.
+
+    :returns: compiled regex, or None if there are no patterns
+    """
+    patterns = [p.strip() for p in patterns.split(',') if p.strip()]
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(p)
+                               for p in patterns))
+
+
+def listing_ranges(trash_prefix, marker, end_marker, reverse=False):
+    """
+    Split the range of an account listing around the names that start with
+    trash_prefix, which sort together.
+
+    :param trash_prefix: WSGI string
+    :param marker: the listing's marker (WSGI string), or '' for none
+    :param end_marker: the listing's end_marker, or '' for none
+    :param reverse: whether the listing is in reverse order
+    :returns: list of 2-tuples (marker, end_marker), in listing order, that
+              together cover the listing's range less the trash
+    """
+    # Sorts after every container name starting with trash_prefix, since
+    # none can be this long, and before every name that sorts after them.
+    past_trash = trash_prefix + swob.str_to_wsgi(u'\U0010ffff') * (
+        constraints.MAX_CONTAINER_NAME_LENGTH // 4 + 1)
+    ranges = []
+    if not reverse:
+        if not marker or marker < trash_prefix:
+            ranges.append((marker, min(end_marker or trash_prefix,
+                                       trash_prefix)))
+        if not end_marker or end_marker > past_trash:
+            ranges.append((max(marker, past_trash), end_marker))
+    else:
+        # marker is the upper bound, end_marker the lower
+        if not marker or marker > past_trash:
+            ranges.append((marker, max(end_marker, past_trash)))
+        if not end_marker or end_marker < trash_prefix:
+            ranges.append((min(marker or trash_prefix, trash_prefix),
+                           end_marker))
+    return ranges
+
+
+def trash_bucket(trash_container, timestamp):
+    """
+    The daily bucket of a trash container that trash from a given time goes
+    into.
+    """
+    return '%s%s%s' % (trash_container, BUCKET_SEPARATOR, time.strftime(
+        BUCKET_DATE_FORMAT, time.gmtime(float(timestamp))))
+
+
+def cached_size(env, acc, con, obj):
+    """
+    An object's size, if its info is already cached in the request
+    environment, else None.
+    """
+    info = env.get('swift.infocache', {}).get(get_cache_key(acc, con, obj))
+    if info and info.get('length') is not None:
+        return int(info['length'])
+    return None
+
+
+def shard_container(trash_prefix, con, shard):
+    """
+    The name of one of a container's trash shards.
+    """
+    return '%s%s%s-%d' % (trash_prefix, trash_prefix, con, shard)
+
+
+def trash_shard(trash_prefix, con, obj, shards):
+    """
+    The trash shard of a container that a deleted object goes into.
+
+    The shard depends on nothing but the object's name (CRC32 of its
+    bytes), so every proxy, and every restore, agrees on it.
+    """
+    return shard_container(
+        trash_prefix, con,
+        (zlib.crc32(swob.wsgi_to_bytes(obj)) & 0xffffffff) % shards)
+
+
+def timestamped_trash_name(obj, timestamp):
+    """
+    The name a copy of an object trashed at a given time gets with
+    timestamped naming. Later copies sort first.
+    """
+    return '%s/%s' % (obj, (~utils.Timestamp(timestamp)).internal)
+
+
+def split_trash_name(name):
+    """
+    Split a timestamped trash name into the object's name and the copy's
+    version (its inverted timestamp).
+
+    :returns: 2-tuple (object name, version), or (name, None) if name isn't
+              a timestamped trash name
+    """
+    obj, _sep, version = name.rpartition('/')
+    if obj and TRASH_VERSION_RE.match(version):
+        return obj, version
+    return name, None
+
+
+def trash_account(account, trash_account_prefix):
+    """
+    The account that holds an account's trash when trash_account_prefix is
+    set: the account's reseller prefix (up to and including the first
+    underscore), then trash_account_prefix, then the rest of the name; e.g.
+    AUTH_test -> AUTH_.trash-test.
+    """
+    reseller, sep, rest = account.partition('_')
+    if not sep:
+        return trash_account_prefix + account
+    return reseller + sep + trash_account_prefix + rest
+
+
+def segments_entry(due):
+    """
+    A new entry name for the segments ledger: the UNIX time its segments
+    are due for deletion, zero-padded so that entries list in due order,
+    then a unique suffix.
+    """
+    return '%010d/%s' % (due, uuid.uuid4().hex)
+
+
+def parse_trash_bucket(container):
+    """
+    Split a trash bucket's name into the trash container it belongs to and
+    the start of its day.
+
+    :returns: 2-tuple (trash container, UNIX time at which the bucket's day
+              starts); the time is None if this isn't a bucket at all
+    """
+    base, sep, day = container.rpartition(BUCKET_SEPARATOR)
+    if not sep or len(day) != 8 or not day.isdigit():
+        return container, None
+    try:
+        return base, calendar.timegm(time.strptime(day, BUCKET_DATE_FORMAT))
+    except ValueError:
+        return container, None
+
+
+def restore_outcome(status):
+    """
+    Sum up the HTTP status code of an object restore in a word.
+    """
+    if http.is_success(status):
+        return 'restored'
+    elif status == 404:
+        return 'missing'
+    elif status == 409:
+        return 'conflict'
+    return 'error'
+
+
+def get_bulk_response_body(data_format, data_dict, error_list):
+    """
+    Render a response body the way the bulk middleware does.
+
+    :param data_format: resulting content type
+    :param data_dict: bulk delete results, e.g. "Number Deleted"
+    :param error_list: list of [quoted name, status] pairs that failed
+    """
+    if data_format == 'application/json':
+        data_dict['Errors'] = error_list
+        return json.dumps(data_dict).encode('ascii')
+    if data_format.endswith('/xml'):
+        output = ['<delete>\n']
+        for key in sorted(data_dict):
+            xml_key = key.replace(' ', '_').lower()
+            output.extend(['<', xml_key, '>', escape(str(data_dict[key])),
+                           '</', xml_key, '>\n'])
+        output.append('<errors>\n')
+        for name, status in error_list:
+            output.extend(['<object><name>', escape(name), '</name><status>',
+                           escape(status), '</status></object>\n'])
+        output.append('</errors>\n</delete>\n')
+        return ''.join(output).encode('utf-8')
+
+    output = ['%s: %s\n' % (key, data_dict[key]) for key in sorted(data_dict)]
+    output.append('Errors:\n')
+    output.extend('%s, %s\n' % (name, status) for name, status in error_list)
+    return ''.join(output).encode('utf-8')
+
+
+class TrashContainerCache(object):
+    """
+    Remembers which trash containers are known to exist.
+
+    Entries live in a bounded per-process LRU for ``ttl`` seconds. If
+    ``use_memcache`` is set and the request environment carries a memcache
+    client, entries are also stored there so that all proxy workers share
+    them, under keys starting with ``namespace``.
+    """
+
+    def __init__(self, ttl=DEFAULT_TRASH_CACHE_TTL,
+                 size=DEFAULT_TRASH_CACHE_SIZE, use_memcache=True,
+                 namespace='undelete/trash'):
+        self.ttl = ttl
+        self.size = size
+        self.use_memcache = use_memcache
+        self.namespace = namespace
+        self._entries = OrderedDict()
+
+    def _key(self, account, container):
+        return '%s/%s/%s' % (self.namespace, account, container)
+
+    def _memcache(self, env):
+        if not self.use_memcache:
+            return None
+        return utils.cache_from_env(env, allow_none=True)
+
+    def _remember(self, key, now):
+        self._entries.pop(key, None)
+        self._entries[key] = now + self.ttl
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def exists(self, env, account, container):
+        """
+        Whether the given trash container is known to exist.
+        """
+        if self.ttl <= 0:
+            return False
+        key = self._key(account, container)
+        now = time.time()
+        expires = self._entries.pop(key, None)
+        if expires is not None and expires > now:
+            # re-insert to mark it as most recently used
+            self._entries[key] = expires
+            return True
+
+        memcache = self._memcache(env)
+        if memcache is not None and memcache.get(key):
+            self._remember(key, now)
+            return True
+        return False
+
+    def add(self, env, account, container):
+        """
+        Record that the given trash container exists.
+        """
+        if self.ttl <= 0:
+            return
+        key = self._key(account, container)
+        self._remember(key, time.time())
+        memcache = self._memcache(env)
+        if memcache is not None:
+            memcache.set(key, 1, time=self.ttl)
+
+    def discard(self, env, account, container):
+        """
+        Forget about the given trash container, e.g. because it turned out
+        not to exist after all.
+        """
+        key = self._key(account, container)
+        self._entries.pop(key, None)
+        memcache = self._memcache(env)
+        if memcache is not None:
+            memcache.delete(key)
+
+
 class ContainerContext(wsgi.WSGIContext):
     """
-    Helper class to perform a container PUT request.
+    Helper class to perform container HEAD, GET and PUT requests.
     """
 
-    def create(self, env, vrs, account, container, versions=None):
+    def head(self, env, vrs, account, container):
+        """
+        Perform a container HEAD request
+
+        :param env: WSGI environment for original request
+        :param vrs: API version, e.g. "v1"
+        :param account: account in which the container lives
+        :param container: container name
+
+        :returns: HTTP status code of the HEAD
+        """
+        env = env.copy()
+        env['REQUEST_METHOD'] = 'HEAD'
+        env["PATH_INFO"] = "/%s/%s/%s" % (vrs, account, container)
+        env['QUERY_STRING'] = ''
+
+        resp_iter = self._app_call(env)
+        close_if_possible(resp_iter)
+        return int(self._response_status.split(' ', 1)[0])
+
+    def list(self, env, vrs, account, container, prefix='', marker=''):
+        """
+        Fetch one page of a container listing
+
+        :param env: WSGI environment for original request
+        :param vrs: API version, e.g. "v1"
+        :param account: account in which the container lives
+        :param container: container name
+        :param prefix: only list objects whose names start with this
+        :param marker: only list objects whose names sort after this
+
+        :returns: 2-tuple (HTTP status code, list of object entries as
+                           dicts; empty unless the listing succeeded)
+        """
+        env = env.copy()
+        env['REQUEST_METHOD'] = 'GET'
+        env["PATH_INFO"] = "/%s/%s/%s" % (vrs, account, container)
+        env['QUERY_STRING'] = 'format=json&limit=%d' % (
+            constraints.CONTAINER_LISTING_LIMIT)
+        if prefix:
+            env['QUERY_STRING'] += '&prefix=' + swob.wsgi_quote(prefix)
+        if marker:
+            env['QUERY_STRING'] += '&marker=' + swob.wsgi_quote(marker)
+        env['CONTENT_LENGTH'] = '0'
+        env['wsgi.input'] = BytesIO(b'')
+        env.pop('HTTP_TRANSFER_ENCODING', None)
+
+        resp_iter = self._app_call(env)
+        body = b''.join(resp_iter)
+        close_if_possible(resp_iter)
+
+        status_int = int(self._response_status.split(' ', 1)[0])
+        if status_int != 200:
+            return status_int, []
+        return status_int, json.loads(body)
+
+    def create(self, env, vrs, account, container, versions=None,
+               storage_policy=None):
         """
         Perform a container PUT request
 
@@ -80,6 +594,8 @@ class ContainerContext(wsgi.WSGIContext):
         :param container: container name
         :param versions: value for X-Versions-Location header
             (for container versioning)
+        :param storage_policy: value for X-Storage-Policy header; None for
+            the cluster's default policy
 
         :returns: None
         :raises: HTTPException on failure (non-2xx response)
@@ -89,11 +605,13 @@ class ContainerContext(wsgi.WSGIContext):
         env["PATH_INFO"] = "/%s/%s/%s" % (vrs, account, container)
         if versions:
             env['HTTP_X_VERSIONS_LOCATION'] = versions
+        if storage_policy:
+            env['HTTP_X_STORAGE_POLICY'] = storage_policy
 
         resp_iter = self._app_call(env)
         # The body of a PUT response is either empty or very short (e.g. error
         # message), so we can get away with slurping the whole thing.
-        body = ''.join(resp_iter)
+        body = b''.join(resp_iter).decode('utf-8', 'replace')
         close_if_possible(resp_iter)
 
         status_int = int(self._response_status.split(' ', 1)[0])
@@ -104,13 +622,218 @@ class ContainerContext(wsgi.WSGIContext):
                 body=friendly_error(body))
 
 
+class ObjectContext(wsgi.WSGIContext):
+    """
+    Helper class to perform object requests with small or empty bodies
+    (HEAD, POST, DELETE and zero-byte PUT).
+    """
+
+    def request(self, env, method, path, headers=None, query_string=None,
+                body=None):
+        """
+        Perform an object request on behalf of the original requester.
+
+        :param env: WSGI environment for original request
+        :param method: HTTP method
+        :param path: unquoted object path, e.g. "/v1/a/c/o"
+        :param headers: dict of request headers
+        :param query_string: optional query string
+        :param body: optional (short) request body
+
+        :returns: 3-tuple (HTTP status code, response headers as a
+                           HeaderKeyDict, full response body)
+        """
+        path = swob.wsgi_quote(path)
+        if query_string:
+            path += '?' + query_string
+        subreq = wsgi.make_subrequest(
+            env, method=method, path=path, headers=headers, body=body,
+            agent='%(orig)s Undelete', swift_source='UN')
+        resp_iter = self._app_call(subreq.environ)
+        # These responses have no body or a short error message.
+        body = b''.join(resp_iter)
+        close_if_possible(resp_iter)
+
+        status_int = int(self._response_status.split(' ', 1)[0])
+        return (status_int, swob.HeaderKeyDict(self._response_headers), body)
+
+
+class TombstoneContext(wsgi.WSGIContext):
+    """
+    Helper class to keep tombstoned objects out of responses.
+    """
+
+    def handle_object(self, env, start_response):
+        """
+        Pass an object GET or HEAD through, answering 404 instead if the
+        object is tombstoned.
+        """
+        resp_iter = self._app_call(env)
+        if self._response_header_value(TOMBSTONE_HEADER) is not None:
+            close_if_possible(resp_iter)
+            return swob.HTTPNotFound()(env, start_response)
+        start_response(self._response_status, self._response_headers,
+                       self._response_exc_info)
+        return resp_iter
+
+    def handle_listing(self, env, start_response):
+        """
+        Pass a container GET through, leaving tombstoned objects out of the
+        listing and fetching more of it as needed to fill the page.
+
+        The listing is requested as JSON; listing_formats, which sits to the
+        left of us, turns it into whatever the client asked for.
+        """
+        req = swob.Request(env)
+        params = req.params
+        try:
+            limit = int(params.get('limit') or
+                        constraints.CONTAINER_LISTING_LIMIT)
+        except ValueError:
+            return self.app(env, start_response)
+        params['format'] = 'json'
+
+        listing = []
+        first = None
+        while True:
+            page_req = swob.Request(env.copy())
+            params['limit'] = str(limit - len(listing))
+            page_req.params = params
+            resp_iter = self._app_call(page_req.environ)
+            content_type = self._response_header_value('content-type') or ''
+            if first is None:
+                first = (self._response_status, self._response_headers)
+                if not self._response_status.startswith('200 ') or \
+                        content_type.partition(';')[0] != 'application/json':
+                    start_response(self._response_status,
+                                   self._response_headers,
+                                   self._response_exc_info)
+                    return resp_iter
+            elif not self._response_status.startswith('200 '):
+                # Nothing more to be had; return what we've got so far.
+                close_if_possible(resp_iter)
+                break
+
+            page = json.loads(b''.join(resp_iter))
+            close_if_possible(resp_iter)
+            listing.extend(
+                item for item in page
+                if TOMBSTONE_PARAM not in item.get('content_type', ''))
+            if len(listing) >= limit or \
+                    len(page) < int(params['limit']) or not page:
+                break
+            params['marker'] = page[-1].get('name', page[-1].get('subdir'))
+
+        body = json.dumps(listing[:limit]).encode('ascii')
+        status, headers = first
+        headers = [(h, v) for h, v in headers
+                   if h.lower() != 'content-length']
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        return [body]
+
+
+class TrashListingContext(wsgi.WSGIContext):
+    """
+    Helper class to keep trash containers out of account listings.
+
+    :param trash_prefix: prefix of trash container names
+    :param is_trash: callable telling whether a container (by its WSGI
+                     string name) is to be left out
+    """
+
+    def __init__(self, wrapped_app, trash_prefix, is_trash):
+        super(TrashListingContext, self).__init__(wrapped_app)
+        self.trash_prefix = trash_prefix
+        self.is_trash = is_trash
+
+    def handle_listing(self, env, start_response):
+        """
+        Pass an account GET through, leaving trash containers out of the
+        listing.
+
+        Trash containers' names share a prefix, so they sort together, and
+        rather than list them only to throw them away, this lists the
+        ranges either side of them. Pages short of the few other hidden
+        containers (the deletion index and such) are filled with more of
+        the listing.
+
+        The listing is requested as JSON; listing_formats, which sits to the
+        left of us, turns it into whatever the client asked for.
+        """
+        req = swob.Request(env)
+        params = req.params
+        try:
+            limit = int(params.get('limit') or
+                        constraints.ACCOUNT_LISTING_LIMIT)
+        except ValueError:
+            return self.app(env, start_response)
+        params['format'] = 'json'
+        ranges = listing_ranges(
+            self.trash_prefix, params.get('marker', ''),
+            params.get('end_marker', ''),
+            utils.config_true_value(params.get('reverse', 'false')))
+
+        listing = []
+        first = None
+        done = False
+        # A listing that is all trash still needs a (empty) listing, for
+        # the account's status and headers.
+        for marker, end_marker in ranges or [(self.trash_prefix,
+                                              self.trash_prefix)]:
+            while not done and (first is None or len(listing) < limit):
+                page_req = swob.Request(env.copy())
+                params['limit'] = str(limit - len(listing))
+                for param, value in (('marker', marker),
+                                     ('end_marker', end_marker)):
+                    if value:
+                        params[param] = value
+                    else:
+                        params.pop(param, None)
+                page_req.params = params
+                resp_iter = self._app_call(page_req.environ)
+                content_type = self._response_header_value(
+                    'content-type') or ''
+                if first is None:
+                    first = (self._response_status, self._response_headers)
+                    if not self._response_status.startswith('200 ') or \
+                            content_type.partition(';')[0] != \
+                            'application/json':
+                        start_response(self._response_status,
+                                       self._response_headers,
+                                       self._response_exc_info)
+                        return resp_iter
+                elif not self._response_status.startswith('200 '):
+                    # Nothing more to be had; return what we've got so far.
+                    close_if_possible(resp_iter)
+                    done = True
+                    break
+
+                page = json.loads(b''.join(resp_iter))
+                close_if_possible(resp_iter)
+                listing.extend(item for item in page if not self.is_trash(
+                    swob.str_to_wsgi(item.get('name', item.get('subdir')))))
+                if len(page) < int(params['limit']) or not page:
+                    break
+                marker = swob.str_to_wsgi(
+                    page[-1].get('name', page[-1].get('subdir')))
+
+        body = json.dumps(listing[:limit]).encode('ascii')
+        status, headers = first
+        headers = [(h, v) for h, v in headers
+                   if h.lower() != 'content-length']
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        return [body]
+
+
 class CopyContext(wsgi.WSGIContext):
     """
     Helper class to perform an object COPY request.
     """
 
     def copy(self, env, destination_container, destination_object,
-             delete_after=None):
+             delete_after=None, destination_account=None):
         """
         Perform a COPY from source to destination.
 
@@ -123,14 +846,18 @@ class CopyContext(wsgi.WSGIContext):
         :param delete_after: value of X-Delete-After; object will be deleted
                              after that many seconds have elapsed. Set to 0 or
                              None to keep the object forever.
+        :param destination_account: account to copy into, if not the
+                                    source object's own
 
         :returns: 3-tuple (HTTP status code, response headers,
-                           full response body)
+                           full response body, decoded)
         """
         env = env.copy()
         env['REQUEST_METHOD'] = 'COPY'
         env['HTTP_DESTINATION'] = '/'.join(
             (destination_container, destination_object))
+        if destination_account:
+            env['HTTP_DESTINATION_ACCOUNT'] = destination_account
         qs = env.get('QUERY_STRING', '')
         if qs:
             qs += '&multipart-manifest=get'
@@ -142,7 +869,7 @@ class CopyContext(wsgi.WSGIContext):
         resp_iter = self._app_call(env)
         # The body of a COPY response is either empty or very short (e.g.
         # error message), so we can get away with slurping the whole thing.
-        body = ''.join(resp_iter)
+        body = b''.join(resp_iter).decode('utf-8', 'replace')
         close_if_possible(resp_iter)
 
         status_int = int(self._response_status.split(' ', 1)[0])
@@ -152,14 +879,171 @@ class CopyContext(wsgi.WSGIContext):
 class UndeleteMiddleware(object):
     def __init__(self, app, trash_prefix=DEFAULT_TRASH_PREFIX,
                  trash_lifetime=DEFAULT_TRASH_LIFETIME,
-                 block_trash_deletes=False):
+                 block_trash_deletes=False, trash_cache=None,
+                 bulk_delete_concurrency=DEFAULT_BULK_DELETE_CONCURRENCY,
+                 max_deletes_per_request=DEFAULT_MAX_DELETES_PER_REQUEST,
+                 mode=MODE_COPY, logger=None, trash_storage_policy=None,
+                 large_object_threshold=0,
+                 large_object_action=LARGE_OBJECT_SEPARATE,
+                 large_trash_storage_policy=None,
+                 restore_concurrency=DEFAULT_RESTORE_CONCURRENCY,
+                 deletion_index=None, enabled_by_default=True,
+                 skip_containers=None, honor_metadata=False, dedup=False,
+                 content_container=DEFAULT_CONTENT_CONTAINER,
+                 register_accounts=False, provision_on_container_put=False,
+                 trash_buckets=False, skip_smaller_than=0,
+                 skip_younger_than=0, skip_expiring_within=0,
+                 skip_content_types=None, skip_objects=None,
+                 trash_shards=0, trash_account_prefix=None,
+                 preserve_segments=False,
+                 segments_container=DEFAULT_SEGMENTS_CONTAINER,
+                 segmented_copy_threshold=0,
+                 segment_size=DEFAULT_SEGMENT_SIZE,
+                 segmented_copy_concurrency=(
+                     DEFAULT_SEGMENTED_COPY_CONCURRENCY),
+                 admission_control=None, admission_action=ADMISSION_503,
+                 admission_max_wait=DEFAULT_ADMISSION_MAX_WAIT,
+                 compress_trash=False,
+                 compress_level=compression.DEFAULT_LEVEL,
+                 compress_min_size=DEFAULT_COMPRESS_MIN_SIZE,
+                 compress_max_ratio=DEFAULT_COMPRESS_MAX_RATIO,
+                 compress_skip_content_types=None,
+                 trash_naming=NAMING_PLAIN, hide_trash_containers=False,
+                 shadow_report_interval=shadow.DEFAULT_REPORT_INTERVAL,
+                 pack_threshold=0, pack_window=packing.DEFAULT_WINDOW,
+                 pack_max_bytes=packing.DEFAULT_MAX_BYTES,
+                 pack_max_objects=packing.DEFAULT_MAX_OBJECTS):
         self.app = app
+        self.logger = logger or utils.get_logger(
+            {}, log_route='undelete', statsd_tail_prefix='undelete')
         self.trash_prefix = trash_prefix
         self.trash_lifetime = trash_lifetime
         self.block_trash_deletes = block_trash_deletes
+        self.mode = mode
+        self.trash_storage_policy = trash_storage_policy
+        self.large_object_threshold = large_object_threshold
+        self.large_object_action = large_object_action
+        self.large_trash_storage_policy = large_trash_storage_policy
+        self.trash_cache = trash_cache or TrashContainerCache()
+        # (account, trash container) -> in-flight creation, so that
+        # concurrent DELETEs in this worker only create a container once
+        self._creations = {}
+        self.bulk_delete_concurrency = bulk_delete_concurrency
+        self.max_deletes_per_request = max_deletes_per_request
+        self.restore_concurrency = restore_concurrency
+        # an index.DeletionIndex, or None to keep no index
+        self.index = deletion_index
+        self.enabled_by_default = enabled_by_default
+        # compiled regex matching "<account>/<container>", or None
+        self.skip_containers = skip_containers
+        self.honor_metadata = honor_metadata
+        self.dedup = dedup
+        self.content_container = content_container
+        self.register_accounts = register_accounts
+        self.provision_on_container_put = provision_on_container_put
+        self.trash_buckets = trash_buckets
+        self.skip_smaller_than = skip_smaller_than
+        self.skip_younger_than = skip_younger_than
+        self.skip_expiring_within = skip_expiring_within
+        # compiled patterns (see compile_patterns), or None
+        self.skip_content_types = skip_content_types
+        self.skip_objects = skip_objects
+        # 0 (or 1) for a single trash container per container
+        self.trash_shards = trash_shards
+        # None to keep trash in the account it came from
+        self.trash_account_prefix = trash_account_prefix
+        self.preserve_segments = preserve_segments
+        self.segments_container = segments_container
+        # 0 to copy every object with a single COPY
+        self.segmented_copy_threshold = segmented_copy_threshold
+        self.segment_size = segment_size
+        self.segmented_copy_concurrency = segmented_copy_concurrency
+        # an admission.AdmissionControl, or None to copy without limits
+        self.admission = admission_control
+        self.admission_action = admission_action
+        self.admission_max_wait = admission_max_wait
+        self.compress_trash = compress_trash
+        self.compress_level = compress_level
+        self.compress_min_size = compress_min_size
+        self.compress_max_ratio = compress_max_ratio
+        # compiled patterns (see compile_patterns), or None
+        self.compress_skip_content_types = compress_skip_content_types
+        self.trash_naming = trash_naming
+        self.hide_trash_containers = hide_trash_containers
+        self.shadow = None
+        if mode == MODE_SHADOW:
+            self.shadow = shadow.ShadowStats(self.logger,
+                                             shadow_report_interval)
+            # trash containers that would have been created by now
+            self.shadow_containers = TrashContainerCache(
+                ttl=SHADOW_CONTAINER_TTL, namespace='undelete/shadow')
+        # 0 to pack nothing
+        self.pack_threshold = pack_threshold
+        self.packer = None
+        if pack_threshold:
+            self.packer = packing.Packer(
+                self.write_pack, window=pack_window,
+                max_bytes=pack_max_bytes, max_objects=pack_max_objects,
+                logger=self.logger)
+        # how often, in seconds, to send whitespace to keep long bulk
+        # deletes from timing out
+        self.yield_frequency = 10
+
+    def __call__(self, env, start_response):
+        # Most traffic is reads that we don't care about; send those on their
+        # way without building any swob objects.
+        if not self.wants_request(env):
+            return self.app(env, start_response)
+        return self.handle_request(env, start_response)
+
+    def wants_request(self, env):
+        """
+        Cheaply decide, from the raw environment alone, whether a request
+        might need handling. False positives are fine; they get a closer
+        look in handle_request.
+        """
+        method = env['REQUEST_METHOD']
+        if method == 'DELETE':
+            # objects, or bulk deletes at the account level
+            return env.get('PATH_INFO', '').count('/') >= 4 or \
+                'bulk-delete' in env.get('QUERY_STRING', '')
+        elif method == 'GET' and \
+                'undelete-index' in env.get('QUERY_STRING', ''):
+            return True
+        elif method == 'GET' and self.hide_trash_containers and \
+                env.get('PATH_INFO', '').rstrip('/').count('/') == 2:
+            # account listings
+            return True
+        elif method == 'PUT' and self.provision_on_container_put:
+            # containers only
+            return env.get('PATH_INFO', '').count('/') == 3
+        elif method == 'POST' and (
+                'bulk-delete' in env.get('QUERY_STRING', '') or
+                'undelete' in env.get('QUERY_STRING', '')):
+            return True
+        elif self.hides_tombstones():
+            # object GET/HEAD/POST and container listings
+            return method in ('GET', 'HEAD', 'POST') and \
+                env.get('PATH_INFO', '').count('/') >= 3
+        return False
 
     @swob.wsgify
-    def __call__(self, req):
+    def handle_request(self, req):
+        if req.method in ('POST', 'DELETE') and 'bulk-delete' in req.params:
+            return self.handle_bulk_delete(req)
+        if req.method == 'POST' and 'undelete' in req.params:
+            return self.handle_restore(req)
+        if req.method == 'GET' and 'undelete-index' in req.params:
+            return self.handle_index_lookup(req)
+        if req.method == 'PUT':
+            return self.handle_container_put(req)
+        if req.method == 'GET' and self.hide_trash_containers and \
+                req.path_info.rstrip('/').count('/') == 2:
+            return self.hide_trash(req)
+        if self.hides_tombstones() and \
+                req.method in ('GET', 'HEAD', 'POST'):
+            return self.hide_tombstones(req)
+
         # We only want to step in on object DELETE requests
         if req.method != 'DELETE':
             return self.app
@@ -171,82 +1055,2760 @@ class UndeleteMiddleware(object):
 
         # Okay, this is definitely an object DELETE request; let's see if it's
         # one we want to step in for.
+        start = time.time()
+        try:
+            outcome, resp = self.handle_object_delete(
+                req, vrs, acc, con, obj)
+        except swob.HTTPException as err:
+            outcome, resp = 'error', err
+        if resp is None:
+            if outcome == 'shadowed':
+                # all that shadow mode adds to the DELETE
+                self.logger.timing_since('shadow.overhead.timing', start)
+            resp = req.get_response(self.app)
+        self.logger.timing_since('delete.%s.timing' % outcome, start)
+        return resp
+
+    def handle_container_put(self, req):
+        """
+        Pass a container PUT through and, if it created the container,
+        create its trash containers in the background, so that the first
+        DELETE from it doesn't have to.
+        """
+        try:
+            vrs, acc, con = req.split_path(3, 3)
+        except ValueError:
+            return self.app
+        if self.is_trash(con) or self.mode == MODE_SHADOW:
+            # shadow mode creates nothing
+            return self.app
+        resp = req.get_response(self.app)
+        # 202 means the container was already there
+        if resp.status_int == 201:
+            # The client's request will be long gone by the time these run,
+            # so give them an environment of their own.
+            provision_req = self.trash_request(swob.Request(wsgi.make_env(
+                req.environ, agent='%(orig)s Undelete', swift_source='UN')))
+            eventlet.spawn_n(self.provision_trash_containers, provision_req,
+                             vrs, acc, con)
+        return resp
+
+    def provision_trash_containers(self, req, vrs, acc, con):
+        """
+        Create the trash containers for a container, unless deleted objects
+        from it aren't saved.
+        """
+        if self.trash_lifetime_for(req.environ, vrs, acc, con) is None:
+            return
+        trash_acc = self.trash_account_for(acc)
+        for trash_container, storage_policy in \
+                self.trash_containers_to_provision(con):
+            try:
+                self.ensure_trash_container(req, vrs, trash_acc,
+                                            trash_container, storage_policy)
+            except swob.HTTPException as err:
+                self.logger.increment('provision.error')
+                self.logger.error('Could not create %s/%s: %s', trash_acc,
+                                  trash_container, err.status)
+            else:
+                self.logger.increment('provision.success')
+
+    def trash_containers_to_provision(self, con):
+        """
+        The trash containers that deletes from a container may need, along
+        with their storage policies.
+
+        :returns: list of 2-tuples (trash container, storage policy)
+        """
+        containers = [(trash_container, self.trash_storage_policy)
+                      for trash_container in self.trash_shards_of(con)]
+        if self.large_object_threshold and \
+                self.large_object_action == LARGE_OBJECT_SEPARATE:
+            containers.extend((trash_container + LARGE_TRASH_SUFFIX,
+                               self.large_trash_storage_policy)
+                              for trash_container in self.trash_shards_of(con))
+        if self.uses_buckets(self.trash_lifetime):
+            # only today's, so only today's deletes are spared creating it
+            now = time.time()
+            containers = [(trash_bucket(trash_container, now), policy)
+                          for trash_container, policy in containers]
+        return containers
+
+    def handle_object_delete(self, req, vrs, acc, con, obj):
+        """
+        Save whatever needs saving before an object DELETE.
+
+        :returns: 2-tuple (outcome, response); the response is None if the
+                  DELETE should go on through the pipeline
+        """
         if self.is_trash(con) and self.block_trash_deletes:
-            return swob.HTTPMethodNotAllowed(
+            self.logger.increment('trash.blocked')
+            return 'blocked', swob.HTTPMethodNotAllowed(
                 content_type="text/plain",
                 body=("Attempted to delete from a trash container, but "
                       "block_trash_deletes is enabled\n"))
         elif not self.should_save_copy(req.environ, con, obj):
-            return self.app
+            self.logger.increment('trash.skip')
+            return 'skipped', None
+        lifetime = self.trash_lifetime_for(req.environ, vrs, acc, con)
+        if lifetime is None:
+            self.logger.increment('trash.skip')
+            return 'skipped', None
+        reason = self.skip_reason(req, vrs, acc, con, obj)
+        if reason == 'missing':
+            return 'missing', None
+        elif reason is not None:
+            self.logger.increment('trash.skip')
+            self.logger.increment('trash.skip.%s' % reason)
+            return 'skipped', None
+        if self.trash_account_prefix:
+            if self.authorize_delete(req) is not None:
+                # the proxy will turn the DELETE down itself
+                return 'denied', None
+            req = self.trash_request(req)
+        return self.save_to_trash(req, vrs, acc, con, obj, lifetime)
 
-        trash_container = self.trash_prefix + con
-        copy_status, copy_headers, copy_body = self.copy_object(
-            req, trash_container, obj)
+    def save_to_trash(self, req, vrs, acc, con, obj, lifetime,
+                      location=None):
+        """
+        Save an object before its DELETE as mode says: copy it to trash,
+        tombstone it, or (in shadow mode) just work out what copying it
+        would cost. Admission control may turn a copy away, or into a
+        tombstone.
+
+        Object DELETEs and bulk deletes alike come through here once the
+        object has been found worth saving and its DELETE authorized.
+
+        :param req: the object's DELETE request, to make trash subrequests
+                    with (see trash_request)
+        :param lifetime: how long, in seconds, to keep the object's trash
+        :param location: 2-tuple (trash container, storage policy) for the
+                         copy, if already worked out (see copy_to_trash)
+        :returns: 2-tuple (outcome, response); the response is None if the
+                  DELETE should go on through the pipeline
+        """
+        if self.mode == MODE_SHADOW:
+            if not self.shadow_copy(req, vrs, acc, con, obj, lifetime):
+                self.logger.increment('trash.skip')
+                return 'skipped', None
+            return 'shadowed', None
+
+        mode = self.mode
+        slot = None
+        if self.admission is not None and mode == MODE_COPY:
+            try:
+                slot = self.admit(req, vrs, acc, con, obj)
+            except admission.Overloaded as err:
+                if self.admission_action != ADMISSION_TOMBSTONE:
+                    return 'overloaded', self.overloaded_response(err)
+                # hide the object instead, which costs no copy
+                mode = MODE_TOMBSTONE
+        if mode == MODE_TOMBSTONE:
+            resp = self.tombstone_object(req, vrs, acc, con, obj, lifetime)
+            if resp is None:
+                return 'missing', None
+            return ('tombstoned' if resp.is_success else 'error'), resp
+
+        try:
+            return self.copy_to_trash(req, vrs, acc, con, obj, lifetime,
+                                      location)
+        finally:
+            if slot is not None:
+                slot.release()
+
+    def copy_to_trash(self, req, vrs, acc, con, obj, lifetime,
+                      location=None):
+        """
+        Save a copy of an object before its DELETE (see save_to_trash).
+
+        :param location: 2-tuple (trash container, storage policy), with the
+                         trash container's bucket if it goes into one; by
+                         default, as trash_location says
+        :returns: 2-tuple (outcome, response); the response is None if the
+                  DELETE should go on through the pipeline
+        """
+        now = time.time()
+        if location is None:
+            location = self.trash_location(req, vrs, acc, con, obj)
+            if location[0] is not None and self.uses_buckets(lifetime):
+                location = (trash_bucket(location[0], now), location[1])
+        trash_container, storage_policy = location
+        if trash_container is None:
+            self.logger.increment('trash.skip')
+            return 'skipped', None
+        entry = None
+        copy_req = req
+        if self.deletes_segments(req, vrs, acc, con, obj):
+            # Only the manifest gets deleted; its segments stay until its
+            # trash would expire, as recorded in the segments ledger.
+            params = req.params
+            params.pop('multipart-manifest')
+            req.params = params
+            entry = self.segments_entry(now, lifetime)
+            if entry is not None:
+                copy_req = swob.Request(req.environ.copy())
+                copy_req.headers[SEGMENTS_HEADER] = entry
+        kept_for = lifetime
+        if self.uses_buckets(lifetime):
+            # the bucket expires as a whole, so the copy needn't
+            lifetime = 0
+        trash_obj = self.trash_name(obj, now)
+        result = None
+        if self.dedup:
+            result = self.dedup_object(req, vrs, acc, con, obj,
+                                       trash_container, storage_policy,
+                                       lifetime, trash_obj)
+        if result is None and self.packer is not None:
+            result = self.packed_copy(req, vrs, acc, con, obj,
+                                      trash_container, storage_policy,
+                                      lifetime, trash_obj)
+        if result is None and self.segmented_copy_threshold:
+            result = self.segmented_copy(req, vrs, acc, con, obj,
+                                         trash_container, storage_policy,
+                                         lifetime, trash_obj)
+        if result is None and self.compress_trash:
+            result = self.compressed_copy(req, vrs, acc, con, obj,
+                                          trash_container, storage_policy,
+                                          lifetime, trash_obj)
+        if result is None:
+            result = self.trash_object(copy_req, vrs, acc, trash_obj,
+                                       trash_container, storage_policy,
+                                       lifetime)
+        copy_status, copy_headers, copy_body = result
         if copy_status == 404:
-            self.create_trash_container(req, vrs, acc, trash_container)
-            copy_status, copy_headers, copy_body = self.copy_object(
-                req, trash_container, obj)
+            return 'missing', None
         elif not http.is_success(copy_status):
             # other error; propagate this to the client
-            return swob.Response(
+            return 'error', swob.Response(
                 body=friendly_error(copy_body),
                 status=copy_status,
                 headers=copy_headers)
-        return self.app
+        if entry is not None:
+            status, headers, body = self.record_segments(req, vrs, acc,
+                                                         entry)
+            if not http.is_success(status):
+                return 'error', swob.Response(
+                    body=friendly_error(body), status=status,
+                    headers=headers)
+        size = self.record_copied_bytes(req.environ, acc, con, obj)
+        self.index_deletion(vrs, acc, con, obj, trash_container,
+                            swob.HeaderKeyDict(copy_headers).get('Etag'), size,
+                            trash_obj, kept_for)
+        if entry is not None:
+            return 'trashed', self.delete_manifest(req, vrs, acc, entry)
+        return 'trashed', None
 
-    def copy_object(self, req, trash_container, obj):
-        return CopyContext(self.app).copy(req.environ, trash_container, obj,
-                                          self.trash_lifetime)
+    def deletes_segments(self, req, vrs, acc, con, obj):
+        """
+        Whether, with preserve_segments on, an object DELETE would take a
+        static large object's segments along with its manifest.
+        """
+        if not self.preserve_segments or \
+                req.params.get('multipart-manifest') != 'delete':
+            return False
+        info = get_object_info(req.environ, self.app,
+                               path='/'.join(('', vrs, acc, con, obj)),
+                               swift_source='UN')
+        return http.is_success(info['status']) and (
+            'slo-size' in info['sysmeta'] or 'slo-etag' in info['sysmeta'])
 
-    def create_trash_container(self, req, vrs, account, trash_container):
+    def segments_entry(self, now, lifetime):
         """
-        Create a trash container and its associated versions container.
+        Name a new segments ledger entry for trash with the given lifetime,
+        saved now: the time its segments are due for deletion (when the
+        trash itself expires, or its bucket is dropped), then a unique
+        suffix.
 
-        :raises HTTPException: if container creation failed
+        :returns: entry name, or None if the trash is kept forever, and so
+                  are its segments
         """
-        ctx = ContainerContext(self.app)
-        versions_container = trash_container + "-versions"
-        ctx.create(req.environ, vrs, account, versions_container)
-        ctx.create(req.environ, vrs, account, trash_container,
-                   versions=versions_container)
+        if not lifetime:
+            return None
+        due = now + lifetime
+        if self.uses_buckets(lifetime):
+            due = int(now) // BUCKET_SECONDS * BUCKET_SECONDS + \
+                BUCKET_SECONDS + lifetime
+        return segments_entry(due)
 
-    def is_trash(self, con):
+    def record_segments(self, req, vrs, acc, entry):
         """
-        Whether a container is a trash container or not
+        COPY the manifest of the static large object a request is aimed at
+        into the account's segments ledger, creating the ledger if needed.
+
+        :returns: 3-tuple (HTTP status code, response headers,
+                           full response body) of the last COPY attempt
+        :raises HTTPException: if ledger creation failed
         """
-        return con.startswith(self.trash_prefix)
+        status, headers, body = self.copy_object(
+            req, self.segments_container, entry, lifetime=0)
+        if status == 404:
+            # The manifest was there a moment ago, so it's the ledger
+            # that's missing.
+            ContainerContext(self.app).create(req.environ, vrs, acc,
+                                              self.segments_container)
+            if self.register_accounts:
+                self.register_account(vrs, acc)
+            status, headers, body = self.copy_object(
+                req, self.segments_container, entry, lifetime=0)
+        return status, headers, body
 
-    def should_save_copy(self, env, con, obj):
+    def delete_manifest(self, req, vrs, acc, entry):
         """
-        Determine whether or not we should save a copy of the object prior to
-        its deletion. For example, if the object is one that's in a trash
-        container, don't save a copy lest we get infinite metatrash recursion.
+        Delete a static large object's manifest, without its segments,
+        dropping its segments ledger entry again if that fails.
+
+        :returns: the DELETE response
         """
-        return not self.is_trash(con)
+        resp = req.get_response(self.app)
+        if not resp.is_success:
+            # the segments still belong to a live object
+            ObjectContext(self.app).request(
+                req.environ, 'DELETE',
+                '/'.join(('', vrs, acc, self.segments_container, entry)))
+        return resp
 
+    def admit(self, req, vrs, acc, con, obj):
+        """
+        Get admission control's go-ahead for copying an object to trash,
+        waiting for it (up to admission_max_wait seconds) if
+        admission_action is "wait".
 
-def filter_factory(global_conf, **local_conf):
-    """
-    Returns the WSGI filter for use with paste.deploy.
+        :returns: an admission.Slot to release once the copy is done
+        :raises admission.Overloaded: if the copy wasn't admitted
+        """
+        size = 0
+        if self.admission.limits_bytes:
+            size = self.copy_size(req, vrs, acc, con, obj) or 0
+        max_wait = 0
+        if self.admission_action == ADMISSION_WAIT:
+            max_wait = self.admission_max_wait
+        start = time.time()
+        try:
+            slot = self.admission.acquire(req.environ, acc, size, max_wait)
+        except admission.Overloaded as err:
+            self.logger.increment('admission.denied.%s' % err.reason)
+            raise
+        self.logger.timing_since('admission.wait.timing', start)
+        return slot
 
-    Parameters in config:
+    def overloaded_response(self, err):
+        """
+        The response to a delete whose trash copy wasn't admitted.
 
-    # value to prepend to the account in order to compute the trash location
-    trash_prefix = ".trash-"
-    # how long, in seconds, trash objects should live before expiring. Set to 0
-    # to keep trash objects forever.
-    trash_lifetime = 7776000  # 90 days
-    """
-    conf = global_conf.copy()
-    conf.update(local_conf)
+        :param err: the admission.Overloaded raised
+        """
+        # not every swob knows 429's reason phrase
+        status = '429 Too Many Requests' \
+            if self.admission_action == ADMISSION_429 \
+            else '503 Service Unavailable'
+        return swob.Response(
+            status=status, headers={'Retry-After': str(err.retry_after)},
+            content_type='text/plain',
+            body='Too many deletes are being saved to trash; try again '
+                 'later\n')
 
-    trash_prefix = conf.get("trash_prefix", DEFAULT_TRASH_PREFIX)
-    trash_lifetime = int(conf.get("trash_lifetime", DEFAULT_TRASH_LIFETIME))
-    block_trash_deletes = utils.config_true_value(
+    def hides_tombstones(self):
+        """
+        Whether reads may come across tombstoned objects, which must be
+        made to look deleted.
+        """
+        return self.mode == MODE_TOMBSTONE or (
+            self.admission is not None and
+            self.admission_action == ADMISSION_TOMBSTONE)
+
+    def trash_name(self, obj, timestamp):
+        """
+        The name in trash of a copy of an object trashed at a given time.
+
+        With timestamped naming, an object whose name leaves no room for
+        the timestamp keeps its own name, and so keeps only its latest copy
+        (there being no versions container for the others).
+        """
+        if self.trash_naming != NAMING_TIMESTAMPED:
+            return obj
+        name = timestamped_trash_name(obj, timestamp)
+        if len(swob.wsgi_to_bytes(name)) > constraints.MAX_OBJECT_NAME_LENGTH:
+            self.logger.increment('trash.name_too_long')
+            return obj
+        return name
+
+    def trash_location(self, req, vrs, acc, con, obj):
+        """
+        Work out which trash container a deleted object's copy belongs in.
+
+        If a large object threshold is set, this looks up the object's
+        size (see get_object_info; usually a HEAD) and sends large objects
+        to a separate trash container, or nowhere.
+
+        :returns: 2-tuple (trash container, storage policy for it); the
+                  container is None if the object shouldn't be copied
+        """
+        trash_container = self.base_trash_container(con, obj)
+        if not self.large_object_threshold:
+            return trash_container, self.trash_storage_policy
+        size = self.copy_size(req, vrs, acc, con, obj)
+        if size is None or size <= self.large_object_threshold:
+            return trash_container, self.trash_storage_policy
+        elif self.large_object_action == LARGE_OBJECT_SKIP:
+            return None, None
+        return (trash_container + LARGE_TRASH_SUFFIX,
+                self.large_trash_storage_policy)
+
+    def base_trash_container(self, con, obj):
+        """
+        The trash container a deleted object goes into, or with trash_shards
+        set, the object's shard of it; before any large object suffix or
+        daily bucket.
+        """
+        if self.trash_shards > 1:
+            return trash_shard(self.trash_prefix, con, obj,
+                               self.trash_shards)
+        return self.trash_prefix + con
+
+    def trash_shards_of(self, con):
+        """
+        All of a container's (unbucketed, small object) trash containers:
+        its shards, or the one trash container if it isn't sharded.
+        """
+        if self.trash_shards > 1:
+            return [shard_container(self.trash_prefix, con, n)
+                    for n in range(self.trash_shards)]
+        return [self.trash_prefix + con]
+
+    def skip_reason(self, req, vrs, acc, con, obj):
+        """
+        Check an object against the skip rules, looking it up as cheaply as
+        the rules allow.
+
+        Name patterns cost nothing. Size and content type come from
+        get_object_info, which the proxy may already have (and which
+        large_object_threshold looks up anyway). Object info carries
+        neither the object's timestamp nor its X-Delete-At, so the age and
+        expiry rules cost a HEAD instead, which then serves as the object's
+        info for the rest of the request.
+
+        :returns: why the object isn't worth saving ("name", "missing",
+                  "young", "expiring", "small" or "content_type"), or None
+                  if it is (or if it couldn't be looked up)
+        """
+        if self.skip_objects is not None and \
+                self.skip_objects.match('/'.join((acc, con, obj))):
+            return 'name'
+        path = '/'.join(('', vrs, acc, con, obj))
+        headers = {}
+        if self.skip_younger_than or self.skip_expiring_within:
+            # Like get_object_info's own HEAD, this bypasses auth; the
+            # result only decides whether to copy.
+            resp = wsgi.make_pre_authed_request(
+                req.environ, method='HEAD', path=swob.wsgi_quote(path),
+                agent='%(orig)s Undelete', swift_source='UN').get_response(
+                    self.app)
+            close_if_possible(resp.app_iter)
+            info = set_object_info_cache(self.app, req.environ, acc, con,
+                                         obj, resp)
+            headers = resp.headers
+        elif self.skip_smaller_than or self.skip_content_types is not None:
+            info = get_object_info(req.environ, self.app, path=path,
+                                   swift_source='UN')
+        else:
+            return None
+        if info['status'] == 404:
+            return 'missing'
+        elif not http.is_success(info['status']):
+            return None
+
+        now = time.time()
+        if self.skip_younger_than and headers.get('X-Timestamp') and \
+                now - float(headers['X-Timestamp']) < \
+                self.skip_younger_than:
+            return 'young'
+        if self.skip_expiring_within and headers.get('X-Delete-At') and \
+                int(headers['X-Delete-At']) - now < \
+                self.skip_expiring_within:
+            return 'expiring'
+        if self.skip_smaller_than and info['length'] is not None and \
+                int(info['length']) < self.skip_smaller_than:
+            return 'small'
+        if self.skip_content_types is not None and info['type'] and \
+                self.skip_content_types.match(
+                    info['type'].split(';', 1)[0].strip()):
+            return 'content_type'
+        return None
+
+    def uses_buckets(self, lifetime):
+        """
+        Whether trash with a given lifetime goes into daily buckets.
+
+        Only trash with the default lifetime does; the sweeper drops buckets
+        according to that. Trash whose lifetime metadata says otherwise, or
+        that is kept forever, goes where it would without buckets, and
+        expires object by object as before.
+        """
+        return bool(self.trash_buckets and lifetime and
+                    lifetime == self.trash_lifetime)
+
+    def copy_size(self, req, vrs, acc, con, obj):
+        """
+        How many bytes copying an object to trash would move, or None if
+        that's unknown (e.g. there is no such object).
+        """
+        info = get_object_info(req.environ, self.app,
+                               path='/'.join(('', vrs, acc, con, obj)),
+                               swift_source='UN')
+        if not http.is_success(info['status']):
+            return None
+        if 'slo-size' in info['sysmeta'] or 'slo-etag' in info['sysmeta']:
+            # We only copy the manifest of a static large object, not the
+            # segments its size is made of.
+            return None
+        return info['length']
+
+    def segmented_copy(self, req, vrs, acc, con, obj, trash_container,
+                       storage_policy=None, lifetime=None, trash_obj=None):
+        """
+        Save a big object into trash as a static large object: copy it,
+        segmented_copy_segment_size bytes at a time and
+        segmented_copy_concurrency segments at once, into the trash
+        container's segments container, then PUT a manifest for them into
+        the trash container.
+
+        Segments are named for the object's timestamp, so if this fails
+        part-way, the segments already copied are found (with a single
+        listing) and kept by the next attempt, rather than copied again.
+
+        :param trash_obj: the manifest's name in trash, if not obj
+        :returns: 3-tuple (HTTP status code, response headers,
+                           full response body) like trash_object, or None
+                  if the object should be copied as usual (e.g. it isn't
+                  big enough, or is a large object manifest)
+        :raises HTTPException: if container creation failed
+        """
+        size = self.copy_size(req, vrs, acc, con, obj)
+        if size is None or size <= self.segmented_copy_threshold:
+            return None
+        if lifetime is None:
+            lifetime = self.trash_lifetime
+        path = '/'.join(('', vrs, acc, con, obj))
+        status, headers, body = ObjectContext(self.app).request(
+            req.environ, 'HEAD', path, query_string='multipart-manifest=get')
+        if not http.is_success(status):
+            return status, headers, body
+        elif 'X-Object-Manifest' in headers or \
+                'X-Static-Large-Object' in headers:
+            return None
+        elif not headers.get('X-Timestamp'):
+            return None
+        size = int(headers['Content-Length'])
+        prefix = '%s/%s/%d/' % (obj, headers['X-Timestamp'],
+                                self.segment_size)
+        if len(swob.wsgi_to_bytes(prefix)) + 8 > \
+                constraints.MAX_OBJECT_NAME_LENGTH:
+            return None
+
+        trash_acc = self.trash_account_for(acc)
+        segments_container = trash_container + TRASH_SEGMENTS_SUFFIX
+        ctx = ContainerContext(self.app)
+        status, listing = ctx.list(req.environ, vrs, trash_acc,
+                                   segments_container, prefix=prefix)
+        if status == 404:
+            ctx.create(req.environ, vrs, trash_acc, segments_container,
+                       storage_policy=storage_policy)
+        elif not http.is_success(status):
+            return status, {}, 'Could not list segments\n'
+        done = dict((swob.str_to_wsgi(item['name']), item)
+                    for item in listing)
+
+        segments = []
+        for n, start in enumerate(range(0, size, self.segment_size)):
+            segment_size = min(self.segment_size, size - start)
+            name = '%s%08d' % (prefix, n)
+            if name in done and done[name]['bytes'] == segment_size:
+                self.logger.increment('segmented_copy.resumed')
+                segments.append((name, start, segment_size,
+                                 done[name]['hash']))
+            else:
+                segments.append((name, start, segment_size, None))
+
+        # statuses of failed segment copies; once there is one, the rest
+        # aren't worth starting
+        failures = []
+
+        def copy(segment):
+            name, start, segment_size, etag = segment
+            tries = 0
+            while etag is None and tries < SEGMENT_COPY_TRIES and \
+                    not failures:
+                tries += 1
+                status, etag = self.copy_segment(
+                    req, path, headers['Etag'], '/'.join((
+                        '', vrs, trash_acc, segments_container, name)),
+                    start, segment_size, lifetime)
+            if etag is None and tries:
+                failures.append(status)
+            return name, segment_size, etag
+
+        manifest = []
+        pile = eventlet.GreenPile(self.segmented_copy_concurrency)
+        for segment in segments:
+            pile.spawn(copy, segment)
+        for name, segment_size, etag in pile:
+            manifest.append({
+                'path': swob.wsgi_to_str('/'.join(('', segments_container,
+                                                   name))),
+                'etag': etag, 'size_bytes': segment_size})
+        if failures:
+            self.logger.increment('segmented_copy.error')
+            return failures[0], {}, 'Could not copy a segment\n'
+
+        manifest_headers = metadata_to_repost(headers)
+        manifest_headers[SEGMENTED_HEADER] = 'true'
+        if lifetime:
+            manifest_headers['X-Delete-After'] = str(lifetime)
+        status, headers, body = self.put_pointer(
+            req, vrs, acc, trash_container, trash_obj or obj,
+            manifest_headers, storage_policy,
+            body=json.dumps(manifest).encode('utf-8'),
+            query_string='multipart-manifest=put')
+        self.logger.increment('segmented_copy.%s' % (
+            'success' if http.is_success(status) else 'error'))
+        return status, headers, body.decode('utf-8', 'replace')
+
+    def copy_segment(self, req, path, etag, segment_path, start, size,
+                     lifetime):
+        """
+        Copy one segment's worth of an object: a ranged GET of the object
+        (of the version with the given ETag), streamed into a PUT of the
+        segment.
+
+        :returns: 2-tuple (HTTP status code, the segment's ETag or None if
+                  the copy failed)
+        """
+        get_resp = wsgi.make_subrequest(
+            req.environ, method='GET',
+            path=swob.wsgi_quote(path) + '?multipart-manifest=get',
+            headers={'Range': 'bytes=%d-%d' % (start, start + size - 1),
+                     'If-Match': etag},
+            agent='%(orig)s Undelete', swift_source='UN').get_response(
+                self.app)
+        if not get_resp.is_success:
+            close_if_possible(get_resp.app_iter)
+            return get_resp.status_int, None
+        put_headers = {'Content-Length': str(size)}
+        if lifetime:
+            put_headers['X-Delete-After'] = str(lifetime)
+        put_req = wsgi.make_subrequest(
+            req.environ, method='PUT', path=swob.wsgi_quote(segment_path),
+            headers=put_headers, agent='%(orig)s Undelete', swift_source='UN')
+        put_req.environ['wsgi.input'] = utils.FileLikeIter(get_resp.app_iter)
+        try:
+            put_resp = put_req.get_response(self.app)
+        finally:
+            close_if_possible(get_resp.app_iter)
+        close_if_possible(put_resp.app_iter)
+        if not put_resp.is_success:
+            return put_resp.status_int, None
+        return put_resp.status_int, put_resp.headers.get('Etag')
+
+    def compressed_copy(self, req, vrs, acc, con, obj, trash_container,
+                        storage_policy=None, lifetime=None, trash_obj=None):
+        """
+        Save an object into trash compressed: a GET of the object, streamed
+        through a compressor into a PUT of the trash object, which records
+        the codec and the object's own ETag and length.
+
+        Objects that aren't worth compressing are left to be copied as
+        usual: ones smaller than compress_min_size, large object manifests,
+        ones compressed already (going by their Content-Encoding and
+        compress_skip_content_types), and ones whose first
+        compression.SAMPLE_SIZE bytes don't compress to compress_max_ratio
+        of their size.
+
+        :param trash_obj: the copy's name in trash, if not obj
+        :returns: 3-tuple (HTTP status code, response headers,
+                           full response body) like trash_object, or None
+                  if the object should be copied as usual
+        :raises HTTPException: if trash container creation failed
+        """
+        path = '/'.join(('', vrs, acc, con, obj))
+        info = get_object_info(req.environ, self.app, path=path,
+                               swift_source='UN')
+        if info['status'] == 404:
+            return 404, {}, ''
+        elif not http.is_success(info['status']):
+            return None
+        reason = None
+        if 'slo-size' in info['sysmeta'] or 'slo-etag' in info['sysmeta']:
+            reason = 'manifest'
+        elif info['length'] is None or \
+                int(info['length']) < self.compress_min_size:
+            reason = 'small'
+        elif self.compress_skip_content_types is not None and \
+                info['type'] and self.compress_skip_content_types.match(
+                    info['type'].split(';', 1)[0].strip()):
+            reason = 'content_type'
+        if reason is not None:
+            self.logger.increment('compress.skip.%s' % reason)
+            return None
+        if lifetime is None:
+            lifetime = self.trash_lifetime
+        trash_acc = self.trash_account_for(acc)
+        # The body can only be streamed once, so there had better be
+        # somewhere to put it.
+        self.prepare_trash_container(req, vrs, trash_acc, trash_container,
+                                     storage_policy)
+
+        start = time.time()
+        get_resp = wsgi.make_subrequest(
+            req.environ, method='GET',
+            path=swob.wsgi_quote(path) + '?multipart-manifest=get',
+            agent='%(orig)s Undelete', swift_source='UN').get_response(
+                self.app)
+        if not get_resp.is_success:
+            close_if_possible(get_resp.app_iter)
+            return get_resp.status_int, {}, 'Could not read the object\n'
+        reason = None
+        if 'X-Object-Manifest' in get_resp.headers or \
+                'X-Static-Large-Object' in get_resp.headers:
+            reason = 'manifest'
+        elif get_resp.headers.get('Content-Encoding'):
+            reason = 'content_type'
+        elif not get_resp.headers.get('Etag') or \
+                get_resp.headers.get('Content-Length') is None:
+            reason = 'unknown'
+        else:
+            sample, rest = compression.read_sample(get_resp.app_iter)
+            if compression.sample_ratio(sample, self.compress_level) > \
+                    self.compress_max_ratio:
+                reason = 'ratio'
+        if reason is not None:
+            close_if_possible(get_resp.app_iter)
+            self.logger.increment('compress.skip.%s' % reason)
+            return None
+
+        put_headers = metadata_to_repost(get_resp.headers)
+        put_headers.update({
+            'Transfer-Encoding': 'chunked',
+            CODEC_HEADER: compression.CODEC_ZLIB,
+            ORIGINAL_ETAG_HEADER: get_resp.headers['Etag'],
+            ORIGINAL_LENGTH_HEADER: get_resp.headers['Content-Length']})
+        if lifetime:
+            put_headers['X-Delete-After'] = str(lifetime)
+        body = compression.CompressingIter(itertools.chain(sample, rest),
+                                           self.compress_level)
+        put_req = wsgi.make_subrequest(
+            req.environ, method='PUT', path=swob.wsgi_quote('/'.join((
+                '', vrs, trash_acc, trash_container, trash_obj or obj))),
+            headers=put_headers, agent='%(orig)s Undelete', swift_source='UN')
+        put_req.environ['wsgi.input'] = utils.FileLikeIter(body)
+        try:
+            put_resp = put_req.get_response(self.app)
+        finally:
+            close_if_possible(get_resp.app_iter)
+        put_body = put_resp.body
+        self.logger.timing_since('compress.%d.timing' % put_resp.status_int,
+                                 start)
+        if self.admission is not None:
+            self.admission.record(put_resp.status_int, time.time() - start)
+        if put_resp.status_int == 404:
+            # The trash container went away after all; a COPY can take care
+            # of that, where a spent body can't.
+            self.trash_cache.discard(req.environ, trash_acc, trash_container)
+            return None
+        elif put_resp.is_success:
+            self.logger.timing('compress.bytes', body.bytes_out)
+        # callers want the ETag of what was saved, not of its compression
+        headers = swob.HeaderKeyDict(put_resp.headers)
+        headers['Etag'] = get_resp.headers['Etag']
+        return put_resp.status_int, headers, put_body.decode('utf-8',
+                                                             'replace')
+
+    def packed_copy(self, req, vrs, acc, con, obj, trash_container,
+                    storage_policy=None, lifetime=None, trash_obj=None):
+        """
+        Save a small object into trash as part of a pack (see
+        swift_undelete.packing): a GET of the object, whose body then waits
+        in this worker, along with those of other objects deleted meanwhile
+        into the same trash container, until their pack is written.
+
+        The object's size comes from get_object_info (usually a HEAD)
+        first, so that only objects up to pack_threshold are read. Bigger
+        objects, large object manifests and objects whose pack couldn't be
+        written are left to be copied as usual.
+
+        :param trash_obj: the object's name in trash, if not obj
+        :returns: 3-tuple (HTTP status code, response headers,
+                           full response body) like trash_object, or None
+                  if the object should be copied as usual
+        """
+        info = get_object_info(req.environ, self.app,
+                               path='/'.join(('', vrs, acc, con, obj)),
+                               swift_source='UN')
+        if info['status'] == 404:
+            return 404, {}, ''
+        elif not http.is_success(info['status']) or \
+                'slo-size' in info['sysmeta'] or \
+                'slo-etag' in info['sysmeta'] or \
+                info['length'] is None or \
+                int(info['length']) > self.pack_threshold:
+            return None
+        get_resp = wsgi.make_subrequest(
+            req.environ, method='GET', path=swob.wsgi_quote(
+                '/'.join(('', vrs, acc, con, obj))) +
+            '?multipart-manifest=get',
+            agent='%(orig)s Undelete', swift_source='UN').get_response(
+                self.app)
+        if not get_resp.is_success:
+            close_if_possible(get_resp.app_iter)
+            return get_resp.status_int, {}, 'Could not read the object\n'
+        elif 'X-Object-Manifest' in get_resp.headers or \
+                'X-Static-Large-Object' in get_resp.headers or \
+                not get_resp.headers.get('Etag') or \
+                get_resp.content_length is None or \
+                get_resp.content_length > self.pack_threshold:
+            close_if_possible(get_resp.app_iter)
+            return None
+        body = get_resp.body
+        if lifetime is None:
+            lifetime = self.trash_lifetime
+        metadata = metadata_to_repost(get_resp.headers)
+        metadata['Etag'] = get_resp.headers['Etag']
+        key = (vrs, self.trash_account_for(acc), trash_container,
+               storage_policy, lifetime)
+        if not self.packer.add(key, req.environ, trash_obj or obj, body,
+                               utils.Timestamp(time.time()).internal,
+                               metadata):
+            self.logger.increment('pack.fallback')
+            return None
+        return 201, {'Etag': get_resp.headers['Etag']}, ''
+
+    def write_pack(self, key, batch):
+        """
+        Write a batch of small objects out as a pack (see packed_copy),
+        creating its trash container if needed.
+
+        The pack is written with the environment of the request that started
+        the batch, and so as its requester, who has the same access to the
+        trash container as the others.
+
+        :param key: 5-tuple (API version, trash account, trash container,
+                    storage policy, lifetime)
+        :param batch: the packing.Batch to write
+        :returns: True if the pack was written
+        """
+        vrs, trash_acc, trash_container, storage_policy, lifetime = key
+        try:
+            self.prepare_trash_container(swob.Request(batch.env), vrs,
+                                         trash_acc, trash_container,
+                                         storage_policy)
+        except swob.HTTPException as err:
+            self.logger.increment('pack.error')
+            self.logger.error('Could not create %s/%s: %s', trash_acc,
+                              trash_container, err.status)
+            return False
+        body, index_offset = packing.build_pack(batch.members)
+        headers = {'Content-Type': packing.PACK_CONTENT_TYPE,
+                   PACK_INDEX_HEADER: str(index_offset)}
+        if lifetime:
+            headers['X-Delete-After'] = str(lifetime)
+        start = time.time()
+        status, _headers, _body = ObjectContext(self.app).request(
+            batch.env, 'PUT', '/'.join((
+                '', vrs, trash_acc, trash_container,
+                packing.pack_name(batch.started))),
+            headers=headers, body=body)
+        self.logger.timing_since('pack.%d.timing' % status, start)
+        if self.admission is not None:
+            self.admission.record(status, time.time() - start)
+        if not http.is_success(status):
+            if status == 404:
+                self.trash_cache.discard(batch.env, trash_acc,
+                                         trash_container)
+            self.logger.increment('pack.error')
+            return False
+        self.logger.timing('pack.objects', len(batch.members))
+        self.logger.timing('pack.bytes', len(body))
+        return True
+
+    def trash_object(self, req, vrs, acc, obj, trash_container,
+                     storage_policy=None, lifetime=None):
+        """
+        Save a copy of an object into a trash container, creating the
+        trash container if needed.
+
+        :param lifetime: how long, in seconds, to keep the copy; None for
+                         trash_lifetime, 0 for forever
+
+        :returns: 3-tuple (HTTP status code, response headers,
+                           full response body) of the last COPY attempt. A
+                  404 means there was no object to save.
+        :raises HTTPException: if trash container creation failed
+        """
+        trash_acc = self.trash_account_for(acc)
+        destination_acc = None if trash_acc == acc else trash_acc
+        known = self.trash_cache.exists(req.environ, trash_acc,
+                                        trash_container)
+        copy_status, copy_headers, copy_body = self.copy_object(
+            req, trash_container, obj, lifetime, destination_acc)
+        if copy_status == 404:
+            # Either the object or the trash container is missing, and we
+            # can't tell which from the COPY response alone.
+            if known and self.trash_container_exists(
+                    req, vrs, trash_acc, trash_container):
+                # nothing to save; let the DELETE 404 (or clean up an
+                # expired object) on its own
+                return copy_status, copy_headers, copy_body
+            self.logger.increment('trash.miss')
+            self.trash_cache.discard(req.environ, trash_acc, trash_container)
+            self.ensure_trash_container(req, vrs, trash_acc, trash_container,
+                                        storage_policy)
+            copy_status, copy_headers, copy_body = self.copy_object(
+                req, trash_container, obj, lifetime, destination_acc)
+        elif http.is_success(copy_status):
+            self.logger.increment('trash.hit')
+            if not known:
+                self.trash_cache.add(req.environ, trash_acc, trash_container)
+        return copy_status, copy_headers, copy_body
+
+    def record_copied_bytes(self, env, acc, con, obj):
+        """
+        Emit the size of an object that was just copied to trash.
+
+        COPY responses don't carry the object's size, so this only reports
+        it when the object's info is already cached in the request
+        environment; it never makes a request of its own.
+
+        :returns: the size, or None if it isn't known
+        """
+        size = cached_size(env, acc, con, obj)
+        if size is not None:
+            self.logger.timing('copy.bytes', size)
+        return size
+
+    def shadow_copy(self, req, vrs, acc, con, obj, lifetime):
+        """
+        Instead of saving an object before its DELETE, record what saving it
+        would cost: the bytes and backend requests of the copy, and the trash
+        containers it would create.
+
+        Like record_copied_bytes, this only knows the object's size if its
+        info is already cached; the only request it makes of its own is a
+        HEAD of the trash container, unless that is known to exist (or known
+        to have been created, had trash been on).
+
+        :returns: False if the object wouldn't be saved after all (see
+                  trash_location), else True
+        """
+        trash_container, _policy = self.trash_location(
+            req, vrs, acc, con, obj)
+        if trash_container is None:
+            return False
+        if self.uses_buckets(lifetime):
+            trash_container = trash_bucket(trash_container, time.time())
+        size = cached_size(req.environ, acc, con, obj)
+        requests = self.copy_requests(size)
+        containers = 0
+        trash_acc = self.trash_account_for(acc)
+        if not self.trash_cache.exists(req.environ, trash_acc,
+                                       trash_container) and \
+                not self.shadow_containers.exists(req.environ, trash_acc,
+                                                  trash_container):
+            status = ContainerContext(self.app).head(
+                req.environ, vrs, trash_acc, trash_container)
+            if http.is_success(status):
+                self.trash_cache.add(req.environ, trash_acc, trash_container)
+            elif status == 404:
+                containers = 1 if self.trash_naming == NAMING_TIMESTAMPED \
+                    else 2
+                # a COPY that fails for want of the container, the
+                # container PUTs, then the COPY again
+                requests += 1 + containers
+                self.shadow_containers.add(req.environ, trash_acc,
+                                           trash_container)
+        self.shadow.record(size, requests, containers)
+        return True
+
+    def copy_requests(self, size):
+        """
+        Roughly how many backend requests copying an object of a given size
+        (None if unknown) to trash takes, into a trash container that
+        exists.
+        """
+        if self.dedup:
+            # HEAD and (for new content) COPY into the content store, then
+            # the symlink PUT
+            return 3
+        if size is not None and self.pack_threshold and \
+                size <= self.pack_threshold:
+            # the GET; the pack's PUT is shared
+            return 1
+        if size is not None and self.segmented_copy_threshold and \
+                size > self.segmented_copy_threshold:
+            # HEAD, segments listing, a COPY per segment, then the manifest
+            segments = (size + self.segment_size - 1) // self.segment_size
+            return 3 + segments
+        if size is not None and self.compress_trash and \
+                size >= self.compress_min_size:
+            # GET, then PUT, if the body compresses well enough
+            return 2
+        return 1
+
+    def index_deletion(self, vrs, acc, con, obj, trash_container, etag,
+                       size, trash_obj=None, lifetime=None):
+        """
+        Record a trashed object in the deletion index, if there is one.
+
+        :param trash_obj: the object's name in trash, if not its own
+        :param lifetime: seconds the object is kept in trash, 0 for ever;
+                         by default, trash_lifetime
+        """
+        if self.index is None:
+            return
+        self.index.add(vrs, self.trash_account_for(acc), index.make_record(
+            utils.Timestamp(time.time()), '/'.join(('', con, obj)), etag,
+            size, '/'.join(('', trash_container, trash_obj or obj))),
+            lifetime)
+
+    def hide_trash(self, req):
+        """
+        Leave trash containers out of an account listing, unless it is a
+        reseller admin's.
+        """
+        if req.environ.get('reseller_request'):
+            return self.app
+        return TrashListingContext(self.app, self.trash_prefix,
+                                   self.is_trash).handle_listing
+
+    def hide_tombstones(self, req):
+        """
+        Make tombstoned objects look deleted to GET, HEAD and POST requests
+        and leave them out of container listings.
+        """
+        try:
+            vrs, acc, con, obj = req.split_path(3, 4, rest_with_last=True)
+        except ValueError:
+            return self.app
+        if self.is_trash(con):
+            return self.app
+        if obj is None:
+            if req.method != 'GET':
+                return self.app
+            return TombstoneContext(self.app).handle_listing
+        if req.method != 'POST':
+            return TombstoneContext(self.app).handle_object
+
+        # A POST would strip the tombstone's metadata and resurrect the
+        # object, so find out first whether there's a live object there.
+        status, headers, _body = ObjectContext(self.app).request(
+            req.environ, 'HEAD', req.path_info)
+        if TOMBSTONE_HEADER in headers:
+            return swob.HTTPNotFound(request=req)
+        return self.app
+
+    def tombstone_object(self, req, vrs, acc, con, obj, lifetime=None):
+        """
+        Trash an object without copying it: leave a zero-byte pointer in the
+        trash container, then hide the object itself and set it to expire
+        along with the pointer.
+
+        :returns: a response to send to the client, or None to let the
+                  DELETE through
+        """
+        ctx = ObjectContext(self.app)
+        path = '/'.join(('', vrs, acc, con, obj))
+        status, headers, body = ctx.request(req.environ, 'HEAD', path)
+        if status == 404:
+            return None
+        elif not http.is_success(status):
+            return swob.Response(status=status, body=friendly_error(
+                body.decode('utf-8', 'replace')))
+        elif TOMBSTONE_HEADER in headers:
+            # already trashed
+            return swob.HTTPNotFound(request=req)
+
+        trashed_at = utils.Timestamp(time.time())
+        trash_container = self.base_trash_container(con, obj)
+        pointer_headers = {
+            'Content-Type': TOMBSTONE_CONTENT_TYPE,
+            'Content-Length': '0',
+            TOMBSTONE_TARGET_HEADER: path}
+        if lifetime is None:
+            lifetime = self.trash_lifetime
+        if lifetime:
+            pointer_headers['X-Delete-After'] = str(lifetime)
+        status, _headers, body = self.put_pointer(
+            req, vrs, acc, trash_container, obj, pointer_headers,
+            self.trash_storage_policy)
+        if not http.is_success(status):
+            return swob.Response(status=status, body=friendly_error(
+                body.decode('utf-8', 'replace')))
+
+        post_headers = metadata_to_repost(headers)
+        post_headers['Content-Type'] = '%s;%s=%s' % (
+            post_headers.get('Content-Type', ''), TOMBSTONE_PARAM,
+            trashed_at.internal)
+        post_headers[TOMBSTONE_HEADER] = trashed_at.internal
+        delete_at = headers.get('X-Delete-At')
+        if delete_at:
+            post_headers[TOMBSTONE_DELETE_AT_HEADER] = delete_at
+        if lifetime:
+            expires = int(float(trashed_at)) + lifetime
+            if not delete_at or expires < int(delete_at):
+                delete_at = str(expires)
+        if delete_at:
+            post_headers['X-Delete-At'] = delete_at
+        status, _headers, body = ctx.request(
+            req.environ, 'POST', path, headers=post_headers)
+        if not http.is_success(status):
+            return swob.Response(status=status, body=friendly_error(
+                body.decode('utf-8', 'replace')))
+        self.index_deletion(vrs, acc, con, obj, trash_container,
+                            headers.get('Etag'),
+                            int(headers.get('Content-Length', 0)),
+                            lifetime=lifetime or 0)
+        return swob.HTTPNoContent(request=req)
+
+    def put_pointer(self, req, vrs, acc, trash_container, obj, headers,
+                    storage_policy=None, body=None, query_string=None):
+        """
+        PUT a zero-byte object (or one with a short body, like a manifest)
+        into a trash container, creating the trash container if needed.
+
+        :returns: 3-tuple (HTTP status code, response headers,
+                           full response body) of the last PUT attempt
+        :raises HTTPException: if trash container creation failed
+        """
+        ctx = ObjectContext(self.app)
+        trash_acc = self.trash_account_for(acc)
+        path = '/'.join(('', vrs, trash_acc, trash_container, obj))
+        status, resp_headers, resp_body = ctx.request(
+            req.environ, 'PUT', path, headers=headers,
+            query_string=query_string, body=body)
+        if status == 404:
+            self.logger.increment('trash.miss')
+            self.trash_cache.discard(req.environ, trash_acc, trash_container)
+            self.ensure_trash_container(req, vrs, trash_acc, trash_container,
+                                        storage_policy)
+            status, resp_headers, resp_body = ctx.request(
+                req.environ, 'PUT', path, headers=headers,
+                query_string=query_string, body=body)
+        elif http.is_success(status):
+            self.logger.increment('trash.hit')
+        if http.is_success(status):
+            self.trash_cache.add(req.environ, trash_acc, trash_container)
+        return status, resp_headers, resp_body
+
+    def dedup_object(self, req, vrs, acc, con, obj, trash_container,
+                     storage_policy=None, lifetime=None, trash_obj=None):
+        """
+        Save an object into trash by content: its bytes go into the content
+        store, once per ETag, and the trash container gets a symlink to them
+        that carries the object's own metadata.
+
+        :param trash_obj: the symlink's name in trash, if not obj
+        :returns: 3-tuple (HTTP status code, response headers,
+                           full response body) like trash_object, or None
+                  if the object can't be deduplicated (e.g. it is a large
+                  object manifest) and should be copied as usual
+        :raises HTTPException: if container creation failed
+        """
+        info = get_object_info(req.environ, self.app,
+                               path='/'.join(('', vrs, acc, con, obj)),
+                               swift_source='UN')
+        if info['status'] == 404:
+            return 404, {}, ''
+        etag = info.get('etag')
+        if not http.is_success(info['status']) or not etag or \
+                etag.startswith('"'):
+            # Large object manifests have quoted ETags that don't identify
+            # the bytes we'd copy.
+            return None
+        if lifetime is None:
+            lifetime = self.trash_lifetime
+
+        ctx = ObjectContext(self.app)
+        content_path = '/'.join(('', vrs, self.trash_account_for(acc),
+                                 self.content_container, etag))
+        status, headers, body = ctx.request(req.environ, 'HEAD', content_path)
+        if status == 404:
+            self.logger.increment('dedup.miss')
+            status, headers, body = self.trash_object(
+                req, vrs, acc, etag, self.content_container,
+                self.trash_storage_policy, lifetime)
+        else:
+            if http.is_success(status):
+                self.logger.increment('dedup.hit')
+                status, headers, body = self.extend_content_expiry(
+                    req, content_path, headers.get('X-Delete-At'), lifetime)
+            body = body.decode('utf-8', 'replace')
+        if not http.is_success(status):
+            return status, headers, body
+
+        pointer_headers = dict(
+            ('X-Object-Meta-' + key, value)
+            for key, value in info['meta'].items())
+        pointer_headers.update({
+            'Content-Type': info.get('type') or 'application/octet-stream',
+            'Content-Length': '0',
+            'X-Symlink-Target': swob.wsgi_quote(
+                '/'.join((self.content_container, etag)))})
+        if lifetime:
+            pointer_headers['X-Delete-After'] = str(lifetime)
+        status, headers, body = self.put_pointer(
+            req, vrs, acc, trash_container, trash_obj or obj,
+            pointer_headers, storage_policy)
+        # callers want the ETag of what was saved, not of the symlink
+        headers = swob.HeaderKeyDict(headers)
+        headers['Etag'] = etag
+        return status, headers, body.decode('utf-8', 'replace')
+
+    def extend_content_expiry(self, req, content_path, delete_at, lifetime):
+        """
+        Make sure content in the content store lives at least as long as a
+        new pointer to it.
+
+        :param delete_at: the content's current X-Delete-At, if any
+        :returns: 3-tuple (HTTP status code, response headers,
+                           full response body)
+        """
+        if not delete_at:
+            # kept forever already
+            return 200, {}, b''
+        post_headers = {}
+        if lifetime:
+            expires = int(time.time()) + lifetime
+            if expires <= int(delete_at):
+                return 200, {}, b''
+            post_headers['X-Delete-At'] = str(expires)
+        # else a POST without X-Delete-At keeps the content forever
+        return ObjectContext(self.app).request(
+            req.environ, 'POST', content_path, headers=post_headers)
+
+    def restore_tombstone(self, req, vrs, acc, con, obj):
+        """
+        Bring a tombstoned object back by removing the metadata that hides
+        it, then drop its pointer from the trash container.
+
+        :returns: HTTP status code; 404 if there was no tombstone to restore
+        """
+        ctx = ObjectContext(self.app)
+        path = '/'.join(('', vrs, acc, con, obj))
+        status, headers, _body = ctx.request(req.environ, 'HEAD', path)
+        if not http.is_success(status):
+            return status
+        elif TOMBSTONE_HEADER not in headers:
+            return 404
+
+        post_headers = metadata_to_repost(headers)
+        post_headers['Content-Type'] = TOMBSTONE_PARAM_RE.sub(
+            '', post_headers.get('Content-Type', ''))
+        post_headers.pop('X-Delete-At', None)
+        if headers.get(TOMBSTONE_DELETE_AT_HEADER):
+            post_headers['X-Delete-At'] = headers[TOMBSTONE_DELETE_AT_HEADER]
+        status, _headers, _body = ctx.request(
+            req.environ, 'POST', path, headers=post_headers)
+        if not http.is_success(status):
+            return status
+
+        pointer_path = '/'.join(
+            ('', vrs, self.trash_account_for(acc),
+             self.base_trash_container(con, obj), obj))
+        ctx.request(req.environ, 'DELETE', pointer_path)
+        return status
+
+    def handle_restore(self, req):
+        """
+        Handle a ``?undelete`` POST by restoring trashed objects.
+
+        Aimed at an object, this restores that one object. Aimed at a
+        container, it restores every object in the container's trash whose
+        name starts with the ``prefix`` parameter and which was deleted
+        between the ``deleted_after`` and ``deleted_before`` parameters (UNIX
+        timestamps, both optional), streaming progress back as one JSON
+        object per line.
+
+        With timestamped naming, an object trashed more than once comes
+        back as its latest copy (within the time range, for a container),
+        unless a ``version`` parameter (the last part of a copy's name in
+        trash) picks another.
+
+        Every subrequest is made as the requester, so restoring takes read
+        access to the trash as well as write access to the container. With
+        trash_account_prefix set, the requester has no access to the trash
+        account, so subrequests bypass auth instead, once the restore
+        request itself has been authorized (which, without container ACLs,
+        takes the account's owner). Objects that have reappeared since
+        their deletion are left alone.
+        """
+        try:
+            vrs, acc, con, obj = req.split_path(3, 4, rest_with_last=True)
+        except ValueError:
+            return swob.HTTPBadRequest(
+                request=req, content_type='text/plain',
+                body='Restores must be aimed at a container or object\n')
+        if self.is_trash(con):
+            return swob.HTTPBadRequest(
+                request=req, content_type='text/plain',
+                body='Cannot restore into a trash container\n')
+        authorize = req.environ.get('swift.authorize')
+        if authorize:
+            denial = authorize(req)
+            if denial:
+                return denial
+        sub_req = self.trash_request(req)
+
+        if obj is not None:
+            version = req.params.get('version')
+            if version is not None and not TRASH_VERSION_RE.match(version):
+                return swob.HTTPBadRequest(
+                    request=req, content_type='text/plain',
+                    body='version must be as in a trashed copy\'s name\n')
+            try:
+                trash_containers = self.trash_containers(
+                    sub_req, vrs, acc, con, obj=obj)
+                for trash_container in trash_containers:
+                    if version is not None:
+                        trash_obj = '/'.join((obj, version))
+                    else:
+                        trash_obj = self.latest_trash_name(
+                            sub_req, vrs, acc, trash_container, obj)
+                    status = self.restore_object(sub_req, vrs, acc, con,
+                                                 obj, trash_container,
+                                                 trash_obj)
+                    if status != 404:
+                        break
+            except swob.HTTPException as err:
+                return swob.Response(status=err.status, request=req)
+            self.logger.increment('restore.%s' % restore_outcome(status))
+            return swob.Response(status=status, request=req)
+
+        try:
+            window = [utils.Timestamp(req.params[param])
+                      if req.params.get(param) else None
+                      for param in ('deleted_after', 'deleted_before')]
+        except ValueError:
+            return swob.HTTPBadRequest(
+                request=req, content_type='text/plain',
+                body='deleted_after and deleted_before must be timestamps\n')
+        prefix = req.params.get('prefix', '')
+
+        # Fetch the first page of each trash listing now, so that errors
+        # (not least auth errors) get a proper response status.
+        first_pages = []
+        ctx = ContainerContext(self.app)
+        trash_acc = self.trash_account_for(acc)
+        try:
+            trash_containers = self.trash_containers(sub_req, vrs, acc, con,
+                                                     window)
+        except swob.HTTPException as err:
+            return swob.Response(status=err.status, request=req)
+        for trash_container in trash_containers:
+            status, page = ctx.list(sub_req.environ, vrs, trash_acc,
+                                    trash_container, prefix=prefix)
+            if status != 404 and not http.is_success(status):
+                return swob.Response(status=status, request=req)
+            first_pages.append((trash_container, page))
+
+        resp = swob.HTTPOk(request=req, content_type='application/x-ndjson')
+        req.environ['eventlet.minimum_write_chunk_size'] = 0
+        resp.app_iter = self._restore_iter(sub_req, vrs, acc, con, prefix,
+                                           window, first_pages)
+        return resp
+
+    def handle_index_lookup(self, req):
+        """
+        Handle an account GET with ``?undelete-index`` by looking up
+        deletions in the deletion index.
+
+        The ``deleted_after`` and ``deleted_before`` parameters (UNIX
+        timestamps, both optional) give a time range, and ``path``
+        ("/<container>/<object>") an object to look for. Matching records
+        are streamed back as one JSON object per line. Without
+        ``deleted_after``, a lookup by path only covers the last
+        index_lookup_window seconds.
+        """
+        if self.index is None:
+            return self.app
+        try:
+            vrs, acc = req.split_path(2, 2)
+        except ValueError:
+            return self.app
+        authorize = req.environ.get('swift.authorize')
+        if authorize:
+            denial = authorize(req)
+            if denial:
+                return denial
+        try:
+            after, before = [utils.Timestamp(req.params[param])
+                             if req.params.get(param) else None
+                             for param in ('deleted_after', 'deleted_before')]
+        except ValueError:
+            return swob.HTTPBadRequest(
+                request=req, content_type='text/plain',
+                body='deleted_after and deleted_before must be timestamps\n')
+        path = req.params.get('path')
+        if path is not None:
+            path = swob.wsgi_to_str(path)
+
+        records = self.index.lookup(
+            self.trash_request(req).environ, vrs, self.trash_account_for(acc),
+            after=after, before=before, path=path)
+        # Read the first of them now, so that errors (not least auth errors)
+        # get a proper response status.
+        first = next(records, None)
+        if first is None:
+            records = iter([])
+        else:
+            records = itertools.chain([first], records)
+        resp = swob.HTTPOk(request=req, content_type=index.INDEX_CONTENT_TYPE)
+        resp.app_iter = (json.dumps(record).encode('ascii') + b'\n'
+                         for record in records)
+        return resp
+
+    def latest_trash_name(self, req, vrs, acc, trash_container, obj):
+        """
+        The name of an object's latest copy in a trash container. That is
+        the object's own name unless naming is timestamped and there is a
+        timestamped copy, which takes listing the trash container.
+
+        :raises HTTPException: if the trash container couldn't be listed
+        """
+        if self.trash_naming != NAMING_TIMESTAMPED:
+            return obj
+        ctx = ContainerContext(self.app)
+        prefix = obj + '/'
+        marker = ''
+        while True:
+            status, page = ctx.list(
+                req.environ, vrs, self.trash_account_for(acc),
+                trash_container, prefix=prefix, marker=marker)
+            if status == 404:
+                return obj
+            elif not http.is_success(status):
+                raise swob.HTTPException(status=status)
+            for item in page:
+                name = swob.str_to_wsgi(item['name'])
+                # Copies of other objects (e.g. obj/x) can come in between,
+                # but an object's own copies come newest first.
+                if split_trash_name(name)[0] == obj:
+                    return name
+            if len(page) < constraints.CONTAINER_LISTING_LIMIT:
+                # trashed before timestamped naming, if at all
+                return obj
+            marker = swob.str_to_wsgi(page[-1]['name'])
+
+    def _restore_iter(self, req, vrs, acc, con, prefix, window,
+                      first_pages):
+        counts = OrderedDict((
+            ('restored', 0), ('missing', 0), ('conflict', 0)))
+        failed = []
+        # objects whose latest copy is already on its way back, with
+        # timestamped naming
+        seen = set()
+
+        def summary():
+            return OrderedDict((
+                ('Number Restored', counts['restored']),
+                ('Number Not Found', counts['missing']),
+                ('Number Conflicts', counts['conflict']),
+                ('Number Failed', len(failed))))
+
+        def entries():
+            """
+            Page through the trash listings, one page at a time, yielding
+            the entries to restore along with the names of their objects.
+            """
+            ctx = ContainerContext(self.app)
+            for trash_container, page in first_pages:
+                while page:
+                    for item in page:
+                        deleted_at = utils.Timestamp.from_isoformat(
+                            item['last_modified'])
+                        if window[0] is not None and \
+                                deleted_at < window[0] or \
+                                window[1] is not None and \
+                                deleted_at >= window[1]:
+                            continue
+                        obj = swob.str_to_wsgi(item['name'])
+                        if item.get('content_type') == \
+                                packing.PACK_CONTENT_TYPE:
+                            # its objects come after
+                            continue
+                        elif self.trash_naming == NAMING_TIMESTAMPED and \
+                                item.get('content_type') != \
+                                TOMBSTONE_CONTENT_TYPE:
+                            obj = split_trash_name(obj)[0]
+                            if obj in seen:
+                                continue
+                            seen.add(obj)
+                        elif self.packer is not None:
+                            # leave any packed copy be
+                            seen.add(obj)
+                        yield trash_container, item, obj
+                    if len(page) < constraints.CONTAINER_LISTING_LIMIT:
+                        break
+                    status, page = ctx.list(
+                        req.environ, vrs, self.trash_account_for(acc),
+                        trash_container, prefix=prefix,
+                        marker=swob.str_to_wsgi(page[-1]['name']))
+                    if not http.is_success(status):
+                        failed.append([
+                            swob.wsgi_quote('/'.join((trash_container, ''))),
+                            swob.Response(status=status).status])
+                if self.packer is not None:
+                    for entry in packed_entries(trash_container):
+                        yield entry
+
+        def packed_entries(trash_container):
+            """
+            Yield the entries to restore out of a trash container's packs,
+            newest first.
+            """
+            trash_acc = self.trash_account_for(acc)
+            try:
+                for pack in self.list_packs(req, vrs, trash_acc,
+                                            trash_container):
+                    start = packing.pack_start(pack)
+                    if window[1] is not None and start is not None and \
+                            start >= float(window[1]):
+                        continue
+                    pack_path = '/'.join(('', vrs, trash_acc,
+                                          trash_container, pack))
+                    packed = self.read_pack_index(req, pack_path)
+                    for name in sorted(packed, reverse=True,
+                                       key=lambda name: packed[name][2]):
+                        deleted_at = utils.Timestamp(packed[name][2])
+                        if not name.startswith(prefix) or \
+                                window[0] is not None and \
+                                deleted_at < window[0] or \
+                                window[1] is not None and \
+                                deleted_at >= window[1]:
+                            continue
+                        obj = name
+                        if self.trash_naming == NAMING_TIMESTAMPED:
+                            obj = split_trash_name(name)[0]
+                        if obj in seen:
+                            continue
+                        seen.add(obj)
+                        yield trash_container, {
+                            'pack': pack_path, 'entry': packed[name]}, obj
+            except swob.HTTPException as err:
+                failed.append([
+                    swob.wsgi_quote('/'.join((trash_container,
+                                              packing.PACK_PREFIX))),
+                    err.status])
+
+        def restore(entry):
+            trash_container, item, obj = entry
+            if item.get('content_type') == TOMBSTONE_CONTENT_TYPE:
+                status = self.restore_tombstone(req, vrs, acc, con, obj)
+            elif 'pack' in item:
+                status = self.restore_packed(req, vrs, acc, con, obj,
+                                             item['pack'], item['entry'])
+            else:
+                status = self.restore_object(
+                    req, vrs, acc, con, obj, trash_container,
+                    swob.str_to_wsgi(item['name']))
+            return obj, status
+
+        last_yield = time.time()
+        pool = eventlet.GreenPool(self.restore_concurrency)
+        for obj, status in pool.imap(restore, entries()):
+            outcome = restore_outcome(status)
+            self.logger.increment('restore.%s' % outcome)
+            if outcome in counts:
+                counts[outcome] += 1
+            else:
+                failed.append([swob.wsgi_quote('/'.join((con, obj))),
+                               swob.Response(status=status).status])
+            if last_yield + self.yield_frequency < time.time():
+                last_yield = time.time()
+                yield json.dumps(summary()).encode('ascii') + b'\n'
+
+        result = summary()
+        if not failed:
+            result['Response Status'] = swob.HTTPOk().status
+        elif any(status.startswith('5') for _name, status in failed):
+            result['Response Status'] = swob.HTTPBadGateway().status
+        else:
+            result['Response Status'] = swob.HTTPBadRequest().status
+        result['Errors'] = failed
+        yield json.dumps(result).encode('ascii') + b'\n'
+
+    def trash_containers(self, req, vrs, acc, con, window=(None, None),
+                         obj=None):
+        """
+        The trash containers that deleted objects from a container may be
+        in: the plain ones first, then any daily buckets, newest first.
+
+        With trash_shards set, that is every shard (or, given an object,
+        just the object's shard), followed by the unsharded trash container
+        in case the object was deleted before sharding was turned on.
+
+        Finding the buckets takes listing the account: once, or with
+        trash_shards set, once for the shards and once for the unsharded
+        trash container, which don't share a prefix.
+
+        :param window: 2-tuple (deleted after, deleted before) of
+                       utils.Timestamps or Nones; buckets from days wholly
+                       outside it are left out
+        :param obj: an object whose trash containers are all that's wanted
+        :raises HTTPException: if the account couldn't be listed
+        """
+        if obj is not None:
+            groups = [[self.base_trash_container(con, obj)]]
+        else:
+            groups = [self.trash_shards_of(con)]
+        if self.trash_shards > 1:
+            groups.append([self.trash_prefix + con])
+        groups = [[name for trash_container in bases
+                   for name in (trash_container,
+                                trash_container + LARGE_TRASH_SUFFIX)]
+                  for bases in groups]
+        containers = [name for group in groups for name in group]
+        if not self.trash_buckets:
+            return containers
+        buckets = []
+        found = []
+        for group in groups:
+            found.extend(self.list_trash_buckets(req, vrs, acc, group))
+        for bucket, start in found:
+            if window[0] is not None and \
+                    start + BUCKET_SECONDS <= float(window[0]) or \
+                    window[1] is not None and start >= float(window[1]):
+                continue
+            buckets.append((start, bucket))
+        buckets.sort(reverse=True)
+        return containers + [bucket for _start, bucket in buckets]
+
+    def list_trash_buckets(self, req, vrs, acc, trash_containers):
+        """
+        List the daily buckets of some trash containers, with a single pass
+        over the account listing.
+
+        :returns: list of 2-tuples (bucket, UNIX time its day starts)
+        :raises HTTPException: if the account couldn't be listed
+        """
+        trash_containers = set(trash_containers)
+        prefix = os.path.commonprefix(sorted(trash_containers))
+        buckets = []
+        marker = ''
+        while True:
+            query = 'format=json&prefix=%s&marker=%s' % (
+                swob.wsgi_quote(prefix, safe=''),
+                swob.wsgi_quote(marker, safe=''))
+            resp = wsgi.make_subrequest(
+                req.environ, method='GET', path='/%s/%s?%s' % (
+                    swob.wsgi_quote(vrs),
+                    swob.wsgi_quote(self.trash_account_for(acc)), query),
+                agent='%(orig)s Undelete', swift_source='UN').get_response(
+                    self.app)
+            if resp.status_int == 404:
+                return buckets
+            elif not resp.is_success:
+                raise swob.HTTPException(status=resp.status)
+            page = json.loads(resp.body) if resp.body else []
+            for item in page:
+                name = swob.str_to_wsgi(item['name'])
+                base, start = parse_trash_bucket(name)
+                if base in trash_containers and start is not None:
+                    buckets.append((name, start))
+            if len(page) < constraints.CONTAINER_LISTING_LIMIT:
+                return buckets
+            marker = swob.str_to_wsgi(page[-1]['name'])
+
+    def restore_object(self, req, vrs, acc, con, obj, trash_container,
+                       trash_obj=None):
+        """
+        Put an object back from a trash container, unless another object
+        has taken its place in the meantime.
+
+        :param trash_obj: the name of the copy to restore, if not obj
+
+        :returns: HTTP status code; 404 if there was nothing to restore, 409
+                  if the object exists
+        """
+        ctx = ObjectContext(self.app)
+        trash_acc = self.trash_account_for(acc)
+        trash_path = '/'.join(('', vrs, trash_acc, trash_container,
+                               trash_obj or obj))
+        # A deduplicated trash entry is a symlink, which carries the
+        # object's metadata; the COPY below follows it to the content.
+        status, headers, _body = ctx.request(
+            req.environ, 'HEAD', trash_path, query_string='symlink=get')
+        if status == 404 and self.packer is not None:
+            return self.restore_from_packs(req, vrs, acc, con, obj,
+                                           trash_container, trash_obj or obj)
+        elif not http.is_success(status):
+            return status
+        elif headers.get('Content-Type') == TOMBSTONE_CONTENT_TYPE:
+            return self.restore_tombstone(req, vrs, acc, con, obj)
+
+        path = '/'.join(('', vrs, acc, con, obj))
+        status, _headers, _body = ctx.request(req.environ, 'HEAD', path)
+        if http.is_success(status):
+            return 409
+        elif status != 404:
+            return status
+
+        if headers.get(CODEC_HEADER):
+            return self.restore_compressed(req, trash_path, path, headers)
+
+        # Fresh metadata drops the trash copy's X-Delete-At; the rest of the
+        # metadata we send along again.
+        copy_headers = metadata_to_repost(headers)
+        copy_headers['Destination'] = swob.wsgi_quote('/'.join((con, obj)))
+        if trash_acc != acc:
+            copy_headers['Destination-Account'] = swob.wsgi_quote(acc)
+        copy_headers['X-Fresh-Metadata'] = 'true'
+        # A big object saved as segments comes back whole, not as a
+        # manifest pointing into trash.
+        status, _headers, _body = ctx.request(
+            req.environ, 'COPY', trash_path, headers=copy_headers,
+            query_string=None if headers.get(SEGMENTED_HEADER) else
+            'multipart-manifest=get')
+        if http.is_success(status) and headers.get(SEGMENTS_HEADER):
+            # the segments are the restored object's again
+            ctx.request(req.environ, 'DELETE', '/'.join((
+                '', vrs, acc, self.segments_container,
+                headers[SEGMENTS_HEADER])))
+        return status
+
+    def restore_compressed(self, req, trash_path, path, headers):
+        """
+        Put an object back from a compressed trash object: a GET of the
+        trash object, streamed through a decompressor into a PUT of the
+        object, which the object server checks against the original ETag.
+
+        :param headers: the trash object's HEAD response headers
+        :returns: HTTP status code
+        """
+        if headers[CODEC_HEADER] not in compression.CODECS:
+            self.logger.error('Unknown codec %r for %s',
+                              headers[CODEC_HEADER], trash_path)
+            return 500
+        get_resp = wsgi.make_subrequest(
+            req.environ, method='GET', path=swob.wsgi_quote(trash_path),
+            agent='%(orig)s Undelete', swift_source='UN').get_response(
+                self.app)
+        if not get_resp.is_success:
+            close_if_possible(get_resp.app_iter)
+            return get_resp.status_int
+        put_headers = metadata_to_repost(headers)
+        put_headers['Content-Length'] = headers[ORIGINAL_LENGTH_HEADER]
+        put_headers['Etag'] = headers[ORIGINAL_ETAG_HEADER]
+        put_req = wsgi.make_subrequest(
+            req.environ, method='PUT', path=swob.wsgi_quote(path),
+            headers=put_headers, agent='%(orig)s Undelete', swift_source='UN')
+        put_req.environ['wsgi.input'] = utils.FileLikeIter(
+            compression.decompress_iter(get_resp.app_iter,
+                                        headers[CODEC_HEADER]))
+        try:
+            put_resp = put_req.get_response(self.app)
+        finally:
+            close_if_possible(get_resp.app_iter)
+        close_if_possible(put_resp.app_iter)
+        return put_resp.status_int
+
+    def restore_from_packs(self, req, vrs, acc, con, obj, trash_container,
+                           trash_obj):
+        """
+        Put an object back from the newest of a trash container's packs to
+        hold its copy, or, with timestamped naming and no particular copy
+        asked for, its latest copy.
+
+        :param trash_obj: the name of the copy to restore
+        :returns: HTTP status code; 404 if no pack holds the copy, 409 if the
+                  object exists
+        """
+        latest = self.trash_naming == NAMING_TIMESTAMPED and trash_obj == obj
+        trash_acc = self.trash_account_for(acc)
+        try:
+            for pack in self.list_packs(req, vrs, trash_acc,
+                                        trash_container):
+                pack_path = '/'.join(('', vrs, trash_acc, trash_container,
+                                      pack))
+                packed = self.read_pack_index(req, pack_path)
+                names = [name for name in packed if name == trash_obj or
+                         latest and split_trash_name(name)[0] == obj]
+                if names:
+                    name = max(names, key=lambda name: packed[name][2])
+                    return self.restore_packed(req, vrs, acc, con, obj,
+                                               pack_path, packed[name])
+        except swob.HTTPException as err:
+            return err.status_int
+        return 404
+
+    def list_packs(self, req, vrs, trash_acc, trash_container):
+        """
+        Page through the names of a trash container's packs, newest first.
+
+        :raises HTTPException: if the trash container couldn't be listed
+        """
+        ctx = ContainerContext(self.app)
+        marker = ''
+        while True:
+            status, page = ctx.list(req.environ, vrs, trash_acc,
+                                    trash_container,
+                                    prefix=packing.PACK_PREFIX, marker=marker)
+            if status == 404:
+                return
+            elif not http.is_success(status):
+                raise swob.HTTPException(status=status)
+            for item in page:
+                yield swob.str_to_wsgi(item['name'])
+            if len(page) < constraints.CONTAINER_LISTING_LIMIT:
+                return
+            marker = swob.str_to_wsgi(page[-1]['name'])
+
+    def read_pack_index(self, req, pack_path):
+        """
+        Read a pack's index, with a HEAD of the pack to find it and a ranged
+        GET of it.
+
+        :returns: the index, as from packing.parse_index; empty if the pack
+                  is gone (e.g. expired) or isn't a pack after all
+        :raises HTTPException: if the pack couldn't be read
+        """
+        ctx = ObjectContext(self.app)
+        status, headers, _body = ctx.request(req.environ, 'HEAD', pack_path)
+        if http.is_success(status):
+            if not headers.get(PACK_INDEX_HEADER):
+                return {}
+            status, headers, body = ctx.request(
+                req.environ, 'GET', pack_path, headers={
+                    'Range': 'bytes=%s-' % headers[PACK_INDEX_HEADER]})
+        if status == 404:
+            return {}
+        elif not http.is_success(status):
+            raise swob.HTTPException(status=status)
+        return packing.parse_index(body)
+
+    def restore_packed(self, req, vrs, acc, con, obj, pack_path, entry):
+        """
+        Put an object back from a pack, with a ranged GET of the pack and a
+        PUT of the object (which the object server checks against the
+        original ETag), unless another object has taken its place in the
+        meantime.
+
+        :param entry: the object's entry in the pack's index
+        :returns: HTTP status code; 409 if the object exists
+        """
+        offset, length, _timestamp, metadata = entry
+        ctx = ObjectContext(self.app)
+        path = '/'.join(('', vrs, acc, con, obj))
+        status, _headers, _body = ctx.request(req.environ, 'HEAD', path)
+        if http.is_success(status):
+            return 409
+        elif status != 404:
+            return status
+        body = b''
+        if length:
+            status, _headers, body = ctx.request(
+                req.environ, 'GET', pack_path, headers={
+                    'Range': 'bytes=%d-%d' % (offset, offset + length - 1)})
+            if not http.is_success(status):
+                return status
+        status, _headers, _body = ctx.request(
+            req.environ, 'PUT', path, headers=dict(metadata), body=body)
+        return status
+
+    def handle_bulk_delete(self, req):
+        """
+        Handle a bulk middleware ``?bulk-delete`` request.
+
+        The object names are copied to trash concurrently, and only the
+        names whose copy succeeded (or whose object was already gone) are
+        passed on to the bulk middleware, which must therefore sit to the
+        right of this middleware in the pipeline. Names that could not be
+        saved are reported as failures in the bulk response.
+        """
+        try:
+            vrs, acc, _junk = req.split_path(2, 3, True)
+        except ValueError:
+            return self.app
+        try:
+            out_content_type = req.accept.best_match(BULK_RESPONSE_FORMATS)
+        except ValueError:
+            out_content_type = None
+        if not out_content_type:
+            return swob.HTTPNotAcceptable(request=req)
+
+        names = self.get_bulk_delete_names(req)
+        resp = swob.HTTPOk(request=req, content_type=out_content_type)
+        req.environ['eventlet.minimum_write_chunk_size'] = 0
+        resp.app_iter = self._bulk_delete_iter(req, vrs, acc, names,
+                                               out_content_type)
+        return resp
+
+    def get_bulk_delete_names(self, req):
+        """
+        Read the newline-separated, URL-encoded names out of a bulk delete
+        request body.
+
+        :returns: list of (raw line, WSGI-string name) pairs
+        :raises HTTPException: if the request body is unacceptable
+        """
+        if req.content_length is None and \
+                req.headers.get('transfer-encoding', '').lower() != 'chunked':
+            raise swob.HTTPLengthRequired(request=req)
+        incoming_format = req.headers.get('Content-Type')
+        if incoming_format and not incoming_format.startswith('text/plain'):
+            raise swob.HTTPNotAcceptable(request=req)
+
+        max_body = self.max_deletes_per_request * MAX_PATH_LENGTH
+        body = req.body_file.read(max_body + 1)
+        if len(body) > max_body:
+            raise swob.HTTPRequestEntityTooLarge(
+                'Maximum Bulk Delete Body: %d bytes' % max_body)
+        names = []
+        for line in body.split(b'\n'):
+            line = line.strip()
+            if not line:
+                continue
+            names.append((line, swob.wsgi_unquote(swob.bytes_to_wsgi(line))))
+            if len(names) > self.max_deletes_per_request:
+                raise swob.HTTPRequestEntityTooLarge(
+                    'Maximum Bulk Deletes: %d per request' %
+                    self.max_deletes_per_request)
+        return names
+
+    def _bulk_delete_iter(self, req, vrs, acc, names, out_content_type):
+        last_yield = time.time()
+        if out_content_type.endswith('/xml'):
+            to_yield = b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        else:
+            to_yield = b' '
+        separator = b''
+
+        failed = []
+        to_forward = []
+        to_route = []
+        lifetimes = {}
+        for line, name in names:
+            parts = name.lstrip('/').split('/', 1)
+            if len(parts) < 2 or not parts[1]:
+                # a container; nothing to save
+                to_forward.append(line)
+            elif self.is_trash(parts[0]) and self.block_trash_deletes:
+                failed.append([swob.wsgi_quote(name),
+                               swob.HTTPMethodNotAllowed().status])
+            elif not self.should_save_copy(req.environ, *parts):
+                to_forward.append(line)
+            else:
+                if parts[0] not in lifetimes:
+                    lifetimes[parts[0]] = self.trash_lifetime_for(
+                        req.environ, vrs, acc, parts[0])
+                if lifetimes[parts[0]] is None:
+                    to_forward.append(line)
+                else:
+                    to_route.append((line, name, parts[0], parts[1]))
+
+        pool = eventlet.GreenPool(self.bulk_delete_concurrency)
+        now = time.time()
+
+        def route(item):
+            _line, _name, con, obj = item
+            reason = self.skip_reason(req, vrs, acc, con, obj)
+            if reason is not None:
+                if reason != 'missing':
+                    self.logger.increment('trash.skip')
+                    self.logger.increment('trash.skip.%s' % reason)
+                return item, (None, None)
+            if self.trash_account_prefix and self.authorize_delete(
+                    make_object_request(req, vrs, acc, con, obj)) is not None:
+                # bulk will turn this one down itself
+                return item, (None, None)
+            if self.mode == MODE_TOMBSTONE:
+                return item, (self.base_trash_container(con, obj),
+                              self.trash_storage_policy)
+            trash_container, storage_policy = self.trash_location(
+                req, vrs, acc, con, obj)
+            if trash_container is not None and \
+                    self.uses_buckets(lifetimes[con]):
+                trash_container = trash_bucket(trash_container, now)
+            return item, (trash_container, storage_policy)
+
+        by_location = {}
+        for item, location in pool.imap(route, to_route):
+            if location[0] is None:
+                to_forward.append(item[0])
+            else:
+                by_location.setdefault(location, []).append(item)
+
+        # names are authorized one by one (see route) by now
+        trash_req = self.trash_request(req)
+        trash_acc = self.trash_account_for(acc)
+
+        def prepare(location):
+            if self.mode == MODE_SHADOW:
+                # which creates nothing
+                return location, None
+            trash_container, storage_policy = location
+            try:
+                self.prepare_trash_container(trash_req, vrs, trash_acc,
+                                             trash_container, storage_policy)
+            except swob.HTTPException as err:
+                return location, err.status
+            return location, None
+
+        to_save = []
+        for location, error in pool.imap(prepare, by_location):
+            if error:
+                failed.extend([swob.wsgi_quote(name), error]
+                              for _line, name, _con, _obj
+                              in by_location[location])
+            else:
+                to_save.extend((item, location)
+                               for item in by_location[location])
+
+        def save(entry):
+            (line, name, con, obj), location = entry
+            obj_req = make_object_request(trash_req, vrs, acc, con, obj)
+            try:
+                _outcome, resp = self.save_to_trash(
+                    obj_req, vrs, acc, con, obj, lifetimes[con], location)
+            except swob.HTTPException as err:
+                resp = err
+            return line, name, resp
+
+        # objects that saving them deleted already (i.e. tombstoned ones,
+        # and manifests whose segments were kept), leaving nothing for bulk
+        num_deleted = 0
+        for line, name, resp in pool.imap(save, to_save):
+            if resp is None:
+                to_forward.append(line)
+            elif resp.is_success:
+                num_deleted += 1
+            else:
+                failed.append([swob.wsgi_quote(name), resp.status])
+            if last_yield + self.yield_frequency < time.time():
+                last_yield = time.time()
+                yield to_yield
+                to_yield, separator = b' ', b'\r\n\r\n'
+
+        if to_forward or not (failed or num_deleted):
+            resp = self._forward_bulk_delete(req, to_forward)
+            body = b''
+            for chunk in resp.app_iter:
+                body += chunk
+                if last_yield + self.yield_frequency < time.time():
+                    last_yield = time.time()
+                    yield to_yield
+                    to_yield, separator = b' ', b'\r\n\r\n'
+            close_if_possible(resp.app_iter)
+            try:
+                if not resp.is_success:
+                    raise ValueError('bulk delete refused')
+                resp_dict = json.loads(body.strip())
+            except ValueError:
+                resp_dict = {'Response Status': resp.status,
+                             'Response Body': body.strip().decode(
+                                 'utf-8', 'replace')}
+                if resp.is_success:
+                    resp_dict['Response Status'] = \
+                        swob.HTTPServerError().status
+        else:
+            resp_dict = {'Response Status': swob.HTTPOk().status,
+                         'Response Body': ''}
+        resp_dict['Number Deleted'] = \
+            resp_dict.get('Number Deleted', 0) + num_deleted
+        resp_dict.setdefault('Number Not Found', 0)
+        failed.extend(resp_dict.pop('Errors', None) or [])
+        if failed and http.is_success(
+                int(resp_dict['Response Status'].split(' ', 1)[0])):
+            if any(status.startswith('5') for _name, status in failed):
+                resp_dict['Response Status'] = swob.HTTPBadGateway().status
+            else:
+                resp_dict['Response Status'] = swob.HTTPBadRequest().status
+
+        yield separator + get_bulk_response_body(
+            out_content_type, resp_dict, failed)
+
+    def _forward_bulk_delete(self, req, lines):
+        """
+        Pass a bulk delete of the given names on to the rest of the
+        pipeline, asking for a JSON response so it can be merged with our
+        own failures.
+
+        :returns: the swob.Response
+        """
+        body = b'\n'.join(lines)
+        env = req.environ.copy()
+        env['wsgi.input'] = BytesIO(body)
+        env['CONTENT_LENGTH'] = str(len(body))
+        env.pop('HTTP_TRANSFER_ENCODING', None)
+        env['CONTENT_TYPE'] = 'text/plain'
+        env['HTTP_ACCEPT'] = 'application/json'
+        return swob.Request(env).get_response(self.app)
+
+    def prepare_trash_container(self, req, vrs, account, trash_container,
+                                storage_policy=None):
+        """
+        Make sure a trash container exists before copying into it, checking
+        with a single HEAD (and creating it if needed) unless it is already
+        known to exist.
+
+        :raises HTTPException: if the container could not be checked or
+                               created
+        """
+        if self.trash_cache.exists(req.environ, account, trash_container):
+            return
+        status = ContainerContext(self.app).head(
+            req.environ, vrs, account, trash_container)
+        if http.is_success(status):
+            self.trash_cache.add(req.environ, account, trash_container)
+        elif status == 404:
+            self.ensure_trash_container(req, vrs, account, trash_container,
+                                        storage_policy)
+        else:
+            raise swob.HTTPException(status=status)
+
+    def copy_object(self, req, trash_container, obj, lifetime=None,
+                    trash_acc=None):
+        """
+        COPY the object a request is aimed at into a trash container.
+
+        :param trash_acc: the trash container's account; None for the
+                          object's own
+        """
+        if lifetime is None:
+            lifetime = self.trash_lifetime
+        start = time.time()
+        result = CopyContext(self.app).copy(req.environ, trash_container, obj,
+                                            lifetime, trash_acc)
+        self.logger.timing_since('copy.%d.timing' % result[0], start)
+        if self.admission is not None:
+            self.admission.record(result[0], time.time() - start)
+        return result
+
+    def trash_container_exists(self, req, vrs, account, trash_container):
+        status = ContainerContext(self.app).head(
+            req.environ, vrs, account, trash_container)
+        return http.is_success(status)
+
+    def ensure_trash_container(self, req, vrs, account, trash_container,
+                               storage_policy=None):
+        """
+        Create a trash container unless it is already known to exist.
+
+        Creation is single-flight per trash container within this worker:
+        the first caller creates the containers while any concurrent callers
+        wait for it to finish instead of sending their own PUTs.
+
+        :raises HTTPException: if container creation failed
+        """
+        key = (account, trash_container)
+        creation = self._creations.get(key)
+        if creation is None:
+            creation = self._creations[key] = {
+                'lock': semaphore.Semaphore(), 'waiters': 0, 'done': False}
+        creation['waiters'] += 1
+        try:
+            with creation['lock']:
+                if creation['done'] or self.trash_cache.exists(
+                        req.environ, account, trash_container):
+                    return
+                self.create_trash_container(req, vrs, account,
+                                            trash_container, storage_policy)
+                creation['done'] = True
+                self.trash_cache.add(req.environ, account, trash_container)
+        finally:
+            creation['waiters'] -= 1
+            if not creation['waiters']:
+                del self._creations[key]
+
+    def create_trash_container(self, req, vrs, account, trash_container,
+                               storage_policy=None):
+        """
+        Create a trash container and its associated versions container, both
+        in the given storage policy (or the default one). With timestamped
+        naming, copies never overwrite each other, so there is no versions
+        container.
+
+        :raises HTTPException: if container creation failed
+        """
+        versions_container = None
+        if self.trash_naming != NAMING_TIMESTAMPED:
+            versions_container = trash_container + "-versions"
+        start = time.time()
+
+        def create(container, versions):
+            try:
+                ContainerContext(self.app).create(
+                    req.environ, vrs, account, container, versions=versions,
+                    storage_policy=storage_policy)
+            except swob.HTTPException as err:
+                return err
+
+        # Setting X-Versions-Location doesn't require the versions container
+        # to exist yet, so both can be created at once.
+        pile = eventlet.GreenPile(2)
+        if versions_container:
+            pile.spawn(create, versions_container, None)
+        pile.spawn(create, trash_container, versions_container)
+        errors = [err for err in pile if err is not None]
+        if errors:
+            self.logger.timing_since(
+                'create_container.%d.timing' % errors[0].status_int, start)
+            raise errors[0]
+        self.logger.timing_since('create_container.success.timing', start)
+        if self.register_accounts:
+            self.register_account(vrs, account)
+
+    def register_account(self, vrs, account):
+        """
+        Note that an account has trash, for the reaper's sake.
+
+        The registry container is created by the reaper; until it exists
+        (or if the registration fails for any other reason) this quietly
+        does nothing.
+        """
+        path = swob.wsgi_quote('/'.join(
+            ('', vrs, REGISTRY_ACCOUNT, REGISTRY_CONTAINER, account)))
+        resp = wsgi.make_pre_authed_request(
+            {}, method='PUT', path=path, body=b'',
+            headers={'Content-Type': 'application/octet-stream'},
+            agent='Undelete', swift_source='UN').get_response(self.app)
+        close_if_possible(resp.app_iter)
+        if not resp.is_success:
+            self.logger.debug('Could not register %s with the reaper: %s',
+                              account, resp.status)
+
+    def trash_account_for(self, acc):
+        """
+        The account that an account's trash lives in.
+        """
+        if not self.trash_account_prefix:
+            return acc
+        return trash_account(acc, self.trash_account_prefix)
+
+    def trash_request(self, req):
+        """
+        The request to make trash subrequests with.
+
+        Requesters have no access to trash accounts, so with
+        trash_account_prefix set, this is a pre-authorized copy of the request,
+        which must have been authorized by then; otherwise it's the request
+        itself, and trash subrequests are made as the requester.
+        """
+        if not self.trash_account_prefix:
+            return req
+        return swob.Request(wsgi.make_pre_authed_env(req.environ, agent=None))
+
+    def authorize_delete(self, req):
+        """
+        Check an object DELETE with the auth middleware, the way the proxy
+        will, before its object is copied with auth bypassed.
+
+        :returns: None if the DELETE is allowed, else the denial response
+        """
+        authorize = req.environ.get('swift.authorize')
+        if authorize is None:
+            return None
+        container_info = get_container_info(req.environ, self.app,
+                                            swift_source='UN')
+        req.acl = container_info['write_acl']
+        return authorize(req)
+
+    def is_trash(self, con):
+        """
+        Whether a container is a trash container (or the deletion index, the
+        content store, or the segments ledger) or not
+        """
+        return con.startswith(self.trash_prefix) or (
+            self.index is not None and con == self.index.container) or (
+            self.dedup and con == self.content_container) or (
+            self.preserve_segments and con == self.segments_container)
+
+    def should_save_copy(self, env, con, obj):
+        """
+        Determine whether or not we should save a copy of the object prior to
+        its deletion. For example, if the object is one that's in a trash
+        container, don't save a copy lest we get infinite metatrash recursion.
+        """
+        return not self.is_trash(con)
+
+    def configured_enabled(self, acc, con):
+        """
+        Whether the operator's settings alone (enabled_by_default and
+        skip_containers) say deleted objects from a container get saved.
+        """
+        if self.skip_containers is not None and \
+                self.skip_containers.match('/'.join((acc, con))):
+            return False
+        return self.enabled_by_default
+
+    def trash_lifetime_for(self, env, vrs, acc, con):
+        """
+        Decide whether objects deleted from a container get saved, and for
+        how long.
+
+        Operators can turn saving off for containers matching
+        skip_containers, or everywhere (enabled_by_default). With
+        honor_metadata on, account and container metadata override that:
+        X-Account-Meta-Undelete-Enabled and -Lifetime, and their container
+        counterparts, which win over the account's. Those are read through
+        get_account_info and get_container_info, which the proxy needs for
+        the DELETE anyway, so they are usually cached already.
+
+        :returns: trash lifetime in seconds (0 for forever), or None if
+                  deleted objects shouldn't be saved
+        """
+        enabled = self.configured_enabled(acc, con)
+        lifetime = self.trash_lifetime
+        if self.honor_metadata:
+            env = dict(env, PATH_INFO='/'.join(('', vrs, acc, con)))
+            for info in (get_account_info(env, self.app, swift_source='UN'),
+                         get_container_info(env, self.app,
+                                            swift_source='UN')):
+                meta = info.get('meta') or {}
+                if meta.get('undelete-enabled'):
+                    enabled = utils.config_true_value(
+                        meta['undelete-enabled'])
+                try:
+                    lifetime = int(meta['undelete-lifetime'])
+                except (KeyError, ValueError):
+                    pass
+        return lifetime if enabled else None
+
+
+def filter_factory(global_conf, **local_conf):
+    """
+    Returns the WSGI filter for use with paste.deploy.
+
+    Parameters in config:
+
+    # value to prepend to the account in order to compute the trash location
+    trash_prefix = ".trash-"
+    # how long, in seconds, trash objects should live before expiring. Set to 0
+    # to keep trash objects forever.
+    trash_lifetime = 7776000  # 90 days
+    # "copy" saves a copy of each deleted object into trash. "tombstone"
+    # leaves the object where it is instead, hidden from GET, HEAD and
+    # listings and set to expire after trash_lifetime, with a zero-byte
+    # pointer to it in the trash container. "shadow" saves nothing, but
+    # works out what "copy" would cost -- bytes copied (for objects whose
+    # info the proxy has cached), backend requests and trash containers
+    # created -- and sends that to StatsD (shadow.*), logging the totals
+    # every shadow_report_interval seconds per worker.
+    mode = copy
+    shadow_report_interval = 300
+    # storage policy for trash containers; defaults to the cluster's default
+    # policy
+    trash_storage_policy =
+    # objects bigger than this many bytes are either copied to a separate
+    # trash container (<trash_prefix><container>-large) in
+    # large_trash_storage_policy, or not saved at all (large_object_action =
+    # skip). Finding out an object's size costs a HEAD. 0 disables this.
+    large_object_threshold = 0
+    large_object_action = separate
+    large_trash_storage_policy =
+    # how long, in seconds, to remember that a trash container exists, and
+    # how many such containers to remember per worker. Set the TTL to 0 to
+    # disable the cache.
+    trash_cache_ttl = 300
+    trash_cache_size = 10000
+    # share the known trash containers between proxy workers via memcache
+    trash_cache_use_memcache = on
+    # how many objects of a bulk delete to copy to trash at once, and how
+    # many names a bulk delete may carry (match the bulk middleware's
+    # setting). This middleware must be to the left of bulk in the pipeline.
+    bulk_delete_concurrency = 10
+    max_deletes_per_request = 10000
+    # how many objects a restore (a POST with ?undelete to a container)
+    # puts back at once
+    restore_concurrency = 10
+    # keep an index of deletions, by time and by name, in this container of
+    # each account (see swift_undelete.index). Records are written in
+    # batches of index_batch_size, or index_flush_interval seconds after
+    # the first record of a batch, whichever comes first, into index objects
+    # grouped by index_bucket_size seconds of deletion time. Lookups by path
+    # without deleted_after only cover the last index_lookup_window seconds
+    # (0 for all time, which reads every index object of the path's shard).
+    deletion_index = off
+    index_container = .undelete-index
+    index_flush_interval = 60
+    index_batch_size = 1000
+    index_bucket_size = 3600
+    index_lookup_window = 3600
+    # whether deleted objects are saved at all, unless metadata says
+    # otherwise (see below)
+    enabled_by_default = on
+    # comma-separated glob patterns, matched against "<account>/<container>",
+    # of containers whose deleted objects are never saved; e.g.
+    # skip_containers = */scratch*, */ci-*, AUTH_ci/*
+    skip_containers =
+    # let accounts and containers turn saving on or off, and set their own
+    # trash lifetime, with X-(Account|Container)-Meta-Undelete-Enabled and
+    # X-(Account|Container)-Meta-Undelete-Lifetime. Container settings win
+    # over account ones, which win over the two options above.
+    honor_metadata = off
+    # store the content of deleted objects once per ETag, in this container
+    # of each account, and make their trash entries symlinks to it. An
+    # object whose content is already there costs no byte copy. Needs the
+    # symlink middleware (to the right of this one); copy mode only.
+    dedup = off
+    content_container = .undelete-content
+    # list accounts that have trash where the reaper (swift-undelete-reaper)
+    # can find them; costs a request whenever a trash container is created
+    register_accounts = off
+    # create a container's trash containers (in the background) as soon as
+    # the container is created, rather than on the first delete from it.
+    # Use swift-undelete-provision to do the same for existing containers.
+    provision_on_container_put = off
+    # put trash with the default trash_lifetime into daily buckets,
+    # <trash_prefix><container>@<YYYYMMDD>, without per-object expiry. Whole
+    # buckets are dropped trash_lifetime after their day by the reaper
+    # (swift-undelete-reaper), which must be running. Restoring from a
+    # bucket takes listing the account. Copy mode only; not with dedup.
+    trash_buckets = off
+    # don't save objects that aren't worth it: those smaller than
+    # skip_smaller_than bytes (1 skips empty ones, like directory markers),
+    # created less than skip_younger_than seconds before their deletion, or
+    # due to expire (X-Delete-At) within skip_expiring_within seconds
+    # anyway; those whose content type matches skip_content_types, or whose
+    # "<account>/<container>/<object>" matches skip_objects (comma-separated
+    # glob patterns). Size and content type come from the proxy's object
+    # info, as for large_object_threshold; age and expiry cost a HEAD per
+    # delete. 0 or empty disables each rule.
+    skip_smaller_than = 0
+    skip_younger_than = 0
+    skip_expiring_within = 0
+    skip_content_types =
+    skip_objects =
+    # spread each container's trash over this many trash containers,
+    # <trash_prefix><trash_prefix><container>-<n>, by a hash of the object
+    # name, so that trash writes aren't limited by what one container DB can
+    # take.
+    # Container restores read every shard, and the unsharded trash
+    # container too, so this can be turned on with trash already there.
+    # 0 (or 1) for one trash container per container.
+    trash_shards = 0
+    # keep trash (and the deletion index, and the dedup content store) out
+    # of the customer's account, in an account of its own: the customer's
+    # reseller prefix, then this, then the rest of the account name (e.g.
+    # AUTH_test -> AUTH_.trash-test), so that trash never adds containers or
+    # container updates to the customer's account DB. Needs cross-account
+    # COPY (Destination-Account) and account_autocreate in the proxy. Since
+    # requesters have no access to the trash account, deletes are authorized
+    # up front and trash subrequests bypass auth; restores take the
+    # account's owner. Empty to keep trash in the customer's account.
+    trash_account_prefix =
+    # on "DELETE ?multipart-manifest=delete" of a static large object, trash
+    # the manifest and delete only the manifest, keeping its segments
+    # instead of copying them. A copy of the manifest goes into this
+    # container of the account (the segments ledger), from which the reaper
+    # (swift-undelete-reaper), which must be running, deletes the segments
+    # once the trash expires. Restoring the manifest takes it off the
+    # ledger. Copy mode only; not with trash_account_prefix, since a
+    # manifest's segments must be in its own account.
+    preserve_segments = off
+    segments_container = .undelete-segments
+    # save objects bigger than this many bytes as static large objects
+    # instead of with one COPY: segmented_copy_concurrency ranged GETs at a
+    # time are streamed into segments of segmented_copy_segment_size bytes,
+    # in <trash container>-segments, and a manifest for them goes into the
+    # trash container. A delete that fails part-way leaves the segments it
+    # copied for the next attempt to pick up. Restores put the object back
+    # whole. Needs the slo middleware (to the right of this one); copy mode
+    # only. 0 disables this.
+    segmented_copy_threshold = 0
+    segmented_copy_segment_size = 104857600
+    segmented_copy_concurrency = 4
+    # limit trash copies (see swift_undelete.admission): bytes copied per
+    # second and copies at once, in all and per account, shared between
+    # proxy workers via memcache. 0 for no limit. The byte limits cost
+    # knowing each object's size, as for large_object_threshold.
+    admission_bytes_per_second = 0
+    admission_account_bytes_per_second = 0
+    admission_max_copies = 0
+    admission_account_max_copies = 0
+    # stop copying for breaker_cooldown seconds when, over the last
+    # breaker_window seconds (and at least breaker_min_copies copies), a
+    # share of breaker_error_rate of the copies failed (5xx, including
+    # 507), or they took breaker_latency seconds on average. Kept per
+    # worker. 0 disables each trigger.
+    breaker_error_rate = 0
+    breaker_latency = 0
+    breaker_window = 60
+    breaker_min_copies = 20
+    breaker_cooldown = 30
+    # what becomes of a delete over the limits, or while the breaker is
+    # open: "503" or "429" turns it down with a Retry-After; "wait" waits
+    # up to admission_max_wait seconds for the limits to allow it, then
+    # turns it down with a 503; "tombstone" hides the object instead of
+    # copying it, as in tombstone mode (so reads are checked for
+    # tombstones, as in tombstone mode). Copy mode only.
+    admission_action = 503
+    admission_max_wait = 10
+    # "plain" keeps each object's name in trash, with a versions container
+    # behind each trash container for objects trashed more than once (whose
+    # every overwrite costs an extra copy). "timestamped" names each copy
+    # "<object>/<inverted timestamp>" instead, newest first, in a single
+    # trash container. Restores bring back the latest copy, or the one the
+    # "version" parameter names. Trash from before a switch is still
+    # restored.
+    trash_naming = plain
+    # leave trash containers (and the deletion index, content store and
+    # segments ledger) out of account listings, but for reseller admins'
+    hide_trash_containers = off
+    # store trash compressed (zlib), streaming each object through the proxy
+    # with a GET and a PUT instead of a COPY. Objects smaller than
+    # compress_min_size bytes, large object manifests, objects that are
+    # compressed already (by their Content-Encoding, or a content type
+    # matching compress_skip_content_types) and objects whose first 64 KiB
+    # don't compress to compress_max_ratio of their size are copied as
+    # usual. Restores decompress. Trashed objects read directly from the
+    # trash container come back compressed.
+    compress_trash = off
+    compress_level = 6
+    compress_min_size = 4096
+    compress_max_ratio = 0.8
+    compress_skip_content_types = image/*, video/*, audio/*, application/zip,
+        application/gzip, application/x-gzip, application/x-bzip2,
+        application/x-xz, application/zstd, application/x-7z-compressed,
+        application/vnd.rar, application/x-rar-compressed
+    # save objects of at most pack_threshold bytes (0 for none) several at a
+    # time, as a single trash object (a "pack", named .undelete-pack/... in
+    # the trash container) per trash container every pack_window seconds, or
+    # sooner once pack_max_bytes bytes or pack_max_objects objects are
+    # waiting. A DELETE waits for its object's pack to be written (so up to
+    # pack_window seconds longer), and falls back to a COPY if that fails.
+    # Restores read packed objects back out with ranged GETs, as long as
+    # packing is on.
+    pack_threshold = 0
+    pack_window = 1
+    pack_max_bytes = 8388608
+    pack_max_objects = 1000
+
+    Metrics are sent to StatsD, under the "undelete" prefix, according to the
+    usual log_statsd_* settings.
+    """
+    conf = global_conf.copy()
+    conf.update(local_conf)
+
+    trash_prefix = conf.get("trash_prefix", DEFAULT_TRASH_PREFIX)
+    trash_lifetime = int(conf.get("trash_lifetime", DEFAULT_TRASH_LIFETIME))
+    block_trash_deletes = utils.config_true_value(
         conf.get('block_trash_deletes', 'off'))
+    mode = conf.get('mode', MODE_COPY).lower()
+    if mode not in MODES:
+        raise ValueError('mode must be one of %s, not %r' %
+                         (', '.join(MODES), mode))
+    trash_storage_policy = conf.get('trash_storage_policy') or None
+    large_object_threshold = int(conf.get('large_object_threshold', 0))
+    large_object_action = conf.get(
+        'large_object_action', LARGE_OBJECT_SEPARATE).lower()
+    if large_object_action not in LARGE_OBJECT_ACTIONS:
+        raise ValueError('large_object_action must be one of %s, not %r' %
+                         (', '.join(LARGE_OBJECT_ACTIONS),
+                          large_object_action))
+    large_trash_storage_policy = \
+        conf.get('large_trash_storage_policy') or None
+    trash_cache_ttl = int(conf.get('trash_cache_ttl', DEFAULT_TRASH_CACHE_TTL))
+    trash_cache_size = int(conf.get('trash_cache_size',
+                                    DEFAULT_TRASH_CACHE_SIZE))
+    trash_cache_use_memcache = utils.config_true_value(
+        conf.get('trash_cache_use_memcache', 'on'))
+    bulk_delete_concurrency = int(conf.get('bulk_delete_concurrency',
+                                           DEFAULT_BULK_DELETE_CONCURRENCY))
+    max_deletes_per_request = int(conf.get('max_deletes_per_request',
+                                           DEFAULT_MAX_DELETES_PER_REQUEST))
+    restore_concurrency = int(conf.get('restore_concurrency',
+                                       DEFAULT_RESTORE_CONCURRENCY))
+    enabled_by_default = utils.config_true_value(
+        conf.get('enabled_by_default', 'on'))
+    skip_containers = compile_patterns(conf.get('skip_containers', ''))
+    honor_metadata = utils.config_true_value(
+        conf.get('honor_metadata', 'off'))
+    dedup = utils.config_true_value(conf.get('dedup', 'off'))
+    content_container = conf.get('content_container',
+                                 DEFAULT_CONTENT_CONTAINER)
+    register_accounts = utils.config_true_value(
+        conf.get('register_accounts', 'off'))
+    provision_on_container_put = utils.config_true_value(
+        conf.get('provision_on_container_put', 'off'))
+    trash_buckets = utils.config_true_value(conf.get('trash_buckets', 'off'))
+    skip_smaller_than = int(conf.get('skip_smaller_than', 0))
+    skip_younger_than = float(conf.get('skip_younger_than', 0))
+    skip_expiring_within = float(conf.get('skip_expiring_within', 0))
+    skip_content_types = compile_patterns(conf.get('skip_content_types', ''))
+    skip_objects = compile_patterns(conf.get('skip_objects', ''))
+    trash_shards = int(conf.get('trash_shards', 0))
+    trash_account_prefix = conf.get('trash_account_prefix') or None
+    preserve_segments = utils.config_true_value(
+        conf.get('preserve_segments', 'off'))
+    segments_container = conf.get('segments_container',
+                                  DEFAULT_SEGMENTS_CONTAINER)
+    segmented_copy_threshold = int(conf.get('segmented_copy_threshold', 0))
+    segment_size = int(conf.get('segmented_copy_segment_size',
+                                DEFAULT_SEGMENT_SIZE))
+    segmented_copy_concurrency = int(conf.get(
+        'segmented_copy_concurrency', DEFAULT_SEGMENTED_COPY_CONCURRENCY))
+    admission_bytes_per_second = int(conf.get(
+        'admission_bytes_per_second', 0))
+    admission_account_bytes_per_second = int(conf.get(
+        'admission_account_bytes_per_second', 0))
+    admission_max_copies = int(conf.get('admission_max_copies', 0))
+    admission_account_max_copies = int(conf.get(
+        'admission_account_max_copies', 0))
+    breaker_error_rate = float(conf.get('breaker_error_rate', 0))
+    breaker_latency = float(conf.get('breaker_latency', 0))
+    breaker_window = float(conf.get('breaker_window', 60))
+    breaker_min_copies = int(conf.get('breaker_min_copies', 20))
+    breaker_cooldown = float(conf.get('breaker_cooldown', 30))
+    admission_action = conf.get('admission_action', ADMISSION_503).lower()
+    if admission_action not in ADMISSION_ACTIONS:
+        raise ValueError('admission_action must be one of %s, not %r' %
+                         (', '.join(ADMISSION_ACTIONS), admission_action))
+    admission_max_wait = float(conf.get('admission_max_wait',
+                                        DEFAULT_ADMISSION_MAX_WAIT))
+    compress_trash = utils.config_true_value(
+        conf.get('compress_trash', 'off'))
+    compress_level = int(conf.get('compress_level',
+                                  compression.DEFAULT_LEVEL))
+    compress_min_size = int(conf.get('compress_min_size',
+                                     DEFAULT_COMPRESS_MIN_SIZE))
+    compress_max_ratio = float(conf.get('compress_max_ratio',
+                                        DEFAULT_COMPRESS_MAX_RATIO))
+    compress_skip_content_types = compile_patterns(conf.get(
+        'compress_skip_content_types', DEFAULT_COMPRESS_SKIP_CONTENT_TYPES))
+    hide_trash_containers = utils.config_true_value(
+        conf.get('hide_trash_containers', 'off'))
+    shadow_report_interval = float(conf.get(
+        'shadow_report_interval', shadow.DEFAULT_REPORT_INTERVAL))
+    pack_threshold = int(conf.get('pack_threshold', 0))
+    pack_window = float(conf.get('pack_window', packing.DEFAULT_WINDOW))
+    pack_max_bytes = int(conf.get('pack_max_bytes',
+                                  packing.DEFAULT_MAX_BYTES))
+    pack_max_objects = int(conf.get('pack_max_objects',
+                                    packing.DEFAULT_MAX_OBJECTS))
+    trash_naming = conf.get('trash_naming', NAMING_PLAIN).lower()
+    if trash_naming not in NAMINGS:
+        raise ValueError('trash_naming must be one of %s, not %r' %
+                         (', '.join(NAMINGS), trash_naming))
+    if compress_trash and not 0 <= compress_level <= 9:
+        raise ValueError('compress_level must be between 0 and 9')
+    use_admission_control = any((
+        admission_bytes_per_second, admission_account_bytes_per_second,
+        admission_max_copies, admission_account_max_copies,
+        breaker_error_rate, breaker_latency))
+    if segmented_copy_threshold and (
+            segment_size <= 0 or segmented_copy_concurrency <= 0):
+        raise ValueError('segmented_copy_segment_size and '
+                         'segmented_copy_concurrency must be positive')
+    if preserve_segments and (mode != MODE_COPY or trash_account_prefix):
+        raise ValueError('preserve_segments needs mode = copy and no '
+                         'trash_account_prefix')
+    if trash_shards < 0:
+        raise ValueError('trash_shards must not be negative')
+    if pack_threshold < 0:
+        raise ValueError('pack_threshold must not be negative')
+    if pack_threshold and (
+            pack_window <= 0 or pack_max_bytes <= 0 or
+            pack_max_objects <= 0):
+        raise ValueError('pack_window, pack_max_bytes and pack_max_objects '
+                         'must be positive')
+    if pack_threshold and dedup:
+        raise ValueError('pack_threshold needs dedup off')
+    if trash_buckets and (mode == MODE_TOMBSTONE or dedup):
+        raise ValueError('trash_buckets needs mode = copy (or shadow) and '
+                         'dedup off')
+    use_deletion_index = utils.config_true_value(
+        conf.get('deletion_index', 'off'))
+    index_container = conf.get('index_container',
+                               index.DEFAULT_INDEX_CONTAINER)
+    index_flush_interval = float(conf.get('index_flush_interval',
+                                          index.DEFAULT_FLUSH_INTERVAL))
+    index_batch_size = int(conf.get('index_batch_size',
+                                    index.DEFAULT_BATCH_SIZE))
+    index_bucket_size = int(conf.get('index_bucket_size',
+                                     index.DEFAULT_BUCKET_SIZE))
+    index_lookup_window = int(conf.get('index_lookup_window',
+                                       index.DEFAULT_LOOKUP_WINDOW))
+
+    logger = utils.get_logger(conf, log_route='undelete',
+                              statsd_tail_prefix='undelete')
 
     def filt(app):
+        trash_cache = TrashContainerCache(
+            ttl=trash_cache_ttl, size=trash_cache_size,
+            use_memcache=trash_cache_use_memcache)
+        admission_control = None
+        if use_admission_control:
+            admission_control = admission.AdmissionControl(
+                bytes_per_second=admission_bytes_per_second,
+                account_bytes_per_second=admission_account_bytes_per_second,
+                max_copies=admission_max_copies,
+                account_max_copies=admission_account_max_copies,
+                breaker=admission.CircuitBreaker(
+                    error_rate=breaker_error_rate, latency=breaker_latency,
+                    window=breaker_window, min_copies=breaker_min_copies,
+                    cooldown=breaker_cooldown))
+        deletion_index = None
+        if use_deletion_index:
+            deletion_index = index.DeletionIndex(
+                app, container=index_container,
+                flush_interval=index_flush_interval,
+                batch_size=index_batch_size, bucket_size=index_bucket_size,
+                lookup_window=index_lookup_window,
+                lifetime=trash_lifetime, logger=logger)
         return UndeleteMiddleware(app, trash_prefix=trash_prefix,
                                   trash_lifetime=trash_lifetime,
-                                  block_trash_deletes=block_trash_deletes)
+                                  block_trash_deletes=block_trash_deletes,
+                                  trash_cache=trash_cache,
+                                  bulk_delete_concurrency=(
+                                      bulk_delete_concurrency),
+                                  max_deletes_per_request=(
+                                      max_deletes_per_request),
+                                  mode=mode, logger=logger,
+                                  trash_storage_policy=trash_storage_policy,
+                                  large_object_threshold=(
+                                      large_object_threshold),
+                                  large_object_action=large_object_action,
+                                  large_trash_storage_policy=(
+                                      large_trash_storage_policy),
+                                  restore_concurrency=restore_concurrency,
+                                  deletion_index=deletion_index,
+                                  enabled_by_default=enabled_by_default,
+                                  skip_containers=skip_containers,
+                                  honor_metadata=honor_metadata,
+                                  dedup=dedup,
+                                  content_container=content_container,
+                                  register_accounts=register_accounts,
+                                  provision_on_container_put=(
+                                      provision_on_container_put),
+                                  trash_buckets=trash_buckets,
+                                  skip_smaller_than=skip_smaller_than,
+                                  skip_younger_than=skip_younger_than,
+                                  skip_expiring_within=skip_expiring_within,
+                                  skip_content_types=skip_content_types,
+                                  skip_objects=skip_objects,
+                                  trash_shards=trash_shards,
+                                  trash_account_prefix=trash_account_prefix,
+                                  preserve_segments=preserve_segments,
+                                  segments_container=segments_container,
+                                  segmented_copy_threshold=(
+                                      segmented_copy_threshold),
+                                  segment_size=segment_size,
+                                  segmented_copy_concurrency=(
+                                      segmented_copy_concurrency),
+                                  admission_control=admission_control,
+                                  admission_action=admission_action,
+                                  admission_max_wait=admission_max_wait,
+                                  compress_trash=compress_trash,
+                                  compress_level=compress_level,
+                                  compress_min_size=compress_min_size,
+                                  compress_max_ratio=compress_max_ratio,
+                                  compress_skip_content_types=(
+                                      compress_skip_content_types),
+                                  trash_naming=trash_naming,
+                                  hide_trash_containers=(
+                                      hide_trash_containers),
+                                  shadow_report_interval=(
+                                      shadow_report_interval),
+                                  pack_threshold=pack_threshold,
+                                  pack_window=pack_window,
+                                  pack_max_bytes=pack_max_bytes,
+                                  pack_max_objects=pack_max_objects)
     return filt
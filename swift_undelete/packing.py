@@ -0,0 +1,183 @@
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Packs: many small trashed objects saved as one.
+
+Saving a small object to trash costs about as much as saving a big one: a
+write, an inode on every replica, a container row and, later, an expirer
+DELETE. Packing buffers small objects' bodies in the proxy worker and writes
+them out together, one pack per trash container per window, as a single
+trash object:
+
+    <trash container>/.undelete-pack/<inverted window start>-<random>
+
+A pack's body is its objects' bodies, one after the other, followed by its
+index: a JSON list of [name in trash, offset, length, deletion timestamp,
+metadata] entries. Where the index starts is kept in the pack's metadata.
+Packs sort newest first.
+
+Unlike the deletion index, nothing here is lost when a worker dies: a DELETE
+waits until its object's pack is written, and the object is saved some other
+way if that fails.
+"""
+import json
+import time
+import uuid
+
+import eventlet
+from eventlet import event
+from swift.common import utils
+
+PACK_PREFIX = '.undelete-pack/'
+PACK_CONTENT_TYPE = 'application/x-undelete-pack'
+DEFAULT_WINDOW = 1  # seconds
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+DEFAULT_MAX_OBJECTS = 1000
+
+
+def pack_name(timestamp):
+    """
+    Name a new pack whose window started at a given time.
+    """
+    return '%s%s-%s' % (PACK_PREFIX, (~utils.Timestamp(timestamp)).internal,
+                        uuid.uuid4().hex[:8])
+
+
+def pack_start(name):
+    """
+    When a pack's window started.
+
+    :returns: UNIX time, or None if name isn't a pack's
+    """
+    if not name.startswith(PACK_PREFIX):
+        return None
+    try:
+        return float(~utils.Timestamp(
+            name[len(PACK_PREFIX):].rsplit('-', 1)[0]))
+    except ValueError:
+        return None
+
+
+def build_pack(members):
+    """
+    Put a pack together.
+
+    :param members: list of 4-tuples (name in trash, body, deletion
+                    timestamp, metadata dict)
+    :returns: 2-tuple (pack body, offset of the index in it)
+    """
+    chunks = []
+    index = []
+    offset = 0
+    for name, body, timestamp, metadata in members:
+        index.append([name, offset, len(body), timestamp, metadata])
+        chunks.append(body)
+        offset += len(body)
+    chunks.append(json.dumps(index).encode('ascii'))
+    return b''.join(chunks), offset
+
+
+def parse_index(data):
+    """
+    Read a pack's index.
+
+    :returns: dict mapping names in trash to 4-tuples (offset, length,
+              deletion timestamp, metadata dict); an object packed twice is
+              there as its later copy
+    """
+    return dict((name, (offset, length, timestamp, metadata))
+                for name, offset, length, timestamp, metadata
+                in json.loads(data))
+
+
+class Batch(object):
+    """
+    Objects on their way into a single pack.
+
+    :param env: WSGI environment to write the pack with
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self.started = time.time()
+        self.members = []
+        self.size = 0
+        self.written = event.Event()
+
+
+class Packer(object):
+    """
+    Buffers small objects per trash container and writes them out as packs.
+
+    A batch is written window seconds after its first object, or as soon as
+    it holds max_bytes bytes or max_objects objects, whichever comes first.
+
+    :param write: callable(key, batch) that writes a batch out as a pack,
+                  returning True if it was written
+    """
+
+    def __init__(self, write, window=DEFAULT_WINDOW,
+                 max_bytes=DEFAULT_MAX_BYTES, max_objects=DEFAULT_MAX_OBJECTS,
+                 logger=None):
+        self.write = write
+        self.window = window
+        self.max_bytes = max_bytes
+        self.max_objects = max_objects
+        self.logger = logger or utils.get_logger(
+            {}, log_route='undelete', statsd_tail_prefix='undelete')
+        # key -> Batch not yet written
+        self._pending = {}
+
+    def add(self, key, env, name, body, timestamp, metadata):
+        """
+        Add an object to the batch for key, and wait for the batch to be
+        written.
+
+        :param key: what the pack's location depends on, passed on to write
+        :param env: WSGI environment to write the pack with, if the object
+                    starts a batch
+        :returns: True if the object is in a pack that was written, False if
+                  it has to be saved some other way
+        """
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = Batch(env)
+            eventlet.spawn_after(self.window, self.flush, key, batch)
+        batch.members.append((name, body, timestamp, metadata))
+        batch.size += len(body)
+        if batch.size >= self.max_bytes or \
+                len(batch.members) >= self.max_objects:
+            del self._pending[key]
+            eventlet.spawn_n(self._write, key, batch)
+        return batch.written.wait()
+
+    def flush(self, key, batch):
+        """
+        Write a batch out once its window is up, unless it filled up (and
+        so was written) first.
+        """
+        if self._pending.get(key) is batch:
+            del self._pending[key]
+            self._write(key, batch)
+
+    def _write(self, key, batch):
+        try:
+            written = self.write(key, batch)
+        except Exception:
+            # nobody must be left waiting
+            self.logger.exception('Failed to write a pack of %d objects',
+                                  len(batch.members))
+            written = False
+        batch.written.send(written)
@@ -0,0 +1,168 @@
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Create trash containers for existing containers.
+
+With provision_on_container_put on, the middleware creates a container's
+trash containers as soon as the container itself is created. This does the
+same, once, for containers that were there before, so that deleting from
+them never has to create anything either:
+
+    swift-undelete-provision [--conf /etc/swift/proxy-server.conf]
+        [--internal-client-conf /etc/swift/internal-client.conf]
+        [--concurrency 8] AUTH_a [AUTH_b ...]
+
+Trash prefix, storage policies and so on are taken from the undelete filter
+section of the proxy config. Containers whose deleted objects are never
+saved (see skip_containers and enabled_by_default) are left alone, unless
+honor_metadata is on, in which case their metadata might say otherwise.
+"""
+import argparse
+import sys
+from io import BytesIO
+
+import eventlet
+from swift.common import utils
+from swift.common.internal_client import InternalClient, UnexpectedResponse
+
+from swift_undelete.middleware import filter_factory, NAMING_TIMESTAMPED, \
+    REGISTRY_ACCOUNT, REGISTRY_CONTAINER
+
+
+class TrashProvisioner(object):
+    """
+    Creates missing trash containers, account by account.
+
+    :param swift: an InternalClient
+    :param undelete: an UndeleteMiddleware configured like the proxy's,
+                     whose settings say which trash containers are needed
+    """
+
+    def __init__(self, swift, undelete, concurrency=8, logger=None):
+        self.swift = swift
+        self.undelete = undelete
+        self.concurrency = concurrency
+        self.logger = logger or utils.get_logger(
+            {}, log_route='undelete-provision')
+
+    def provision_account(self, account):
+        """
+        Create the trash containers an account's containers are missing (in
+        the account's trash account, if the middleware uses those).
+
+        :returns: 2-tuple (trash containers created, failures)
+        """
+        trash_account = self.undelete.trash_account_for(account)
+        existing = set()
+        wanted = []
+        for container in self.swift.iter_containers(account):
+            name = container['name']
+            if self.undelete.is_trash(name):
+                existing.add(name)
+            elif self.undelete.configured_enabled(account, name) or \
+                    self.undelete.honor_metadata:
+                wanted.extend(
+                    self.undelete.trash_containers_to_provision(name))
+        if trash_account != account:
+            existing = set(
+                container['name'] for container in
+                self.swift.iter_containers(trash_account)
+                if self.undelete.is_trash(container['name']))
+        missing = [(trash_container, storage_policy)
+                   for trash_container, storage_policy in wanted
+                   if trash_container not in existing]
+
+        created = failed = 0
+        pool = eventlet.GreenPool(self.concurrency)
+        for ok in pool.imap(lambda args: self.create(trash_account, *args),
+                            missing):
+            if ok:
+                created += 1
+            else:
+                failed += 1
+        if created and self.undelete.register_accounts:
+            self.register(trash_account)
+        return created, failed
+
+    def create(self, account, trash_container, storage_policy=None):
+        """
+        Create a trash container and its versions container (if trash is
+        named plainly) at once.
+
+        :returns: True on success, False otherwise
+        """
+        headers = {}
+        if storage_policy:
+            headers['X-Storage-Policy'] = storage_policy
+        if self.undelete.trash_naming == NAMING_TIMESTAMPED:
+            return self._put(account, trash_container, headers)
+        versions_container = trash_container + '-versions'
+        pile = eventlet.GreenPile(2)
+        pile.spawn(self._put, account, versions_container, headers)
+        pile.spawn(self._put, account, trash_container,
+                   dict(headers, **{'X-Versions-Location':
+                                    versions_container}))
+        return all(list(pile))
+
+    def _put(self, account, container, headers):
+        try:
+            self.swift.create_container(account, container, headers)
+        except UnexpectedResponse as err:
+            self.logger.error('Could not create %s/%s: %s', account,
+                              container, err)
+            return False
+        return True
+
+    def register(self, account):
+        try:
+            self.swift.upload_object(BytesIO(b''), REGISTRY_ACCOUNT,
+                                     REGISTRY_CONTAINER, account)
+        except UnexpectedResponse as err:
+            self.logger.warning('Could not register %s with the reaper: %s',
+                                account, err)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('--conf', default='/etc/swift/proxy-server.conf',
+                        help='proxy config with the undelete filter section')
+    parser.add_argument('--filter-section', default='filter:undelete')
+    parser.add_argument('--internal-client-conf',
+                        default='/etc/swift/internal-client.conf')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='how many trash containers to create at once')
+    parser.add_argument('accounts', nargs='+', metavar='account')
+    args = parser.parse_args(argv)
+
+    filter_conf = utils.readconf(args.conf, args.filter_section)
+    # the middleware only serves as a description of the config here
+    undelete = filter_factory({}, **filter_conf)(None)
+    swift = InternalClient(args.internal_client_conf,
+                           'Swift Undelete Provisioner', 3)
+    provisioner = TrashProvisioner(swift, undelete, args.concurrency)
+
+    status = 0
+    for account in args.accounts:
+        created, failed = provisioner.provision_account(account)
+        print('%s: created %d trash containers, %d failed' % (
+            account, created, failed))
+        if failed:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,471 @@
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Trash quota reaper.
+
+Trash normally goes away only when it expires. This daemon also caps how much
+of it each account may have: it adds up the bytes in every account's trash
+containers and, in accounts over quota, deletes the oldest trash until they
+aren't. When the cluster is nearly full, a (usually much smaller) emergency
+quota applies instead, so that deleting things doesn't become impossible.
+
+With the middleware's trash_buckets option on, the reaper is also what
+expires trash: it drops each daily trash bucket, along with its versions and
+segments containers, once trash_lifetime has passed since the end of its
+day. Objects are deleted with bulk deletes, so the internal client's pipeline
+should include the bulk middleware; without it they are deleted one at a
+time.
+
+With the middleware's preserve_segments option on, it also deletes the
+segments of trashed static large objects once their trash expires, working
+from each account's segments ledger. It deletes the ledger's copy of each
+manifest with multipart-manifest=delete, so the internal client's pipeline
+must include the slo middleware.
+
+It is configured in the proxy server's config file, and reads trash_prefix,
+trash_lifetime, trash_buckets, preserve_segments, segments_container and
+dedup from the undelete filter section there:
+
+    [undelete-reaper]
+    # section of this file that configures the middleware
+    filter_section = filter:undelete
+    # seconds between passes over all accounts
+    interval = 300
+    # how many trash containers to list, or objects to delete, at once
+    concurrency = 8
+    # how many objects each bulk delete of an expired bucket carries
+    bulk_delete_size = 1000
+    # the most trash, in bytes, an account may keep; 0 for no limit
+    quota_bytes = 0
+    # when the cluster's disks are this full (in percent, as reported by
+    # recon), apply cluster_full_quota_bytes instead; 0 to never check
+    cluster_full_percent = 0
+    cluster_full_quota_bytes = 0
+    recon_timeout = 5
+    # accounts to check besides those the middleware registered (see its
+    # register_accounts option)
+    accounts =
+    # where to remember progress across restarts
+    checkpoint_file = /var/cache/swift/undelete-reaper.json
+    internal_client_conf_path = /etc/swift/internal-client.conf
+    request_tries = 3
+
+and run as
+
+    swift-undelete-reaper /etc/swift/proxy-server.conf [--once]
+
+Only the trash containers themselves (and their versions containers) count
+toward the quota and are reaped. The quota does not cover deduplicated trash:
+with the middleware's dedup option on, trash holds empty pointers into the
+content store, whose content expires only at its own X-Delete-At (which each
+new pointer pushes later), so evicting pointers frees nothing. The reaper
+warns at startup if a quota is set along with dedup.
+
+A pass checkpoints after each account, so a restarted reaper carries on with
+the account it was working on rather than starting over.
+"""
+import heapq
+import itertools
+import json
+import os
+import time
+from io import BytesIO
+
+import eventlet
+from swift.common import utils
+from swift.common.bufferedhttp import http_connect_raw
+from swift.common.daemon import Daemon
+from swift.common.internal_client import InternalClient, UnexpectedResponse
+from swift.common.storage_policy import POLICIES
+
+from swift_undelete.middleware import BUCKET_SECONDS, \
+    DEFAULT_SEGMENTS_CONTAINER, DEFAULT_TRASH_LIFETIME, \
+    DEFAULT_TRASH_PREFIX, parse_trash_bucket, REGISTRY_ACCOUNT, \
+    REGISTRY_CONTAINER, TRASH_SEGMENTS_SUFFIX
+
+
+class TrashReaper(Daemon):
+    """
+    Keeps each account's trash within quota, oldest trash first.
+    """
+
+    def __init__(self, conf, logger=None, swift=None):
+        self.conf = conf
+        self.logger = logger or utils.get_logger(
+            conf, log_route='undelete-reaper')
+        filter_conf = {}
+        if '__file__' in conf:
+            try:
+                filter_conf = utils.readconf(
+                    conf['__file__'],
+                    conf.get('filter_section', 'filter:undelete'))
+            except ValueError:
+                pass
+        self.trash_prefix = filter_conf.get('trash_prefix',
+                                            DEFAULT_TRASH_PREFIX)
+        self.trash_lifetime = int(filter_conf.get('trash_lifetime',
+                                                  DEFAULT_TRASH_LIFETIME))
+        self.trash_buckets = utils.config_true_value(
+            filter_conf.get('trash_buckets', 'off'))
+        self.preserve_segments = utils.config_true_value(
+            filter_conf.get('preserve_segments', 'off'))
+        self.segments_container = filter_conf.get(
+            'segments_container', DEFAULT_SEGMENTS_CONTAINER)
+        self.dedup = utils.config_true_value(
+            filter_conf.get('dedup', 'off'))
+        self.interval = int(conf.get('interval', 300))
+        self.concurrency = int(conf.get('concurrency', 8))
+        self.bulk_delete_size = int(conf.get('bulk_delete_size', 1000))
+        # None means no quota, whereas 0 means no trash at all
+        self.quota_bytes = int(conf.get('quota_bytes', 0)) or None
+        self.cluster_full_percent = float(conf.get('cluster_full_percent', 0))
+        self.cluster_full_quota_bytes = int(
+            conf.get('cluster_full_quota_bytes', 0))
+        self.recon_timeout = float(conf.get('recon_timeout', 5))
+        if self.dedup and (self.quota_bytes is not None or
+                           self.cluster_full_percent):
+            self.logger.warning(
+                'Trash quotas do not cover deduplicated trash; with dedup '
+                'on, accounts may keep more trash than their quota')
+        self.accounts = sorted(
+            a.strip() for a in conf.get('accounts', '').split(',')
+            if a.strip())
+        self.checkpoint_file = conf.get(
+            'checkpoint_file', '/var/cache/swift/undelete-reaper.json')
+        self.swift = swift or InternalClient(
+            conf.get('internal_client_conf_path',
+                     '/etc/swift/internal-client.conf'),
+            'Swift Undelete Reaper', int(conf.get('request_tries', 3)))
+
+    def run_forever(self, *args, **kwargs):
+        while True:
+            begin = time.time()
+            try:
+                self.run_once()
+            except (Exception, eventlet.Timeout):
+                self.logger.exception('Unhandled exception in reaper pass')
+            elapsed = time.time() - begin
+            if elapsed < self.interval:
+                time.sleep(self.interval - elapsed)
+
+    def run_once(self, *args, **kwargs):
+        """
+        Make one pass over every account with trash, carrying on from the
+        checkpoint if the last pass didn't finish.
+        """
+        begin = time.time()
+        try:
+            # the middleware can only register accounts once this exists
+            self.swift.create_container(REGISTRY_ACCOUNT, REGISTRY_CONTAINER)
+        except UnexpectedResponse as err:
+            self.logger.warning('Could not create the account registry: %s',
+                                err)
+
+        quota = self.quota_bytes
+        if self.cluster_full_percent:
+            fullness = self.cluster_fullness()
+            if fullness is not None and \
+                    fullness >= self.cluster_full_percent:
+                self.logger.warning(
+                    'Cluster is %.1f%% full; limiting trash to %d bytes per '
+                    'account', fullness, self.cluster_full_quota_bytes)
+                quota = self.cluster_full_quota_bytes
+
+        checkpoint = self.load_checkpoint()
+        for account in self.iter_accounts(checkpoint['marker']):
+            try:
+                if self.trash_buckets and self.trash_lifetime:
+                    self.sweep_account(account)
+                if self.preserve_segments:
+                    self.expire_segments(account)
+                trash_bytes = self.reap_account(account, quota)
+            except UnexpectedResponse as err:
+                self.logger.error('Could not reap trash in %s: %s',
+                                  account, err)
+                continue
+            checkpoint['accounts'][account] = {
+                'trash_bytes': trash_bytes, 'checked_at': time.time()}
+            checkpoint['marker'] = account
+            self.save_checkpoint(checkpoint)
+        checkpoint['marker'] = ''
+        self.save_checkpoint(checkpoint)
+        self.logger.info('Reaper pass completed in %.02fs',
+                         time.time() - begin)
+
+    def iter_accounts(self, marker=''):
+        """
+        Yield, in order, the accounts after marker that may have trash.
+        """
+        registered = (obj['name'] for obj in self.swift.iter_objects(
+            REGISTRY_ACCOUNT, REGISTRY_CONTAINER, marker=marker))
+        configured = (a for a in self.accounts if a > marker)
+        last = None
+        for account in heapq.merge(registered, configured):
+            if account != last:
+                yield account
+            last = account
+
+    def sweep_account(self, account):
+        """
+        Drop an account's trash buckets whose trash has all expired.
+
+        :returns: number of buckets dropped
+        """
+        cutoff = time.time() - self.trash_lifetime - BUCKET_SECONDS
+        expired = []
+        for container in self.swift.iter_containers(
+                account, prefix=self.trash_prefix):
+            _trash_container, start = parse_trash_bucket(container['name'])
+            if start is not None and start <= cutoff:
+                expired.append(container['name'])
+        return len([bucket for bucket in expired
+                    if self.drop_bucket(account, bucket)])
+
+    def expire_segments(self, account):
+        """
+        Delete the segments of trashed static large objects whose trash has
+        expired, along with their entries in the account's segments ledger.
+
+        :returns: number of ledger entries dealt with
+        """
+        # Entries are named for when they're due, so the due ones come first.
+        end_marker = '%010d' % (int(time.time()) + 1)
+        due = [obj['name'] for obj in self.swift.iter_objects(
+            account, self.segments_container, end_marker=end_marker)]
+
+        def expire(name):
+            try:
+                resp = self.swift.make_request(
+                    'DELETE', self.swift.make_path(
+                        account, self.segments_container, name),
+                    {'Accept': 'application/json'}, (2, 404),
+                    params={'multipart-manifest': 'delete'})
+            except UnexpectedResponse as err:
+                self.logger.warning('Could not expire segments of %s/%s/%s: '
+                                    '%s', account, self.segments_container,
+                                    name, err)
+                return False
+            if resp.status_int == 404:
+                return True
+            try:
+                result = json.loads(resp.body)
+            except ValueError:
+                result = None
+            if not isinstance(result, dict):
+                # Without slo, the DELETE took the manifest alone.
+                self.logger.error('Could not expire segments of %s/%s/%s; '
+                                  'is slo in the internal client pipeline?',
+                                  account, self.segments_container, name)
+                return False
+            elif result.get('Errors'):
+                self.logger.warning('Could not delete %d segments of '
+                                    '%s/%s/%s', len(result['Errors']),
+                                    account, self.segments_container, name)
+                return False
+            self.logger.increment('reaper.segments_expired')
+            return True
+
+        pool = eventlet.GreenPool(self.concurrency)
+        return len([ok for ok in pool.imap(expire, due) if ok])
+
+    def drop_bucket(self, account, bucket):
+        """
+        Delete a trash bucket, its versions container and the segments
+        container of its segmented copies, contents and all.
+
+        :returns: True if all three are gone, False if any is left for the
+                  next pass
+        """
+        # The versions container goes first; deleting from the bucket while
+        # it still has versions would only bring them back.
+        for container in (bucket + '-versions', bucket,
+                          bucket + TRASH_SEGMENTS_SUFFIX):
+            names = (obj['name'] for obj in self.swift.iter_objects(
+                account, container))
+            while True:
+                batch = list(itertools.islice(names, self.bulk_delete_size))
+                if not batch:
+                    break
+                self.bulk_delete(account, container, batch)
+            try:
+                self.swift.delete_container(account, container)
+            except UnexpectedResponse as err:
+                # usually a 409 from a listing that hasn't caught up yet
+                self.logger.warning('Could not drop %s/%s: %s',
+                                    account, container, err)
+                return False
+        self.logger.increment('reaper.swept')
+        return True
+
+    def bulk_delete(self, account, container, names):
+        """
+        Delete objects from a container with a single bulk delete, or one by
+        one if the internal client's pipeline has no bulk middleware.
+        """
+        body = ''.join(utils.quote('/%s/%s' % (container, name)) + '\n'
+                       for name in names).encode('utf-8')
+        try:
+            resp = self.swift.make_request(
+                'POST', self.swift.make_path(account),
+                {'Accept': 'application/json', 'Content-Type': 'text/plain'},
+                (2,), body_file=BytesIO(body), params={'bulk-delete': ''})
+            result = json.loads(resp.body)
+        except (UnexpectedResponse, ValueError):
+            result = None
+        if not isinstance(result, dict) or 'Number Deleted' not in result:
+            # Without bulk, the POST went to the account itself.
+            def delete(name):
+                try:
+                    self.swift.delete_object(account, container, name)
+                except UnexpectedResponse as err:
+                    self.logger.warning('Could not delete %s/%s/%s: %s',
+                                        account, container, name, err)
+
+            pool = eventlet.GreenPool(self.concurrency)
+            for name in names:
+                pool.spawn_n(delete, name)
+            pool.waitall()
+        elif result.get('Errors'):
+            self.logger.warning('Could not delete %d objects from %s/%s',
+                                len(result['Errors']), account, container)
+
+    def reap_account(self, account, quota):
+        """
+        Bring an account's trash within quota, oldest first.
+
+        :param quota: bytes of trash the account may keep, or None for no
+                      limit
+        :returns: bytes of trash the account has left
+        """
+        containers = [c for c in self.swift.iter_containers(
+            account, prefix=self.trash_prefix)]
+        trash_bytes = sum(c['bytes'] for c in containers)
+        if quota is None or trash_bytes <= quota:
+            return trash_bytes
+
+        victims = self.oldest_trash(account, [c['name'] for c in containers],
+                                    trash_bytes - quota)
+        freed = 0
+        pool = eventlet.GreenPool(self.concurrency)
+        for size in pool.imap(lambda victim: self.evict(account, victim),
+                              victims):
+            freed += size
+        self.logger.info('Evicted %d bytes of trash from %s (%d over quota)',
+                         freed, account, trash_bytes - quota)
+        return trash_bytes - freed
+
+    def oldest_trash(self, account, containers, excess):
+        """
+        Find the oldest trash objects that together make up at least excess
+        bytes, listing the trash containers concurrently.
+
+        Only those objects are ever held in memory, not whole listings.
+
+        :returns: list of (timestamp, container, object name, bytes)
+                  tuples
+        """
+        # a heap of the oldest objects seen so far, youngest on top
+        heap = []
+        held = [0]
+
+        def scan(container):
+            for obj in self.swift.iter_objects(account, container):
+                ts = float(utils.Timestamp.from_isoformat(
+                    obj['last_modified']))
+                heapq.heappush(heap, (-ts, container, obj['name'],
+                                      obj['bytes']))
+                held[0] += obj['bytes']
+                while held[0] - heap[0][3] >= excess:
+                    held[0] -= heapq.heappop(heap)[3]
+
+        pool = eventlet.GreenPool(self.concurrency)
+        for container in containers:
+            pool.spawn_n(scan, container)
+        pool.waitall()
+        return sorted((-neg_ts, container, name, size)
+                      for neg_ts, container, name, size in heap)
+
+    def evict(self, account, victim):
+        """
+        Delete one trash object.
+
+        Evicting the newest copy of a versioned trash object brings back the
+        version before it, which is older still, and so normally due for
+        eviction too.
+
+        :returns: bytes freed
+        """
+        _ts, container, name, size = victim
+        try:
+            self.swift.delete_object(account, container, name)
+        except UnexpectedResponse as err:
+            self.logger.warning('Could not evict %s/%s/%s: %s',
+                                account, container, name, err)
+            return 0
+        self.logger.increment('reaper.evicted')
+        return size
+
+    def cluster_fullness(self):
+        """
+        How full, in percent, the cluster's object disks are, according to
+        recon on every object server; None if nobody answered.
+        """
+        hosts = set()
+        for policy in POLICIES:
+            ring = self.swift.get_object_ring(int(policy))
+            hosts.update((dev['ip'], dev['port'])
+                         for dev in ring.devs if dev)
+        size = used = 0
+        pool = eventlet.GreenPool(self.concurrency)
+        for devices in pool.imap(self.disk_usage, sorted(hosts)):
+            for device in devices or []:
+                if device.get('mounted') is True:
+                    size += device['size']
+                    used += device['used']
+        if not size:
+            return None
+        return 100.0 * used / size
+
+    def disk_usage(self, host):
+        ip, port = host
+        try:
+            with eventlet.Timeout(self.recon_timeout):
+                conn = http_connect_raw(ip, port, 'GET', '/recon/diskusage')
+                resp = conn.getresponse()
+                body = resp.read()
+            if resp.status != 200:
+                return None
+            return json.loads(body)
+        except (Exception, eventlet.Timeout) as err:
+            self.logger.warning('Could not get disk usage from %s:%s: %s',
+                                ip, port, err)
+            return None
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_file) as fp:
+                checkpoint = json.load(fp)
+        except (IOError, OSError, ValueError):
+            checkpoint = {}
+        checkpoint.setdefault('marker', '')
+        checkpoint.setdefault('accounts', {})
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint):
+        utils.mkdirs(os.path.dirname(self.checkpoint_file))
+        tmp_file = self.checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as fp:
+            json.dump(checkpoint, fp)
+        os.rename(tmp_file, self.checkpoint_file)
@@ -0,0 +1,87 @@
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cost estimates for shadow mode.
+
+In shadow mode nothing is saved to trash. Instead, for each DELETE whose
+object would have been saved, the middleware works out what saving it would
+have cost -- bytes copied, backend requests and trash containers created --
+and records that here. Each estimate goes to StatsD as it is made, and
+running totals are logged every report_interval seconds, per worker.
+"""
+import time
+
+DEFAULT_REPORT_INTERVAL = 300  # seconds
+FIELDS = ('copies', 'bytes', 'unknown_size', 'requests', 'containers')
+
+
+class ShadowStats(object):
+    """
+    Running totals of what trash would have cost, since this worker started
+    and since its last report.
+    """
+
+    def __init__(self, logger, report_interval=DEFAULT_REPORT_INTERVAL):
+        self.logger = logger
+        self.report_interval = report_interval
+        self.totals = dict.fromkeys(FIELDS, 0)
+        self.interval = dict.fromkeys(FIELDS, 0)
+        self.last_report = time.time()
+
+    def record(self, size, requests, containers):
+        """
+        Record what saving one object would have cost, reporting the totals
+        if it's time to.
+
+        :param size: bytes the copy would have moved, or None if unknown
+        :param requests: backend requests the copy would have taken
+        :param containers: trash containers it would have created
+        """
+        estimate = {'copies': 1, 'bytes': size or 0,
+                    'unknown_size': int(size is None),
+                    'requests': requests, 'containers': containers}
+        for field, value in estimate.items():
+            self.totals[field] += value
+            self.interval[field] += value
+        self.logger.increment('shadow.copies')
+        if size is None:
+            self.logger.increment('shadow.unknown_size')
+        else:
+            self.logger.timing('shadow.copy.bytes', size)
+        self.logger.update_stats('shadow.requests', requests)
+        if containers:
+            self.logger.update_stats('shadow.containers_created', containers)
+        now = time.time()
+        if now - self.last_report >= self.report_interval:
+            self.report(now)
+
+    def report(self, now=None):
+        """
+        Log the totals, and start a new interval.
+        """
+        if now is None:
+            now = time.time()
+        self.logger.info('Trash would have cost, over the last %ds: %s; '
+                         'since startup: %s', now - self.last_report,
+                         format_counts(self.interval),
+                         format_counts(self.totals))
+        self.interval = dict.fromkeys(FIELDS, 0)
+        self.last_report = now
+
+
+def format_counts(counts):
+    return ('%(copies)d copies of %(bytes)d bytes (and %(unknown_size)d of '
+            'unknown size), %(requests)d backend requests, %(containers)d '
+            'trash containers created' % counts)
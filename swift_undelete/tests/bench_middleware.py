@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Micro-benchmarks for the undelete middleware.
+
+Each scenario drives the middleware with the FakeApp from the unit tests
+standing in for the rest of the proxy, and reports the time per request
+with and without the middleware in front of it (the difference being the
+middleware's own overhead), throughput, and peak memory allocated while
+handling a single request.
+
+Run it as a script:
+
+    python swift_undelete/tests/bench_middleware.py [-n 20000]
+        [-s passthrough -s trash-hit ...] [--profile trash-miss]
+"""
+
+import argparse
+import cProfile
+import pstats
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # python 2
+
+from swift.common import swob
+
+from swift_undelete import middleware as md
+from test_middleware import FakeApp
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Scenario(object):
+    """
+    A kind of request to benchmark, along with the backend responses it
+    needs.
+    """
+
+    def __init__(self, name, method, path, responses, setup=None,
+                 unique_path=False):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.responses = responses
+        self.setup = setup
+        # use a fresh container on every iteration so that trash containers
+        # are never known to exist
+        self.unique_path = unique_path
+
+    def environ(self, i):
+        path = self.path % i if self.unique_path else self.path
+        return swob.Request.blank(path, method=self.method).environ
+
+
+def _known_trash_container(undelete):
+    undelete.trash_cache.add({}, 'a', '.trash-c')
+
+
+SCENARIOS = [
+    Scenario('passthrough', 'GET', '/v1/a/c/o',
+             [{'status': '200 OK', 'body_iter': [b'x' * 64]}]),
+    Scenario('trash-hit', 'DELETE', '/v1/a/c/o',
+             [{'status': '201 Created'}, {'status': '204 No Content'}],
+             setup=_known_trash_container),
+    Scenario('trash-miss', 'DELETE', '/v1/a/c%d/o',
+             [{'status': '404 Not Found'}, {'status': '201 Created'},
+              {'status': '201 Created'}, {'status': '201 Created'},
+              {'status': '204 No Content'}],
+             unique_path=True),
+    Scenario('error', 'DELETE', '/v1/a/c/o',
+             [{'status': '503 Service Unavailable'}]),
+]
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def run_once(app, fake_app, scenario, i):
+    fake_app.responses = list(scenario.responses)
+    del fake_app._calls[:]
+    del fake_app.bodies[:]
+    resp_iter = app(scenario.environ(i), _start_response)
+    for _chunk in resp_iter:
+        pass
+    md.close_if_possible(resp_iter)
+
+
+def make_apps(scenario):
+    fake_app = FakeApp()
+    undelete = md.filter_factory({})(fake_app)
+    if scenario.setup:
+        scenario.setup(undelete)
+    return fake_app, undelete
+
+
+def time_requests(app, fake_app, scenario, iterations):
+    start = timer()
+    for i in range(iterations):
+        run_once(app, fake_app, scenario, i)
+    return timer() - start
+
+
+def peak_bytes(app, fake_app, scenario, samples=20):
+    """
+    Largest amount of memory allocated at once while handling one request,
+    or None if tracemalloc isn't available.
+    """
+    if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+        return None
+    peaks = []
+    tracemalloc.start()
+    try:
+        for i in range(samples):
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            run_once(app, fake_app, scenario, i)
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return max(peaks)
+
+
+def bench(scenario, iterations):
+    fake_app, undelete = make_apps(scenario)
+    # warm up
+    time_requests(undelete, fake_app, scenario, min(iterations, 100))
+
+    bare = time_requests(fake_app, fake_app, scenario, iterations)
+    wrapped = time_requests(undelete, fake_app, scenario, iterations)
+    return {
+        'scenario': scenario.name,
+        'bare_us': bare / iterations * 1e6,
+        'wrapped_us': wrapped / iterations * 1e6,
+        'overhead_us': (wrapped - bare) / iterations * 1e6,
+        'req_per_s': iterations / wrapped,
+        'bare_peak': peak_bytes(fake_app, fake_app, scenario),
+        'wrapped_peak': peak_bytes(undelete, fake_app, scenario),
+    }
+
+
+def profile(scenario, iterations, out=sys.stdout):
+    fake_app, undelete = make_apps(scenario)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    time_requests(undelete, fake_app, scenario, iterations)
+    profiler.disable()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(
+        25)
+
+
+def format_results(results):
+    def kib(value):
+        return '-' if value is None else '%.1f' % (value / 1024.0)
+
+    lines = ['%-12s %10s %10s %10s %10s %10s %10s' % (
+        'scenario', 'bare us', 'mw us', 'overhead', 'req/s',
+        'bare KiB', 'mw KiB')]
+    for r in results:
+        lines.append('%-12s %10.1f %10.1f %10.1f %10.0f %10s %10s' % (
+            r['scenario'], r['bare_us'], r['wrapped_us'], r['overhead_us'],
+            r['req_per_s'], kib(r['bare_peak']), kib(r['wrapped_peak'])))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    names = [s.name for s in SCENARIOS]
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('-n', '--iterations', type=int, default=20000)
+    parser.add_argument('-s', '--scenario', action='append', choices=names,
+                        help='scenario to run (default: all)')
+    parser.add_argument('--profile', choices=names,
+                        help='run one scenario under cProfile and print '
+                        'the top functions instead')
+    args = parser.parse_args(argv)
+
+    by_name = dict((s.name, s) for s in SCENARIOS)
+    if args.profile:
+        profile(by_name[args.profile], args.iterations)
+        return
+    results = [bench(by_name[name], args.iterations)
+               for name in (args.scenario or names)]
+    print(format_results(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+import mock
+from swift.common.memcached import MemcacheConnectionError
+from swift_undelete import admission
+
+
+class FakeClock(object):
+    def __init__(self, now=1500000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class AdmissionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patchers = [mock.patch('time.time', self.clock.time),
+                    mock.patch('eventlet.sleep', self.clock.sleep)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class TestLocalCounters(AdmissionTestCase):
+    def test_incr_decr(self):
+        counters = admission.LocalCounters()
+        self.assertEqual(counters.incr('k', time=10), 1)
+        self.assertEqual(counters.incr('k', delta=5), 6)
+        self.assertEqual(counters.decr('k', delta=10), 0)
+        counters.set('k', '7', serialize=False)
+        self.assertEqual(counters.incr('k'), 8)
+
+    def test_expiry(self):
+        counters = admission.LocalCounters()
+        counters.incr('k', time=10)
+        self.clock.now += 5
+        # increments don't push the expiry back
+        self.assertEqual(counters.incr('k', time=10), 2)
+        self.clock.now += 5
+        self.assertIsNone(counters.get('k'))
+        self.assertEqual(counters.incr('k', time=10), 1)
+
+
+class TestAdmissionControl(AdmissionTestCase):
+    def test_no_limits(self):
+        control = admission.AdmissionControl()
+        self.assertFalse(control.limits_bytes)
+        slot = control.acquire({}, 'AUTH_a', 10 ** 12)
+        self.assertEqual(slot.keys, [])
+
+    def test_max_copies(self):
+        control = admission.AdmissionControl(max_copies=2,
+                                             account_max_copies=1)
+        first = control.acquire({}, 'AUTH_a')
+        self.assertEqual(first.keys, ['undelete/admission/copies',
+                                      'undelete/admission/copies/AUTH_a'])
+        with self.assertRaises(admission.Overloaded) as caught:
+            control.acquire({}, 'AUTH_a')
+        self.assertEqual(caught.exception.reason, 'copies')
+        self.assertEqual(caught.exception.retry_after, 1)
+        second = control.acquire({}, 'AUTH_b')
+        # over the global limit, even though AUTH_c has copies to spare
+        self.assertRaises(admission.Overloaded, control.acquire, {},
+                          'AUTH_c')
+        # a refused copy gives back what it took
+        self.assertEqual(control.local.get('undelete/admission/copies'), 2)
+        first.release()
+        second.release()
+        control.acquire({}, 'AUTH_a')
+
+    def test_wait_for_slot(self):
+        control = admission.AdmissionControl(max_copies=1)
+        slot = control.acquire({}, 'AUTH_a')
+        start = self.clock.now
+        with mock.patch('eventlet.sleep') as sleep:
+            sleep.side_effect = lambda s: (
+                self.clock.sleep(s), slot.release())
+            control.acquire({}, 'AUTH_a', max_wait=5)
+        self.assertAlmostEqual(self.clock.now - start,
+                               admission.SLOT_POLL_INTERVAL, places=5)
+
+    def test_bytes_per_second(self):
+        control = admission.AdmissionControl(bytes_per_second=1000)
+        self.assertTrue(control.limits_bytes)
+        start = self.clock.now
+        control.acquire({}, 'AUTH_a', 1000)
+        self.assertRaises(admission.Overloaded, control.acquire, {},
+                          'AUTH_a', 1000)
+        control.acquire({}, 'AUTH_a', 1000, max_wait=5)
+        # the copy waited for the first one's second to pass
+        self.assertAlmostEqual(self.clock.now - start, 1, places=5)
+        with self.assertRaises(admission.Overloaded) as caught:
+            control.acquire({}, 'AUTH_a', 3000, max_wait=0.5)
+        self.assertEqual(caught.exception.reason, 'bytes')
+        # turned down, it took nothing
+        control.acquire({}, 'AUTH_b', 500, max_wait=1.5)
+
+    def test_account_bytes_per_second(self):
+        control = admission.AdmissionControl(account_bytes_per_second=100)
+        control.acquire({}, 'AUTH_a', 1000)
+        self.assertRaises(admission.Overloaded, control.acquire, {},
+                          'AUTH_a', 100)
+        control.acquire({}, 'AUTH_b', 100)
+
+    def test_memcache_shared_and_optional(self):
+        memcache = mock.MagicMock()
+        memcache.incr.return_value = 5
+        control = admission.AdmissionControl(max_copies=4)
+        env = {'swift.cache': memcache}
+        self.assertRaises(admission.Overloaded, control.acquire, env,
+                          'AUTH_a')
+        memcache.incr.assert_called_with('undelete/admission/copies',
+                                         time=admission.SLOT_TTL)
+        memcache.decr.assert_called_with('undelete/admission/copies',
+                                         time=admission.SLOT_TTL)
+
+        # without memcache there's no telling; let the copy through
+        memcache.incr.side_effect = MemcacheConnectionError
+        control.acquire(env, 'AUTH_a')
+
+    def test_breaker_turns_copies_away(self):
+        breaker = admission.CircuitBreaker(error_rate=0.5, min_copies=2,
+                                           cooldown=30)
+        control = admission.AdmissionControl(breaker=breaker)
+        control.record(201, 0.1)
+        control.record(507, 0.1)
+        with self.assertRaises(admission.Overloaded) as caught:
+            control.acquire({}, 'AUTH_a')
+        self.assertEqual(caught.exception.reason, 'breaker')
+        self.assertEqual(caught.exception.retry_after, 30)
+
+
+class TestCircuitBreaker(AdmissionTestCase):
+    def test_disabled(self):
+        breaker = admission.CircuitBreaker()
+        for _ in range(100):
+            breaker.record(True, 100)
+        self.assertEqual(breaker.allow(), 0)
+
+    def test_error_rate(self):
+        breaker = admission.CircuitBreaker(error_rate=0.5, min_copies=4,
+                                           window=60, cooldown=30)
+        for failed in (True, True, True):
+            breaker.record(failed, 0.1)
+        # too few copies to tell
+        self.assertEqual(breaker.allow(), 0)
+        breaker.record(False, 0.1)
+        self.assertEqual(breaker.allow(), 30)
+
+        # half-open: one copy gets through, the rest wait for it
+        self.clock.now += 30
+        self.assertEqual(breaker.allow(), 0)
+        self.assertEqual(breaker.allow(), 30)
+        breaker.record(True, 0.1)
+        self.assertEqual(breaker.allow(), 30)
+        self.clock.now += 30
+        self.assertEqual(breaker.allow(), 0)
+        breaker.record(False, 0.1)
+        self.assertIsNone(breaker.open_until)
+        self.assertEqual(breaker.allow(), 0)
+
+    def test_lost_probe(self):
+        breaker = admission.CircuitBreaker(error_rate=0.5, min_copies=1,
+                                           cooldown=30)
+        breaker.record(True, 0.1)
+        self.clock.now += 30
+        self.assertEqual(breaker.allow(), 0)
+        self.clock.now += 30
+        self.assertEqual(breaker.allow(), 0)
+
+    def test_latency_over_window(self):
+        breaker = admission.CircuitBreaker(latency=2, min_copies=2,
+                                           window=60, cooldown=30)
+        breaker.record(False, 10)
+        self.clock.now += 61
+        # the slow copy is out of the window by now
+        breaker.record(False, 1)
+        breaker.record(False, 1)
+        self.assertEqual(breaker.allow(), 0)
+        breaker.record(False, 5)
+        self.assertEqual(breaker.allow(), 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import unittest
+import zlib
+
+import mock
+from swift_undelete import compression
+
+
+class TestCompression(unittest.TestCase):
+    def test_round_trip(self):
+        chunks = [b'line %d\n' % n for n in range(1000)]
+        compressed = compression.CompressingIter(chunks)
+        stored = list(compressed)
+        self.assertEqual(compressed.bytes_in, len(b''.join(chunks)))
+        self.assertEqual(compressed.bytes_out, len(b''.join(stored)))
+        self.assertLess(compressed.bytes_out, compressed.bytes_in)
+        self.assertEqual(b''.join(compression.decompress_iter(stored)),
+                         b''.join(chunks))
+
+    def test_empty(self):
+        stored = list(compression.CompressingIter([]))
+        self.assertEqual(b''.join(compression.decompress_iter(stored)), b'')
+
+    def test_close(self):
+        chunks = mock.MagicMock()
+        compression.CompressingIter(chunks).close()
+        chunks.close.assert_called_once_with()
+
+    def test_decompressed_chunks_are_bounded(self):
+        stored = [zlib.compress(b'\0' * (10 * compression.CHUNK_SIZE))]
+        out = list(compression.decompress_iter(stored))
+        self.assertEqual(len(out), 10)
+        self.assertEqual(max(len(chunk) for chunk in out),
+                         compression.CHUNK_SIZE)
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, compression.decompress_iter, [],
+                          'lzma')
+
+    def test_corrupt(self):
+        out = compression.decompress_iter([b'not zlib'])
+        self.assertRaises(zlib.error, list, out)
+
+    def test_sample(self):
+        sample, rest = compression.read_sample(
+            iter([b'a' * 10, b'b' * 10, b'c' * 10]), size=15)
+        self.assertEqual(sample, [b'a' * 10, b'b' * 10])
+        self.assertEqual(list(rest), [b'c' * 10])
+
+        self.assertLess(compression.sample_ratio([b'a' * 4096]), 0.1)
+        self.assertGreater(compression.sample_ratio([os.urandom(4096)]), 1)
+        self.assertEqual(compression.sample_ratio([]), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import unittest
+
+import mock
+from swift.common import swob, utils
+from swift_undelete import index
+
+from test_middleware import FakeApp, FakeLogger
+
+
+def record(deleted_at, path):
+    return index.make_record(utils.Timestamp(deleted_at), path, 'abc', 3,
+                             '/.trash-' + path.lstrip('/'))
+
+
+def ndjson(*records):
+    return {'status': '200 OK',
+            'body_iter': [b''.join(json.dumps(r).encode('ascii') + b'\n'
+                                   for r in records)]}
+
+
+def listing(*names):
+    return {'status': '200 OK',
+            'headers': [('Content-Type', 'application/json')],
+            'body_iter': [json.dumps([{'name': n} for n in names]).encode(
+                'ascii')]}
+
+
+class TestHelpers(unittest.TestCase):
+    def test_make_record(self):
+        self.assertEqual(
+            index.make_record(utils.Timestamp(1500000000), '/c/o\xc3\xa9',
+                              '"abc"', 12, '/.trash-c/o\xc3\xa9'),
+            {'deleted_at': '1500000000.00000', 'path': u'/c/o\xe9',
+             'etag': 'abc', 'bytes': 12, 'trash': u'/.trash-c/o\xe9'})
+
+    def test_time_bucket(self):
+        self.assertEqual(index.time_bucket('1500000000.12345', 3600),
+                         '1499997600')
+        self.assertEqual(index.time_bucket(3599, 3600), '0000000000')
+
+
+class TestDeletionIndex(unittest.TestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.logger = FakeLogger()
+        self.index = index.DeletionIndex(self.app, batch_size=3,
+                                         lifetime=86400, logger=self.logger)
+
+    def test_add_schedules_flush(self):
+        with mock.patch('eventlet.spawn_after') as spawn_after, \
+                mock.patch('eventlet.spawn_n') as spawn_n:
+            self.index.add('v1', 'a', record(1500000000, '/c/o1'))
+            self.index.add('v1', 'a', record(1500000001, '/c/o2'))
+            self.assertEqual(spawn_after.call_args_list, [
+                mock.call(60, self.index.flush, 'v1', 'a')])
+            self.assertFalse(spawn_n.called)
+
+            self.index.add('v1', 'a', record(1500000002, '/c/o3'))
+            self.assertEqual(spawn_n.call_args_list, [
+                mock.call(self.index.flush, 'v1', 'a')])
+        self.assertEqual(self.app.calls, [])
+
+    def test_flush(self):
+        self.app.responses = [{'status': '201 Created'}]
+        with mock.patch('eventlet.spawn_after'):
+            self.index.add('v1', 'a', record(1500000000, '/c/o1'))
+            self.index.add('v1', 'a', record(1500003600, '/c/o2'))
+        self.index.flush('v1', 'a')
+
+        paths = [path for method, path in self.app.calls]
+        self.assertEqual(
+            [path.rsplit('/', 1)[0] for path in paths],
+            sorted(set('/v1/a/.undelete-index/name/' + index.name_shard(p)
+                       for p in ('/c/o1', '/c/o2'))) +
+            ['/v1/a/.undelete-index/time/1499997600',
+             '/v1/a/.undelete-index/time/1500001200'])
+        # one batch, one suffix
+        self.assertEqual(len(set(path.rsplit('/', 1)[1] for path in paths)),
+                         1)
+        self.assertEqual(self.app.call_headers[0]['X-Delete-After'], '86400')
+        self.assertEqual(self.app.call_headers[0]['Content-Type'],
+                         'application/x-ndjson')
+        self.assertEqual(json.loads(self.app.bodies[-2]),
+                         record(1500000000, '/c/o1'))
+        self.assertEqual(self.logger.named('increment'), ['index.flush'])
+
+        # nothing left to flush
+        self.index.flush('v1', 'a')
+        self.assertEqual(len(self.app.calls), len(paths))
+
+    def flushed_lifetimes(self, *lifetimes):
+        self.app._calls = []
+        with mock.patch('eventlet.spawn_after'):
+            for i, lifetime in enumerate(lifetimes):
+                self.index.add('v1', 'a', record(1500000000, '/c/o%d' % i),
+                               lifetime)
+        self.index.flush('v1', 'a')
+        # the time bucket's object holds them all
+        return [headers.get('X-Delete-After') for (_method, path), headers
+                in zip(self.app.calls, self.app.call_headers)
+                if '/time/' in path]
+
+    def test_flush_lifetimes(self):
+        self.app.responses = [{'status': '201 Created'}]
+        self.assertEqual(self.flushed_lifetimes(None), ['86400'])
+        self.assertEqual(self.flushed_lifetimes(3600, 86400 * 365),
+                         [str(86400 * 365)])
+        # one kept for ever, and so is its index object
+        self.assertEqual(self.flushed_lifetimes(3600, 0), [None])
+
+    def test_name_shards(self):
+        shards = set(index.name_shard(u'/c/o%d' % i) for i in range(1000))
+        self.assertEqual(set(len(shard) for shard in shards), {2})
+        self.assertGreater(len(shards), 200)
+
+    def test_flush_creates_container(self):
+        self.app.responses = [{'status': '404 Not Found'},
+                              {'status': '201 Created'}]
+        with mock.patch('eventlet.spawn_after'):
+            self.index.add('v1', 'a', record(1500000000, '/c/o'))
+        self.index.flush('v1', 'a')
+        self.assertEqual(self.app.calls[1], ('PUT', '/v1/a/.undelete-index'))
+        self.assertEqual(self.app.calls[2], self.app.calls[0])
+
+    def test_flush_error(self):
+        self.app.responses = [{'status': '503 Service Unavailable'}]
+        with mock.patch('eventlet.spawn_after'):
+            self.index.add('v1', 'a', record(1500000000, '/c/o'))
+        with mock.patch.object(self.logger, 'error', create=True) as error:
+            self.index.flush('v1', 'a')
+        # one name shard, one time bucket
+        self.assertEqual(error.call_count, 2)
+        self.assertEqual(self.logger.named('increment'),
+                         ['index.error', 'index.error', 'index.flush'])
+
+    def test_lookup_by_time(self):
+        self.app.responses = [
+            listing('time/1499997600/1500000100.00000-aaaa',
+                    'time/1500001200/1500003700.00000-bbbb'),
+            ndjson(record(1500000000, '/c/o1'), record(1500000500, '/c/o2')),
+            ndjson(record(1500003600, '/c/o3'))]
+
+        env = swob.Request.blank('/v1/a').environ
+        records = list(self.index.lookup(
+            env, 'v1', 'a', after=utils.Timestamp(1500000100),
+            before=utils.Timestamp(1500003700)))
+        self.assertEqual([r['path'] for r in records], ['/c/o2', '/c/o3'])
+        self.assertEqual(self.app.calls, [
+            ('GET', '/v1/a/.undelete-index'),
+            ('GET', '/v1/a/.undelete-index/time/1499997600/'
+             '1500000100.00000-aaaa'),
+            ('GET', '/v1/a/.undelete-index/time/1500001200/'
+             '1500003700.00000-bbbb')])
+
+    def test_lookup_by_name(self):
+        shard = index.name_shard(u'/c/o2')
+        self.app.responses = [
+            listing('name/%s/1500000100.00000-aaaa' % shard),
+            ndjson(record(1500000000, '/c/o1'), record(1500000050, '/c/o2'))]
+
+        env = swob.Request.blank('/v1/a').environ
+        records = list(self.index.lookup(
+            env, 'v1', 'a', after=utils.Timestamp(1500000000),
+            path=u'/c/o2'))
+        self.assertEqual(records, [record(1500000050, '/c/o2')])
+        self.assertEqual(self.app.calls[1][1],
+                         '/v1/a/.undelete-index/name/%s/'
+                         '1500000100.00000-aaaa' % shard)
+
+    def test_lookup_by_name_reads_its_window(self):
+        # a day of flushes, a minute apart, all into the one name shard
+        objects = {}
+
+        def app(env, start_response):
+            req = swob.Request(env)
+            name = req.path.split('/', 4)[-1]
+            if req.method == 'PUT':
+                objects[name] = req.body
+                start_response('201 Created', [])
+                return []
+            self.app._calls.append((req.method, req.path, req.headers))
+            if name == '.undelete-index':
+                body = json.dumps([
+                    {'name': n} for n in sorted(objects)
+                    if n.startswith(req.params['prefix']) and
+                    n > req.params['marker']]).encode('ascii')
+            else:
+                body = objects[name]
+            start_response('200 OK', [])
+            return [body]
+        self.index.app = app
+        start = 1500000000
+        for minute in range(24 * 60):
+            now = start + minute * 60
+            with mock.patch('time.time', return_value=now + 1), \
+                    mock.patch('eventlet.spawn_after'):
+                self.index.add('v1', 'a', record(now, '/c/o'))
+                self.index.flush('v1', 'a')
+
+        env = swob.Request.blank('/v1/a').environ
+        with mock.patch('time.time', return_value=start + 86400):
+            records = list(self.index.lookup(env, 'v1', 'a', path=u'/c/o'))
+        # the last hour's, one index object apiece, and a listing
+        self.assertEqual(len(records), 60)
+        self.assertEqual(len(self.app.calls), 61)
+
+        self.app._calls = []
+        records = list(self.index.lookup(env, 'v1', 'a', path=u'/c/o',
+                                         after=utils.Timestamp(start)))
+        self.assertEqual(len(records), 24 * 60)
+
+    def test_lookup_no_index(self):
+        self.app.responses = [{'status': '404 Not Found'}]
+        env = swob.Request.blank('/v1/a').environ
+        self.assertEqual(list(self.index.lookup(env, 'v1', 'a')), [])
+
+    def test_lookup_error(self):
+        self.app.responses = [{'status': '403 Forbidden'}]
+        env = swob.Request.blank('/v1/a').environ
+        with self.assertRaises(swob.HTTPException) as caught:
+            list(self.index.lookup(env, 'v1', 'a'))
+        self.assertEqual(caught.exception.status_int, 403)
+
+
+if __name__ == '__main__':
+    unittest.main()
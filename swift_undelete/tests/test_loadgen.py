@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import random
+import unittest
+
+from swift.common import swob
+from swift_undelete import loadgen, middleware
+
+
+def log_line(method, path, status='204', recvd='-', sent='-', source='-',
+             start='1500000000.000000'):
+    return ('Oct 16 12:00:00 proxy1 proxy-server: 10.0.0.1 10.0.0.1 '
+            '16/Oct/2026/12/00/00 %s %s HTTP/1.0 %s - curl AUTH_tk %s %s '
+            '- tx1 - 0.0100 %s - %s 1500000000.010000 0\n' % (
+                method, path, status, recvd, sent, source, start))
+
+
+class TestParseAccessLog(unittest.TestCase):
+    def test_parse(self):
+        requests, existing = loadgen.parse_access_log([
+            log_line('PUT', '/v1/AUTH_a/c/new', '201', recvd='100'),
+            log_line('DELETE', '/v1/AUTH_a/c/new', start='1500000001.5'),
+            log_line('GET', '/v1/AUTH_a/c/old', '200', sent='42'),
+            log_line('DELETE', '/v1/AUTH_a/c/old'),
+            log_line('DELETE', '/v1/AUTH_a/c/gone', '404'),
+            log_line('HEAD', '/v1/AUTH_a/c/unsized', '200'),
+            # subrequests of middleware, bulk deletes, junk
+            log_line('COPY', '/v1/AUTH_a/c/old', '201', source='UN'),
+            log_line('POST', '/v1/AUTH_a%3Fbulk-delete', '200'),
+            'Oct 16 12:00:00 proxy1 kernel: hello\n'])
+        self.assertEqual([(r.method, r.path, r.size) for r in requests], [
+            ('PUT', '/v1/AUTH_a/c/new', 100),
+            ('DELETE', '/v1/AUTH_a/c/new', 0),
+            ('GET', '/v1/AUTH_a/c/old', 0),
+            ('DELETE', '/v1/AUTH_a/c/old', 0),
+            ('DELETE', '/v1/AUTH_a/c/gone', 0),
+            ('HEAD', '/v1/AUTH_a/c/unsized', 0)])
+        self.assertEqual(requests[1].at, 1.5)
+        self.assertEqual(existing, {'/v1/AUTH_a/c/old': 42,
+                                    '/v1/AUTH_a/c/unsized': None})
+
+    def test_synthetic(self):
+        requests, existing = loadgen.synthetic_workload(
+            random.Random(1), 200, accounts=2, containers=3,
+            mix={'DELETE': 1}, initial_objects=50)
+        self.assertEqual(len(existing), 50)
+        deleted = [r.path for r in requests if r.method == 'DELETE']
+        # every object is deleted at most once, and existed beforehand
+        self.assertEqual(len(deleted), len(set(deleted)))
+        put = set(r.path for r in requests if r.method == 'PUT')
+        self.assertTrue(set(deleted) <= set(existing) | put)
+        self.assertEqual(
+            len(set(p.rsplit('/', 1)[0] for p in existing)), 6)
+
+
+class TestStandInSwift(unittest.TestCase):
+    def setUp(self):
+        self.swift = loadgen.StandInSwift()
+        self.swift.create_container('AUTH_a', 'c')
+        self.swift.create_object('AUTH_a', 'c', 'o', 10)
+
+    def call(self, path, method, headers=None, trans_id='tx1'):
+        req = swob.Request.blank(path, environ={'REQUEST_METHOD': method},
+                                 headers=headers)
+        req.environ['swift.trans_id'] = trans_id
+        return req.get_response(self.swift)
+
+    def test_copy(self):
+        self.assertEqual(self.call('/v1/AUTH_a/c/o', 'COPY', {
+            'Destination': 'trash/o'}).status_int, 404)
+        self.assertEqual(self.call('/v1/AUTH_a/trash-versions',
+                                   'PUT').status_int, 201)
+        self.assertEqual(self.call('/v1/AUTH_a/trash', 'PUT', {
+            'X-Versions-Location': 'trash-versions'}).status_int, 201)
+        for _ in range(2):
+            self.assertEqual(self.call('/v1/AUTH_a/c/o', 'COPY', {
+                'Destination': 'trash/o',
+                'X-Delete-After': '60'}).status_int, 201)
+        resp = self.call('/v1/AUTH_a/trash/o', 'HEAD')
+        self.assertEqual(resp.content_length, 10)
+        self.assertIn('X-Delete-At', resp.headers)
+        self.assertEqual(len([k for k in self.swift.objects
+                              if k[1] == 'trash-versions']), 1)
+        self.assertEqual(self.swift.used_bytes, 30)
+        self.assertEqual(self.swift.pop_requests('tx1'),
+                         {'COPY': 3, 'PUT': 2, 'HEAD': 1})
+        self.assertEqual(self.swift.pop_requests('tx1'), {})
+
+    def test_failures(self):
+        self.swift.capacity = 15
+        self.assertEqual(self.call('/v1/AUTH_a/c/o2', 'PUT', {
+            'Content-Length': '10'}).status_int, 507)
+        self.assertEqual(self.call('/v1/AUTH_a/c/o', 'COPY', {
+            'Destination': 'c/o2'}).status_int, 507)
+        self.swift.capacity = 0
+        self.swift.copy_404_rate = 1
+        self.assertEqual(self.call('/v1/AUTH_a/c/o', 'COPY', {
+            'Destination': 'c/o2'}).status_int, 404)
+        self.swift.error_rate = 1
+        resp = self.call('/v1/AUTH_a/c/o', 'GET')
+        self.assertEqual(resp.status_int, 503)
+        self.assertIn(b'Service Unavailable', resp.body)
+
+    def test_slow_containers(self):
+        self.swift.slow_containers = middleware.compile_patterns('*/sl*')
+        self.swift.slow_latency = 0.05
+        begin = loadgen.timer()
+        self.call('/v1/AUTH_a/c/o', 'HEAD')
+        self.assertLess(loadgen.timer() - begin, 0.05)
+        self.call('/v1/AUTH_a/slow/o', 'HEAD')
+        self.assertGreaterEqual(loadgen.timer() - begin, 0.05)
+
+    def test_get_and_listing(self):
+        self.assertEqual(self.call('/v1/AUTH_a/c/o', 'GET').body, b'\0' * 10)
+        listing = json.loads(self.call('/v1/AUTH_a/c?format=json',
+                                       'GET').body)
+        self.assertEqual([(o['name'], o['bytes']) for o in listing],
+                         [('o', 10)])
+        self.assertEqual(self.call('/v1/AUTH_a/c', 'DELETE').status_int, 409)
+        self.assertEqual(self.call('/v1/AUTH_a/c/o', 'DELETE').status_int,
+                         204)
+        self.assertEqual(self.call('/v1/AUTH_a/c', 'DELETE').status_int, 204)
+
+
+class TestRun(unittest.TestCase):
+    def test_amplification(self):
+        swift = loadgen.StandInSwift()
+        loadgen.seed(swift, {'/v1/AUTH_a/c/o%d' % i: 10 for i in range(5)},
+                     default_size=1)
+        app = middleware.filter_factory({})(swift)
+        workload = [loadgen.Request('DELETE', '/v1/AUTH_a/c/o%d' % i, 0, None)
+                    for i in range(5)]
+        workload.append(loadgen.Request('GET', '/v1/AUTH_a/c/o0', 0, None))
+        summary = loadgen.report(loadgen.run(app, swift, workload,
+                                             concurrency=1))
+
+        self.assertEqual(summary['requests'], 6)
+        deletes = summary['methods']['DELETE']
+        self.assertEqual(deletes['statuses'], {'204': 5})
+        # the first DELETE creates the trash containers; after that it's a
+        # COPY and a DELETE apiece
+        self.assertEqual(deletes['backend_by_method'],
+                         {'COPY': 1.2, 'DELETE': 1.0, 'PUT': 0.4})
+        self.assertEqual(summary['methods']['GET']['statuses'], {'404': 1})
+        self.assertIn('backend requests per DELETE: COPY 1.20',
+                      loadgen.format_report(summary))
+
+    def test_backend_errors(self):
+        swift = loadgen.StandInSwift()
+        loadgen.seed(swift, {'/v1/AUTH_a/c/o': 10}, default_size=1)
+        swift.error_rate = 1
+        app = middleware.filter_factory({})(swift)
+        summary = loadgen.report(loadgen.run(app, swift, [
+            loadgen.Request('DELETE', '/v1/AUTH_a/c/o', 0, None)]))
+        # the COPY's error comes back to the client, body and all
+        self.assertEqual(summary['methods']['DELETE']['statuses'],
+                         {'503': 1})
+
+    def test_percentile(self):
+        values = list(range(1, 1001))
+        self.assertEqual(loadgen.percentile(values, 0.5), 500)
+        self.assertEqual(loadgen.percentile(values, 0.99), 990)
+        self.assertEqual(loadgen.percentile(values, 0.999), 999)
+        self.assertIsNone(loadgen.percentile([], 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,18 +15,26 @@
 # limitations under the License.
 
 
+import json
+import os
 import unittest
+import zlib
+
+import eventlet
+import mock
 from swift.common import swob
-from swift_undelete import middleware as md
+from swift_undelete import loadgen, middleware as md, packing
 
 
 class FakeApp(object):
     def __init__(self):
         self.responses = []  # fill in later
         self._calls = []
+        self.bodies = []
 
     def __call__(self, env, start_response):
         req = swob.Request(env)
+        self.bodies.append(req.body)
 
         self._calls.append((
             req.method, req.path,
@@ -69,6 +77,35 @@ class FakeApp(object):
         return self._calls
 
 
+class FakeLogger(object):
+    """
+    Records the StatsD calls made through it.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def increment(self, metric):
+        self.metrics.append(('increment', metric))
+
+    def timing(self, metric, value):
+        self.metrics.append(('timing', metric, value))
+
+    def timing_since(self, metric, orig_time):
+        self.metrics.append(('timing_since', metric))
+
+    def debug(self, msg, *args):
+        self.metrics.append(('debug', msg % args))
+
+    def info(self, msg, *args):
+        self.metrics.append(('info', msg % args))
+
+    def update_stats(self, metric, value):
+        self.metrics.append(('update_stats', metric, value))
+
+    def named(self, kind):
+        return [m[1] for m in self.metrics if m[0] == kind]
+
+
 class TestConfigParsing(unittest.TestCase):
     def test_defaults(self):
         app = FakeApp()
@@ -77,6 +114,9 @@ class TestConfigParsing(unittest.TestCase):
         self.assertEqual(undelete.trash_prefix, ".trash-")
         self.assertEqual(undelete.trash_lifetime, 86400 * 90)
         self.assertFalse(undelete.block_trash_deletes)
+        self.assertEqual(undelete.mode, 'copy')
+        self.assertEqual(undelete.bulk_delete_concurrency, 10)
+        self.assertEqual(undelete.max_deletes_per_request, 10000)
 
     def test_non_defaults(self):
         app = FakeApp()
@@ -84,11 +124,37 @@ class TestConfigParsing(unittest.TestCase):
             'trash_prefix': '.heap__',
             'trash_lifetime': '31536000',
             'block_trash_deletes': 'on',
+            'mode': 'Tombstone',
         })(app)
 
         self.assertEqual(undelete.trash_prefix, ".heap__")
         self.assertEqual(undelete.trash_lifetime, 31536000)
         self.assertTrue(undelete.block_trash_deletes)
+        self.assertEqual(undelete.mode, 'tombstone')
+
+    def test_bad_mode(self):
+        self.assertRaises(ValueError, md.filter_factory, {'mode': 'shred'})
+
+    def test_large_objects(self):
+        undelete = md.filter_factory({})(FakeApp())
+        self.assertIsNone(undelete.trash_storage_policy)
+        self.assertEqual(undelete.large_object_threshold, 0)
+        self.assertEqual(undelete.large_object_action, 'separate')
+        self.assertIsNone(undelete.large_trash_storage_policy)
+
+        undelete = md.filter_factory({
+            'trash_storage_policy': 'ec',
+            'large_object_threshold': '1048576',
+            'large_object_action': 'Skip',
+            'large_trash_storage_policy': 'cold',
+        })(FakeApp())
+        self.assertEqual(undelete.trash_storage_policy, 'ec')
+        self.assertEqual(undelete.large_object_threshold, 1048576)
+        self.assertEqual(undelete.large_object_action, 'skip')
+        self.assertEqual(undelete.large_trash_storage_policy, 'cold')
+
+        self.assertRaises(ValueError, md.filter_factory,
+                          {'large_object_action': 'shrink'})
 
 
 class MiddlewareTestCase(unittest.TestCase):
@@ -109,7 +175,7 @@ class MiddlewareTestCase(unittest.TestCase):
             headers[0] = h
 
         body_iter = self.undelete(req.environ, start_response)
-        body = ''
+        body = b''
         caught_exc = None
         try:
             for chunk in body_iter:
@@ -274,7 +340,7 @@ class TestObjectDeletion(MiddlewareTestCase):
             # COPY attempt: some mysterious error with some headers
             {'status': '503 Service Unavailable',
              'headers': [('X-Scraggedness', 'Goclenian')],
-             'body_iter': ['dunno what happened boss']}]
+             'body_iter': [b'dunno what happened boss']}]
 
         req = swob.Request.blank('/v1/a/elements/Te')
         req.method = 'DELETE'
@@ -282,7 +348,7 @@ class TestObjectDeletion(MiddlewareTestCase):
         status, headers, body = self.call_mware(req)
         self.assertEqual(status, "503 Service Unavailable")
         self.assertEqual(headers.get('X-Scraggedness'), 'Goclenian')
-        self.assertIn('what happened', body)
+        self.assertIn(b'what happened', body)
         self.assertEqual(self.app.calls, [('COPY', '/v1/a/elements/Te')])
 
     def test_copy_missing_trash_container_error_creating_vrs_container(self):
@@ -292,7 +358,7 @@ class TestObjectDeletion(MiddlewareTestCase):
             # trash-versions container creation request: failure!
             {'status': '403 Forbidden',
              'headers': [('X-Pupillidae', 'Barry')],
-             'body_iter': ['oh hell no']}]
+             'body_iter': [b'oh hell no']}]
 
         req = swob.Request.blank('/v1/a/elements/U')
         req.method = 'DELETE'
@@ -300,10 +366,12 @@ class TestObjectDeletion(MiddlewareTestCase):
         status, headers, body = self.call_mware(req)
         self.assertEqual(status, "403 Forbidden")
         self.assertEqual(headers.get('X-Pupillidae'), 'Barry')
-        self.assertIn('oh hell no', body)
+        self.assertIn(b'oh hell no', body)
+        # the two containers are created at once
         self.assertEqual(self.app.calls,
                          [('COPY', '/v1/a/elements/U'),
-                          ('PUT', '/v1/a/.trash-elements-versions')])
+                          ('PUT', '/v1/a/.trash-elements-versions'),
+                          ('PUT', '/v1/a/.trash-elements')])
 
     def test_copy_missing_trash_container_error_creating_container(self):
         self.app.responses = [
@@ -314,7 +382,7 @@ class TestObjectDeletion(MiddlewareTestCase):
             # trash container creation request: fails!
             {'status': "418 I'm a teapot",
              'headers': [('X-Body-Type', 'short and stout')],
-             'body_iter': ['here is my handle, here is my spout']}]
+             'body_iter': [b'here is my handle, here is my spout']}]
 
         req = swob.Request.blank('/v1/a/elements/Mo')
         req.method = 'DELETE'
@@ -322,7 +390,7 @@ class TestObjectDeletion(MiddlewareTestCase):
         status, headers, body = self.call_mware(req)
         self.assertEqual(status, "418 I'm a teapot")
         self.assertEqual(headers.get('X-Body-Type'), 'short and stout')
-        self.assertIn('spout', body)
+        self.assertIn(b'spout', body)
         self.assertEqual(self.app.calls,
                          [('COPY', '/v1/a/elements/Mo'),
                           ('PUT', '/v1/a/.trash-elements-versions'),
@@ -349,3 +417,3243 @@ class TestObjectDeletion(MiddlewareTestCase):
         status, headers, body = self.call_mware(req)
         self.assertEqual(status, "405 Method Not Allowed")
         self.assertEqual(self.app.calls, [])
+
+
+class TestLargeObjects(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({
+            'trash_storage_policy': 'standard',
+            'large_object_threshold': '1000',
+            'large_trash_storage_policy': 'cold'})(self.app)
+
+    def head_response(self, length, headers=()):
+        return {'status': '200 OK',
+                'headers': [('Content-Length', str(length))] + list(headers)}
+
+    def test_large_object_gets_own_container(self):
+        self.app.responses = [
+            self.head_response(1001),
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls,
+                         [('HEAD', '/v1/a/c/o'),
+                          ('COPY', '/v1/a/c/o'),
+                          ('PUT', '/v1/a/.trash-c-large-versions'),
+                          ('PUT', '/v1/a/.trash-c-large'),
+                          ('COPY', '/v1/a/c/o'),
+                          ('DELETE', '/v1/a/c/o')])
+        self.assertEqual(self.app.call_headers[1]['Destination'],
+                         '.trash-c-large/o')
+        self.assertEqual(self.app.call_headers[2]['X-Storage-Policy'],
+                         'cold')
+        self.assertEqual(self.app.call_headers[3]['X-Storage-Policy'],
+                         'cold')
+
+    def test_small_object(self):
+        self.app.responses = [
+            self.head_response(1000),
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.app.calls[2:4],
+                         [('PUT', '/v1/a/.trash-c-versions'),
+                          ('PUT', '/v1/a/.trash-c')])
+        self.assertEqual(self.app.call_headers[3]['X-Storage-Policy'],
+                         'standard')
+
+    def test_slo_manifest_is_small(self):
+        self.app.responses = [
+            self.head_response(
+                100, [('X-Object-Sysmeta-Slo-Size', '5000000')]),
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+        self.undelete.trash_cache.add({}, 'a', '.trash-c')
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.app.call_headers[1]['Destination'],
+                         '.trash-c/o')
+
+    def test_skip(self):
+        self.undelete.large_object_action = 'skip'
+        self.app.responses = [
+            self.head_response(5000),
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls,
+                         [('HEAD', '/v1/a/c/o'),
+                          ('DELETE', '/v1/a/c/o')])
+
+    def test_missing_object(self):
+        self.app.responses = [
+            {'status': '404 Not Found'},
+            {'status': '404 Not Found'},
+            {'status': '404 Not Found'}]
+        self.undelete.trash_cache.add({}, 'a', '.trash-c')
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '404 Not Found')
+        self.assertEqual(self.app.calls[0], ('HEAD', '/v1/a/c/o'))
+
+    def test_bulk_delete(self):
+        self.app.responses = [
+            self.head_response(10),
+            self.head_response(5000),
+            # trash containers already exist
+            {'status': '204 No Content'},
+            {'status': '204 No Content'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '200 OK', 'body_iter': [json.dumps({
+                'Number Deleted': 2, 'Number Not Found': 0,
+                'Response Status': '200 OK', 'Response Body': '',
+                'Errors': []}).encode('ascii')]}]
+
+        req = swob.Request.blank(
+            '/v1/a?bulk-delete', method='POST', body='/c/small\n/c/big',
+            headers={'Accept': 'application/json'})
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(
+            sorted(self.app.calls[:6]),
+            [('COPY', '/v1/a/c/big'), ('COPY', '/v1/a/c/small'),
+             ('HEAD', '/v1/a/.trash-c'), ('HEAD', '/v1/a/.trash-c-large'),
+             ('HEAD', '/v1/a/c/big'), ('HEAD', '/v1/a/c/small')])
+        destinations = dict(
+            (path, hdrs['Destination'])
+            for method, path, hdrs in self.app.calls_with_headers
+            if method == 'COPY')
+        self.assertEqual(destinations, {'/v1/a/c/small': '.trash-c/small',
+                                        '/v1/a/c/big': '.trash-c-large/big'})
+
+
+class FakeMemcache(object):
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, time=0):
+        self.store[key] = value
+
+    def delete(self, key):
+        self.store.pop(key, None)
+
+
+class TestTrashContainerCache(unittest.TestCase):
+    def test_remembers_containers(self):
+        cache = md.TrashContainerCache()
+        self.assertFalse(cache.exists({}, 'a', '.trash-c'))
+        cache.add({}, 'a', '.trash-c')
+        self.assertTrue(cache.exists({}, 'a', '.trash-c'))
+        self.assertFalse(cache.exists({}, 'b', '.trash-c'))
+        cache.discard({}, 'a', '.trash-c')
+        self.assertFalse(cache.exists({}, 'a', '.trash-c'))
+
+    def test_ttl(self):
+        cache = md.TrashContainerCache(ttl=10)
+        with mock.patch('time.time', return_value=1000.0):
+            cache.add({}, 'a', '.trash-c')
+        with mock.patch('time.time', return_value=1009.0):
+            self.assertTrue(cache.exists({}, 'a', '.trash-c'))
+        with mock.patch('time.time', return_value=1011.0):
+            self.assertFalse(cache.exists({}, 'a', '.trash-c'))
+
+    def test_disabled(self):
+        cache = md.TrashContainerCache(ttl=0)
+        cache.add({}, 'a', '.trash-c')
+        self.assertFalse(cache.exists({}, 'a', '.trash-c'))
+
+    def test_lru_eviction(self):
+        cache = md.TrashContainerCache(size=2)
+        cache.add({}, 'a', '.trash-1')
+        cache.add({}, 'a', '.trash-2')
+        # touch the first one so the second is least recently used
+        self.assertTrue(cache.exists({}, 'a', '.trash-1'))
+        cache.add({}, 'a', '.trash-3')
+        self.assertTrue(cache.exists({}, 'a', '.trash-1'))
+        self.assertFalse(cache.exists({}, 'a', '.trash-2'))
+        self.assertTrue(cache.exists({}, 'a', '.trash-3'))
+
+    def test_shared_through_memcache(self):
+        memcache = FakeMemcache()
+        env = {'swift.cache': memcache}
+        md.TrashContainerCache().add(env, 'a', '.trash-c')
+
+        other_worker = md.TrashContainerCache()
+        self.assertTrue(other_worker.exists(env, 'a', '.trash-c'))
+        self.assertFalse(other_worker.exists({}, 'a', '.trash-d'))
+
+        other_worker.discard(env, 'a', '.trash-c')
+        self.assertEqual(memcache.store, {})
+
+    def test_memcache_disabled(self):
+        memcache = FakeMemcache()
+        env = {'swift.cache': memcache}
+        md.TrashContainerCache(use_memcache=False).add(env, 'a', '.trash-c')
+        self.assertEqual(memcache.store, {})
+
+
+class TestKnownTrashContainers(MiddlewareTestCase):
+    def test_second_delete_skips_container_creation(self):
+        self.app.responses = [
+            # first COPY attempt: trash container doesn't exist
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '204 No Content'},
+            # second DELETE: COPY goes straight through
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+
+        for name in ('Ag', 'Au'):
+            req = swob.Request.blank('/v1/a/elements/' + name)
+            req.method = 'DELETE'
+            status, _, _ = self.call_mware(req)
+            self.assertEqual(status, "204 No Content")
+
+        self.assertEqual(self.app.calls,
+                         [('COPY', '/v1/a/elements/Ag'),
+                          ('PUT', '/v1/a/.trash-elements-versions'),
+                          ('PUT', '/v1/a/.trash-elements'),
+                          ('COPY', '/v1/a/elements/Ag'),
+                          ('DELETE', '/v1/a/elements/Ag'),
+                          ('COPY', '/v1/a/elements/Au'),
+                          ('DELETE', '/v1/a/elements/Au')])
+
+    def test_registers_account_with_reaper(self):
+        self.undelete = md.filter_factory({'register_accounts': 'yes'})(
+            self.app)
+        self.app.responses = [
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            # the registry container doesn't exist yet; carry on anyway
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/elements/Ag')
+        req.method = 'DELETE'
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, "204 No Content")
+        self.assertEqual(self.app.calls,
+                         [('COPY', '/v1/a/elements/Ag'),
+                          ('PUT', '/v1/a/.trash-elements-versions'),
+                          ('PUT', '/v1/a/.trash-elements'),
+                          ('PUT', '/v1/.undelete/accounts/a'),
+                          ('COPY', '/v1/a/elements/Ag'),
+                          ('DELETE', '/v1/a/elements/Ag')])
+
+    def test_known_container_missing_object(self):
+        self.undelete.trash_cache.add({}, 'a', '.trash-elements')
+        self.app.responses = [
+            # COPY: object isn't there
+            {'status': '404 Not Found'},
+            # HEAD of the trash container: it's fine
+            {'status': '204 No Content'},
+            # DELETE
+            {'status': '404 Not Found'}]
+
+        req = swob.Request.blank('/v1/a/elements/Uue')
+        req.method = 'DELETE'
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, "404 Not Found")
+        self.assertEqual(self.app.calls,
+                         [('COPY', '/v1/a/elements/Uue'),
+                          ('HEAD', '/v1/a/.trash-elements'),
+                          ('DELETE', '/v1/a/elements/Uue')])
+
+    def test_known_container_went_away(self):
+        self.undelete.trash_cache.add({}, 'a', '.trash-elements')
+        self.app.responses = [
+            {'status': '404 Not Found'},
+            # HEAD of the trash container: somebody deleted it
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/elements/Ts')
+        req.method = 'DELETE'
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, "204 No Content")
+        self.assertEqual(self.app.calls,
+                         [('COPY', '/v1/a/elements/Ts'),
+                          ('HEAD', '/v1/a/.trash-elements'),
+                          ('PUT', '/v1/a/.trash-elements-versions'),
+                          ('PUT', '/v1/a/.trash-elements'),
+                          ('COPY', '/v1/a/elements/Ts'),
+                          ('DELETE', '/v1/a/elements/Ts')])
+        self.assertTrue(self.undelete.trash_cache.exists(
+            {}, 'a', '.trash-elements'))
+
+    def test_known_via_memcache(self):
+        memcache = FakeMemcache()
+        md.TrashContainerCache().add(
+            {'swift.cache': memcache}, 'a', '.trash-elements')
+        self.app.responses = [
+            {'status': '404 Not Found'},
+            {'status': '204 No Content'},
+            {'status': '404 Not Found'}]
+
+        req = swob.Request.blank('/v1/a/elements/Og',
+                                 environ={'swift.cache': memcache})
+        req.method = 'DELETE'
+        self.call_mware(req)
+        self.assertEqual(self.app.calls,
+                         [('COPY', '/v1/a/elements/Og'),
+                          ('HEAD', '/v1/a/.trash-elements'),
+                          ('DELETE', '/v1/a/elements/Og')])
+
+    def test_concurrent_creation_is_single_flight(self):
+        app = self.app
+
+        class SlowPutApp(object):
+            def __call__(self, env, start_response):
+                if env['REQUEST_METHOD'] == 'PUT':
+                    # let the other greenthreads pile up behind us
+                    eventlet.sleep(0.01)
+                return app(env, start_response)
+
+        self.undelete.app = SlowPutApp()
+        app.responses = [{'status': '404 Not Found'}] * 3 + [
+            {'status': '201 Created'}]
+
+        def delete(name):
+            req = swob.Request.blank('/v1/a/elements/' + name)
+            req.method = 'DELETE'
+            return self.call_mware(req)[0]
+
+        pool = eventlet.GreenPool()
+        statuses = list(pool.imap(delete, ['Fe', 'Co', 'Ni']))
+        self.assertEqual(statuses, ['201 Created'] * 3)
+        puts = [call for call in app.calls if call[0] == 'PUT']
+        self.assertEqual(puts, [('PUT', '/v1/a/.trash-elements-versions'),
+                                ('PUT', '/v1/a/.trash-elements')])
+        self.assertEqual(self.undelete._creations, {})
+
+
+class TestBulkDelete(MiddlewareTestCase):
+    def make_request(self, names, accept='application/json'):
+        req = swob.Request.blank(
+            '/v1/a?bulk-delete', body='\n'.join(names),
+            headers={'Accept': accept, 'Content-Type': 'text/plain'})
+        req.method = 'POST'
+        return req
+
+    def bulk_response(self, **kwargs):
+        resp_dict = {'Number Deleted': 0, 'Number Not Found': 0,
+                     'Response Status': '200 OK', 'Response Body': '',
+                     'Errors': []}
+        resp_dict.update(kwargs)
+        return {'status': '200 OK',
+                'headers': [('Content-Type', 'application/json')],
+                'body_iter': [b' ', json.dumps(resp_dict).encode('ascii')]}
+
+    def test_copies_then_forwards(self):
+        self.app.responses = [
+            # one HEAD per trash container
+            {'status': '204 No Content'},
+            {'status': '204 No Content'},
+            # COPYs
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '404 Not Found'},
+            # the trash container is there, so it's o3 that's gone
+            {'status': '204 No Content'},
+            # the bulk delete itself
+            self.bulk_response(**{'Number Deleted': 3,
+                                  'Number Not Found': 1})]
+
+        req = self.make_request(['/c/o1', 'c/o%202', '/d/o3', '/e'])
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(self.app.calls,
+                         [('HEAD', '/v1/a/.trash-c'),
+                          ('HEAD', '/v1/a/.trash-d'),
+                          ('COPY', '/v1/a/c/o1'),
+                          ('COPY', '/v1/a/c/o%202'),
+                          ('COPY', '/v1/a/d/o3'),
+                          ('HEAD', '/v1/a/.trash-d'),
+                          ('POST', '/v1/a')])
+        self.assertEqual(self.app.call_headers[2]['Destination'],
+                         '.trash-c/o1')
+        self.assertEqual(self.app.bodies[-1],
+                         b'/e\n/c/o1\nc/o%202\n/d/o3')
+        self.assertEqual(self.app.call_headers[-1]['Accept'],
+                         'application/json')
+
+        resp_dict = json.loads(body)
+        self.assertEqual(resp_dict['Number Deleted'], 3)
+        self.assertEqual(resp_dict['Response Status'], '200 OK')
+        self.assertEqual(resp_dict['Errors'], [])
+
+    def test_failed_copies_are_not_deleted(self):
+        self.app.responses = [
+            {'status': '204 No Content'},
+            {'status': '201 Created'},
+            {'status': '503 Service Unavailable'},
+            self.bulk_response(**{'Number Deleted': 1})]
+
+        req = self.make_request(['/c/o1', '/c/o2'], accept='text/plain')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(self.app.bodies[-1], b'/c/o1')
+        self.assertIn(b'Number Deleted: 1\n', body)
+        self.assertIn(b'Response Status: 502 Bad Gateway\n', body)
+        self.assertIn(b'/c/o2, 503 Service Unavailable\n', body)
+
+    def test_nothing_saved(self):
+        self.app.responses = [
+            {'status': '204 No Content'},
+            {'status': '507 Insufficient Storage'}]
+
+        req = self.make_request(['/c/o1'])
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/.trash-c'),
+                                          ('COPY', '/v1/a/c/o1')])
+        resp_dict = json.loads(body)
+        self.assertEqual(resp_dict['Number Deleted'], 0)
+        self.assertEqual(resp_dict['Response Status'], '502 Bad Gateway')
+        self.assertEqual(resp_dict['Errors'],
+                         [['/c/o1', '507 Insufficient Storage']])
+
+    def test_trash_container_created_once(self):
+        self.app.responses = [
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            self.bulk_response(**{'Number Deleted': 2})]
+
+        req = self.make_request(['/c/o1', '/c/o2'])
+        self.call_mware(req)
+        self.assertEqual(self.app.calls,
+                         [('HEAD', '/v1/a/.trash-c'),
+                          ('PUT', '/v1/a/.trash-c-versions'),
+                          ('PUT', '/v1/a/.trash-c'),
+                          ('COPY', '/v1/a/c/o1'),
+                          ('COPY', '/v1/a/c/o2'),
+                          ('POST', '/v1/a')])
+
+    def test_trash_container_gone_after_all(self):
+        self.app.responses = [
+            {'status': '204 No Content'},
+            # deleted since the HEAD
+            {'status': '404 Not Found'},
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            self.bulk_response(**{'Number Deleted': 1})]
+        req = self.make_request(['/c/o'])
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(json.loads(body)['Number Deleted'], 1)
+        self.assertEqual(self.app.calls,
+                         [('HEAD', '/v1/a/.trash-c'),
+                          ('COPY', '/v1/a/c/o'),
+                          ('HEAD', '/v1/a/.trash-c'),
+                          ('PUT', '/v1/a/.trash-c-versions'),
+                          ('PUT', '/v1/a/.trash-c'),
+                          ('COPY', '/v1/a/c/o'),
+                          ('POST', '/v1/a')])
+
+    def test_trash_container_creation_fails(self):
+        self.app.responses = [
+            {'status': '404 Not Found'},
+            # both trash container PUTs
+            {'status': '403 Forbidden'},
+            {'status': '403 Forbidden'},
+            self.bulk_response(**{'Number Deleted': 1})]
+
+        req = self.make_request(['/c/o1', '/d'])
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(self.app.bodies[-1], b'/d')
+        resp_dict = json.loads(body)
+        self.assertEqual(resp_dict['Response Status'], '400 Bad Request')
+        self.assertEqual(resp_dict['Errors'], [['/c/o1', '403 Forbidden']])
+
+    def test_trash_deletes_blocked(self):
+        self.undelete.block_trash_deletes = True
+        self.app.responses = [self.bulk_response(**{'Number Deleted': 1})]
+
+        req = self.make_request(['/.trash-c/o1', '/.trash-c'])
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(self.app.calls, [('POST', '/v1/a')])
+        self.assertEqual(self.app.bodies[-1], b'/.trash-c')
+        resp_dict = json.loads(body)
+        self.assertEqual(resp_dict['Errors'],
+                         [['/.trash-c/o1', '405 Method Not Allowed']])
+
+    def test_too_many_names(self):
+        self.undelete.max_deletes_per_request = 2
+        req = self.make_request(['/c/o1', '/c/o2', '/c/o3'])
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '413 Request Entity Too Large')
+        self.assertEqual(self.app.calls, [])
+
+    def test_body_too_long(self):
+        self.undelete.max_deletes_per_request = 2
+        long_name = '/c/' + 'o' * md.MAX_PATH_LENGTH
+        req = self.make_request([long_name, long_name])
+        req.body_file = mock.MagicMock(wraps=req.body_file)
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '413 Request Entity Too Large')
+        self.assertEqual(self.app.calls, [])
+        # the body is read no further than the cap
+        req.body_file.read.assert_called_once_with(
+            2 * md.MAX_PATH_LENGTH + 1)
+
+    def test_not_acceptable(self):
+        req = self.make_request(['/c/o1'], accept='image/png')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '406 Not Acceptable')
+        self.assertEqual(self.app.calls, [])
+
+
+class TestTombstoneMode(MiddlewareTestCase):
+    def setUp(self):
+        super(TestTombstoneMode, self).setUp()
+        self.undelete.mode = md.MODE_TOMBSTONE
+        self.undelete.trash_lifetime = 1000
+
+    def test_delete(self):
+        self.app.responses = [
+            # HEAD of the object
+            {'status': '200 OK',
+             'headers': [('Content-Type', 'text/plain'),
+                         ('Content-Length', '5000000000'),
+                         ('Content-Disposition', 'attachment'),
+                         ('X-Object-Meta-Color', 'blue'),
+                         ('Etag', 'e1f1')]},
+            # PUT of the pointer into trash
+            {'status': '201 Created'},
+            # POST hiding the original
+            {'status': '202 Accepted'}]
+
+        req = swob.Request.blank('/v1/a/c/huge', method='DELETE')
+        with mock.patch('time.time', return_value=1500000000.0):
+            status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/huge'),
+                                          ('PUT', '/v1/a/.trash-c/huge'),
+                                          ('POST', '/v1/a/c/huge')])
+
+        pointer_headers = self.app.call_headers[1]
+        self.assertEqual(pointer_headers['Content-Type'],
+                         md.TOMBSTONE_CONTENT_TYPE)
+        self.assertEqual(pointer_headers['Content-Length'], '0')
+        self.assertEqual(pointer_headers['X-Delete-After'], '1000')
+        self.assertEqual(pointer_headers[md.TOMBSTONE_TARGET_HEADER],
+                         '/v1/a/c/huge')
+
+        post_headers = self.app.call_headers[2]
+        self.assertEqual(
+            post_headers['Content-Type'],
+            'text/plain;undelete_trashed=1500000000.00000')
+        self.assertEqual(post_headers['Content-Disposition'], 'attachment')
+        self.assertEqual(post_headers['X-Object-Meta-Color'], 'blue')
+        self.assertEqual(post_headers['X-Delete-At'], '1500001000')
+        self.assertEqual(post_headers[md.TOMBSTONE_HEADER],
+                         '1500000000.00000')
+        self.assertNotIn(md.TOMBSTONE_DELETE_AT_HEADER, post_headers)
+
+    def test_delete_keeps_earlier_expiry(self):
+        self.app.responses = [
+            {'status': '200 OK',
+             'headers': [('Content-Type', 'text/plain'),
+                         ('X-Delete-At', '1500000100')]},
+            {'status': '201 Created'},
+            {'status': '202 Accepted'}]
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        with mock.patch('time.time', return_value=1500000000.0):
+            self.call_mware(req)
+        post_headers = self.app.call_headers[2]
+        self.assertEqual(post_headers['X-Delete-At'], '1500000100')
+        self.assertEqual(post_headers[md.TOMBSTONE_DELETE_AT_HEADER],
+                         '1500000100')
+
+    def test_delete_creates_trash_container(self):
+        self.app.responses = [
+            {'status': '200 OK'},
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '202 Accepted'}]
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('PUT', '/v1/a/.trash-c/o'),
+                                          ('PUT', '/v1/a/.trash-c-versions'),
+                                          ('PUT', '/v1/a/.trash-c'),
+                                          ('PUT', '/v1/a/.trash-c/o'),
+                                          ('POST', '/v1/a/c/o')])
+
+    def test_delete_missing_object(self):
+        self.app.responses = [{'status': '404 Not Found'}]
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '404 Not Found')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+
+    def test_delete_tombstoned_object(self):
+        self.app.responses = [
+            {'status': '200 OK',
+             'headers': [(md.TOMBSTONE_HEADER, '1500000000.00000')]}]
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '404 Not Found')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o')])
+
+    def test_hidden_from_get_and_head(self):
+        self.app.responses = [
+            {'status': '200 OK',
+             'headers': [(md.TOMBSTONE_HEADER, '1500000000.00000')],
+             'body_iter': [b'secret']}]
+        for method in ('GET', 'HEAD'):
+            req = swob.Request.blank('/v1/a/c/o', method=method)
+            status, headers, body = self.call_mware(req)
+            self.assertEqual(status, '404 Not Found')
+            self.assertNotIn(b'secret', body)
+
+        self.app.responses = [{'status': '200 OK', 'body_iter': [b'data']}]
+        req = swob.Request.blank('/v1/a/c/o')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, b'data')
+
+    def test_hidden_from_post(self):
+        self.app.responses = [
+            {'status': '200 OK',
+             'headers': [(md.TOMBSTONE_HEADER, '1500000000.00000')]}]
+        req = swob.Request.blank('/v1/a/c/o', method='POST')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '404 Not Found')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o')])
+
+        self.app.responses = [{'status': '200 OK'}, {'status': '202 Accepted'}]
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '202 Accepted')
+
+    def test_hidden_from_listings(self):
+        def listing(*entries):
+            body = json.dumps([
+                {'name': name, 'content_type': ctype, 'bytes': 0}
+                for name, ctype in entries]).encode('ascii')
+            return {'status': '200 OK',
+                    'headers': [('Content-Type',
+                                 'application/json; charset=utf-8'),
+                                ('Content-Length', str(len(body))),
+                                ('X-Container-Object-Count', '4')],
+                    'body_iter': [body]}
+
+        self.app.responses = [
+            listing(('a', 'text/plain;undelete_trashed=1'),
+                    ('b', 'text/plain')),
+            listing(('c', 'text/plain;undelete_trashed=1')),
+            listing(('d', 'text/plain')),
+        ]
+
+        req = swob.Request.blank('/v1/a/c?limit=2&prefix=')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual([item['name'] for item in json.loads(body)],
+                         ['b', 'd'])
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.assertEqual(headers['X-Container-Object-Count'], '4')
+        self.assertEqual(len(self.app.calls), 3)
+
+    def test_listing_refill_parameters(self):
+        queries = []
+        app = self.app
+
+        def recording_app(env, start_response):
+            queries.append(swob.Request(env).params)
+            return app(env, start_response)
+
+        self.undelete.app = recording_app
+        body = json.dumps([{'name': 'x', 'content_type':
+                            'a/b;undelete_trashed=1'}]).encode('ascii')
+        self.app.responses = [
+            {'status': '200 OK',
+             'headers': [('Content-Type', 'application/json')],
+             'body_iter': [body]},
+            {'status': '200 OK',
+             'headers': [('Content-Type', 'application/json')],
+             'body_iter': [b'[]']}]
+
+        req = swob.Request.blank('/v1/a/c?limit=1&marker=m&end_marker=z')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(json.loads(body), [])
+        self.assertEqual(queries, [
+            {'limit': '1', 'marker': 'm', 'end_marker': 'z',
+             'format': 'json'},
+            {'limit': '1', 'marker': 'x', 'end_marker': 'z',
+             'format': 'json'}])
+
+    def test_trash_listing_not_filtered(self):
+        self.app.responses = [{'status': '200 OK', 'body_iter': [b'[]']}]
+        req = swob.Request.blank('/v1/a/.trash-c')
+        self.call_mware(req)
+        self.assertEqual(self.app.calls, [('GET', '/v1/a/.trash-c')])
+
+    def test_restore(self):
+        self.app.responses = [
+            {'status': '200 OK',
+             'headers': [
+                 ('Content-Type', 'text/plain;undelete_trashed=15.00000'),
+                 ('X-Object-Meta-Color', 'blue'),
+                 ('X-Delete-At', '1500001000'),
+                 (md.TOMBSTONE_HEADER, '15.00000'),
+                 (md.TOMBSTONE_DELETE_AT_HEADER, '1600000000')]},
+            {'status': '202 Accepted'},
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/c/o')
+        status = self.undelete.restore_tombstone(req, 'v1', 'a', 'c', 'o')
+        self.assertEqual(status, 202)
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('POST', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/.trash-c/o')])
+        post_headers = self.app.call_headers[1]
+        self.assertEqual(post_headers['Content-Type'], 'text/plain')
+        self.assertEqual(post_headers['X-Object-Meta-Color'], 'blue')
+        self.assertEqual(post_headers['X-Delete-At'], '1600000000')
+        self.assertNotIn(md.TOMBSTONE_HEADER, post_headers)
+
+    def test_restore_not_tombstoned(self):
+        self.app.responses = [{'status': '200 OK'}]
+        req = swob.Request.blank('/v1/a/c/o')
+        status = self.undelete.restore_tombstone(req, 'v1', 'a', 'c', 'o')
+        self.assertEqual(status, 404)
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o')])
+
+    def test_bulk_delete(self):
+        self.app.responses = [
+            # HEAD of trash container
+            {'status': '204 No Content'},
+            # first object: tombstoned
+            {'status': '200 OK'},
+            {'status': '201 Created'},
+            {'status': '202 Accepted'},
+            # second object: not there
+            {'status': '404 Not Found'},
+            # bulk delete of what's left
+            {'status': '200 OK',
+             'body_iter': [json.dumps({
+                 'Number Deleted': 0, 'Number Not Found': 1,
+                 'Response Status': '200 OK', 'Response Body': '',
+                 'Errors': []}).encode('ascii')]}]
+
+        req = swob.Request.blank(
+            '/v1/a?bulk-delete', method='POST', body='/c/o1\n/c/o2',
+            headers={'Accept': 'application/json'})
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(self.app.bodies[-1], b'/c/o2')
+        resp_dict = json.loads(body)
+        self.assertEqual(resp_dict['Number Deleted'], 1)
+        self.assertEqual(resp_dict['Number Not Found'], 1)
+        self.assertEqual(resp_dict['Response Status'], '200 OK')
+
+
+class TestRestore(MiddlewareTestCase):
+    def listing(self, *names, **kwargs):
+        return {'status': '200 OK',
+                'headers': [('Content-Type', 'application/json')],
+                'body_iter': [json.dumps([
+                    {'name': name,
+                     'last_modified': kwargs.get(
+                         'last_modified', '2017-07-14T02:40:00.000000'),
+                     'content_type': kwargs.get('content_type',
+                                                'text/plain')}
+                    for name in names]).encode('ascii')]}
+
+    def test_restore_object(self):
+        self.app.responses = [
+            {'status': '200 OK', 'headers': [
+                ('Content-Type', 'text/plain'),
+                ('X-Object-Meta-Color', 'blue'),
+                ('X-Delete-At', '1500001000')]},
+            {'status': '404 Not Found'},
+            {'status': '201 Created'}]
+
+        req = swob.Request.blank('/v1/a/c/o%20x?undelete', method='POST')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(self.app.calls,
+                         [('HEAD', '/v1/a/.trash-c/o%20x'),
+                          ('HEAD', '/v1/a/c/o%20x'),
+                          ('COPY', '/v1/a/.trash-c/o%20x')])
+        copy_headers = self.app.call_headers[2]
+        self.assertEqual(copy_headers['Destination'], 'c/o%20x')
+        self.assertEqual(copy_headers['X-Fresh-Metadata'], 'true')
+        self.assertEqual(copy_headers['X-Object-Meta-Color'], 'blue')
+        self.assertNotIn('X-Delete-At', copy_headers)
+
+    def test_restore_object_from_large_trash(self):
+        self.app.responses = [
+            {'status': '404 Not Found'},
+            {'status': '200 OK'},
+            {'status': '404 Not Found'},
+            {'status': '201 Created'}]
+
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(self.app.calls[:2],
+                         [('HEAD', '/v1/a/.trash-c/o'),
+                          ('HEAD', '/v1/a/.trash-c-large/o')])
+        self.assertEqual(self.app.call_headers[3]['Destination'], 'c/o')
+
+    def test_restore_object_not_in_trash(self):
+        self.app.responses = [{'status': '404 Not Found'}]
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '404 Not Found')
+        self.assertEqual(len(self.app.calls), 2)
+
+    def test_restore_object_exists(self):
+        self.app.responses = [{'status': '200 OK'}]
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '409 Conflict')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/.trash-c/o'),
+                                          ('HEAD', '/v1/a/c/o')])
+
+    def test_restore_tombstone(self):
+        self.app.responses = [
+            {'status': '200 OK',
+             'headers': [('Content-Type', md.TOMBSTONE_CONTENT_TYPE)]},
+            {'status': '200 OK', 'headers': [
+                ('Content-Type', 'text/plain;undelete_trashed=15.00000'),
+                (md.TOMBSTONE_HEADER, '15.00000')]},
+            {'status': '202 Accepted'},
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '202 Accepted')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/.trash-c/o'),
+                                          ('HEAD', '/v1/a/c/o'),
+                                          ('POST', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/.trash-c/o')])
+
+    def test_unauthorized(self):
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        req.environ['swift.authorize'] = \
+            lambda req: swob.HTTPForbidden(request=req)
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '403 Forbidden')
+        self.assertEqual(self.app.calls, [])
+
+    def test_bad_requests(self):
+        for path in ('/v1/a?undelete', '/v1/a/.trash-c/o?undelete',
+                     '/v1/a/c?undelete&deleted_after=yesterday'):
+            req = swob.Request.blank(path, method='POST')
+            status, headers, body = self.call_mware(req)
+            self.assertEqual(status, '400 Bad Request')
+        self.assertEqual(self.app.calls, [])
+
+    def test_restore_container(self):
+        self.app.responses = [
+            self.listing('d/o1', 'd/o2'),
+            {'status': '404 Not Found'},
+            # o1: restored
+            {'status': '200 OK'},
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            # o2: exists again
+            {'status': '200 OK'},
+            {'status': '200 OK'}]
+
+        req = swob.Request.blank('/v1/a/c?undelete&prefix=d/',
+                                 method='POST')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(self.app.calls,
+                         [('GET', '/v1/a/.trash-c'),
+                          ('GET', '/v1/a/.trash-c-large'),
+                          ('HEAD', '/v1/a/.trash-c/d/o1'),
+                          ('HEAD', '/v1/a/c/d/o1'),
+                          ('COPY', '/v1/a/.trash-c/d/o1'),
+                          ('HEAD', '/v1/a/.trash-c/d/o2'),
+                          ('HEAD', '/v1/a/c/d/o2')])
+
+        result = json.loads(body.strip().split(b'\n')[-1])
+        self.assertEqual(result['Number Restored'], 1)
+        self.assertEqual(result['Number Conflicts'], 1)
+        self.assertEqual(result['Number Failed'], 0)
+        self.assertEqual(result['Response Status'], '200 OK')
+        self.assertEqual(result['Errors'], [])
+
+    def test_restore_container_time_window(self):
+        self.app.responses = [
+            self.listing('early', last_modified='2017-07-14T02:40:00.000000'),
+            self.listing('late', last_modified='2017-07-14T02:50:00.000000'),
+            {'status': '200 OK'},
+            {'status': '404 Not Found'},
+            {'status': '201 Created'}]
+
+        # 2017-07-14T02:45:00 and 2017-07-14T02:55:00
+        req = swob.Request.blank(
+            '/v1/a/c?undelete&deleted_after=1500000300'
+            '&deleted_before=1500000900', method='POST')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(self.app.calls[2:],
+                         [('HEAD', '/v1/a/.trash-c-large/late'),
+                          ('HEAD', '/v1/a/c/late'),
+                          ('COPY', '/v1/a/.trash-c-large/late')])
+        result = json.loads(body.strip().split(b'\n')[-1])
+        self.assertEqual(result['Number Restored'], 1)
+
+    def test_restore_container_tombstones(self):
+        self.app.responses = [
+            self.listing('o', content_type=md.TOMBSTONE_CONTENT_TYPE),
+            {'status': '404 Not Found'},
+            {'status': '200 OK', 'headers': [
+                ('Content-Type', 'text/plain;undelete_trashed=15.00000'),
+                (md.TOMBSTONE_HEADER, '15.00000')]},
+            {'status': '202 Accepted'},
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/c?undelete', method='POST')
+        status, headers, body = self.call_mware(req)
+        # no HEAD of the pointer; the listing says what it is
+        self.assertEqual(self.app.calls[2:], [('HEAD', '/v1/a/c/o'),
+                                              ('POST', '/v1/a/c/o'),
+                                              ('DELETE', '/v1/a/.trash-c/o')])
+
+    def test_restore_container_pages(self):
+        with mock.patch.object(md.constraints, 'CONTAINER_LISTING_LIMIT', 2):
+            self.app.responses = [
+                self.listing('o1', 'o2'),
+                self.listing('o3'),
+                {'status': '404 Not Found'}]
+            req = swob.Request.blank('/v1/a/c?undelete', method='POST')
+            status, headers, body = self.call_mware(req)
+
+        self.assertEqual([call for call in self.app.calls
+                          if call[0] == 'GET'],
+                         [('GET', '/v1/a/.trash-c'),
+                          ('GET', '/v1/a/.trash-c-large'),
+                          ('GET', '/v1/a/.trash-c')])
+        result = json.loads(body.strip().split(b'\n')[-1])
+        self.assertEqual(result['Number Not Found'], 3)
+
+    def test_restore_container_failures(self):
+        self.app.responses = [
+            self.listing('o'),
+            {'status': '404 Not Found'},
+            {'status': '200 OK'},
+            {'status': '404 Not Found'},
+            {'status': '503 Service Unavailable'}]
+
+        req = swob.Request.blank('/v1/a/c?undelete', method='POST')
+        status, headers, body = self.call_mware(req)
+        result = json.loads(body.strip().split(b'\n')[-1])
+        self.assertEqual(result['Number Failed'], 1)
+        self.assertEqual(result['Response Status'], '502 Bad Gateway')
+        self.assertEqual(result['Errors'],
+                         [['c/o', '503 Service Unavailable']])
+
+    def test_restore_container_listing_error(self):
+        self.app.responses = [{'status': '401 Unauthorized'}]
+        req = swob.Request.blank('/v1/a/c?undelete', method='POST')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '401 Unauthorized')
+
+    def test_progress(self):
+        self.undelete.yield_frequency = -1
+        self.app.responses = [
+            self.listing('o1', 'o2'),
+            {'status': '404 Not Found'}]
+        req = swob.Request.blank('/v1/a/c?undelete', method='POST')
+        status, headers, body = self.call_mware(req)
+        lines = [json.loads(line) for line in body.strip().split(b'\n')]
+        self.assertEqual([line['Number Not Found'] for line in lines],
+                         [1, 2, 2])
+        self.assertNotIn('Errors', lines[0])
+        self.assertIn('Errors', lines[-1])
+
+
+class TestDeletionIndexing(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({'deletion_index': 'on'})(self.app)
+        self.records = []
+        self.undelete.index.add = \
+            lambda vrs, acc, record, lifetime: self.records.append(
+                (vrs, acc, record, lifetime))
+
+    def test_config(self):
+        self.assertIsNone(md.filter_factory({})(FakeApp()).index)
+        undelete = md.filter_factory({
+            'deletion_index': 'on',
+            'index_container': '.deletions',
+            'index_flush_interval': '5',
+            'index_batch_size': '10',
+            'index_bucket_size': '60',
+            'index_lookup_window': '600',
+            'trash_lifetime': '3600'})(FakeApp())
+        self.assertEqual(undelete.index.container, '.deletions')
+        self.assertEqual(undelete.index.flush_interval, 5)
+        self.assertEqual(undelete.index.batch_size, 10)
+        self.assertEqual(undelete.index.bucket_size, 60)
+        self.assertEqual(undelete.index.lookup_window, 600)
+        self.assertEqual(undelete.index.lifetime, 3600)
+        self.assertTrue(undelete.is_trash('.deletions'))
+
+    def test_copy(self):
+        self.app.responses = [
+            {'status': '201 Created', 'headers': [('Etag', 'abc')]},
+            {'status': '204 No Content'}]
+        self.undelete.trash_cache.add({}, 'a', '.trash-c')
+        req = swob.Request.blank(
+            '/v1/a/c/o', method='DELETE', environ={'swift.infocache': {
+                'object/a/c/o': {'status': 200, 'length': 1234}}})
+        self.call_mware(req)
+
+        self.assertEqual(len(self.records), 1)
+        vrs, acc, record, lifetime = self.records[0]
+        self.assertEqual((vrs, acc), ('v1', 'a'))
+        self.assertEqual(record['path'], '/c/o')
+        self.assertEqual(record['trash'], '/.trash-c/o')
+        self.assertEqual(record['etag'], 'abc')
+        self.assertEqual(record['bytes'], 1234)
+        self.assertEqual(lifetime, md.DEFAULT_TRASH_LIFETIME)
+
+    def test_own_lifetime(self):
+        # e.g. set by container metadata, with honor_metadata on
+        self.undelete.trash_lifetime_for = mock.MagicMock(
+            return_value=86400 * 365)
+        self.app.responses = [
+            {'status': '201 Created', 'headers': [('Etag', 'abc')]},
+            {'status': '204 No Content'}]
+        self.undelete.trash_cache.add({}, 'a', '.trash-c')
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.records[0][3], 86400 * 365)
+
+    def test_failed_copy(self):
+        self.app.responses = [{'status': '503 Service Unavailable'}]
+        self.undelete.trash_cache.add({}, 'a', '.trash-c')
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.records, [])
+
+    def test_tombstone(self):
+        self.undelete.mode = 'tombstone'
+        self.app.responses = [
+            {'status': '200 OK', 'headers': [('Etag', 'abc'),
+                                             ('Content-Length', '12')]},
+            {'status': '201 Created'},
+            {'status': '202 Accepted'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        _vrs, _acc, record, lifetime = self.records[0]
+        self.assertEqual((record['etag'], record['bytes'], record['trash']),
+                         ('abc', 12, '/.trash-c/o'))
+        self.assertEqual(lifetime, md.DEFAULT_TRASH_LIFETIME)
+
+    def test_bulk_delete(self):
+        self.app.responses = [
+            {'status': '204 No Content'},
+            {'status': '201 Created', 'headers': [('Etag', 'abc')]},
+            {'status': '200 OK', 'body_iter': [json.dumps({
+                'Number Deleted': 1, 'Number Not Found': 0,
+                'Response Status': '200 OK', 'Response Body': '',
+                'Errors': []}).encode('ascii')]}]
+        req = swob.Request.blank(
+            '/v1/a?bulk-delete', method='POST', body='/c/o',
+            headers={'Accept': 'application/json'})
+        self.call_mware(req)
+        self.assertEqual([r['path'] for _v, _a, r, _l in self.records],
+                         ['/c/o'])
+
+    def test_lookup(self):
+        records = [{'path': '/c/o'}]
+        with mock.patch.object(self.undelete.index, 'lookup',
+                               return_value=iter(records)) as lookup:
+            req = swob.Request.blank(
+                '/v1/a?undelete-index&deleted_after=1500000000'
+                '&path=/c/o%C3%A9')
+            status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(body, b'{"path": "/c/o"}\n')
+        self.assertEqual(lookup.call_args[1], {
+            'after': md.utils.Timestamp(1500000000), 'before': None,
+            'path': u'/c/o\xe9'})
+        self.assertEqual(self.app.calls, [])
+
+    def test_lookup_error(self):
+        with mock.patch.object(
+                self.undelete.index, 'lookup',
+                side_effect=swob.HTTPException(status=403)):
+            req = swob.Request.blank('/v1/a?undelete-index')
+            status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '403 Forbidden')
+
+    def test_lookup_without_index(self):
+        self.undelete.index = None
+        self.app.responses = [{'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a?undelete-index')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(self.app.calls, [('GET', '/v1/a')])
+
+
+class TestEnablement(MiddlewareTestCase):
+    def delete(self, path, account_meta=None, container_meta=None):
+        acc, con = path.split('/')[2:4]
+        infocache = {
+            'account/%s' % acc: {'status': 200, 'meta': account_meta or {}},
+            'container/%s/%s' % (acc, con): {
+                'status': 200, 'meta': container_meta or {}}}
+        req = swob.Request.blank(path, method='DELETE', environ={
+            'swift.infocache': infocache})
+        self.app.responses = [{'status': '204 No Content'}]
+        self.call_mware(req)
+        return self.app.calls_with_headers
+
+    def test_config(self):
+        undelete = md.filter_factory({})(FakeApp())
+        self.assertTrue(undelete.enabled_by_default)
+        self.assertIsNone(undelete.skip_containers)
+        self.assertFalse(undelete.honor_metadata)
+
+        undelete = md.filter_factory({
+            'enabled_by_default': 'off',
+            'skip_containers': '*/scratch*, AUTH_ci/*',
+            'honor_metadata': 'yes'})(FakeApp())
+        self.assertFalse(undelete.enabled_by_default)
+        self.assertTrue(undelete.skip_containers.match('AUTH_x/scratch-1'))
+        self.assertTrue(undelete.skip_containers.match('AUTH_ci/builds'))
+        self.assertFalse(undelete.skip_containers.match('AUTH_x/builds'))
+        self.assertTrue(undelete.honor_metadata)
+
+    def test_skip_containers(self):
+        self.undelete = md.filter_factory(
+            {'skip_containers': '*/scratch*, AUTH_ci/*'})(self.app)
+        for path in ('/v1/AUTH_x/scratch-1/o', '/v1/AUTH_ci/c/o'):
+            del self.app._calls[:]
+            self.assertEqual([c[:2] for c in self.delete(path)],
+                             [('DELETE', path)])
+        del self.app._calls[:]
+        self.assertEqual(self.delete('/v1/AUTH_x/c/o')[0][0], 'COPY')
+
+    def test_metadata_ignored_by_default(self):
+        calls = self.delete('/v1/a/c/o',
+                            container_meta={'undelete-enabled': 'no'})
+        self.assertEqual(calls[0][0], 'COPY')
+
+    def test_container_metadata(self):
+        self.undelete.honor_metadata = True
+        calls = self.delete('/v1/a/c/o',
+                            container_meta={'undelete-enabled': 'no'})
+        self.assertEqual([c[:2] for c in calls], [('DELETE', '/v1/a/c/o')])
+
+        del self.app._calls[:]
+        calls = self.delete('/v1/a/c/o',
+                            container_meta={'undelete-lifetime': '3600'})
+        self.assertEqual(calls[0][0], 'COPY')
+        self.assertEqual(calls[0][2]['X-Delete-After'], '3600')
+
+    def test_container_overrides_account(self):
+        self.undelete = md.filter_factory({
+            'honor_metadata': 'on',
+            'skip_containers': '*/scratch'})(self.app)
+        calls = self.delete(
+            '/v1/a/scratch/o',
+            account_meta={'undelete-enabled': 'no',
+                          'undelete-lifetime': '60'},
+            container_meta={'undelete-enabled': 'yes'})
+        self.assertEqual(calls[0][0], 'COPY')
+        self.assertEqual(calls[0][2]['X-Delete-After'], '60')
+
+    def test_opt_in(self):
+        self.undelete = md.filter_factory({
+            'honor_metadata': 'on',
+            'enabled_by_default': 'off'})(self.app)
+        calls = self.delete('/v1/a/c/o')
+        self.assertEqual([c[:2] for c in calls], [('DELETE', '/v1/a/c/o')])
+        del self.app._calls[:]
+        calls = self.delete('/v1/a/c/o',
+                            account_meta={'undelete-enabled': 'on'})
+        self.assertEqual(calls[0][0], 'COPY')
+
+    def test_tombstone_lifetime(self):
+        self.undelete.honor_metadata = True
+        self.undelete.mode = 'tombstone'
+        self.app.responses = [{'status': '200 OK'},
+                              {'status': '201 Created'},
+                              {'status': '202 Accepted'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE', environ={
+            'swift.infocache': {
+                'account/a': {'status': 200, 'meta': {}},
+                'container/a/c': {'status': 200, 'meta': {
+                    'undelete-lifetime': '60'}}}})
+        with mock.patch('time.time', return_value=1500000000):
+            self.call_mware(req)
+        self.assertEqual(self.app.call_headers[1]['X-Delete-After'], '60')
+        self.assertEqual(self.app.call_headers[2]['X-Delete-At'],
+                         '1500000060')
+
+    def test_bulk_delete(self):
+        self.undelete = md.filter_factory(
+            {'skip_containers': '*/scratch'})(self.app)
+        self.app.responses = [
+            {'status': '204 No Content'},
+            {'status': '201 Created'},
+            {'status': '200 OK', 'body_iter': [json.dumps({
+                'Number Deleted': 2, 'Number Not Found': 0,
+                'Response Status': '200 OK', 'Response Body': '',
+                'Errors': []}).encode('ascii')]}]
+        req = swob.Request.blank(
+            '/v1/a?bulk-delete', method='POST', body='/scratch/o\n/c/o',
+            headers={'Accept': 'application/json'})
+        self.call_mware(req)
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/.trash-c'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('POST', '/v1/a')])
+        self.assertEqual(self.app.bodies[-1], b'/scratch/o\n/c/o')
+
+
+class TestDedup(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({
+            'dedup': 'on', 'trash_lifetime': '3600'})(self.app)
+        self.undelete.trash_cache.add({}, 'a', '.trash-c')
+        self.undelete.trash_cache.add({}, 'a', '.undelete-content')
+
+    def object_head(self, etag='abc'):
+        return {'status': '200 OK', 'headers': [
+            ('Etag', etag), ('Content-Length', '10'),
+            ('Content-Type', 'text/plain'), ('X-Object-Meta-Color', 'red')]}
+
+    def test_config(self):
+        undelete = md.filter_factory({})(FakeApp())
+        self.assertFalse(undelete.dedup)
+        self.assertFalse(undelete.is_trash('.undelete-content'))
+        self.assertTrue(self.undelete.dedup)
+        self.assertEqual(self.undelete.content_container, '.undelete-content')
+        self.assertTrue(self.undelete.is_trash('.undelete-content'))
+
+    def test_new_content(self):
+        self.app.responses = [
+            self.object_head(),
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls,
+                         [('HEAD', '/v1/a/c/o'),
+                          ('HEAD', '/v1/a/.undelete-content/abc'),
+                          ('COPY', '/v1/a/c/o'),
+                          ('PUT', '/v1/a/.trash-c/o'),
+                          ('DELETE', '/v1/a/c/o')])
+        self.assertEqual(self.app.call_headers[2]['Destination'],
+                         '.undelete-content/abc')
+        self.assertEqual(self.app.call_headers[2]['X-Delete-After'], '3600')
+        symlink_headers = self.app.call_headers[3]
+        self.assertEqual(symlink_headers['X-Symlink-Target'],
+                         '.undelete-content/abc')
+        self.assertEqual(symlink_headers['X-Object-Meta-Color'], 'red')
+        self.assertEqual(symlink_headers['Content-Type'], 'text/plain')
+        self.assertEqual(symlink_headers['X-Delete-After'], '3600')
+
+    def test_errors(self):
+        for responses in (
+                # the pointer PUT
+                [self.object_head(), {'status': '200 OK'}],
+                # the content store HEAD
+                [self.object_head()]):
+            self.app._calls = []
+            self.app.responses = responses + [{
+                'status': '503 Service Unavailable',
+                'body_iter': [b'Backend trouble']}]
+            req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+            status, headers, body = self.call_mware(req)
+            self.assertEqual(status, '503 Service Unavailable')
+            self.assertEqual(
+                body, b'Error copying object to trash:\nBackend trouble')
+            self.assertNotIn('DELETE', [m for m, _path in self.app.calls])
+
+    def test_known_content(self):
+        self.app.responses = [
+            self.object_head(),
+            {'status': '200 OK', 'headers': [('X-Delete-At', '1500000100')]},
+            {'status': '202 Accepted'},
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        with mock.patch('time.time', return_value=1500000000):
+            status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls,
+                         [('HEAD', '/v1/a/c/o'),
+                          ('HEAD', '/v1/a/.undelete-content/abc'),
+                          ('POST', '/v1/a/.undelete-content/abc'),
+                          ('PUT', '/v1/a/.trash-c/o'),
+                          ('DELETE', '/v1/a/c/o')])
+        self.assertEqual(self.app.call_headers[2]['X-Delete-At'],
+                         '1500003600')
+
+    def test_known_content_lives_long_enough(self):
+        self.app.responses = [
+            self.object_head(),
+            {'status': '200 OK', 'headers': [('X-Delete-At', '1600000000')]},
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        with mock.patch('time.time', return_value=1500000000):
+            self.call_mware(req)
+        self.assertEqual([c[0] for c in self.app.calls],
+                         ['HEAD', 'HEAD', 'PUT', 'DELETE'])
+
+    def test_content_kept_forever(self):
+        self.undelete.trash_lifetime = 0
+        self.app.responses = [
+            self.object_head(),
+            {'status': '200 OK', 'headers': [('X-Delete-At', '1600000000')]},
+            {'status': '202 Accepted'},
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.app.calls[2],
+                         ('POST', '/v1/a/.undelete-content/abc'))
+        self.assertNotIn('X-Delete-At', self.app.call_headers[2])
+        self.assertNotIn('X-Delete-After', self.app.call_headers[3])
+
+    def test_large_object_copied(self):
+        self.app.responses = [
+            self.object_head(etag='"abc"'),
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.app.calls,
+                         [('HEAD', '/v1/a/c/o'),
+                          ('COPY', '/v1/a/c/o'),
+                          ('DELETE', '/v1/a/c/o')])
+        self.assertEqual(self.app.call_headers[1]['Destination'],
+                         '.trash-c/o')
+
+    def test_missing_object(self):
+        self.app.responses = [{'status': '404 Not Found'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '404 Not Found')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+
+    def test_bulk_delete(self):
+        self.app.responses = [
+            self.object_head(),
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '201 Created'},
+            {'status': '200 OK', 'body_iter': [json.dumps({
+                'Number Deleted': 1, 'Number Not Found': 0,
+                'Response Status': '200 OK', 'Response Body': '',
+                'Errors': []}).encode('ascii')]}]
+        req = swob.Request.blank(
+            '/v1/a?bulk-delete', method='POST', body='/c/o',
+            headers={'Accept': 'application/json'})
+        self.call_mware(req)
+        self.assertEqual(self.app.calls,
+                         [('HEAD', '/v1/a/c/o'),
+                          ('HEAD', '/v1/a/.undelete-content/abc'),
+                          ('COPY', '/v1/a/c/o'),
+                          ('PUT', '/v1/a/.trash-c/o'),
+                          ('POST', '/v1/a')])
+
+    def test_restore_follows_symlink(self):
+        self.app.responses = [
+            {'status': '200 OK', 'headers': [
+                ('Content-Type', 'text/plain'),
+                ('X-Symlink-Target', '.undelete-content/abc'),
+                ('X-Object-Meta-Color', 'red')]},
+            {'status': '404 Not Found'},
+            {'status': '201 Created'}]
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        copy_headers = self.app.call_headers[2]
+        self.assertEqual(copy_headers['X-Object-Meta-Color'], 'red')
+        self.assertNotIn('X-Symlink-Target', copy_headers)
+
+
+class TestTrashBuckets(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({'trash_buckets': 'on'})(self.app)
+        # 2017-07-14T02:40:00
+        self.now = 1500000000
+
+    def test_config(self):
+        self.assertFalse(md.filter_factory({})(self.app).trash_buckets)
+        self.assertTrue(self.undelete.trash_buckets)
+        self.assertRaises(ValueError, md.filter_factory,
+                          {'trash_buckets': 'on', 'mode': 'tombstone'})
+        self.assertRaises(ValueError, md.filter_factory,
+                          {'trash_buckets': 'on', 'dedup': 'on'})
+
+    def test_bucket_names(self):
+        self.assertEqual(md.trash_bucket('.trash-c', self.now),
+                         '.trash-c@20170714')
+        self.assertEqual(md.parse_trash_bucket('.trash-c@20170714'),
+                         ('.trash-c', 1499990400))
+        self.assertEqual(md.parse_trash_bucket('.trash-c@x@20170714'),
+                         ('.trash-c@x', 1499990400))
+        for name in ('.trash-c', '.trash-logs-20170714',
+                     '.trash-c@20170714-versions', '.trash-c@20171399'):
+            self.assertEqual(md.parse_trash_bucket(name), (name, None))
+
+    def test_delete_into_bucket(self):
+        self.app.responses = [{'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o')
+        req.method = 'DELETE'
+        with mock.patch('time.time', return_value=self.now):
+            status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls, [('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+        copy_headers = self.app.call_headers[0]
+        self.assertEqual(copy_headers['Destination'], '.trash-c@20170714/o')
+        self.assertNotIn('X-Delete-After', copy_headers)
+
+    def test_other_lifetimes_skip_buckets(self):
+        self.undelete.honor_metadata = True
+        self.app.responses = [{'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o')
+        req.method = 'DELETE'
+        with mock.patch.object(md, 'get_account_info', return_value={}), \
+                mock.patch.object(md, 'get_container_info', return_value={
+                    'meta': {'undelete-lifetime': '3600'}}):
+            self.call_mware(req)
+        copy_headers = self.app.call_headers[0]
+        self.assertEqual(copy_headers['Destination'], '.trash-c/o')
+        self.assertEqual(copy_headers['X-Delete-After'], '3600')
+
+    def test_bulk_delete_into_bucket(self):
+        self.undelete.trash_cache.add({}, 'a', '.trash-c@20170714')
+        self.app.responses = [
+            {'status': '201 Created'},
+            {'status': '200 OK',
+             'headers': [('Content-Type', 'application/json')],
+             'body_iter': [json.dumps({
+                 'Response Status': '200 OK', 'Response Body': '',
+                 'Number Deleted': 1, 'Number Not Found': 0,
+                 'Errors': []}).encode('ascii')]}]
+        req = swob.Request.blank('/v1/a?bulk-delete', method='POST',
+                                 headers={'Accept': 'application/json'},
+                                 body=b'/c/o\n')
+        with mock.patch('time.time', return_value=self.now):
+            self.call_mware(req)
+        self.assertEqual(self.app.calls, [('COPY', '/v1/a/c/o'),
+                                          ('POST', '/v1/a')])
+        self.assertEqual(self.app.call_headers[0]['Destination'],
+                         '.trash-c@20170714/o')
+        self.assertNotIn('X-Delete-After', self.app.call_headers[0])
+
+    def account_listing(self, *names):
+        return {'status': '200 OK',
+                'headers': [('Content-Type', 'application/json')],
+                'body_iter': [json.dumps([{'name': n} for n in names])
+                              .encode('ascii')]}
+
+    def test_restore_object_from_bucket(self):
+        self.app.responses = [
+            self.account_listing('.trash-c@20170713', '.trash-c@20170714',
+                                 '.trash-c@20170714-versions',
+                                 '.trash-c@x@20170714'),
+            # not in the plain trash containers, nor the newest bucket
+            {'status': '404 Not Found'},
+            {'status': '404 Not Found'},
+            {'status': '404 Not Found'},
+            {'status': '200 OK'},
+            {'status': '404 Not Found'},
+            {'status': '201 Created'}]
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        # one listing finds the buckets of all the trash containers
+        self.assertEqual(self.app.calls, [
+            ('GET', '/v1/a'),
+            ('HEAD', '/v1/a/.trash-c/o'),
+            ('HEAD', '/v1/a/.trash-c-large/o'),
+            ('HEAD', '/v1/a/.trash-c%4020170714/o'),
+            ('HEAD', '/v1/a/.trash-c%4020170713/o'),
+            ('HEAD', '/v1/a/c/o'),
+            ('COPY', '/v1/a/.trash-c%4020170713/o')])
+
+    def test_restore_window_skips_buckets(self):
+        req = swob.Request.blank('/v1/a/c', method='POST')
+        with mock.patch.object(self.undelete, 'list_trash_buckets',
+                               return_value=[
+                                   ('.trash-c@20170713', 1499904000),
+                                   ('.trash-c@20170714', 1499990400),
+                                   ('.trash-c@20170715', 1500076800)]):
+            self.assertEqual(
+                self.undelete.trash_containers(
+                    req, 'v1', 'a', 'c',
+                    (md.utils.Timestamp(1499990400),
+                     md.utils.Timestamp(1500076800))),
+                ['.trash-c', '.trash-c-large', '.trash-c@20170714'])
+
+    def test_restore_account_listing_denied(self):
+        self.app.responses = [{'status': '403 Forbidden'}]
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '403 Forbidden')
+        self.assertEqual(self.app.calls, [('GET', '/v1/a')])
+
+
+class TestSkipRules(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.logger = FakeLogger()
+        self.now = 1500000000
+
+    def make_undelete(self, **conf):
+        self.undelete = md.filter_factory(conf)(self.app)
+        self.undelete.logger = self.logger
+
+    def delete(self, path='/v1/a/c/o'):
+        req = swob.Request.blank(path)
+        req.method = 'DELETE'
+        with mock.patch('time.time', return_value=self.now):
+            status, _, _ = self.call_mware(req)
+        return status
+
+    def head_response(self, status='200 OK', **kwargs):
+        headers = {'Content-Length': '10', 'Content-Type': 'text/plain'}
+        headers.update((k.replace('_', '-'), v) for k, v in kwargs.items())
+        return {'status': status, 'headers': list(headers.items())}
+
+    def test_config(self):
+        self.make_undelete()
+        self.assertEqual(self.undelete.skip_smaller_than, 0)
+        self.assertEqual(self.undelete.skip_younger_than, 0)
+        self.assertEqual(self.undelete.skip_expiring_within, 0)
+        self.assertIsNone(self.undelete.skip_content_types)
+        self.assertIsNone(self.undelete.skip_objects)
+
+    def test_no_rules_no_lookups(self):
+        self.make_undelete()
+        self.app.responses = [{'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        self.delete()
+        self.assertEqual(self.app.calls, [('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+
+    def test_skip_by_name(self):
+        self.make_undelete(skip_objects='*/*/tmp/*, */*/*.swp')
+        self.app.responses = [{'status': '204 No Content'}]
+        self.assertEqual(self.delete('/v1/a/c/tmp/x'), '204 No Content')
+        self.delete('/v1/a/c/.notes.swp')
+        self.assertEqual(self.app.calls, [('DELETE', '/v1/a/c/tmp/x'),
+                                          ('DELETE', '/v1/a/c/.notes.swp')])
+        self.assertEqual(self.logger.named('increment'),
+                         ['trash.skip', 'trash.skip.name'] * 2)
+
+    def test_skip_small_and_directory_markers(self):
+        self.make_undelete(skip_smaller_than='1',
+                           skip_content_types='application/directory')
+        self.app.responses = [
+            self.head_response(Content_Length='0'),
+            {'status': '204 No Content'},
+            self.head_response(Content_Type='application/directory; x=y'),
+            {'status': '204 No Content'},
+            self.head_response(),
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+        for name in ('empty', 'dir', 'keep'):
+            self.delete('/v1/a/c/' + name)
+        self.assertEqual(self.app.calls, [
+            ('HEAD', '/v1/a/c/empty'), ('DELETE', '/v1/a/c/empty'),
+            ('HEAD', '/v1/a/c/dir'), ('DELETE', '/v1/a/c/dir'),
+            ('HEAD', '/v1/a/c/keep'), ('COPY', '/v1/a/c/keep'),
+            ('DELETE', '/v1/a/c/keep')])
+        self.assertEqual(self.logger.named('increment')[:4], [
+            'trash.skip', 'trash.skip.small',
+            'trash.skip', 'trash.skip.content_type'])
+
+    def test_skip_young_and_expiring(self):
+        self.make_undelete(skip_younger_than='60',
+                           skip_expiring_within='300')
+        self.app.responses = [
+            self.head_response(X_Timestamp='%.5f' % (self.now - 5)),
+            {'status': '204 No Content'},
+            self.head_response(X_Timestamp='%.5f' % (self.now - 3600),
+                               X_Delete_At=str(self.now + 10)),
+            {'status': '204 No Content'},
+            self.head_response(X_Timestamp='%.5f' % (self.now - 3600),
+                               X_Delete_At=str(self.now + 3600)),
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+        for name in ('temp', 'expiring', 'keep'):
+            self.delete('/v1/a/c/' + name)
+        self.assertEqual([call[0] for call in self.app.calls],
+                         ['HEAD', 'DELETE', 'HEAD', 'DELETE',
+                          'HEAD', 'COPY', 'DELETE'])
+        self.assertEqual(self.logger.named('increment')[:4], [
+            'trash.skip', 'trash.skip.young',
+            'trash.skip', 'trash.skip.expiring'])
+
+    def test_head_shared_with_large_object_check(self):
+        self.make_undelete(skip_younger_than='60',
+                           large_object_threshold='5')
+        self.app.responses = [
+            self.head_response(X_Timestamp='%.5f' % (self.now - 3600)),
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+        self.delete()
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+        self.assertEqual(self.app.call_headers[1]['Destination'],
+                         '.trash-c-large/o')
+
+    def test_missing_object_skips_copy(self):
+        self.make_undelete(skip_smaller_than='1')
+        self.app.responses = [{'status': '404 Not Found'}]
+        self.assertEqual(self.delete(), '404 Not Found')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+
+    def test_lookup_error_copies_anyway(self):
+        self.make_undelete(skip_smaller_than='1')
+        self.app.responses = [{'status': '503 Service Unavailable'},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        self.delete()
+        self.assertEqual([call[0] for call in self.app.calls],
+                         ['HEAD', 'COPY', 'DELETE'])
+
+    def test_bulk_delete(self):
+        self.make_undelete(skip_smaller_than='1')
+        self.undelete.trash_cache.add({}, 'a', '.trash-c')
+        self.app.responses = [
+            self.head_response(Content_Length='0'),
+            {'status': '200 OK',
+             'headers': [('Content-Type', 'application/json')],
+             'body_iter': [json.dumps({
+                 'Response Status': '200 OK', 'Response Body': '',
+                 'Number Deleted': 1, 'Number Not Found': 0,
+                 'Errors': []}).encode('ascii')]}]
+        req = swob.Request.blank('/v1/a?bulk-delete', method='POST',
+                                 headers={'Accept': 'application/json'},
+                                 body=b'/c/o\n')
+        self.call_mware(req)
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('POST', '/v1/a')])
+        self.assertEqual(self.app.bodies[-1], b'/c/o')
+
+
+class TestProvisioning(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.logger = FakeLogger()
+        self.undelete = md.filter_factory(
+            {'provision_on_container_put': 'on'})(self.app)
+        self.undelete.logger = self.logger
+
+    def put_container(self, path='/v1/a/c'):
+        req = swob.Request.blank(path)
+        req.method = 'PUT'
+        with mock.patch('eventlet.spawn_n') as spawn_n:
+            status, _, _ = self.call_mware(req)
+        for call in spawn_n.call_args_list:
+            call[0][0](*call[0][1:])
+        return status
+
+    def test_config(self):
+        self.assertFalse(md.filter_factory({})(self.app)
+                         .provision_on_container_put)
+        self.assertTrue(self.undelete.provision_on_container_put)
+
+    def test_container_put_creates_trash_containers(self):
+        self.app.responses = [{'status': '201 Created'}]
+        self.assertEqual(self.put_container(), '201 Created')
+        self.assertEqual(self.app.calls,
+                         [('PUT', '/v1/a/c'),
+                          ('PUT', '/v1/a/.trash-c-versions'),
+                          ('PUT', '/v1/a/.trash-c')])
+        self.assertEqual(self.app.call_headers[2]['X-Versions-Location'],
+                         '.trash-c-versions')
+        self.assertIn('Undelete', self.app.call_headers[1]['User-Agent'])
+        self.assertTrue(self.undelete.trash_cache.exists({}, 'a', '.trash-c'))
+        self.assertEqual(self.logger.named('increment'),
+                         ['provision.success'])
+
+        # so deleting from it goes straight to the COPY
+        self.app.responses = [{'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o')
+        req.method = 'DELETE'
+        self.call_mware(req)
+        self.assertEqual(self.app.calls[3:],
+                         [('COPY', '/v1/a/c/o'), ('DELETE', '/v1/a/c/o')])
+
+    def test_large_trash_container(self):
+        self.undelete.large_object_threshold = 100
+        self.undelete.large_trash_storage_policy = 'cold'
+        self.app.responses = [{'status': '201 Created'}]
+        self.put_container()
+        self.assertEqual(self.app.calls[3:],
+                         [('PUT', '/v1/a/.trash-c-large-versions'),
+                          ('PUT', '/v1/a/.trash-c-large')])
+        self.assertEqual(self.app.call_headers[4]['X-Storage-Policy'],
+                         'cold')
+
+    def test_existing_container(self):
+        self.app.responses = [{'status': '202 Accepted'}]
+        self.assertEqual(self.put_container(), '202 Accepted')
+        self.assertEqual(self.app.calls, [('PUT', '/v1/a/c')])
+
+    def test_put_failure(self):
+        self.app.responses = [{'status': '507 Insufficient Storage'}]
+        self.put_container()
+        self.assertEqual(self.app.calls, [('PUT', '/v1/a/c')])
+
+    def test_skipped_containers(self):
+        self.undelete.skip_containers = md.compile_patterns('*/scratch*')
+        self.app.responses = [{'status': '201 Created'}]
+        self.put_container('/v1/a/scratch')
+        self.put_container('/v1/a/.trash-c')
+        self.put_container('/v1/a/c/o')
+        self.assertEqual(self.app.calls, [('PUT', '/v1/a/scratch'),
+                                          ('PUT', '/v1/a/.trash-c'),
+                                          ('PUT', '/v1/a/c/o')])
+
+    def test_provisioning_error(self):
+        self.app.responses = [{'status': '201 Created'},
+                              {'status': '403 Forbidden'}]
+        with mock.patch.object(self.logger, 'error', create=True) as error:
+            self.assertEqual(self.put_container(), '201 Created')
+        self.assertEqual(error.call_count, 1)
+        self.assertFalse(self.undelete.trash_cache.exists({}, 'a',
+                                                          '.trash-c'))
+        self.assertEqual(self.logger.named('increment'), ['provision.error'])
+
+
+class TestTrashShards(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({'trash_shards': '4'})(self.app)
+
+    def test_config(self):
+        self.assertEqual(md.filter_factory({})(self.app).trash_shards, 0)
+        self.assertEqual(self.undelete.trash_shards, 4)
+        self.assertRaises(ValueError, md.filter_factory,
+                          {'trash_shards': '-1'})
+
+    def test_shard_names(self):
+        # a stable hash, not Python's per-process one
+        self.assertEqual(md.trash_shard('.trash-', 'c', 'o2', 4),
+                         '.trash-.trash-c-3')
+        self.assertEqual(md.trash_shard('.trash-', 'c', u'é', 4),
+                         md.trash_shard('.trash-', 'c', u'é', 4))
+        self.assertEqual(
+            set(md.trash_shard('.trash-', 'c', 'o%d' % i, 4)
+                for i in range(100)),
+            set(self.undelete.trash_shards_of('c')))
+        self.assertEqual(md.filter_factory({'trash_shards': '1'})(
+            self.app).trash_shards_of('c'), ['.trash-c'])
+
+    def test_delete_into_shard(self):
+        self.app.responses = [{'status': '404 Not Found'},
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o2')
+        req.method = 'DELETE'
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        # created on demand, like any other trash container
+        self.assertEqual(self.app.calls,
+                         [('COPY', '/v1/a/c/o2'),
+                          ('PUT', '/v1/a/.trash-.trash-c-3-versions'),
+                          ('PUT', '/v1/a/.trash-.trash-c-3'),
+                          ('COPY', '/v1/a/c/o2'),
+                          ('DELETE', '/v1/a/c/o2')])
+        self.assertEqual(self.app.call_headers[3]['Destination'],
+                         '.trash-.trash-c-3/o2')
+
+    def test_large_objects_shard_too(self):
+        self.undelete.large_object_threshold = 100
+        with mock.patch.object(self.undelete, 'copy_size', return_value=200):
+            self.assertEqual(
+                self.undelete.trash_location(None, 'v1', 'a', 'c', 'o2'),
+                ('.trash-.trash-c-3-large', None))
+        self.assertEqual(
+            [c for c, _policy in
+             self.undelete.trash_containers_to_provision('c')],
+            ['.trash-.trash-c-0', '.trash-.trash-c-1', '.trash-.trash-c-2',
+             '.trash-.trash-c-3', '.trash-.trash-c-0-large',
+             '.trash-.trash-c-1-large', '.trash-.trash-c-2-large',
+             '.trash-.trash-c-3-large'])
+
+    def test_restore_object_tries_its_shard_then_unsharded(self):
+        self.app.responses = [{'status': '404 Not Found'},
+                              {'status': '404 Not Found'},
+                              {'status': '200 OK'},
+                              {'status': '404 Not Found'},
+                              {'status': '201 Created'}]
+        req = swob.Request.blank('/v1/a/c/o2?undelete', method='POST')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(self.app.calls, [
+            ('HEAD', '/v1/a/.trash-.trash-c-3/o2'),
+            ('HEAD', '/v1/a/.trash-.trash-c-3-large/o2'),
+            ('HEAD', '/v1/a/.trash-c/o2'),
+            ('HEAD', '/v1/a/c/o2'),
+            ('COPY', '/v1/a/.trash-c/o2')])
+
+    def test_container_restore_reads_every_shard(self):
+        req = swob.Request.blank('/v1/a/c', method='POST')
+        self.assertEqual(
+            self.undelete.trash_containers(req, 'v1', 'a', 'c'),
+            ['.trash-.trash-c-0', '.trash-.trash-c-0-large',
+             '.trash-.trash-c-1', '.trash-.trash-c-1-large',
+             '.trash-.trash-c-2', '.trash-.trash-c-2-large',
+             '.trash-.trash-c-3', '.trash-.trash-c-3-large',
+             '.trash-c', '.trash-c-large'])
+
+        self.undelete.trash_buckets = True
+        listing = {'status': '200 OK',
+                   'headers': [('Content-Type', 'application/json')],
+                   'body_iter': [json.dumps([
+                       {'name': '.trash-.trash-c-1@20170714'},
+                       {'name': '.trash-.trash-c-3@20170714'},
+                       {'name': '.trash-.trash-c-x@20170714'}]).encode(
+                           'ascii')]}
+        unsharded_listing = {
+            'status': '200 OK',
+            'headers': [('Content-Type', 'application/json')],
+            'body_iter': [json.dumps([
+                {'name': '.trash-c-1@20170715'},
+                {'name': '.trash-c@20170713'}]).encode('ascii')]}
+        self.app.responses = [listing, unsharded_listing]
+        self.assertEqual(
+            self.undelete.trash_containers(req, 'v1', 'a', 'c')[-3:],
+            ['.trash-.trash-c-3@20170714', '.trash-.trash-c-1@20170714',
+             '.trash-c@20170713'])
+        # one listing for the shards, one for the unsharded trash
+        self.assertEqual(self.app.calls, [('GET', '/v1/a'), ('GET', '/v1/a')])
+
+    def test_similar_names_kept_apart(self):
+        # The trash of "logs-1" from before sharding, and a shard of "logs",
+        # are different containers.
+        swift = loadgen.StandInSwift()
+        swift.create_container('a', 'logs')
+        swift.create_container('a', 'logs-1')
+        self.undelete.app = swift
+        shard_1 = [o for o in ('o%d' % i for i in range(100))
+                   if md.trash_shard('.trash-', 'logs', o, 4).endswith('-1')]
+        self.undelete.trash_shards = 0
+        swift.create_object('a', 'logs-1', 'before', 1)
+        self.call_mware(swob.Request.blank('/v1/a/logs-1/before',
+                                           method='DELETE'))
+        self.undelete.trash_shards = 4
+        for con, obj in (('logs', shard_1[0]), ('logs-1', 'after')):
+            swift.create_object('a', con, obj, 1)
+            self.call_mware(swob.Request.blank('/v1/a/%s/%s' % (con, obj),
+                                               method='DELETE'))
+
+        for con, obj in (('logs-1', shard_1[0]), ('logs', 'before'),
+                         ('logs', 'after')):
+            status, _, _ = self.call_mware(swob.Request.blank(
+                '/v1/a/%s/%s?undelete' % (con, obj), method='POST'))
+            self.assertEqual(status, '404 Not Found')
+        self.call_mware(swob.Request.blank('/v1/a/logs-1?undelete',
+                                           method='POST'))
+        self.call_mware(swob.Request.blank('/v1/a/logs?undelete',
+                                           method='POST'))
+        self.assertEqual(
+            sorted(key for key in swift.objects
+                   if not key[1].startswith('.trash-')),
+            [('a', 'logs', shard_1[0]), ('a', 'logs-1', 'after'),
+             ('a', 'logs-1', 'before')])
+
+
+class TestTrashAccount(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory(
+            {'trash_account_prefix': '.trash-'})(self.app)
+        # the environments the app saw, to tell pre-authed requests apart
+        self.envs = []
+
+        def app(env, start_response):
+            self.envs.append(env)
+            return self.app(env, start_response)
+        self.undelete.app = app
+
+    def test_trash_account_names(self):
+        self.assertEqual(md.trash_account('AUTH_test', '.trash-'),
+                         'AUTH_.trash-test')
+        self.assertEqual(md.trash_account('AUTH_a_b', '.trash-'),
+                         'AUTH_.trash-a_b')
+        self.assertEqual(md.trash_account('test', '.trash-'), '.trash-test')
+        self.assertEqual(md.filter_factory({})(self.app).trash_account_for(
+            'AUTH_test'), 'AUTH_test')
+
+    def test_delete_copies_into_trash_account(self):
+        self.app.responses = [{'status': '404 Not Found'},
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/AUTH_a/c/o')
+        req.method = 'DELETE'
+        req.environ['swift.authorize'] = lambda req: None
+        with mock.patch.object(md, 'get_container_info',
+                               return_value={'write_acl': None}):
+            status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls, [
+            ('COPY', '/v1/AUTH_a/c/o'),
+            ('PUT', '/v1/AUTH_.trash-a/.trash-c-versions'),
+            ('PUT', '/v1/AUTH_.trash-a/.trash-c'),
+            ('COPY', '/v1/AUTH_a/c/o'),
+            ('DELETE', '/v1/AUTH_a/c/o')])
+        self.assertEqual(self.app.call_headers[0]['Destination'],
+                         '.trash-c/o')
+        self.assertEqual(self.app.call_headers[0]['Destination-Account'],
+                         'AUTH_.trash-a')
+        self.assertTrue(self.undelete.trash_cache.exists(
+            {}, 'AUTH_.trash-a', '.trash-c'))
+        # trash bookkeeping bypasses auth; the DELETE itself doesn't
+        self.assertEqual([env.get('swift.authorize_override')
+                          for env in self.envs],
+                         [True, True, True, True, None])
+
+    def test_denied_delete_saves_nothing(self):
+        self.app.responses = [{'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/AUTH_a/c/o')
+        req.method = 'DELETE'
+        acls = []
+
+        def authorize(req):
+            acls.append(req.acl)
+            return swob.HTTPForbidden(request=req)
+        req.environ['swift.authorize'] = authorize
+        with mock.patch.object(md, 'get_container_info',
+                               return_value={'write_acl': 'bob'}):
+            self.call_mware(req)
+        # the proxy gets to turn it down
+        self.assertEqual(self.app.calls, [('DELETE', '/v1/AUTH_a/c/o')])
+        self.assertEqual(acls, ['bob'])
+
+    def test_restore_from_trash_account(self):
+        self.app.responses = [{'status': '200 OK'},
+                              {'status': '404 Not Found'},
+                              {'status': '201 Created'}]
+        req = swob.Request.blank('/v1/AUTH_a/c/o?undelete', method='POST')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(self.app.calls, [
+            ('HEAD', '/v1/AUTH_.trash-a/.trash-c/o'),
+            ('HEAD', '/v1/AUTH_a/c/o'),
+            ('COPY', '/v1/AUTH_.trash-a/.trash-c/o')])
+        self.assertEqual(self.app.call_headers[2]['Destination'], 'c/o')
+        self.assertEqual(self.app.call_headers[2]['Destination-Account'],
+                         'AUTH_a')
+
+    def test_container_restore_lists_trash_account(self):
+        self.app.responses = [{'status': '404 Not Found'}]
+        req = swob.Request.blank('/v1/AUTH_a/c?undelete', method='POST')
+        status, _, body = self.call_mware(req)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(self.app.calls, [
+            ('GET', '/v1/AUTH_.trash-a/.trash-c'),
+            ('GET', '/v1/AUTH_.trash-a/.trash-c-large')])
+
+    def test_bulk_delete_copies_into_trash_account(self):
+        self.undelete.trash_cache.add({}, 'AUTH_.trash-a', '.trash-c')
+        self.app.responses = [
+            {'status': '201 Created'},
+            {'status': '200 OK',
+             'headers': [('Content-Type', 'application/json')],
+             'body_iter': [json.dumps({
+                 'Response Status': '200 OK', 'Response Body': '',
+                 'Number Deleted': 1, 'Number Not Found': 0,
+                 'Errors': []}).encode('ascii')]}]
+        req = swob.Request.blank('/v1/AUTH_a?bulk-delete', method='POST',
+                                 headers={'Accept': 'application/json'},
+                                 body=b'/c/o\n')
+        self.call_mware(req)
+        self.assertEqual(self.app.calls, [('COPY', '/v1/AUTH_a/c/o'),
+                                          ('POST', '/v1/AUTH_a')])
+        self.assertEqual(self.app.call_headers[0]['Destination-Account'],
+                         'AUTH_.trash-a')
+        self.assertTrue(self.envs[0].get('swift.authorize_override'))
+        self.assertIsNone(self.envs[1].get('swift.authorize_override'))
+
+    def test_index_lives_in_trash_account(self):
+        self.undelete.index = mock.MagicMock(container='.undelete-index')
+        self.undelete.index_deletion('v1', 'AUTH_a', 'c', 'o', '.trash-c',
+                                     'etag', 3)
+        self.assertEqual(self.undelete.index.add.call_args[0][:2],
+                         ('v1', 'AUTH_.trash-a'))
+
+
+class TestPreserveSegments(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({
+            'preserve_segments': 'on', 'trash_lifetime': '3600'})(self.app)
+        self.undelete.trash_cache.add({}, 'a', '.trash-c')
+        self.query_strings = []
+
+        def app(env, start_response):
+            self.query_strings.append(env.get('QUERY_STRING'))
+            return self.app(env, start_response)
+        self.undelete.app = app
+
+    manifest_head = {'status': '200 OK',
+                     'headers': [('Content-Length', '100'),
+                                 ('X-Object-Sysmeta-Slo-Etag', 'abc')]}
+
+    def test_config(self):
+        self.assertFalse(md.filter_factory({})(FakeApp()).preserve_segments)
+        self.assertEqual(self.undelete.segments_container,
+                         '.undelete-segments')
+        self.assertTrue(self.undelete.is_trash('.undelete-segments'))
+        self.assertRaises(ValueError, md.filter_factory, {
+            'preserve_segments': 'on', 'mode': 'tombstone'})
+        self.assertRaises(ValueError, md.filter_factory, {
+            'preserve_segments': 'on', 'trash_account_prefix': '.trash-'})
+
+    def test_manifest_delete_keeps_segments(self):
+        self.app.responses = [self.manifest_head,
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o?multipart-manifest=delete',
+                                 method='DELETE')
+        with mock.patch('time.time', return_value=1500000000.5):
+            status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+        self.assertEqual(self.query_strings[1:],
+                         ['multipart-manifest=get',
+                          'multipart-manifest=get', ''])
+        trash_copy, ledger_copy = self.app.call_headers[1:3]
+        self.assertEqual(trash_copy['Destination'], '.trash-c/o')
+        entry = trash_copy[md.SEGMENTS_HEADER]
+        self.assertTrue(entry.startswith('1500003600/'))
+        self.assertEqual(ledger_copy['Destination'],
+                         '.undelete-segments/' + entry)
+        self.assertNotIn('X-Delete-After', ledger_copy)
+        self.assertNotIn(md.SEGMENTS_HEADER, ledger_copy)
+
+    def test_bulk_delete_keeps_segments(self):
+        self.app.responses = [self.manifest_head,
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank(
+            '/v1/a?bulk-delete&multipart-manifest=delete', method='POST',
+            body='/c/o', headers={'Accept': 'application/json',
+                                  'Content-Type': 'text/plain'})
+        status, _, body = self.call_mware(req)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(body)['Number Deleted'], 1)
+        # the manifest alone is deleted, so there's nothing left for bulk
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+        self.assertEqual(self.query_strings[-1], '')
+        self.assertIn(md.SEGMENTS_HEADER, self.app.call_headers[1])
+
+    def test_ledger_created_on_demand(self):
+        self.undelete.register_accounts = True
+        self.app.responses = [self.manifest_head,
+                              {'status': '201 Created'},
+                              {'status': '404 Not Found'},
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o?multipart-manifest=delete',
+                                 method='DELETE')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls[2:], [
+            ('COPY', '/v1/a/c/o'),
+            ('PUT', '/v1/a/.undelete-segments'),
+            ('PUT', '/v1/.undelete/accounts/a'),
+            ('COPY', '/v1/a/c/o'),
+            ('DELETE', '/v1/a/c/o')])
+        self.assertNotIn('X-Versions-Location', self.app.call_headers[3])
+
+    def test_ledger_failure_stops_delete(self):
+        self.app.responses = [self.manifest_head,
+                              {'status': '201 Created'},
+                              {'status': '503 Service Unavailable'}]
+        req = swob.Request.blank('/v1/a/c/o?multipart-manifest=delete',
+                                 method='DELETE')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '503 Service Unavailable')
+        self.assertNotIn(('DELETE', '/v1/a/c/o'), self.app.calls)
+
+    def test_failed_delete_drops_ledger_entry(self):
+        self.app.responses = [self.manifest_head,
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '409 Conflict'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o?multipart-manifest=delete',
+                                 method='DELETE')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '409 Conflict')
+        entry = self.app.call_headers[1][md.SEGMENTS_HEADER]
+        self.assertEqual(self.app.calls[-1],
+                         ('DELETE', '/v1/a/.undelete-segments/' + entry))
+
+    def test_kept_forever(self):
+        self.undelete.trash_lifetime = 0
+        self.app.responses = [self.manifest_head,
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o?multipart-manifest=delete',
+                                 method='DELETE')
+        self.call_mware(req)
+        # no ledger entry, so the segments stay as long as the trash
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+        self.assertNotIn(md.SEGMENTS_HEADER, self.app.call_headers[1])
+        self.assertEqual(self.query_strings[-1], '')
+
+    def test_bucket_entry_due_with_bucket(self):
+        self.undelete.trash_buckets = True
+        self.undelete.trash_cache.add({}, 'a', '.trash-c@20170714')
+        self.app.responses = [self.manifest_head,
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o?multipart-manifest=delete',
+                                 method='DELETE')
+        with mock.patch('time.time', return_value=1500000000.5):
+            self.call_mware(req)
+        self.assertEqual(self.app.call_headers[1]['Destination'],
+                         '.trash-c@20170714/o')
+        # the bucket's day ends at 1500076800; it's dropped an hour later
+        self.assertTrue(self.app.call_headers[1][
+            md.SEGMENTS_HEADER].startswith('1500080400/'))
+
+    def test_other_deletes_untouched(self):
+        self.app.responses = [{'status': '200 OK',
+                               'headers': [('Content-Length', '100')]},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o?multipart-manifest=delete',
+                                 method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+        self.assertEqual(self.query_strings[-1], 'multipart-manifest=delete')
+
+        # without multipart-manifest=delete, there's nothing to look up
+        self.app._calls = []
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.app.calls, [('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+
+    def test_restore_drops_ledger_entry(self):
+        self.app.responses = [
+            {'status': '200 OK',
+             'headers': [(md.SEGMENTS_HEADER, '1500003600/abc')]},
+            {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(self.app.calls[2:], [
+            ('COPY', '/v1/a/.trash-c/o'),
+            ('DELETE', '/v1/a/.undelete-segments/1500003600/abc')])
+
+
+class TestSegmentedCopy(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({
+            'segmented_copy_threshold': '5',
+            'segmented_copy_segment_size': '4',
+            'segmented_copy_concurrency': '1',
+            'trash_lifetime': '3600'})(self.app)
+        self.undelete.trash_cache.add({}, 'a', '.trash-c')
+        self.query_strings = []
+
+        def app(env, start_response):
+            self.query_strings.append(env.get('QUERY_STRING'))
+            return self.app(env, start_response)
+        self.undelete.app = app
+
+    object_head = {'status': '200 OK',
+                   'headers': [('Content-Length', '10'), ('Etag', 'abc'),
+                               ('X-Timestamp', '1500000000.00000'),
+                               ('Content-Type', 'text/plain'),
+                               ('X-Object-Meta-Color', 'blue')]}
+
+    def segment_responses(self, *sizes):
+        responses = []
+        for n, size in enumerate(sizes):
+            responses.extend([
+                {'status': '206 Partial Content',
+                 'body_iter': [str(n).encode('ascii') * size]},
+                {'status': '201 Created', 'headers': [('Etag', 'e%d' % n)]}])
+        return responses
+
+    def test_config(self):
+        self.assertEqual(md.filter_factory(
+            {})(FakeApp()).segmented_copy_threshold, 0)
+        self.assertEqual(self.undelete.segment_size, 4)
+        self.assertRaises(ValueError, md.filter_factory, {
+            'segmented_copy_threshold': '5',
+            'segmented_copy_segment_size': '0'})
+
+    def test_big_object_copied_in_segments(self):
+        self.app.responses = [self.object_head, self.object_head,
+                              {'status': '404 Not Found'},
+                              {'status': '201 Created'}] + \
+            self.segment_responses(4, 4, 2) + [
+                {'status': '201 Created'},
+                {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        prefix = '/v1/a/.trash-c-segments/o/1500000000.00000/4/'
+        self.assertEqual(self.app.calls, [
+            ('HEAD', '/v1/a/c/o'),
+            ('HEAD', '/v1/a/c/o'),
+            ('GET', '/v1/a/.trash-c-segments'),
+            ('PUT', '/v1/a/.trash-c-segments'),
+            ('GET', '/v1/a/c/o'), ('PUT', prefix + '00000000'),
+            ('GET', '/v1/a/c/o'), ('PUT', prefix + '00000001'),
+            ('GET', '/v1/a/c/o'), ('PUT', prefix + '00000002'),
+            ('PUT', '/v1/a/.trash-c/o'),
+            ('DELETE', '/v1/a/c/o')])
+        headers = self.app.call_headers
+        self.assertEqual([headers[i]['Range'] for i in (4, 6, 8)],
+                         ['bytes=0-3', 'bytes=4-7', 'bytes=8-9'])
+        self.assertEqual(headers[4]['If-Match'], 'abc')
+        self.assertEqual(self.app.bodies[5], b'0000')
+        self.assertEqual(self.app.bodies[9], b'22')
+        self.assertEqual(headers[5]['X-Delete-After'], '3600')
+        self.assertNotIn('X-Versions-Location', headers[3])
+
+        self.assertEqual(self.query_strings[10], 'multipart-manifest=put')
+        self.assertEqual(headers[10]['X-Delete-After'], '3600')
+        self.assertEqual(headers[10]['X-Object-Meta-Color'], 'blue')
+        self.assertEqual(headers[10][md.SEGMENTED_HEADER], 'true')
+        manifest = json.loads(self.app.bodies[10])
+        self.assertEqual([(m['path'], m['etag'], m['size_bytes'])
+                          for m in manifest], [
+            ('/.trash-c-segments/o/1500000000.00000/4/00000000', 'e0', 4),
+            ('/.trash-c-segments/o/1500000000.00000/4/00000001', 'e1', 4),
+            ('/.trash-c-segments/o/1500000000.00000/4/00000002', 'e2', 2)])
+
+    def test_resume(self):
+        listing = [{'name': 'o/1500000000.00000/4/00000000', 'bytes': 4,
+                    'hash': 'h0'},
+                   # cut short
+                   {'name': 'o/1500000000.00000/4/00000001', 'bytes': 1,
+                    'hash': 'h1'}]
+        self.app.responses = [
+            self.object_head, self.object_head,
+            {'status': '200 OK',
+             'body_iter': [json.dumps(listing).encode('ascii')]}] + \
+            self.segment_responses(4, 2) + [
+                {'status': '201 Created'},
+                {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual([c for c in self.app.calls if c[0] == 'PUT'], [
+            ('PUT', '/v1/a/.trash-c-segments/o/1500000000.00000/4/00000001'),
+            ('PUT', '/v1/a/.trash-c-segments/o/1500000000.00000/4/00000002'),
+            ('PUT', '/v1/a/.trash-c/o')])
+        manifest = json.loads(self.app.bodies[-2])
+        self.assertEqual([m['etag'] for m in manifest], ['h0', 'e0', 'e1'])
+
+    def test_segment_failure_fails_delete(self):
+        self.app.responses = [
+            self.object_head, self.object_head,
+            {'status': '200 OK', 'body_iter': [b'[]']},
+            {'status': '503 Service Unavailable'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, _, body = self.call_mware(req)
+        self.assertEqual(status, '503 Service Unavailable')
+        # tried twice, then given up on
+        self.assertEqual(self.app.calls[3:], [('GET', '/v1/a/c/o'),
+                                              ('GET', '/v1/a/c/o')])
+
+    def test_small_and_manifest_objects_copied_as_usual(self):
+        self.app.responses = [{'status': '200 OK',
+                               'headers': [('Content-Length', '5')]},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+
+        self.app._calls = []
+        dlo_head = {'status': '200 OK',
+                    'headers': [('Content-Length', '10'),
+                                ('X-Object-Manifest', 'segs/o')]}
+        self.app.responses = [dlo_head, dlo_head,
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('HEAD', '/v1/a/c/o'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+
+    def test_restore_comes_back_whole(self):
+        self.app.responses = [
+            {'status': '200 OK', 'headers': [(md.SEGMENTED_HEADER, 'true')]},
+            {'status': '404 Not Found'},
+            {'status': '201 Created'}]
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(self.app.calls[-1], ('COPY', '/v1/a/.trash-c/o'))
+        self.assertNotIn('multipart-manifest', self.query_strings[-1])
+
+
+class TestCompressedTrash(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({
+            'compress_trash': 'on',
+            'trash_lifetime': '3600'})(self.app)
+        self.undelete.trash_cache.add({}, 'a', '.trash-c')
+
+    text = b''.join(b'2014-05-01 line %d\n' % n for n in range(1000))
+
+    def object_response(self, body, content_type='text/plain'):
+        return {'status': '200 OK',
+                'headers': [('Content-Length', str(len(body))),
+                            ('Etag', 'abc'), ('Content-Type', content_type),
+                            ('X-Object-Meta-Color', 'blue')],
+                'body_iter': [body[:5000], body[5000:]]}
+
+    def test_config(self):
+        undelete = md.filter_factory({})(FakeApp())
+        self.assertFalse(undelete.compress_trash)
+        self.assertEqual(undelete.compress_min_size, 4096)
+        self.assertTrue(undelete.compress_skip_content_types.match(
+            'image/png'))
+        self.assertRaises(ValueError, md.filter_factory, {
+            'compress_trash': 'on', 'compress_level': '10'})
+
+    def test_compressed_copy(self):
+        self.app.responses = [self.object_response(self.text),
+                              self.object_response(self.text),
+                              {'status': '201 Created',
+                               'headers': [('Etag', 'zipped')]},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('GET', '/v1/a/c/o'),
+                                          ('PUT', '/v1/a/.trash-c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+        headers = self.app.call_headers[2]
+        self.assertEqual(headers[md.CODEC_HEADER], 'zlib')
+        self.assertEqual(headers[md.ORIGINAL_ETAG_HEADER], 'abc')
+        self.assertEqual(headers[md.ORIGINAL_LENGTH_HEADER],
+                         str(len(self.text)))
+        self.assertEqual(headers['X-Delete-After'], '3600')
+        self.assertEqual(headers['X-Object-Meta-Color'], 'blue')
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        self.assertLess(len(self.app.bodies[2]), len(self.text) // 4)
+        self.assertEqual(zlib.decompress(self.app.bodies[2]), self.text)
+
+    def test_not_worth_compressing(self):
+        for responses in (
+                [{'status': '200 OK', 'headers': [('Content-Length', '10')]}],
+                [self.object_response(self.text, 'image/png')],
+                [self.object_response(os.urandom(10000))] * 2):
+            self.app._calls = []
+            self.app.responses = responses + [{'status': '201 Created'},
+                                              {'status': '204 No Content'}]
+            req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+            status, _, _ = self.call_mware(req)
+            self.assertEqual(status, '204 No Content')
+            self.assertEqual(self.app.calls[-2:], [('COPY', '/v1/a/c/o'),
+                                                   ('DELETE', '/v1/a/c/o')])
+
+    def test_vanished_trash_container_copies_as_usual(self):
+        self.app.responses = [self.object_response(self.text),
+                              self.object_response(self.text),
+                              {'status': '404 Not Found'},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls[2:], [('PUT', '/v1/a/.trash-c/o'),
+                                              ('COPY', '/v1/a/c/o'),
+                                              ('DELETE', '/v1/a/c/o')])
+
+    def test_restore_decompresses(self):
+        stored = zlib.compress(self.text)
+        self.app.responses = [
+            {'status': '200 OK',
+             'headers': [(md.CODEC_HEADER, 'zlib'),
+                         (md.ORIGINAL_ETAG_HEADER, 'abc'),
+                         (md.ORIGINAL_LENGTH_HEADER, str(len(self.text))),
+                         ('Content-Type', 'text/plain'),
+                         ('X-Delete-At', '1500000000')]},
+            {'status': '404 Not Found'},
+            {'status': '200 OK', 'body_iter': [stored[:100], stored[100:]]},
+            {'status': '201 Created'}]
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/.trash-c/o'),
+                                          ('HEAD', '/v1/a/c/o'),
+                                          ('GET', '/v1/a/.trash-c/o'),
+                                          ('PUT', '/v1/a/c/o')])
+        headers = self.app.call_headers[3]
+        self.assertEqual(headers['Etag'], 'abc')
+        self.assertEqual(headers['Content-Length'], str(len(self.text)))
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        self.assertNotIn('X-Delete-At', headers)
+        self.assertNotIn(md.CODEC_HEADER, headers)
+        self.assertEqual(self.app.bodies[3], self.text)
+
+
+class TestTimestampedNaming(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({
+            'trash_naming': 'timestamped',
+            'restore_concurrency': '1'})(self.app)
+
+    def listing(self, *names):
+        return {'status': '200 OK', 'body_iter': [json.dumps([
+            {'name': name, 'last_modified': '2017-07-14T02:40:00.000000',
+             'content_type': 'text/plain', 'bytes': 3, 'hash': 'abc'}
+            for name in names]).encode('ascii')]}
+
+    def test_config(self):
+        self.assertEqual(md.filter_factory({})(FakeApp()).trash_naming,
+                         'plain')
+        self.assertRaises(ValueError, md.filter_factory,
+                          {'trash_naming': 'random'})
+
+    def test_names(self):
+        name = md.timestamped_trash_name('a/b', 1500000000.12345)
+        self.assertEqual(name, 'a/b/8499999999.87654')
+        self.assertEqual(md.split_trash_name(name),
+                         ('a/b', '8499999999.87654'))
+        self.assertEqual(md.split_trash_name('a/b'), ('a/b', None))
+        # later copies sort first
+        self.assertLess(md.timestamped_trash_name('o', 1500000001),
+                        md.timestamped_trash_name('o', 1500000000))
+
+    def test_delete(self):
+        self.app.responses = [{'status': '404 Not Found'},
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        with mock.patch('time.time', return_value=1500000000.12345):
+            status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        # no versions container
+        self.assertEqual(self.app.calls, [('COPY', '/v1/a/c/o'),
+                                          ('PUT', '/v1/a/.trash-c'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+        self.assertNotIn('X-Versions-Location', self.app.call_headers[1])
+        self.assertEqual(self.app.call_headers[2]['Destination'],
+                         '.trash-c/o/8499999999.87654')
+
+    def test_name_too_long(self):
+        obj = 'o' * (md.constraints.MAX_OBJECT_NAME_LENGTH - 1)
+        self.assertEqual(self.undelete.trash_name(obj, 1500000000), obj)
+
+    def test_restore_latest(self):
+        self.app.responses = [
+            self.listing('o/1/8499999999.00000', 'o/8499999998.00000',
+                         'o/8499999999.00000'),
+            {'status': '200 OK'},
+            {'status': '404 Not Found'},
+            {'status': '201 Created'}]
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(self.app.calls, [
+            ('GET', '/v1/a/.trash-c'),
+            ('HEAD', '/v1/a/.trash-c/o/8499999998.00000'),
+            ('HEAD', '/v1/a/c/o'),
+            ('COPY', '/v1/a/.trash-c/o/8499999998.00000')])
+
+    def test_restore_from_before_timestamped_naming(self):
+        self.app.responses = [self.listing('o/1/8499999999.00000'),
+                              {'status': '200 OK'},
+                              {'status': '404 Not Found'},
+                              {'status': '201 Created'}]
+        req = swob.Request.blank('/v1/a/c/o?undelete', method='POST')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(self.app.calls[-1], ('COPY', '/v1/a/.trash-c/o'))
+
+    def test_restore_version(self):
+        self.app.responses = [{'status': '200 OK'},
+                              {'status': '404 Not Found'},
+                              {'status': '201 Created'}]
+        req = swob.Request.blank(
+            '/v1/a/c/o?undelete&version=8499999999.00000', method='POST')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(self.app.calls[-1],
+                         ('COPY', '/v1/a/.trash-c/o/8499999999.00000'))
+
+        req = swob.Request.blank('/v1/a/c/o?undelete&version=../x',
+                                 method='POST')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '400 Bad Request')
+
+    def test_restore_container(self):
+        self.app.responses = [
+            self.listing('o/8499999998.00000', 'o/8499999999.00000',
+                         'p/8499999999.00000'),
+            {'status': '404 Not Found'},
+            {'status': '200 OK'}, {'status': '404 Not Found'},
+            {'status': '201 Created'},
+            {'status': '200 OK'}, {'status': '404 Not Found'},
+            {'status': '201 Created'}]
+        req = swob.Request.blank('/v1/a/c?undelete', method='POST')
+        status, _, body = self.call_mware(req)
+        self.assertEqual(status, '200 OK')
+        result = json.loads(body.splitlines()[-1])
+        self.assertEqual(result['Number Restored'], 2)
+        self.assertEqual([c for c in self.app.calls if c[0] == 'COPY'], [
+            ('COPY', '/v1/a/.trash-c/o/8499999998.00000'),
+            ('COPY', '/v1/a/.trash-c/p/8499999999.00000')])
+        self.assertEqual(self.app.call_headers[4]['Destination'], 'c/o')
+
+
+class TestHideTrashContainers(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({
+            'hide_trash_containers': 'on',
+            'preserve_segments': 'on'})(self.app)
+        self.params = []
+
+        def app(env, start_response):
+            self.params.append(swob.Request(env).params)
+            return self.app(env, start_response)
+        self.undelete.app = app
+
+    past_trash = '.trash-' + swob.str_to_wsgi(u'\U0010ffff') * 65
+
+    def listing(self, *names):
+        return {'status': '200 OK',
+                'headers': [('Content-Type',
+                             'application/json; charset=utf-8'),
+                            ('X-Account-Container-Count', '9')],
+                'body_iter': [json.dumps([
+                    {'name': name, 'count': 0, 'bytes': 0}
+                    for name in names]).encode('ascii')]}
+
+    def get(self, path):
+        status, headers, body = self.call_mware(swob.Request.blank(path))
+        return status, dict(headers), body
+
+    def test_listing_ranges(self):
+        self.assertEqual(md.listing_ranges('.trash-', '', ''), [
+            ('', '.trash-'), (self.past_trash, '')])
+        self.assertEqual(md.listing_ranges('.trash-', '.trash-c', 'd'), [
+            (self.past_trash, 'd')])
+        self.assertEqual(md.listing_ranges('.trash-', '.a', '.b'), [
+            ('.a', '.b')])
+        self.assertEqual(md.listing_ranges('.trash-', '', '', True), [
+            ('', self.past_trash), ('.trash-', '')])
+        self.assertEqual(md.listing_ranges('.trash-', 'd', '.a', True), [
+            ('d', self.past_trash), ('.trash-', '.a')])
+        self.assertEqual(
+            md.listing_ranges('.trash-', '.trash-d', '.trash-c'), [])
+        # every possible trash container sorts before the end of the trash
+        self.assertLess(
+            '.trash-' + swob.str_to_wsgi(u'\U0010ffff' * 62 + u'x'),
+            self.past_trash)
+        self.assertLess(self.past_trash, '.trash.')
+
+    def test_trash_left_out(self):
+        self.app.responses = [self.listing('.a'),
+                              self.listing('.undelete-segments', 'c')]
+        status, headers, body = self.get('/v1/a')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(body), [
+            {'name': '.a', 'count': 0, 'bytes': 0},
+            {'name': 'c', 'count': 0, 'bytes': 0}])
+        self.assertEqual(headers['X-Account-Container-Count'], '9')
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.assertEqual(self.app.calls, [('GET', '/v1/a'),
+                                          ('GET', '/v1/a')])
+        self.assertEqual(self.params[0], {
+            'format': 'json', 'limit': '10000', 'end_marker': '.trash-'})
+        self.assertEqual(self.params[1], {
+            'format': 'json', 'limit': '9999', 'marker': self.past_trash})
+
+    def test_page_filled(self):
+        self.app.responses = [self.listing(),
+                              self.listing('.undelete-segments', 'c'),
+                              self.listing('d')]
+        status, headers, body = self.get('/v1/a?limit=2&prefix=')
+        self.assertEqual([c['name'] for c in json.loads(body)], ['c', 'd'])
+        self.assertEqual(self.params[2]['marker'], 'c')
+        self.assertEqual(self.params[2]['limit'], '1')
+
+    def test_all_trash(self):
+        self.app.responses = [self.listing()]
+        status, headers, body = self.get(
+            '/v1/a?marker=.trash-c&end_marker=.trash-d')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(body), [])
+        self.assertEqual(self.params[0]['marker'], '.trash-')
+        self.assertEqual(self.params[0]['end_marker'], '.trash-')
+
+    def test_errors_and_admins(self):
+        self.app.responses = [{'status': '401 Unauthorized'}]
+        status, _, _ = self.get('/v1/a')
+        self.assertEqual(status, '401 Unauthorized')
+
+        self.app.responses = [self.listing('.trash-c')]
+        req = swob.Request.blank('/v1/a', environ={'reseller_request': True})
+        status, _, body = self.call_mware(req)
+        self.assertEqual(json.loads(body)[0]['name'], '.trash-c')
+        self.assertEqual(self.params[-1], {})
+
+        # containers are listed as usual
+        self.undelete.app = self.app
+        self.assertFalse(self.undelete.wants_request(
+            {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/v1/a/c'}))
+
+
+class TestShadowMode(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({'mode': 'shadow'})(self.app)
+        self.logger = self.undelete.logger = \
+            self.undelete.shadow.logger = FakeLogger()
+
+    def delete(self, path='/v1/a/c/o', length=None):
+        environ = {}
+        if length is not None:
+            environ['swift.infocache'] = {
+                'object/a/c/o': {'status': 200, 'length': length}}
+        req = swob.Request.blank(path, method='DELETE', environ=environ)
+        return self.call_mware(req)
+
+    def test_nothing_copied(self):
+        self.app.responses = [{'status': '204 No Content'},
+                              {'status': '204 No Content'},
+                              {'status': '204 No Content'}]
+        status, _, _ = self.delete(length=1234)
+        self.assertEqual(status, '204 No Content')
+        self.delete()
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/.trash-c'),
+                                          ('DELETE', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+        self.assertEqual(self.logger.named('increment'), [
+            'shadow.copies', 'shadow.copies', 'shadow.unknown_size'])
+        self.assertIn(('timing', 'shadow.copy.bytes', 1234),
+                      self.logger.metrics)
+        self.assertEqual(self.logger.named('timing_since'), [
+            'shadow.overhead.timing', 'delete.shadowed.timing'] * 2)
+        self.assertEqual(self.undelete.shadow.totals, {
+            'copies': 2, 'bytes': 1234, 'unknown_size': 1, 'requests': 2,
+            'containers': 0})
+
+    def test_missing_trash_container(self):
+        self.app.responses = [{'status': '404 Not Found'},
+                              {'status': '204 No Content'},
+                              {'status': '204 No Content'}]
+        self.delete()
+        # counted once
+        self.delete()
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/.trash-c'),
+                                          ('DELETE', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+        self.assertIn(('update_stats', 'shadow.containers_created', 2),
+                      self.logger.metrics)
+        self.assertEqual(self.undelete.shadow.totals['requests'], 5)
+        self.assertEqual(self.undelete.shadow.totals['containers'], 2)
+
+    def test_request_estimates(self):
+        self.undelete.segmented_copy_threshold = 100
+        self.undelete.segment_size = 40
+        self.assertEqual(self.undelete.copy_requests(None), 1)
+        self.assertEqual(self.undelete.copy_requests(100), 1)
+        self.assertEqual(self.undelete.copy_requests(101), 6)
+        self.undelete.compress_trash = True
+        self.undelete.compress_min_size = 50
+        self.assertEqual(self.undelete.copy_requests(49), 1)
+        self.assertEqual(self.undelete.copy_requests(99), 2)
+        self.undelete.dedup = True
+        self.assertEqual(self.undelete.copy_requests(99), 3)
+
+    def test_skips_still_skip(self):
+        self.app.responses = [{'status': '204 No Content'}]
+        self.delete('/v1/a/.trash-c/o')
+        self.assertEqual(self.logger.named('increment'), ['trash.skip'])
+        self.assertEqual(self.undelete.shadow.totals['copies'], 0)
+
+    def test_bulk_delete(self):
+        self.app.responses = [
+            {'status': '204 No Content'},
+            {'status': '200 OK',
+             'headers': [('Content-Type', 'application/json')],
+             'body_iter': [json.dumps({
+                 'Number Deleted': 2, 'Number Not Found': 0,
+                 'Response Status': '200 OK', 'Response Body': '',
+                 'Errors': []}).encode('ascii')]}]
+        req = swob.Request.blank(
+            '/v1/a?bulk-delete', body='/c/o1\n/c/o2',
+            headers={'Accept': 'application/json',
+                     'Content-Type': 'text/plain'})
+        req.method = 'POST'
+        status, _, body = self.call_mware(req)
+        self.assertEqual(json.loads(body)['Number Deleted'], 2)
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/.trash-c'),
+                                          ('POST', '/v1/a')])
+        self.assertEqual(self.undelete.shadow.totals['copies'], 2)
+
+    def test_container_put_provisions_nothing(self):
+        self.undelete.provision_on_container_put = True
+        self.app.responses = [{'status': '201 Created'}]
+        req = swob.Request.blank('/v1/a/c', method='PUT')
+        self.call_mware(req)
+        self.assertEqual(self.app.calls, [('PUT', '/v1/a/c')])
+
+    def test_periodic_report(self):
+        stats = self.undelete.shadow
+        stats.record(10, 1, 0)
+        self.assertEqual(self.logger.named('info'), [])
+        with mock.patch('time.time',
+                        return_value=stats.last_report + 300):
+            stats.record(None, 3, 2)
+        self.assertEqual(self.logger.named('info'), [
+            'Trash would have cost, over the last 300s: 2 copies of 10 '
+            'bytes (and 1 of unknown size), 4 backend requests, 2 trash '
+            'containers created; since startup: 2 copies of 10 bytes (and '
+            '1 of unknown size), 4 backend requests, 2 trash containers '
+            'created'])
+        self.assertEqual(stats.interval['copies'], 0)
+        self.assertEqual(stats.totals['copies'], 2)
+
+    def test_config(self):
+        undelete = md.filter_factory({
+            'mode': 'shadow', 'trash_buckets': 'on',
+            'shadow_report_interval': '60'})(FakeApp())
+        self.assertEqual(undelete.shadow.report_interval, 60)
+        self.assertIsNone(md.filter_factory({})(FakeApp()).shadow)
+        self.assertRaises(ValueError, md.filter_factory, {
+            'mode': 'tombstone', 'trash_buckets': 'on'})
+
+
+class TestPackedTrash(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({
+            'pack_threshold': '1000', 'pack_window': '0.01',
+            'trash_lifetime': '3600'})(self.app)
+        self.undelete.trash_cache.add({}, 'a', '.trash-c')
+
+    def object_response(self, body, etag='abc'):
+        return {'status': '200 OK',
+                'headers': [('Content-Length', str(len(body))),
+                            ('Etag', etag), ('Content-Type', 'text/plain'),
+                            ('X-Object-Meta-Color', 'blue')],
+                'body_iter': [body]}
+
+    def object_head(self, size):
+        return {'status': '200 OK',
+                'headers': [('Content-Length', str(size)), ('Etag', 'abc')]}
+
+    def delete(self, path='/v1/a/c/o'):
+        return self.call_mware(swob.Request.blank(path, method='DELETE'))
+
+    def test_config(self):
+        undelete = md.filter_factory({})(FakeApp())
+        self.assertIsNone(undelete.packer)
+        self.assertEqual(self.undelete.packer.window, 0.01)
+        self.assertRaises(ValueError, md.filter_factory, {
+            'pack_threshold': '1000', 'dedup': 'on'})
+        self.assertRaises(ValueError, md.filter_factory, {
+            'pack_threshold': '1000', 'pack_window': '0'})
+
+    def test_packed(self):
+        self.app.responses = [self.object_head(5),
+                              self.object_response(b'hello'),
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        status, _, _ = self.delete()
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls[:2], [('HEAD', '/v1/a/c/o'),
+                                              ('GET', '/v1/a/c/o')])
+        method, path = self.app.calls[2]
+        self.assertEqual(method, 'PUT')
+        self.assertTrue(path.startswith('/v1/a/.trash-c/.undelete-pack/'))
+        self.assertEqual(self.app.calls[3], ('DELETE', '/v1/a/c/o'))
+        headers = self.app.call_headers[2]
+        self.assertEqual(headers['Content-Type'], packing.PACK_CONTENT_TYPE)
+        self.assertEqual(headers[md.PACK_INDEX_HEADER], '5')
+        self.assertEqual(headers['X-Delete-After'], '3600')
+        body = self.app.bodies[2]
+        self.assertEqual(body[:5], b'hello')
+        offset, length, _ts, metadata = packing.parse_index(body[5:])['o']
+        self.assertEqual((offset, length), (0, 5))
+        self.assertEqual(metadata, {'Content-Type': 'text/plain',
+                                    'X-Object-Meta-Color': 'blue',
+                                    'Etag': 'abc'})
+
+    def test_deletes_share_a_pack(self):
+        self.undelete.packer.max_objects = 2
+        self.app.responses = [self.object_head(5),
+                              self.object_response(b'hello'),
+                              self.object_head(5),
+                              self.object_response(b'world'),
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        pool = eventlet.GreenPool()
+        statuses = list(pool.imap(lambda path: self.delete(path)[0],
+                                  ['/v1/a/c/o1', '/v1/a/c/o2']))
+        self.assertEqual(statuses, ['204 No Content'] * 2)
+        self.assertEqual([method for method, _path in self.app.calls],
+                         ['HEAD', 'GET', 'HEAD', 'GET', 'PUT', 'DELETE',
+                          'DELETE'])
+        self.assertEqual(sorted(packing.parse_index(
+            self.app.bodies[4][10:])), ['o1', 'o2'])
+
+    def test_big_objects_copied(self):
+        # big, it isn't read
+        self.app.responses = [self.object_head(1001),
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        self.delete()
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+
+        # grown since the HEAD, it's read but not packed
+        self.app._calls = []
+        self.app.responses = [self.object_head(5),
+                              self.object_response(b'x' * 1001),
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        self.delete()
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('GET', '/v1/a/c/o'),
+                                          ('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+
+        # known to be big, it isn't even HEADed
+        self.app._calls = []
+        self.app.responses = [{'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        self.call_mware(swob.Request.blank(
+            '/v1/a/c/o', method='DELETE', environ={'swift.infocache': {
+                'object/a/c/o': {'status': 200, 'length': 1001,
+                                 'sysmeta': {}}}}))
+        self.assertEqual(self.app.calls, [('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+
+    def test_failed_pack_copies_as_usual(self):
+        self.undelete.logger = self.undelete.packer.logger = FakeLogger()
+        self.app.responses = [self.object_head(5),
+                              self.object_response(b'hello'),
+                              {'status': '503 Service Unavailable'},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        status, _, _ = self.delete()
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls[3:], [('COPY', '/v1/a/c/o'),
+                                              ('DELETE', '/v1/a/c/o')])
+        self.assertEqual(self.undelete.logger.named('increment'),
+                         ['pack.error', 'pack.fallback', 'trash.hit'])
+
+    def listing(self, *items):
+        return {'status': '200 OK',
+                'headers': [('Content-Type', 'application/json')],
+                'body_iter': [json.dumps([
+                    {'name': name,
+                     'last_modified': '2017-07-14T02:40:00.000000',
+                     'content_type': content_type}
+                    for name, content_type in items]).encode('ascii')]}
+
+    def pack_app(self, responses):
+        """
+        Route requests by method and path, as concurrent restores make
+        their order unpredictable.
+        """
+        def app(env, start_response):
+            req = swob.Request(env)
+            self.app._calls.append((req.method, req.path,
+                                    swob.HeaderKeyDict(req.headers)))
+            self.app.bodies.append(req.body)
+            resp = responses[req.method, req.path]
+            start_response(resp['status'], resp.get('headers', []))
+            return resp.get('body_iter', [])
+        self.undelete.app = app
+
+    def pack_responses(self, members):
+        body, offset = packing.build_pack(members)
+        return body, {
+            ('GET', '/v1/a/.trash-c'): self.listing(
+                ('.undelete-pack/x', packing.PACK_CONTENT_TYPE)),
+            ('HEAD', '/v1/a/.trash-c/.undelete-pack/x'): {
+                'status': '200 OK',
+                'headers': [(md.PACK_INDEX_HEADER, str(offset))]},
+            ('GET', '/v1/a/.trash-c/.undelete-pack/x'): {
+                'status': '206 Partial Content',
+                'body_iter': [body[offset:]]}}
+
+    def test_restore_object(self):
+        body, responses = self.pack_responses([
+            ('o', b'hello', '1500000000.00000', {'Etag': 'abc'}),
+            ('p', b'world', '1500000000.00000', {'Etag': 'def'})])
+        responses.update({
+            ('HEAD', '/v1/a/.trash-c/p'): {'status': '404 Not Found'},
+            ('HEAD', '/v1/a/c/p'): {'status': '404 Not Found'},
+            ('PUT', '/v1/a/c/p'): {'status': '201 Created'}})
+        self.pack_app(responses)
+        req = swob.Request.blank('/v1/a/c/p?undelete', method='POST')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(self.app.calls, [
+            ('HEAD', '/v1/a/.trash-c/p'),
+            ('GET', '/v1/a/.trash-c'),
+            ('HEAD', '/v1/a/.trash-c/.undelete-pack/x'),
+            ('GET', '/v1/a/.trash-c/.undelete-pack/x'),
+            ('HEAD', '/v1/a/c/p'),
+            ('GET', '/v1/a/.trash-c/.undelete-pack/x'),
+            ('PUT', '/v1/a/c/p')])
+        self.assertEqual(self.app.call_headers[3]['Range'], 'bytes=10-')
+        self.assertEqual(self.app.call_headers[5]['Range'], 'bytes=5-9')
+        self.assertEqual(self.app.call_headers[6]['Etag'], 'def')
+
+    def test_restore_container(self):
+        # the packed copy of o is older than the one in the trash container
+        body, responses = self.pack_responses([
+            ('o', b'hello', '1500000000.00000', {'Etag': 'abc'}),
+            ('p', b'world', '1500000000.00000', {'Etag': 'def'})])
+        responses.update({
+            ('GET', '/v1/a/.trash-c'): self.listing(
+                ('.undelete-pack/x', packing.PACK_CONTENT_TYPE),
+                ('o', 'text/plain')),
+            ('GET', '/v1/a/.trash-c-large'): {'status': '404 Not Found'},
+            ('HEAD', '/v1/a/.trash-c/o'): {'status': '200 OK'},
+            ('HEAD', '/v1/a/c/o'): {'status': '404 Not Found'},
+            ('COPY', '/v1/a/.trash-c/o'): {'status': '201 Created'},
+            ('HEAD', '/v1/a/c/p'): {'status': '404 Not Found'},
+            ('PUT', '/v1/a/c/p'): {'status': '201 Created'}})
+        self.pack_app(responses)
+        req = swob.Request.blank('/v1/a/c?undelete', method='POST')
+        status, _, body = self.call_mware(req)
+        result = json.loads(body.splitlines()[-1])
+        self.assertEqual(result['Number Restored'], 2)
+        self.assertEqual(result['Errors'], [])
+        self.assertIn(('COPY', '/v1/a/.trash-c/o'), self.app.calls)
+        self.assertIn(('PUT', '/v1/a/c/p'), self.app.calls)
+        self.assertNotIn(('PUT', '/v1/a/c/o'), self.app.calls)
+
+    def test_shadow_estimate(self):
+        self.undelete.compress_trash = True
+        self.undelete.compress_min_size = 0
+        self.assertEqual(self.undelete.copy_requests(1000), 1)
+        self.assertEqual(self.undelete.copy_requests(1001), 2)
+
+
+class TestAdmission(MiddlewareTestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.undelete = md.filter_factory({
+            'admission_max_copies': '1'})(self.app)
+        self.undelete.trash_cache.add({}, 'a', '.trash-c')
+        # another copy is under way
+        self.slot = self.undelete.admission.acquire({}, 'a')
+
+    def test_config(self):
+        self.assertIsNone(md.filter_factory({})(FakeApp()).admission)
+        undelete = md.filter_factory({
+            'admission_account_bytes_per_second': '1000',
+            'breaker_error_rate': '0.5',
+            'admission_action': 'Wait',
+            'admission_max_wait': '2.5'})(FakeApp())
+        self.assertEqual(undelete.admission.account_bytes_per_second, 1000)
+        self.assertEqual(undelete.admission.breaker.error_rate, 0.5)
+        self.assertEqual(undelete.admission_action, 'wait')
+        self.assertEqual(undelete.admission_max_wait, 2.5)
+        self.assertRaises(ValueError, md.filter_factory,
+                          {'admission_action': 'drop'})
+
+    def test_turned_down(self):
+        self.app.responses = [{'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '503 Service Unavailable')
+        self.assertEqual(headers['Retry-After'], '1')
+        self.assertEqual(self.app.calls, [])
+
+        self.undelete.admission_action = md.ADMISSION_429
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(status, '429 Too Many Requests')
+
+    def test_admitted_copy_releases_slot(self):
+        self.slot.release()
+        self.app.responses = [{'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        for _ in range(2):
+            req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+            status, _, _ = self.call_mware(req)
+            self.assertEqual(status, '204 No Content')
+
+    def test_wait(self):
+        self.undelete.admission_action = md.ADMISSION_WAIT
+        self.undelete.admission_max_wait = 1
+        self.app.responses = [{'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        with mock.patch('eventlet.sleep') as sleep:
+            sleep.side_effect = lambda s: self.slot.release()
+            status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls, [('COPY', '/v1/a/c/o'),
+                                          ('DELETE', '/v1/a/c/o')])
+
+    def test_tombstone_instead(self):
+        self.undelete.admission_action = md.ADMISSION_TOMBSTONE
+        self.app.responses = [{'status': '200 OK'},
+                              {'status': '201 Created'},
+                              {'status': '202 Accepted'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '204 No Content')
+        self.assertEqual(self.app.calls, [('HEAD', '/v1/a/c/o'),
+                                          ('PUT', '/v1/a/.trash-c/o'),
+                                          ('POST', '/v1/a/c/o')])
+        # so reads have to look out for tombstones
+        self.assertTrue(self.undelete.wants_request(
+            {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/v1/a/c/o'}))
+        self.undelete.admission_action = md.ADMISSION_503
+        self.assertFalse(self.undelete.wants_request(
+            {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/v1/a/c/o'}))
+
+    def test_breaker_sees_copies(self):
+        self.slot.release()
+        self.undelete.admission.breaker = breaker = mock.MagicMock()
+        breaker.allow.return_value = 0
+        self.app.responses = [{'status': '507 Insufficient Storage'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '507 Insufficient Storage')
+        self.assertEqual(breaker.record.call_args[0][0], True)
+
+    def test_bulk_delete(self):
+        self.app.responses = [
+            {'status': '200 OK', 'body_iter': [json.dumps({
+                'Number Deleted': 0, 'Number Not Found': 0,
+                'Response Status': '200 OK', 'Response Body': '',
+                'Errors': []}).encode('ascii')]}]
+        req = swob.Request.blank(
+            '/v1/a?bulk-delete', method='POST', body='/c/o\n',
+            headers={'Accept': 'application/json'})
+        status, headers, body = self.call_mware(req)
+        self.assertEqual(json.loads(body)['Errors'],
+                         [['/c/o', '503 Service Unavailable']])
+        self.assertEqual(self.app.calls, [])
+
+
+class TestMetrics(MiddlewareTestCase):
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.logger = self.undelete.logger = FakeLogger()
+
+    def test_trash_hit(self):
+        self.app.responses = [{'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.logger.named('increment'), ['trash.hit'])
+        self.assertEqual(self.logger.named('timing_since'),
+                         ['copy.201.timing', 'delete.trashed.timing'])
+
+    def test_trash_miss(self):
+        self.app.responses = [{'status': '404 Not Found'},
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.logger.named('increment'), ['trash.miss'])
+        self.assertEqual(self.logger.named('timing_since'),
+                         ['copy.404.timing',
+                          'create_container.success.timing',
+                          'copy.201.timing',
+                          'delete.trashed.timing'])
+
+    def test_container_creation_error(self):
+        self.app.responses = [{'status': '404 Not Found'},
+                              {'status': '403 Forbidden'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        status, _, _ = self.call_mware(req)
+        self.assertEqual(status, '403 Forbidden')
+        self.assertEqual(self.logger.named('timing_since'),
+                         ['copy.404.timing',
+                          'create_container.403.timing',
+                          'delete.error.timing'])
+
+    def test_copy_error(self):
+        self.app.responses = [{'status': '507 Insufficient Storage'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.logger.named('increment'), [])
+        self.assertEqual(self.logger.named('timing_since'),
+                         ['copy.507.timing', 'delete.error.timing'])
+
+    def test_skip_and_block(self):
+        self.app.responses = [{'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/.trash-c/o', method='DELETE')
+        self.call_mware(req)
+        self.undelete.block_trash_deletes = True
+        self.call_mware(req)
+        self.assertEqual(self.logger.named('increment'),
+                         ['trash.skip', 'trash.blocked'])
+        self.assertEqual(self.logger.named('timing_since'),
+                         ['delete.skipped.timing', 'delete.blocked.timing'])
+
+    def test_bytes_from_cached_object_info(self):
+        self.app.responses = [{'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank(
+            '/v1/a/c/o', method='DELETE', environ={'swift.infocache': {
+                'object/a/c/o': {'status': 200, 'length': 1234}}})
+        self.call_mware(req)
+        self.assertIn(('timing', 'copy.bytes', 1234), self.logger.metrics)
+
+    def test_no_bytes_without_object_info(self):
+        self.app.responses = [{'status': '201 Created'},
+                              {'status': '204 No Content'}]
+        req = swob.Request.blank('/v1/a/c/o', method='DELETE')
+        self.call_mware(req)
+        self.assertEqual(self.logger.named('timing'), [])
+
+
+class TestFastPath(MiddlewareTestCase):
+    def call_raw(self, method, path, query_string=''):
+        calls = []
+
+        def app(env, start_response):
+            calls.append((env['REQUEST_METHOD'], env['PATH_INFO']))
+            start_response('200 OK', [])
+            return [b'']
+
+        self.undelete.app = app
+        env = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+               'QUERY_STRING': query_string}
+        with mock.patch.object(swob, 'Request',
+                               side_effect=AssertionError('slow path')):
+            self.undelete(env, lambda *args: None)
+        return calls
+
+    def test_reads_skip_swob(self):
+        for method in ('GET', 'HEAD', 'PUT', 'POST', 'COPY', 'OPTIONS'):
+            self.assertEqual(self.call_raw(method, '/v1/a/c/o'),
+                             [(method, '/v1/a/c/o')])
+
+    def test_non_object_deletes_skip_swob(self):
+        self.assertEqual(self.call_raw('DELETE', '/v1/a/c'),
+                         [('DELETE', '/v1/a/c')])
+        self.assertEqual(self.call_raw('DELETE', '/v1/a'),
+                         [('DELETE', '/v1/a')])
+
+    def test_wanted_requests(self):
+        wants = self.undelete.wants_request
+        self.assertTrue(wants({'REQUEST_METHOD': 'DELETE',
+                               'PATH_INFO': '/v1/a/c/o'}))
+        self.assertTrue(wants({'REQUEST_METHOD': 'POST', 'PATH_INFO': '/v1/a',
+                               'QUERY_STRING': 'bulk-delete'}))
+        self.assertTrue(wants({'REQUEST_METHOD': 'DELETE',
+                               'PATH_INFO': '/v1/a',
+                               'QUERY_STRING': 'bulk-delete=1'}))
+        self.assertFalse(wants({'REQUEST_METHOD': 'GET',
+                                'PATH_INFO': '/v1/a/c/o'}))
+
+        self.undelete.mode = md.MODE_TOMBSTONE
+        self.assertTrue(wants({'REQUEST_METHOD': 'GET',
+                               'PATH_INFO': '/v1/a/c/o'}))
+        self.assertTrue(wants({'REQUEST_METHOD': 'GET',
+                               'PATH_INFO': '/v1/a/c'}))
+        self.assertFalse(wants({'REQUEST_METHOD': 'GET',
+                                'PATH_INFO': '/v1/a'}))
+        self.assertFalse(wants({'REQUEST_METHOD': 'PUT',
+                                'PATH_INFO': '/v1/a/c/o'}))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+import eventlet
+import mock
+from swift_undelete import packing
+
+
+class TestPacks(unittest.TestCase):
+    def test_names(self):
+        older = packing.pack_name(1500000000)
+        newer = packing.pack_name(1500000001.5)
+        self.assertTrue(older.startswith('.undelete-pack/'))
+        self.assertLess(newer, older)
+        self.assertEqual(packing.pack_start(newer), 1500000001.5)
+        self.assertIsNone(packing.pack_start('o'))
+        self.assertIsNone(packing.pack_start('.undelete-pack/junk'))
+
+    def test_build_and_parse(self):
+        body, offset = packing.build_pack([
+            ('o', b'hello', '1500000000.00000', {'Etag': 'a'}),
+            ('p', b'', '1500000000.00000', {}),
+            ('o', b'world', '1500000001.00000', {'Etag': 'b'})])
+        self.assertEqual(offset, 10)
+        self.assertEqual(body[:offset], b'helloworld')
+        self.assertEqual(packing.parse_index(body[offset:]), {
+            # the later copy
+            'o': (5, 5, '1500000001.00000', {'Etag': 'b'}),
+            'p': (5, 0, '1500000000.00000', {})})
+
+
+class TestPacker(unittest.TestCase):
+    def setUp(self):
+        self.written = []
+
+        def write(key, batch):
+            self.written.append((key, [m[0] for m in batch.members]))
+            return True
+        self.packer = packing.Packer(write, window=0.01, max_objects=2,
+                                     logger=mock.MagicMock())
+
+    def add(self, key, name):
+        return self.packer.add(key, {}, name, b'x', '1500000000.00000', {})
+
+    def test_batches(self):
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(lambda args: self.add(*args), [
+            ('k', 'o1'), ('k', 'o2'), ('k', 'o3'), ('j', 'o4')]))
+        self.assertEqual(results, [True] * 4)
+        # the first two fill a batch; the others wait out the window
+        self.assertEqual(sorted(self.written), [
+            ('j', ['o4']), ('k', ['o1', 'o2']), ('k', ['o3'])])
+
+    def test_failed_write(self):
+        self.packer.write = mock.MagicMock(side_effect=Exception('boom'))
+        self.assertFalse(self.add('k', 'o'))
+        self.packer.write = mock.MagicMock(return_value=False)
+        self.assertFalse(self.add('k', 'o'))
+        self.assertEqual(self.packer._pending, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
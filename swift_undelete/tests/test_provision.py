@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+import mock
+from swift.common.internal_client import UnexpectedResponse
+from swift_undelete import middleware as md
+from swift_undelete import provision
+
+
+class FakeInternalClient(object):
+    def __init__(self, containers, fail=()):
+        self.containers = containers
+        self.fail = fail
+        self.created = []
+        self.uploaded = []
+
+    def iter_containers(self, account):
+        # a list of container names, or a dict of them by account
+        containers = self.containers
+        if isinstance(containers, dict):
+            containers = containers.get(account, [])
+        for name in containers:
+            yield {'name': name, 'count': 0, 'bytes': 0}
+
+    def create_container(self, account, container, headers=None):
+        if container in self.fail:
+            raise UnexpectedResponse('nope', mock.MagicMock(status_int=403))
+        self.created.append((account, container, headers))
+
+    def upload_object(self, fobj, account, container, obj):
+        self.uploaded.append((account, container, obj, fobj.read()))
+
+
+class TestTrashProvisioner(unittest.TestCase):
+    def make_provisioner(self, swift, **conf):
+        undelete = md.filter_factory({}, **conf)(None)
+        return provision.TrashProvisioner(swift, undelete,
+                                          logger=mock.MagicMock())
+
+    def test_creates_missing_trash_containers(self):
+        swift = FakeInternalClient(['.trash-c', '.trash-c-versions', 'c',
+                                    'd', 'scratch'])
+        p = self.make_provisioner(swift, skip_containers='*/scratch',
+                                  trash_storage_policy='cheap')
+        self.assertEqual(p.provision_account('AUTH_a'), (1, 0))
+        self.assertEqual(swift.created, [
+            ('AUTH_a', '.trash-d-versions', {'X-Storage-Policy': 'cheap'}),
+            ('AUTH_a', '.trash-d', {
+                'X-Storage-Policy': 'cheap',
+                'X-Versions-Location': '.trash-d-versions'})])
+        self.assertEqual(swift.uploaded, [])
+
+    def test_large_trash_containers(self):
+        swift = FakeInternalClient(['c'])
+        p = self.make_provisioner(swift, large_object_threshold='10')
+        self.assertEqual(p.provision_account('AUTH_a'), (2, 0))
+        self.assertEqual([c[1] for c in swift.created],
+                         ['.trash-c-versions', '.trash-c',
+                          '.trash-c-large-versions', '.trash-c-large'])
+
+    def test_timestamped_naming(self):
+        swift = FakeInternalClient(['c'])
+        p = self.make_provisioner(swift, trash_naming='timestamped')
+        self.assertEqual(p.provision_account('AUTH_a'), (1, 0))
+        self.assertEqual(swift.created, [('AUTH_a', '.trash-c', {})])
+
+    def test_failure(self):
+        swift = FakeInternalClient(['c', 'd'], fail=['.trash-c-versions'])
+        p = self.make_provisioner(swift)
+        self.assertEqual(p.provision_account('AUTH_a'), (1, 1))
+
+    def test_registers_account(self):
+        swift = FakeInternalClient(['c'])
+        p = self.make_provisioner(swift, register_accounts='on')
+        p.provision_account('AUTH_a')
+        self.assertEqual(swift.uploaded,
+                         [('.undelete', 'accounts', 'AUTH_a', b'')])
+
+    def test_trash_account(self):
+        swift = FakeInternalClient({
+            'AUTH_a': ['c', 'd', '.trash-old'],
+            'AUTH_.trash-a': ['.trash-c', '.trash-c-versions']})
+        p = self.make_provisioner(swift, trash_account_prefix='.trash-',
+                                  register_accounts='on')
+        self.assertEqual(p.provision_account('AUTH_a'), (1, 0))
+        self.assertEqual([c[:2] for c in swift.created], [
+            ('AUTH_.trash-a', '.trash-d-versions'),
+            ('AUTH_.trash-a', '.trash-d')])
+        self.assertEqual(swift.uploaded,
+                         [('.undelete', 'accounts', 'AUTH_.trash-a', b'')])
+
+
+if __name__ == '__main__':
+    unittest.main()
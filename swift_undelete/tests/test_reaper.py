@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 SwiftStack, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+from swift.common.internal_client import UnexpectedResponse
+from swift_undelete import reaper
+
+
+def iso(timestamp):
+    return reaper.utils.Timestamp(timestamp).isoformat
+
+
+class FakeInternalClient(object):
+    """
+    Just enough of an InternalClient: accounts are dicts of containers,
+    containers are lists of object listing entries.
+    """
+    def __init__(self, accounts=None):
+        self.accounts = accounts or {}
+        self.deleted = []
+        self.created = []
+        self.requests = []
+
+    def create_container(self, account, container):
+        self.created.append((account, container))
+        self.accounts.setdefault(account, {}).setdefault(container, [])
+
+    def iter_containers(self, account, prefix=''):
+        for name, objs in sorted(self.accounts.get(account, {}).items()):
+            if name.startswith(prefix):
+                yield {'name': name, 'count': len(objs),
+                       'bytes': sum(o['bytes'] for o in objs)}
+
+    def iter_objects(self, account, container, marker='', end_marker=''):
+        for obj in sorted(self.accounts[account].get(container, []),
+                          key=lambda o: o['name']):
+            if obj['name'] > marker and (
+                    not end_marker or obj['name'] < end_marker):
+                yield obj
+
+    def delete_object(self, account, container, obj):
+        self.deleted.append((account, container, obj))
+        objs = self.accounts[account][container]
+        objs[:] = [o for o in objs if o['name'] != obj]
+
+    def delete_container(self, account, container):
+        if self.accounts[account].get(container):
+            raise UnexpectedResponse('409', mock.MagicMock(status_int=409))
+        self.accounts[account].pop(container, None)
+
+    def make_path(self, *parts):
+        return '/'.join(('', 'v1') + parts)
+
+    def make_request(self, method, path, headers, acceptable_statuses,
+                     body_file=None, params=None):
+        # no bulk middleware: the POST hits the account
+        self.requests.append((method, path, params,
+                              body_file and body_file.read()))
+        return mock.MagicMock(status_int=204, body=b'')
+
+
+def trash(name, size, timestamp):
+    return {'name': name, 'bytes': size, 'last_modified': iso(timestamp)}
+
+
+class TestTrashReaper(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.checkpoint_file = os.path.join(self.tempdir, 'reaper.json')
+        self.swift = FakeInternalClient({
+            'AUTH_a': {
+                '.trash-c': [trash('o1', 10, 1500000000),
+                             trash('o2', 10, 1500000300)],
+                '.trash-d': [trash('o3', 10, 1500000100),
+                             trash('o4', 10, 1500000400)],
+                'c': [trash('live', 1000, 1500000000)]},
+            'AUTH_b': {
+                '.trash-c': [trash('o1', 5, 1500000000)]},
+            '.undelete': {'accounts': [{'name': 'AUTH_a'}]}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_reaper(self, **conf):
+        conf.setdefault('checkpoint_file', self.checkpoint_file)
+        return reaper.TrashReaper(conf, logger=mock.MagicMock(),
+                                  swift=self.swift)
+
+    def test_under_quota(self):
+        r = self.make_reaper(quota_bytes='40')
+        self.assertEqual(r.reap_account('AUTH_a', r.quota_bytes), 40)
+        self.assertEqual(self.swift.deleted, [])
+
+    def test_no_quota(self):
+        r = self.make_reaper()
+        self.assertIsNone(r.quota_bytes)
+        self.assertEqual(r.reap_account('AUTH_a', None), 40)
+        self.assertEqual(self.swift.deleted, [])
+
+    def test_evicts_oldest_first(self):
+        r = self.make_reaper(quota_bytes='15')
+        self.assertEqual(r.reap_account('AUTH_a', r.quota_bytes), 10)
+        # 25 bytes over: the three oldest objects, across both containers
+        self.assertEqual(sorted(self.swift.deleted), [
+            ('AUTH_a', '.trash-c', 'o1'),
+            ('AUTH_a', '.trash-c', 'o2'),
+            ('AUTH_a', '.trash-d', 'o3')])
+
+    def test_eviction_failure(self):
+        def fail(account, container, obj):
+            raise UnexpectedResponse('oops', mock.MagicMock(status_int=503))
+        self.swift.delete_object = fail
+        r = self.make_reaper(quota_bytes='35')
+        self.assertEqual(r.reap_account('AUTH_a', r.quota_bytes), 40)
+
+    def test_run_once(self):
+        r = self.make_reaper(quota_bytes='20', accounts='AUTH_b, AUTH_a')
+        self.assertEqual(r.accounts, ['AUTH_a', 'AUTH_b'])
+        r.run_once()
+
+        self.assertEqual(self.swift.created, [('.undelete', 'accounts')])
+        self.assertEqual(sorted(self.swift.deleted), [
+            ('AUTH_a', '.trash-c', 'o1'), ('AUTH_a', '.trash-d', 'o3')])
+        with open(self.checkpoint_file) as fp:
+            checkpoint = json.load(fp)
+        self.assertEqual(checkpoint['marker'], '')
+        self.assertEqual(
+            dict((a, v['trash_bytes'])
+                 for a, v in checkpoint['accounts'].items()),
+            {'AUTH_a': 20, 'AUTH_b': 5})
+
+    def test_run_once_resumes_from_checkpoint(self):
+        with open(self.checkpoint_file, 'w') as fp:
+            json.dump({'marker': 'AUTH_a', 'accounts': {}}, fp)
+        r = self.make_reaper(quota_bytes='1', accounts='AUTH_b')
+        r.run_once()
+        self.assertEqual(self.swift.deleted, [('AUTH_b', '.trash-c', 'o1')])
+
+    def test_cluster_full_quota(self):
+        r = self.make_reaper(cluster_full_percent='90',
+                             cluster_full_quota_bytes='30')
+        with mock.patch.object(r, 'cluster_fullness', return_value=95.0):
+            r.run_once()
+        self.assertEqual(self.swift.deleted, [('AUTH_a', '.trash-c', 'o1')])
+
+        self.swift.deleted = []
+        with mock.patch.object(r, 'cluster_fullness', return_value=50.0):
+            r.run_once()
+        self.assertEqual(self.swift.deleted, [])
+
+    def test_cluster_fullness(self):
+        ring = mock.MagicMock(devs=[{'ip': '10.0.0.1', 'port': 6200},
+                                    None,
+                                    {'ip': '10.0.0.1', 'port': 6200},
+                                    {'ip': '10.0.0.2', 'port': 6200}])
+        self.swift.get_object_ring = lambda policy_index: ring
+        usage = {
+            ('10.0.0.1', 6200): [
+                {'mounted': True, 'size': 100, 'used': 90},
+                {'mounted': False}],
+            ('10.0.0.2', 6200): None}
+        r = self.make_reaper()
+        with mock.patch.object(r, 'disk_usage', side_effect=usage.get):
+            self.assertEqual(r.cluster_fullness(), 90.0)
+        with mock.patch.object(r, 'disk_usage', return_value=None):
+            self.assertIsNone(r.cluster_fullness())
+
+    def test_sweep_expired_buckets(self):
+        day = 86400
+        now = 1500000000 // day * day + 3600
+        self.swift.accounts['AUTH_c'] = {
+            # expired yesterday
+            '.trash-c@%s' % time.strftime('%Y%m%d', time.gmtime(
+                now - 3 * day)): [trash('o1', 10, now - 3 * day)],
+            '.trash-c@%s-versions' % time.strftime('%Y%m%d', time.gmtime(
+                now - 3 * day)): [trash('001o1/1', 10, now - 3 * day)],
+            '.trash-c@%s-segments' % time.strftime('%Y%m%d', time.gmtime(
+                now - 3 * day)): [trash('o5/1/4/00000000', 4, now - 3 * day)],
+            # expires at midnight
+            '.trash-c@%s' % time.strftime('%Y%m%d', time.gmtime(
+                now - day)): [trash('o2', 10, now - day)],
+            # not a bucket
+            '.trash-logs-19700101': [trash('o3', 10, 0)]}
+        r = self.make_reaper()
+        r.trash_buckets = True
+        r.trash_lifetime = day
+        with mock.patch('time.time', return_value=now):
+            self.assertEqual(r.sweep_account('AUTH_c'), 1)
+        self.assertEqual(sorted(self.swift.accounts['AUTH_c']), [
+            '.trash-c@%s' % time.strftime('%Y%m%d', time.gmtime(
+                now - day)),
+            '.trash-logs-19700101'])
+        # versions first, segments last, falling back to single deletes
+        self.assertEqual([d[1][len('.trash-c@20170711'):]
+                          for d in self.swift.deleted],
+                         ['-versions', '', '-segments'])
+        self.assertEqual(self.swift.requests[0][:3],
+                         ('POST', '/v1/AUTH_c', {'bulk-delete': ''}))
+        self.assertEqual(self.swift.requests[0][3], (
+            '/.trash-c%%40%s-versions/001o1/1\n' % time.strftime(
+                '%Y%m%d', time.gmtime(now - 3 * day))).encode('ascii'))
+
+    def test_bulk_delete(self):
+        r = self.make_reaper()
+        self.swift.make_request = mock.MagicMock(return_value=mock.MagicMock(
+            body=json.dumps({'Number Deleted': 2, 'Errors': []})))
+        r.bulk_delete('AUTH_a', '.trash-c', ['o1', 'o2'])
+        self.assertEqual(self.swift.deleted, [])
+        self.assertEqual(self.swift.make_request.call_count, 1)
+
+    def test_run_once_sweeps(self):
+        r = self.make_reaper()
+        with mock.patch.object(r, 'sweep_account') as sweep:
+            r.run_once()
+        self.assertFalse(sweep.called)
+        r.trash_buckets = True
+        with mock.patch.object(r, 'sweep_account') as sweep:
+            r.run_once()
+        self.assertEqual(sweep.call_args_list, [mock.call('AUTH_a')])
+
+    def test_expire_segments(self):
+        self.swift.accounts['AUTH_a']['.undelete-segments'] = [
+            {'name': '1499999999/abc', 'bytes': 10},
+            {'name': '1500000000/def', 'bytes': 10},
+            {'name': '1500000001/ghi', 'bytes': 10}]
+        r = self.make_reaper()
+        self.swift.make_request = mock.MagicMock(return_value=mock.MagicMock(
+            status_int=200, body=json.dumps({
+                'Number Deleted': 3, 'Errors': []}).encode('ascii')))
+        with mock.patch('time.time', return_value=1500000000.5):
+            self.assertEqual(r.expire_segments('AUTH_a'), 2)
+        self.assertEqual(sorted(
+            call[0][:2] + (call[1]['params'],)
+            for call in self.swift.make_request.call_args_list), [
+            ('DELETE', '/v1/AUTH_a/.undelete-segments/1499999999/abc',
+             {'multipart-manifest': 'delete'}),
+            ('DELETE', '/v1/AUTH_a/.undelete-segments/1500000000/def',
+             {'multipart-manifest': 'delete'})])
+
+        # without slo in the pipeline, the DELETE gets a 204 and no report
+        self.swift.make_request = mock.MagicMock(
+            return_value=mock.MagicMock(status_int=204, body=b''))
+        with mock.patch('time.time', return_value=1500000000.5):
+            self.assertEqual(r.expire_segments('AUTH_a'), 0)
+        self.assertTrue(r.logger.error.called)
+        # no ledger at all
+        self.assertEqual(r.expire_segments('AUTH_b'), 0)
+
+    def test_run_once_expires_segments(self):
+        r = self.make_reaper()
+        with mock.patch.object(r, 'expire_segments') as expire:
+            r.run_once()
+        self.assertFalse(expire.called)
+        r.preserve_segments = True
+        with mock.patch.object(r, 'expire_segments') as expire:
+            r.run_once()
+        self.assertEqual(expire.call_args_list, [mock.call('AUTH_a')])
+
+    def test_trash_prefix_from_filter_section(self):
+        conf_path = os.path.join(self.tempdir, 'proxy-server.conf')
+        with open(conf_path, 'w') as fp:
+            fp.write('[filter:undelete]\ntrash_prefix = .bin-\n'
+                     'trash_lifetime = 3600\ntrash_buckets = on\n'
+                     'preserve_segments = on\n')
+        r = self.make_reaper(__file__=conf_path)
+        self.assertEqual(r.trash_prefix, '.bin-')
+        self.assertEqual(r.trash_lifetime, 3600)
+        self.assertTrue(r.trash_buckets)
+        self.assertTrue(r.preserve_segments)
+        self.assertEqual(r.segments_container, '.undelete-segments')
+        r = self.make_reaper(__file__=conf_path, filter_section='nope')
+        self.assertEqual(r.trash_prefix, '.trash-')
+
+    def test_quota_with_dedup_warns(self):
+        conf_path = os.path.join(self.tempdir, 'proxy-server.conf')
+        with open(conf_path, 'w') as fp:
+            fp.write('[filter:undelete]\ndedup = on\n')
+        r = self.make_reaper(__file__=conf_path)
+        self.assertTrue(r.dedup)
+        self.assertFalse(r.logger.warning.called)
+        r = self.make_reaper(__file__=conf_path, quota_bytes='100')
+        self.assertEqual(r.logger.warning.call_count, 1)
+        self.assertIn('deduplicated', r.logger.warning.call_args[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()